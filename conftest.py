@@ -0,0 +1 @@
+# Makes the tools package importable when the tests are run with plain `pytest` from the repository root.
@@ -12,6 +12,8 @@ timeToLiveInMinutes=$1
 shift
 
 instanceTypeConfig=''
+# tools.sweep points this at a generated copy of custom-files for each model
+customFilesDir=${DOTS_CUSTOM_FILES_DIR:-custom-files}
 
 if [[ -n "$DEEPRACER_INSTANCE_TYPE" ]]; then
     instanceTypeConfig="InstanceType=$DEEPRACER_INSTANCE_TYPE"
@@ -48,7 +50,7 @@ if [[ $? -ne 0 ]]; then
         read -p "[y / n]: " yn
         case $yn in
             [Yy]* ) break;;
-            [Nn]* ) exit;;
+            [Nn]* ) exit 1;;
             * ) echo "Please answer yes or no.";;
         esac
     done
@@ -56,8 +58,9 @@ fi
 
 set -x
 
-source custom-files/run.env
-aws s3 cp custom-files s3://${BUCKET}/${DR_LOCAL_S3_CUSTOM_FILES_PREFIX} --recursive
+source ${customFilesDir}/run.env
+aws s3 cp ${customFilesDir} s3://${BUCKET}/${DR_LOCAL_S3_CUSTOM_FILES_PREFIX} --recursive
+aws s3 cp tools s3://${BUCKET}/${DR_LOCAL_S3_CUSTOM_FILES_PREFIX}/tools --recursive --exclude "*" --include "*.py"
 aws cloudformation deploy --stack-name $stackName --parameter-overrides ${instanceTypeConfig} ResourcesStackName=$baseResourcesStackName DeepRacerImportName=$stackName TimeToLiveInMinutes=$timeToLiveInMinutes AmiId=$amiId BUCKET=$BUCKET CUSTOMFILELOCATION=$DR_LOCAL_S3_CUSTOM_FILES_PREFIX --template-file standard-instance.yaml --s3-bucket $BUCKET --s3-prefix cf_templates
 EC2_IP=`aws cloudformation list-exports --query "Exports[?Name=='${stackName}-PublicIp'].Value" --no-paginate --output text`
 echo "Logs will upload every 2 minutes to https://s3.console.aws.amazon.com/s3/buckets/${BUCKET}/${stackName}/logs/"
@@ -1,4 +1,57 @@
-import math
+import hashlib, math
+
+# Turn angle and direction at every waypoint, keyed by track. The track never changes during
+# training, so this is computed on the first step instead of on every step.
+_TRACK_TURNS = {}
+# The last waypoints list, a few sampled points of it and its fingerprint (see tools/track_geometry.py)
+_LAST_TRACK = (None, None, None)
+
+
+def _track_key(waypoints):
+    global _LAST_TRACK
+    last, sampled, key = _LAST_TRACK
+    if waypoints is not last:
+        count = len(waypoints)
+        sample = (count, tuple(tuple(waypoints[i]) for i in range(0, count, max(1, count // 8))),
+                  tuple(waypoints[-1]))
+        if sample != sampled:
+            # a different track, or the same one in a new list: hash every waypoint
+            digest = hashlib.sha1()
+            for x, y in waypoints:
+                digest.update("{:.3f},{:.3f};".format(x, y).encode())
+            key = digest.hexdigest()[:16]
+        _LAST_TRACK = (waypoints, sample, key)
+    return key
+
+
+def _track_turns(waypoints):
+    key = _track_key(waypoints)
+    turns = _TRACK_TURNS.get(key)
+    if turns is None:
+        angles, directions = [], []
+        count = len(waypoints)
+        for wp in range(count):
+            prev_wp_pos = waypoints[wp - 1]
+            wp_pos = waypoints[wp]
+            next_wp_pos = waypoints[(wp + 1) % count]
+
+            # Vectors into and out of the waypoint
+            vector_a = [wp_pos[0] - prev_wp_pos[0], wp_pos[1] - prev_wp_pos[1]]
+            vector_b = [next_wp_pos[0] - wp_pos[0], next_wp_pos[1] - wp_pos[1]]
+            mag_a = math.sqrt(vector_a[0] ** 2 + vector_a[1] ** 2)
+            mag_b = math.sqrt(vector_b[0] ** 2 + vector_b[1] ** 2)
+            if mag_a == 0 or mag_b == 0:
+                # Repeated waypoint where a closed track meets its start, no turn to report
+                angles.append(math.pi)
+                directions.append(0)
+                continue
+
+            dot_product = vector_a[0] * vector_b[0] + vector_a[1] * vector_b[1]
+            angles.append(math.acos(max(-1.0, min(1.0, dot_product / (mag_a * mag_b)))))
+            directions.append(vector_a[0] * vector_b[1] - vector_a[1] * vector_b[0])
+        turns = _TRACK_TURNS[key] = (angles, directions)
+    return turns
+
 
 def reward_function(params):
     '''
@@ -25,30 +78,17 @@ def reward_function(params):
     # Initialize reward
     reward = 1.0
 
-    # Get the indices of the closest waypoints
-    prev_wp = closest_waypoints[0]
+    # Get the index of the next waypoint
     next_wp = closest_waypoints[1]
 
-    # Calculate the direction of the turn based on the curvature
+    # Look up the turn at the next waypoint, precomputed once per track
     if len(waypoints) > 1:
-        prev_wp_pos = waypoints[prev_wp]
-        next_wp_pos = waypoints[next_wp]
-        future_wp = (next_wp + 1) % len(waypoints)  # Next waypoint after the next
-        future_wp_pos = waypoints[future_wp]
-
-        # Calculate vectors
-        vector_a = [next_wp_pos[0] - prev_wp_pos[0], next_wp_pos[1] - prev_wp_pos[1]]
-        vector_b = [future_wp_pos[0] - next_wp_pos[0], future_wp_pos[1] - next_wp_pos[1]]
-
-        # Calculate the angle between vectors
-        dot_product = vector_a[0] * vector_b[0] + vector_a[1] * vector_b[1]
-        mag_a = math.sqrt(vector_a[0] ** 2 + vector_a[1] ** 2)
-        mag_b = math.sqrt(vector_b[0] ** 2 + vector_b[1] ** 2)
-        angle = math.acos(dot_product / (mag_a * mag_b))
+        turn_angles, turn_directions = _track_turns(waypoints)
+        angle = turn_angles[next_wp]
 
         # Check if the angle indicates a sharp turn
         if angle < 0.5:  # Adjusted threshold
-            if vector_a[0] * vector_b[1] - vector_a[1] * vector_b[0] > 0:
+            if turn_directions[next_wp] > 0:
                 # Left U-turn
                 if is_left_of_center:
                     reward += 1.5  # Increased reward for correct side in sharp turn
@@ -1,86 +1,60 @@
 
-import json, os
+import os, subprocess, sys, tempfile
 
-# ENV Config files functions
+from tools.config_session import ConfigSession
 
-def write_env_variable(file, variable, value):
-    with open(file, "r") as f:
-        content = f.readlines()
+# run.env, hyperparameters.json and model_metadata.json are parsed once and re-read only when they change on disk
+CONFIG = ConfigSession()
 
-    for i, line in enumerate(content):
-        if line.startswith(variable + "="):
-            content[i] = variable + "=" + value + "\n"
-            break
-    else:
-        content.append(variable + "=" + value + "\n")
+# ENV Config files functions
 
-    with open(file, "w") as f:
-        f.writelines(content)
+def write_env_variable(file, variable, value):
+    CONFIG.set(file, variable, value)
+    CONFIG.commit()
 
 
 def read_env_variable(file, variable):
-    with open(file, "r") as f:
-        content = f.readlines()
-
-    for line in content:
-        if line.startswith(variable + "="):
-            return line.split("=", 1)[1].strip()
-
-    return None
+    return CONFIG.get(file, variable)
 
 
 # Funciones para archivos JSON
 
-def write_json_value(file, key, value,dtype):
-    with open(file, "r") as f:
-        data = json.load(f)
+def json_value(value, dtype):
     if dtype== "int":
-        data[key] = int(value)
+        return int(value)
     elif dtype=="float":
-        data[key] = float(value)
-    else:
-        data[key] = value
-    with open(file, "w") as f:
-        json.dump(data, f, indent=2)
+        return float(value)
+    return value
+
+
+def write_json_value(file, key, value,dtype):
+    CONFIG.set(file, key, json_value(value, dtype))
+    CONFIG.commit()
 
 
 def read_json_value(file, key):
-    with open(file, "r") as f:
-        data = json.load(f)
-    return data.get(key, None)
+    return CONFIG.get(file, key)
 
 
 def read_all_json_values(file, key):
-    with open(file, "r") as f:
-        data = json.load(f)
-    return data.get(key, None)
+    return CONFIG.get(file, key)
 
 
 def bulk_add_array_values(file, key, values):
-    with open(file, "r") as f:
-        data = json.load(f)
-    if key in data and isinstance(data[key], list):
-        data[key].extend(values)
-    with open(file, "w") as f:
-        json.dump(data, f, indent=2)
+    current = CONFIG.get(file, key)
+    if isinstance(current, list):
+        CONFIG.set(file, key, current + list(values))
+        CONFIG.commit()
 
 
 def clear_action_space(file):
-    with open(file, "r") as f:
-        data = json.load(f)
-    if "action_space" in data:
-        data["action_space"] = []
-    with open(file, "w") as f:
-        json.dump(data, f, indent=2)
+    clear_array(file, "action_space")
 
 
 def clear_array(file, key):
-    with open(file, "r") as f:
-        data = json.load(f)
-    if key in data:
-        data[key] = []
-    with open(file, "w") as f:
-        json.dump(data, f, indent=2)
+    if CONFIG.get(file, key) is not None:
+        CONFIG.set(file, key, [])
+        CONFIG.commit()
 
 
 # Función para seleccionar una opción del menú
@@ -118,16 +92,31 @@ def process_action_space(file):
     key = "action_space"
     current_values = read_all_json_values(file, key)
     print(f"Current values of {key} are: {current_values}")
+    if input("Design the action space from the track curvature and recorded steps? (y/n): ").strip().lower() == "y":
+        design_action_space(file)
+        return
     num_values = int(input("Input the number of new values you want to add: "))
     new_values = []
-    clear_action_space(file)
     for i in range(num_values):
         steering_angle = float(input(f"Insert the steering angle for the value {i + 1}: "))
         speed = float(input(f"Insert the speed for the value {i + 1}: "))
         new_values.append({"steering_angle": steering_angle, "speed": speed})
-    bulk_add_array_values(file, key, new_values)
+    # the new action space replaces the old one in a single write
+    CONFIG.set(file, key, new_values)
+    CONFIG.commit()
     print(f"{num_values} have been added to {key}.")
 
+
+def design_action_space(file):
+    size = input("Number of actions (default 10): ").strip() or "10"
+    traces = input("SIM_TRACE_LOG files or folders to learn from, space separated (keep blank for none): ").split()
+    command = [sys.executable, "-m", "tools.action_space", "--size", size, "--metadata", file, "--write"]
+    if traces:
+        command += ["--traces"] + traces
+    # tools.action_space prints why it stopped, e.g. the download hint when the track .npy is missing
+    if subprocess.run(command).returncode != 0:
+        print(f"The action space in {file} was not changed.")
+
 def menu_picker(label,options,custom):
     if custom==True:
         options.append("Custom")
@@ -168,8 +157,8 @@ def run_training(pretrained):
       i_modelname=input("Pick a name for your model (leave blank to keep current: {}): ".format(modelname))
       if i_modelname!="":
         modelname=i_modelname
-      write_env_variable(envfile, "DR_LOCAL_S3_PRETRAINED","False")
-      write_env_variable(envfile, "DR_LOCAL_S3_MODEL_PREFIX",modelname) 
+      CONFIG.set(envfile, "DR_LOCAL_S3_PRETRAINED","False")
+      CONFIG.set(envfile, "DR_LOCAL_S3_MODEL_PREFIX",modelname)
     else:
       i_pre_modelname=input("Insert your pretrained model name (leave blank to select: {}): ".format(modelname))
       if i_pre_modelname=="":
@@ -177,13 +166,15 @@ def run_training(pretrained):
       else:
         pre_modelname=i_pre_modelname
       modelname=input("Pick a new name for your model: ")
-      write_env_variable(envfile, "DR_LOCAL_S3_PRETRAINED","True")
-      write_env_variable(envfile, "DR_LOCAL_S3_MODEL_PREFIX",modelname)
-      write_env_variable(envfile, "DR_LOCAL_S3_PRETRAINED_PREFIX",pre_modelname)
+      CONFIG.set(envfile, "DR_LOCAL_S3_PRETRAINED","True")
+      CONFIG.set(envfile, "DR_LOCAL_S3_MODEL_PREFIX",modelname)
+      CONFIG.set(envfile, "DR_LOCAL_S3_PRETRAINED_PREFIX",pre_modelname)
+    CONFIG.commit()
 
     print()
     standarspot=menu_picker("Select EC2 type: ",[  "spot", "standard" ],False)
     print()
+    recommend_capacity(standarspot)
     machinetype=menu_picker("Pick HW configuration (Recommended is g4dn.2xlarge, any larger will be more expensive): ",[  "g4dn.2xlarge", "g4dn.4xlarge", "g4dn.8xlarge", "g4dn.12xlarge", "g5.2xlarge", "g5.4xlarge", "g5.8xlarge", "g5.12xlarge" ],True)
     print()
     stack=read_env_variable(OPTIONS['13']['file'], OPTIONS['13']['key'])
@@ -199,6 +190,13 @@ def run_training(pretrained):
     os.system("./create-{}-instance.sh {} {} {}".format(standarspot,stack,modelname,wait))
 
 
+def recommend_capacity(standarspot):
+    # Only when throughput samples of earlier trainings were downloaded, see tools/capacity.py
+    if os.path.isdir(os.environ.get("DOTS_CAPACITY_DIR", "capacity")):
+        subprocess.run([sys.executable, "-m", "tools.capacity", "--top", "0"] + (["--spot"] if standarspot == "spot" else []))
+        print()
+
+
 def set_new_reward():
     print("Enter/Paste your reward function code (Press Enter then Control + D when done)")
     contents = []
@@ -208,10 +206,29 @@ def set_new_reward():
         except EOFError:
             break
         contents.append(line + '\n')
+    if not benchmark_reward(''.join(contents)):
+        keep = input("Save this reward function anyway? (y/n): ")
+        if keep.strip().lower() != "y":
+            print("Reward Function not updated")
+            return
     with open('custom-files/reward_function.py', 'w') as the_file:
         the_file.write(''.join(contents))
     print("Reward Function updated")
 
+
+def benchmark_reward(code):
+    # Run tools.reward_bench on the new code in a separate process, a slow reward stalls every worker
+    with tempfile.NamedTemporaryFile("w", suffix=".py", delete=False) as candidate:
+        candidate.write(code)
+    try:
+        result = subprocess.run([sys.executable, "-m", "tools.reward_bench", candidate.name], timeout=600)
+        return result.returncode == 0
+    except subprocess.TimeoutExpired:
+        print("Reward function benchmark did not finish in 10 minutes")
+        return False
+    finally:
+        os.remove(candidate.name)
+
 # Function to show menu
 def show_menu():
     while True:
@@ -222,10 +239,8 @@ def show_menu():
 
         for option_num, option in OPTIONS.items():
             file, key, label = option.get('file',''), option.get('key',''), option.get('label','')
-            if '.env' in file:
-                current_value = read_env_variable(file, key)
-            elif '.json' in file:
-                current_value = read_json_value(file, key)
+            if '.env' in file or '.json' in file:
+                current_value = CONFIG.get(file, key)
             else:
                 current_value = ""
             comparison = "("+str(key)+'=\033[93m'+ str(current_value)+"\033[0m)" if key or current_value else ""
@@ -0,0 +1,10 @@
+import boto3
+import pytest
+from moto import mock_aws
+
+
+@pytest.fixture
+def s3_client():
+    """A boto3 S3 client on moto's in-memory S3, without buckets."""
+    with mock_aws():
+        yield boto3.client("s3", region_name="us-east-1")
@@ -0,0 +1,45 @@
+#!/bin/bash
+# Stands in for create-<instance>-instance.sh with --create-script: checks the arguments and the
+# custom files like the create scripts do, prints what they would upload and exits with
+# STUB_CREATE_EXIT (default 0), without creating a stack. A reward_function.py that does not parse
+# fails validation, which the sweep's "n" answer turns into exit code 1 as in the create scripts.
+
+baseResourcesStackName=$1
+stackName=$2
+timeToLiveInMinutes=$3
+customFilesDir=${DOTS_CUSTOM_FILES_DIR:-custom-files}
+
+if [[ $# -ne 3 ]]; then
+    echo "usage: $0 <base stack> <stack name> <time to live in minutes>"
+    exit 2
+fi
+if ! grep -q '^[-0-9a-zA-Z]\{1,64\}$' <<<"$stackName"; then
+    echo "Stack name is not acceptable for deepracer import: $stackName"
+    exit 1
+fi
+for file in run.env hyperparameters.json model_metadata.json reward_function.py; do
+    if [[ ! -f "$customFilesDir/$file" ]]; then
+        echo "missing $customFilesDir/$file"
+        exit 1
+    fi
+done
+echo "base stack: $baseResourcesStackName"
+echo "stack: $stackName"
+echo "time to live: $timeToLiveInMinutes"
+echo "instance type: ${DEEPRACER_INSTANCE_TYPE:-default}"
+# stands in for validation.sh: a reward function that does not parse is an error in the custom files
+if python3 -c 'import ast, sys; ast.parse(open(sys.argv[1]).read())' "$customFilesDir/reward_function.py" 2>/dev/null; then
+    echo "validation: ok"
+else
+    echo "validation: errors"
+    # the prompt of the create scripts, "n" exits with 1 and no stack is created
+    read -r -t 1 answer
+    echo "validation answer: ${answer:-none}"
+    case $answer in
+        [Yy]* ) ;;
+        * ) exit 1;;
+    esac
+fi
+echo "would upload $customFilesDir:"
+(cd "$customFilesDir" && find . -type f | sort)
+exit "${STUB_CREATE_EXIT:-0}"
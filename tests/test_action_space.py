@@ -0,0 +1,52 @@
+import math, sys
+
+import pytest
+
+from tools import action_space, tracks
+
+
+def test_missing_track_asks_to_download_it(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracks, "TRACKS_DIR", str(tmp_path))
+    monkeypatch.setattr(sys, "argv", ["action_space", "--track", "2022_may_open_ccw"])
+    with pytest.raises(SystemExit) as stopped:
+        action_space.main()
+    assert str(stopped.value) == ("No track file {}, download it from deepracer-race-data (raw_data/tracks/npy)".format(
+        tmp_path / "2022_may_open_ccw.npy"))
+
+
+def step(episode, steering, speed, status="in_progress"):
+    done = status != "in_progress"
+    return ("SIM_TRACE_LOG:{},1,1.0,2.0,90.0,{},{},3,1.5,{},True,50.0,5,17.7,1.000,{},0.0\n"
+            .format(episode, steering, speed, done, status))
+
+
+def histogram(observed):
+    return {(round(s, 2), round(v, 2)): count for s, v, count in zip(*observed)}
+
+
+def test_observed_steps_are_counted_per_cell_of_completed_laps(tmp_path):
+    trace = tmp_path / "robomaker1.log"
+    # episode 0 leaves the track, 1 and 2 complete a lap, 3 is still running at the end of the log
+    trace.write_text(step(0, 30.0, 1.0) + step(0, 30.0, 1.0, "off_track")
+                     + step(1, 14.9, 2.01) + step(1, 15.1, 1.99) + step(2, -7.0, 3.5)
+                     + step(1, -7.1, 3.52, "lap_complete") + step(2, -7.0, 3.5, "lap_complete")
+                     + step(3, 0.0, 4.0) + "not a step\n")
+    assert histogram(action_space.observed_pairs([str(trace)])) == {(15.0, 2.0): 2, (-7.0, 3.5): 3}
+
+    # without a completed lap every recorded step counts
+    trace.write_text(step(0, 30.0, 1.0) + step(0, 30.0, 1.0, "off_track") + step(1, 0.2, 4.0))
+    assert histogram(action_space.observed_pairs([str(trace)])) == {(30.0, 1.0): 2, (0.0, 4.0): 1}
+
+
+def test_a_long_trace_adds_no_points_to_cluster(tmp_path):
+    short, long = tmp_path / "short.log", tmp_path / "long.log"
+    lap = [step(0, steering, speed) for steering, speed in [(-10.0, 2.0), (0.0, 3.0), (10.0, 2.0)]]
+    short.write_text("".join(lap) + step(0, 0.0, 3.0, "lap_complete"))
+    long.write_text("".join(line.replace(":0,", ":{},".format(episode), 1)
+                            for episode in range(1000) for line in lap + [step(0, 0.0, 3.0, "lap_complete")]))
+    few, many = action_space.observed_pairs([str(short)]), action_space.observed_pairs([str(long)])
+    assert len(many[0]) == len(few[0]) == 3
+    assert histogram(many) == {cell: count * 1000 for cell, count in histogram(few).items()}
+
+    waypoints = [(math.cos(a / 50 * math.tau) * 3, math.sin(a / 50 * math.tau) * 2) for a in range(51)]
+    assert action_space.design(waypoints, 4, few) == action_space.design(waypoints, 4, many)
@@ -0,0 +1,69 @@
+from tools.analysis_service import NOTEBOOKS, AnalysisService, NewFilesHandler, changed_notebooks
+
+
+class FileHandler:
+
+    def __init__(self, files):
+        self.files = files
+        self.bucket = "my-bucket"
+
+    def list_files(self, filterexp=None, check_exist=False):
+        return list(self.files)
+
+
+def test_trace_listings_only_return_files_not_loaded_yet():
+    handler = FileHandler(["my-model/training-simtrace/0-iteration.csv", "my-model/training-simtrace/1-iteration.csv"])
+    files = NewFilesHandler(handler)
+    assert files.list_files(filterexp="training-simtrace/(.*)-iteration.csv") == handler.files
+    # marked as loaded by the service once the dataframe of the listed files is built
+    files.loaded.update(files.listed)
+    handler.files.append("my-model/training-simtrace/2-iteration.csv")
+    assert files.list_files() == ["my-model/training-simtrace/2-iteration.csv"]
+    files.loaded.update(files.listed)
+    assert files.list_files() == [] and files.listed == []
+
+    # other listings pass through, as do the other attributes of the handler
+    handler.files = ["my-model/model/model_metadata.json"]
+    assert files.list_files() == handler.files and files.bucket == "my-bucket"
+
+
+def inputs(**values):
+    return dict({"df": 100, "simulation_agg": 5, "track": True, "top_laps": ((1, 2), (2, 1)), "metrics": '"etag-1"'},
+                **values)
+
+
+def test_notebooks_are_rendered_when_their_inputs_change():
+    signatures = {}
+    assert set(changed_notebooks(inputs(), signatures)) == set(NOTEBOOKS)
+    signatures.update(changed_notebooks(inputs(), signatures))
+    assert changed_notebooks(inputs(), signatures) == {}
+
+    assert set(changed_notebooks(inputs(df=200), signatures)) == {"Heatmap"}
+    assert set(changed_notebooks(inputs(simulation_agg=6, metrics='"etag-2"'), signatures)) == {
+        "Training_progress", "Quintiles", "Data_tables", "Training_and_Evaluation_Overview"}
+    # more episodes without new fastest or best rewarded laps leave the laps notebook alone
+    assert "Path_for_complete_laps" not in changed_notebooks(inputs(simulation_agg=6), signatures)
+    assert set(changed_notebooks(inputs(top_laps=((3, 1), (2, 1))), signatures)) == {"Path_for_complete_laps"}
+
+
+def test_a_failed_render_is_tried_again_at_the_next_tick(capsys):
+    service = AnalysisService.__new__(AnalysisService)
+    service.s3_sync, service.signatures = None, {}
+    service.load_new = lambda: False
+    service.store = lambda names: None
+    service.inputs = inputs
+    failing = {"Heatmap"}
+    rendered = []
+
+    def render(notebook):
+        rendered.append(notebook)
+        return notebook not in failing
+
+    service.render = render
+    service.tick()
+    assert rendered == list(NOTEBOOKS) and "Heatmap" not in service.signatures
+    del rendered[:]
+    failing.clear()
+    service.tick()
+    assert rendered == ["Heatmap"]
+    assert "rendered Heatmap in" in capsys.readouterr().out.splitlines()[-1]
@@ -0,0 +1,64 @@
+import pytest
+
+from tools.capacity import PRIOR, episodes_between_training, fit, predict
+
+
+def observation(workers, load, worker_rate, gpu_memory=None, instance_type="g4dn.2xlarge", cpus=8,
+                out_of_memory=False):
+    return {"instance_type": instance_type, "cpus": cpus, "workers": workers, "worker_rate": worker_rate,
+            "load": load, "gpu_memory": gpu_memory, "gpu_memory_total": 15360, "out_of_memory": out_of_memory}
+
+
+def test_fit_without_observations_is_the_prior():
+    model = fit([])
+    assert {key: model[key] for key in PRIOR} == PRIOR
+    assert model["out_of_memory"] == {} and model["runs"] == 0
+
+
+def test_fit_recovers_the_model_of_the_observations():
+    # load = 2 + 1.5 * workers, 10 steps/s per worker with a free CPU, memory = 4000 + 500 * workers
+    observations = [observation(2, 5.0, 10.0, 5000), observation(4, 8.0, 10.0, 6000),
+                    observation(6, 11.0, 10.0 * 8 / 11, 7000, out_of_memory=True),
+                    observation(8, 14.0, 10.0, 8000, instance_type="g4dn.4xlarge", cpus=16)]
+    model = fit(observations)
+    assert model["base_load"] == pytest.approx(2.0)
+    assert model["load_per_worker"] == pytest.approx(1.5)
+    # the contended run is corrected by cpus / load
+    assert model["worker_rate"] == pytest.approx(10.0)
+    assert model["base_memory"] == pytest.approx(4000.0)
+    assert model["memory_per_worker"] == pytest.approx(500.0)
+    assert model["out_of_memory"] == {"g4dn.2xlarge": 6}
+    assert model["runs"] == 4
+
+    rate, load, memory, feasible = predict(model, "g5.2xlarge", 8)
+    assert (rate, load, memory, feasible) == (pytest.approx(8 * 10.0 * 8 / 14), pytest.approx(14.0),
+                                              pytest.approx(8000.0), True)
+    rate, load, _, feasible = predict(model, "g4dn.4xlarge", 4)
+    assert (rate, load, feasible) == (pytest.approx(40.0), pytest.approx(8.0), True)
+    # 6 workers ran out of memory on a 15GB GPU, so do 6 or more on any GPU that is not larger
+    assert not predict(model, "g4dn.4xlarge", 6)[3]
+    assert predict(model, "g4dn.4xlarge", 5)[3]
+    assert predict(model, "g5.4xlarge", 6)[3]
+
+
+def test_a_single_worker_count_keeps_the_prior_intercepts():
+    model = fit([observation(3, 6.5, 12.0, 9000), observation(3, 6.5, 12.0, 9500)])
+    assert model["base_load"] == PRIOR["base_load"]
+    assert model["load_per_worker"] == pytest.approx((6.5 - PRIOR["base_load"]) / 3)
+    assert model["base_memory"] == 9500
+    assert model["memory_per_worker"] == PRIOR["memory_per_worker"]
+    # too much memory for the GPU headroom
+    assert not predict(dict(model, base_memory=14000), "g4dn.2xlarge", 1)[3]
+
+
+@pytest.mark.parametrize("workers, advance, expected", [
+    (4, 0.05, (80, 0.05)),
+    (3, 0.05, (60, 0.05)),
+    (1, 0.1, (10, 0.1)),
+    (7, 0.05, (100, 0.07)),
+    (2, 0.3, (40, 0.05)),
+])
+def test_episodes_between_training_advance_one_lap_per_iteration(workers, advance, expected):
+    episodes, distance = episodes_between_training(workers, advance)
+    assert (episodes, distance) == (expected[0], pytest.approx(expected[1]))
+    assert episodes / workers * distance == pytest.approx(1.0)
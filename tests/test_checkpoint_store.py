@@ -0,0 +1,137 @@
+import hashlib, json, os, random
+
+import pytest
+
+from tools import checkpoint_store
+from tools.checkpoint_store import CheckpointStore, chunk_boundaries
+
+BUCKET = "checkpoint-store-test"
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # the same cuts as in production, 16 times smaller so the files stay small
+    monkeypatch.setattr(checkpoint_store, "MIN_CHUNK", 16 * 1024)
+    monkeypatch.setattr(checkpoint_store, "AVERAGE_BITS", 16)
+    monkeypatch.setattr(checkpoint_store, "MAX_CHUNK", 256 * 1024)
+
+
+@pytest.fixture
+def client(s3_client):
+    s3_client.create_bucket(Bucket=BUCKET)
+    return s3_client
+
+
+def random_bytes(size, seed):
+    return random.Random(seed).randbytes(size)
+
+
+def chunks(data):
+    start, digests = 0, []
+    for end in chunk_boundaries(data):
+        digests.append(hashlib.sha256(data[start:end]).hexdigest())
+        start = end
+    return digests
+
+
+def write_checkpoint(model_dir, number, data):
+    name = "{}_Step-{}.ckpt".format(number, number * 1000)
+    files = {
+        "model/{}.index".format(name): data[:4096],
+        "model/{}.data-00000-of-00001".format(name): data,
+        "model/{}.meta".format(name): random_bytes(64 * 1024, "meta"),
+        "model/model_{}.pb".format(number): data[::7],
+        "model/model_metadata.json": b'{"action_space": []}',
+        "ip/hyperparameters.json": b'{"batch_size": 64}',
+        "reward_function.py": b"def reward_function(params):\n    return 1.0\n",
+    }
+    for relative, content in files.items():
+        path = model_dir / relative
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+    (model_dir / "model" / "deepracer_checkpoints.json").write_text(json.dumps(
+        {"best_checkpoint": {"name": name}, "last_checkpoint": {"name": name, "avg_comp_pct": 42.0}}))
+    return files
+
+
+def test_boundaries_after_an_insert_shift_with_it():
+    data = random_bytes(2 * 1024 * 1024, 1)
+    middle = len(data) // 2
+    inserted = data[:middle] + b"inserted" * 100 + data[middle:]
+
+    before, after = chunk_boundaries(data), chunk_boundaries(inserted)
+    assert before[-1] == len(data) and after[-1] == len(inserted)
+    assert [end for end in before if end < middle] == [end for end in after if end < middle]
+    # past the chunk around the insert every cut is the same one, 800 bytes later
+    assert set(end + 800 for end in before if end > middle + 300 * 1024) <= set(after)
+    shared = set(chunks(data)) & set(chunks(inserted))
+    assert len(shared) >= len(before) - 2
+
+
+def test_second_upload_stores_only_the_changed_chunks(client, tmp_path):
+    store = CheckpointStore(BUCKET, "runs/checkpoints", client, workers=4)
+    data = random_bytes(1024 * 1024, 2)
+    write_checkpoint(tmp_path, 1, data)
+    first = store.upload(str(tmp_path), "last")
+    assert first["new_chunks"] == len(store.stored_chunks()) > 1
+
+    changed = bytearray(data)
+    changed[500 * 1024:500 * 1024 + 16] = b"\xff" * 16
+    write_checkpoint(tmp_path, 2, bytes(changed))
+    second = store.upload(str(tmp_path), 2)
+
+    # the shared files, the unchanged chunks of the weights and the index are not sent again
+    assert second["checkpoint"] == "2_Step-2000.ckpt"
+    assert 0 < second["new_chunks"] <= 3
+    assert second["uploaded"] < second["size"] / 4
+    assert list(store.checkpoints()) == ["1_Step-1000", "2_Step-2000"]
+    assert len(store.stored_chunks()) == first["new_chunks"] + second["new_chunks"]
+
+    again = store.upload(str(tmp_path), 2)
+    assert again["new_chunks"] == 0 and again["uploaded"] == 0
+
+
+def test_restore_rebuilds_the_files_of_each_checkpoint(client, tmp_path):
+    store = CheckpointStore(BUCKET, "runs/checkpoints", client, workers=4)
+    model_dir = tmp_path / "model-dir"
+    first = write_checkpoint(model_dir, 1, random_bytes(700 * 1024, 3))
+    store.upload(str(model_dir))
+    second = write_checkpoint(model_dir, 2, random_bytes(700 * 1024, 4))
+    store.upload(str(model_dir))
+
+    for checkpoint, files in ((1, first), ("last", second)):
+        target = tmp_path / "restored-{}".format(checkpoint)
+        manifest = store.restore(checkpoint, str(target))
+        for relative, content in files.items():
+            restored = (target / relative).read_bytes()
+            assert hashlib.sha256(restored).hexdigest() == hashlib.sha256(content).hexdigest()
+            assert manifest["files"][relative]["sha256"] == hashlib.sha256(content).hexdigest()
+        name = manifest["checkpoint"]
+        assert (target / "model" / ".coach_checkpoint").read_text() == name
+        assert '"{}"'.format(name) in (target / "model" / "checkpoint").read_text()
+        assert json.loads((target / "model" / "deepracer_checkpoints.json").read_text())["last_checkpoint"]["name"] == name
+        assert not list(target.rglob("*.part"))
+
+
+def test_restore_to_prefix_uploads_a_plain_model(client, tmp_path):
+    store = CheckpointStore(BUCKET, "runs/checkpoints", client, workers=4)
+    files = write_checkpoint(tmp_path / "model-dir", 3, random_bytes(300 * 1024, 5))
+    store.upload(str(tmp_path / "model-dir"))
+
+    store.restore_to_prefix(3, BUCKET, "/restored/", str(tmp_path / "work"))
+    for relative, content in files.items():
+        body = client.get_object(Bucket=BUCKET, Key="restored/" + relative)["Body"].read()
+        assert body == content
+    assert client.get_object(Bucket=BUCKET, Key="restored/model/.coach_checkpoint")["Body"].read() == b"3_Step-3000.ckpt"
+
+
+def test_corrupt_chunk_is_not_restored(client, tmp_path):
+    store = CheckpointStore(BUCKET, "runs/checkpoints", client, workers=4)
+    write_checkpoint(tmp_path / "model-dir", 1, random_bytes(100 * 1024, 6))
+    manifest = store.upload(str(tmp_path / "model-dir"))
+    digest = manifest["files"]["reward_function.py"]["chunks"][0][0]
+    client.put_object(Bucket=BUCKET, Key=store.key("chunks", digest), Body=b"def reward_function(params):\n    return 0.0\n")
+
+    with pytest.raises(IOError):
+        store.restore(1, str(tmp_path / "restored"))
+    assert not os.path.exists(tmp_path / "restored" / "reward_function.py")
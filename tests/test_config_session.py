@@ -0,0 +1,121 @@
+import json, os
+
+import pytest
+
+from tools.config_session import ConfigSession
+
+RUN_ENV = """# the track and race
+DR_WORLD_NAME=reInvent2019_track
+DR_RACE_TYPE=TIME_TRIAL
+
+# cars
+DR_WORKERS=2"""
+
+
+def set_mtime(path, offset):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + offset))
+
+
+def test_a_file_is_parsed_again_only_when_its_mtime_changes(tmp_path):
+    path = tmp_path / "run.env"
+    path.write_text(RUN_ENV)
+    config = ConfigSession()
+    assert config.get(str(path), "DR_WORKERS") == "2"
+
+    mtime = os.stat(path).st_mtime_ns
+    path.write_text(RUN_ENV.replace("DR_WORKERS=2", "DR_WORKERS=4"))
+    os.utime(path, ns=(mtime, mtime))
+    assert config.get(str(path), "DR_WORKERS") == "2"
+
+    set_mtime(path, 1000000000)
+    assert config.get(str(path), "DR_WORKERS") == "4"
+    assert config.variables(str(path)) == {"DR_WORLD_NAME": "reInvent2019_track", "DR_RACE_TYPE": "TIME_TRIAL",
+                                           "DR_WORKERS": "4"}
+
+
+def test_edits_reach_the_disk_only_on_commit(tmp_path):
+    env, hyperparameters = tmp_path / "run.env", tmp_path / "hyperparameters.json"
+    env.write_text(RUN_ENV)
+    hyperparameters.write_text(json.dumps({"lr": 0.0003, "batch_size": 64}))
+    config = ConfigSession()
+    config.set(str(env), "DR_WORKERS", 3)
+    config.set(str(hyperparameters), "lr", 0.0001)
+    config.set(str(env), "DR_WORKERS", 4)
+
+    assert config.get(str(env), "DR_WORKERS") == 4
+    assert config.data(str(hyperparameters))["lr"] == 0.0001
+    assert env.read_text() == RUN_ENV
+    assert json.loads(hyperparameters.read_text())["lr"] == 0.0003
+
+    # a change made by another process meanwhile is kept, the edits go on top of it
+    hyperparameters.write_text(json.dumps({"lr": 0.0003, "batch_size": 128}))
+    set_mtime(hyperparameters, 1000000000)
+
+    assert sorted(config.commit()) == sorted([str(env), str(hyperparameters)])
+    assert "DR_WORKERS=4\n" in env.read_text()
+    assert json.loads(hyperparameters.read_text()) == {"lr": 0.0001, "batch_size": 128}
+    assert config.pending() == {}
+    assert config.commit() == []
+
+
+def test_a_failed_session_writes_nothing(tmp_path):
+    path = tmp_path / "run.env"
+    path.write_text(RUN_ENV)
+    with pytest.raises(RuntimeError):
+        with ConfigSession() as config:
+            config.set(str(path), "DR_WORKERS", 4)
+            raise RuntimeError("stop")
+    assert path.read_text() == RUN_ENV
+
+
+def test_commit_replaces_the_file_atomically(tmp_path, monkeypatch):
+    path = tmp_path / "run.env"
+    path.write_text(RUN_ENV)
+    os.chmod(path, 0o640)
+    inode = os.stat(path).st_ino
+
+    config = ConfigSession()
+    config.set(str(path), "DR_WORKERS", 4)
+
+    def interrupted(source, destination):
+        raise OSError("disk full")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(os, "replace", interrupted)
+        with pytest.raises(OSError):
+            config.commit()
+    assert path.read_text() == RUN_ENV
+    assert os.listdir(tmp_path) == ["run.env"]
+
+    config.set(str(path), "DR_WORKERS", 4)
+    config.commit()
+    assert os.stat(path).st_ino != inode
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    assert os.listdir(tmp_path) == ["run.env"]
+
+
+def test_run_env_keeps_comments_and_order_and_json_keeps_key_order(tmp_path):
+    env, hyperparameters = tmp_path / "run.env", tmp_path / "hyperparameters.json"
+    env.write_text(RUN_ENV)
+    hyperparameters.write_text(json.dumps({"lr": 0.0003, "batch_size": 64, "epochs": 10}, indent=2))
+    with ConfigSession() as config:
+        config.set(str(env), "DR_RACE_TYPE", "OBJECT_AVOIDANCE")
+        config.set(str(env), "DR_OA_NUMBER_OF_OBSTACLES", 3)
+        config.set(str(hyperparameters), "batch_size", 128)
+        config.set(str(hyperparameters), "loss_type", "huber")
+
+    assert env.read_text() == ("# the track and race\n"
+                               "DR_WORLD_NAME=reInvent2019_track\n"
+                               "DR_RACE_TYPE=OBJECT_AVOIDANCE\n"
+                               "\n"
+                               "# cars\n"
+                               "DR_WORKERS=2\n"
+                               "DR_OA_NUMBER_OF_OBSTACLES=3\n")
+    assert list(json.loads(hyperparameters.read_text()).items()) == [("lr", 0.0003), ("batch_size", 128),
+                                                                      ("epochs", 10), ("loss_type", "huber")]
+
+    config = ConfigSession()
+    assert config.get(str(env), "DR_OA_NUMBER_OF_OBSTACLES") == "3"
+    assert config.get(str(hyperparameters), "loss_type") == "huber"
+    assert config.get(str(hyperparameters), "missing", "default") == "default"
@@ -0,0 +1,132 @@
+import json, random, sys
+
+from tools import early_stop
+from tools.early_stop import MIN_EVALUATIONS, new_state, update
+
+ITERATION = 600
+
+
+def metrics(completions, laps=None):
+    """A training entry every ITERATION seconds, each followed a minute later by an evaluation of two episodes."""
+    entries = []
+    for i, completion in enumerate(completions):
+        start = i * ITERATION
+        entries.append({"phase": "training", "metric_time": start * 1000, "completion_percentage": 20})
+        for _ in range(2):
+            entry = {"phase": "evaluation", "metric_time": (start + 60) * 1000, "completion_percentage": completion}
+            if laps and laps[i]:
+                entry["elapsed_time_in_milliseconds"] = laps[i] * 1000
+            entries.append(entry)
+    return entries
+
+
+def first_stop(entries, checkpoints=None, window=60):
+    """Index of the entry on which update() stops when the entries arrive one by one, with the reason."""
+    state = new_state()
+    for i in range(len(entries)):
+        reason = update(state, entries[:i + 1], checkpoints, window)
+        if reason:
+            return i, reason
+    return None, None
+
+
+def test_no_stop_before_the_minimum_evaluations():
+    entries = metrics([50] * MIN_EVALUATIONS)
+    for entry in entries:
+        entry["metric_time"] *= 100
+    state = new_state()
+    # the last evaluation is only folded in by the next training entry
+    assert update(state, entries, None, 1) is None
+    assert state["evaluations"] == MIN_EVALUATIONS - 1
+
+    entries.append({"phase": "training", "metric_time": entries[-1]["metric_time"] + 1000})
+    assert update(state, entries, None, 1).startswith("no improvement for")
+    assert state["evaluations"] == MIN_EVALUATIONS
+
+
+def test_stops_exactly_when_the_window_passed():
+    entries = metrics([50] * 20)
+    # the rolling completion is first known with the third evaluation, 2 * ITERATION + 60 seconds in
+    assert entries[-1]["metric_time"] / 1000 > 2 * ITERATION + 60 + 3600
+    index, reason = first_stop(entries)
+    assert entries[index]["metric_time"] / 1000 == 2 * ITERATION + 60 + 3600
+    assert entries[index - 1]["metric_time"] / 1000 < 2 * ITERATION + 60 + 3600
+    assert reason == "no improvement for 60 minutes after 8 evaluations, best rolling completion 50.0%, best lap none"
+
+
+def test_improvements_keep_the_training_running():
+    completions = [50, 50, 50, 50, 55, 55, 55, 60, 60, 60, 60, 60, 60, 60, 60, 60, 60, 60, 60, 60]
+    entries = metrics(completions)
+    index, _ = first_stop(entries)
+    # the rolling mean improves for the last time with the tenth evaluation, [60, 60, 60] over [55, 60, 60]
+    assert entries[index]["metric_time"] / 1000 == 9 * ITERATION + 60 + 3600
+
+    laps = [40.0 - i for i in range(12)] + [28.9] * 8
+    entries = metrics([100] * 20, laps)
+    index, reason = first_stop(entries)
+    # 28.9s is less than MIN_LAP_GAIN faster than 29s
+    assert entries[index]["metric_time"] / 1000 == 11 * ITERATION + 60 + 3600
+    assert reason.endswith("best lap 29.00s")
+
+
+def test_a_better_best_checkpoint_resets_the_clock():
+    entries = metrics([50] * 30)
+    reset = 8 * ITERATION
+    assert entries[24]["metric_time"] / 1000 == reset
+    state = new_state()
+    assert update(state, entries[:25], {"best_checkpoint": {"avg_eval_metric": 40.0}}, 60) is None
+    assert update(state, entries[:25], {"best_checkpoint": {"avg_eval_metric": 50.0}}, 60) is None
+    assert state["last_improvement"] == reset
+
+    # a gain below MIN_CHECKPOINT_GAIN is not an improvement
+    checkpoints = {"best_checkpoint": {"avg_eval_metric": 50.2}}
+    for i in range(25, len(entries)):
+        reason = update(state, entries[:i + 1], checkpoints, 60)
+        if reason:
+            break
+    assert entries[i]["metric_time"] / 1000 == reset + 3600
+    assert state["best_checkpoint"] == 50.0
+
+
+def test_the_decision_does_not_depend_on_how_the_metrics_arrive():
+    generator = random.Random(3)
+    for _ in range(20):
+        completions = [generator.choice([40, 60, 80, 100]) for _ in range(40)]
+        laps = [generator.uniform(25, 35) if completion == 100 else None for completion in completions]
+        entries = metrics(completions, laps)
+
+        batch = new_state()
+        batch_reason = update(batch, entries, None, 90)
+
+        incremental, reason, end = new_state(), None, 0
+        while end < len(entries) and not reason:
+            end += generator.randint(1, 7)
+            reason = update(incremental, entries[:end], None, 90)
+        assert reason == batch_reason
+        assert incremental == batch
+
+
+def test_a_shorter_metrics_list_starts_over():
+    state = new_state()
+    assert update(state, metrics([50] * 6), None, 600) is None
+    assert state["evaluations"] == 5
+
+    # a new training wrote its first entries over the metrics of the last one
+    assert update(state, metrics([70] * 2), None, 600) is None
+    assert state["seen"] == 6
+    assert state["evaluations"] == 1
+    assert state["completions"] == [70]
+    assert state["best_completion"] is None
+
+
+def test_main_dry_run_prints_the_decision(tmp_path, monkeypatch, capsys):
+    path = tmp_path / "TrainingMetrics.json"
+    path.write_text(json.dumps({"metrics": metrics([50] * 20)}))
+    monkeypatch.setattr(sys, "argv", ["early_stop", "--workdir", str(tmp_path), "--metrics", str(path),
+                                      "--window", "60", "--dry-run"])
+    stops = []
+    monkeypatch.setattr(early_stop.subprocess, "run", lambda *args, **kwargs: stops.append(args))
+    early_stop.main()
+    assert capsys.readouterr().out.splitlines()[-1].startswith("stop: no improvement for 60 minutes")
+    assert stops == []
+    assert not (tmp_path / "early_stop_state.json").exists()
@@ -0,0 +1,121 @@
+import csv, os
+
+import pytest
+
+from tools.evaluation import (RESULT_COLUMNS, Orchestrator, ReplayEvaluator, TrialParser, bootstrap_interval,
+                              leaderboard, load_results, parse_testing, percentile, wilson_interval)
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "evaluation")
+MODELS = ["model-a", "model-b", "model-c"]
+
+
+def parse(model):
+    parser = TrialParser()
+    with open(os.path.join(FIXTURES, model + ".log"), "r") as f:
+        return [trial for trial in map(parser.feed, f) if trial is not None]
+
+
+def test_parse_testing():
+    assert parse_testing("2024-05-01T12:00:10Z Testing> Name=main_level/agent, Worker=0, Episode=3, "
+                         "Total reward=146.0, Steps=146, Training iteration=0") == {"reward": 146.0, "steps": 146}
+    assert parse_testing("Training> Name=main_level/agent, Worker=0, Episode=3, Total reward=1.0, Steps=2") is None
+    assert parse_testing("Testing> Name=main_level/agent, Worker=0") is None
+
+
+def test_lap_time_counts_every_step_from_the_episode_start():
+    trials = parse("model-a")
+    assert [trial["trial"] for trial in trials] == [1, 2, 3]
+    # tstamp is logged in seconds, rounded to the millisecond
+    assert [trial["lap_time"] for trial in trials] == pytest.approx([steps / 15 for steps in (149, 152, 146)],
+                                                                    abs=0.002)
+    assert all(trial["complete"] and trial["progress"] == 100.0 and trial["off_track"] == 0 for trial in trials)
+
+
+def test_trials_off_track_and_without_steps():
+    first, crashed, last = parse("model-b")
+    assert first["complete"] and first["off_track"] == 2 and first["lap_time"] == pytest.approx(160 / 15, abs=0.002)
+    assert crashed == dict(crashed, complete=False, lap_time=None, progress=45.0, off_track=1, reward=60.0, steps=68)
+    assert last["complete"] and last["off_track"] == 0
+
+    # output.txt has the Testing> lines only, the lap time comes from the steps and completion is unknown
+    assert [(trial["lap_time"], trial["complete"]) for trial in parse("model-c")] == [
+        (141 / 15, None), (150 / 15, None), (144 / 15, None)]
+
+
+def test_resume_records_only_the_missing_trials(tmp_path):
+    results = str(tmp_path / "evaluations.csv")
+    replay = ReplayEvaluator(FIXTURES)
+
+    def interrupted(model, slot, trials):
+        # the instance goes away after the second Testing> line of model-b
+        seen = 0
+        for line in replay(model, slot, trials):
+            seen += "Testing>" in line
+            if model == "model-b" and seen == 2:
+                raise ConnectionError("evaluation stopped")
+            yield line
+
+    errors = Orchestrator(interrupted, results, 3, workers=2).run(MODELS[:2])
+    assert list(errors) == ["model-b"]
+    assert [(row["model"], row["trial"]) for row in load_results(results) if row["model"] == "model-b"] == [
+        ("model-b", 1)]
+
+    started = []
+
+    def counted(model, slot, trials):
+        started.append(model)
+        return replay(model, slot, trials)
+
+    assert Orchestrator(counted, results, 3, workers=2).run(MODELS) == {}
+    assert sorted(started) == ["model-b", "model-c"]
+    rows = load_results(results)
+    assert sorted((row["model"], row["trial"]) for row in rows) == [(model, trial) for model in MODELS
+                                                                    for trial in (1, 2, 3)]
+    # the numbers survive the round trip through the csv
+    assert {row["model"]: row for row in rows if row["trial"] == 2}["model-b"] == {
+        "model": "model-b", "trial": 2, "reward": 60.0, "steps": 68, "progress": 45.0, "off_track": 1,
+        "complete": False, "lap_time": None}
+    with open(results, "r", newline="") as f:
+        assert next(csv.reader(f)) == RESULT_COLUMNS
+
+
+def test_percentile_and_intervals():
+    assert percentile([], 50) is None
+    assert percentile([1.0, 2.0, 3.0, 4.0], 50) == 2.5
+    assert percentile([1.0, 2.0, 3.0, 4.0], 90) == pytest.approx(3.7)
+
+    assert wilson_interval(0, 0) == (None, None)
+    low, high = wilson_interval(2, 3)
+    assert low == pytest.approx(20.77, abs=0.01) and high == pytest.approx(93.85, abs=0.01)
+    low, high = wilson_interval(3, 3)
+    assert low == pytest.approx(43.85, abs=0.01) and high == pytest.approx(100.0)
+
+    laps = [9.5, 9.8, 10.0, 10.1, 10.4, 11.0]
+    assert bootstrap_interval(laps[:1]) == (None, None)
+    low, high = bootstrap_interval(laps)
+    assert min(laps) < low < sum(laps) / len(laps) < high < max(laps)
+    assert bootstrap_interval(laps) == (low, high)
+    wide_low, wide_high = bootstrap_interval(laps, confidence=0.99)
+    assert wide_low <= low and wide_high >= high
+
+
+def test_leaderboard_of_the_recorded_evaluations(tmp_path):
+    results = str(tmp_path / "evaluations.csv")
+    Orchestrator(ReplayEvaluator(FIXTURES), results, 3).run(MODELS)
+    board = {entry["model"]: entry for entry in leaderboard(load_results(results))}
+
+    a, b, c = board["model-a"], board["model-b"], board["model-c"]
+    assert a["completion"] == 100.0 and a["completion_interval"] == list(wilson_interval(3, 3))
+    assert a["laps"] == 3 and a["lap_percentiles"]["50"] == pytest.approx(149 / 15, abs=0.002)
+    low, high = a["mean_lap_interval"]
+    assert 146 / 15 - 0.002 <= low < a["mean_lap"] < high <= 152 / 15 + 0.002
+
+    # the crash counts against the completion rate and has no lap time
+    assert b["completion"] == pytest.approx(200 / 3) and b["completion_interval"] == list(wilson_interval(2, 3))
+    assert b["laps"] == 2 and b["off_track_per_trial"] == 1.0
+    assert b["mean_reward"] == pytest.approx((150.5 + 60.0 + 155.0) / 3)
+
+    assert c["completion"] is None and c["completion_interval"] == [None, None] and c["laps"] == 3
+
+    ranked = [entry["model"] for entry in leaderboard(load_results(results), {"model-a", "model-b"})]
+    assert ranked == ["model-a", "model-b"]
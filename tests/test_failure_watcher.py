@@ -0,0 +1,88 @@
+import os
+
+from tools import failure_watcher
+from tools.failure_watcher import MAX_RESTARTS, RESTART, UPLOAD, FailureWatcher, FlowRunner, docker_events, replay
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "failure_watcher")
+
+
+def replayed(case, **options):
+    return [(kind, message) for _, kind, message in replay(os.path.join(FIXTURES, case), FailureWatcher(**options))]
+
+
+def test_out_of_memory_in_the_sagemaker_log():
+    alerts = replayed("oom")
+    assert [kind for kind, _ in alerts] == ["out_of_memory"]
+    assert "ran out of memory" in alerts[0][1]
+
+
+def test_die_without_kill_alerts_and_killed_container_does_not():
+    assert replayed("die") == [("container_exit", "container deepracer-0_robomaker.1.abc exited with code 139")]
+
+
+def test_one_stalled_worker_while_the_other_runs():
+    alerts = replayed("stall")
+    assert [kind for kind, _ in alerts] == ["stalled"]
+    assert "deepracer-0_robomaker.2" in alerts[0][1]
+    assert replayed("stall", stall_seconds=600) == []
+
+
+def test_everything_stalled():
+    watcher = FailureWatcher(stall_seconds=120)
+    watcher.on_log_line("sagemaker", "sagemaker", "Policy training> epoch=0", 1000.0)
+    watcher.check(1100.0)
+    assert watcher.alerts == []
+    watcher.check(1121.0)
+    assert [kind for _, kind, _ in watcher.alerts] == ["stalled"]
+
+
+def test_reward_collapse():
+    alerts = replayed("collapse")
+    assert [kind for kind, _ in alerts] == ["reward_collapse"]
+    assert replayed("collapse", collapse_ratio=0.01) == []
+
+
+def test_nan_reward():
+    watcher = FailureWatcher()
+    line = "SIM_TRACE_LOG:0,1,1.0,2.0,90.0,0.0,2.0,3,nan,False,True,2.0,10,17.7,1.0,in_progress,0.0"
+    watcher.on_log_line("robomaker", "deepracer-0_robomaker.1", line, 10.0)
+    assert [kind for _, kind, _ in watcher.alerts] == ["reward_collapse"]
+
+
+def test_cooldown_mutes_the_same_kind_only():
+    watcher = FailureWatcher(cooldown=900)
+    watcher.alert("out_of_memory", "first", 0)
+    watcher.alert("out_of_memory", "muted", 899)
+    watcher.alert("stalled", "other kind", 899)
+    watcher.alert("out_of_memory", "after the cooldown", 900)
+    assert [message for _, _, message in watcher.alerts] == ["first", "other kind", "after the cooldown"]
+
+
+def test_restarts_are_capped(monkeypatch):
+    commands = []
+    monkeypatch.setattr(failure_watcher.subprocess, "run", lambda command: commands.append(command[-1]))
+    runner = FlowRunner()
+    for _ in range(MAX_RESTARTS + 2):
+        commands.clear()
+        runner.run("out_of_memory", "ran out of memory")
+    assert runner.restarts == MAX_RESTARTS
+    # past the cap the model is still uploaded and the notification says why it was not restarted
+    assert not any(command.endswith(RESTART) for command in commands)
+    assert commands[-1].endswith(UPLOAD)
+    assert "not restarting after {} restarts".format(MAX_RESTARTS) in commands[0]
+
+
+def test_reward_collapse_is_not_restarted(monkeypatch):
+    commands = []
+    monkeypatch.setattr(failure_watcher.subprocess, "run", lambda command: commands.append(command[-1]))
+    runner = FlowRunner()
+    runner.run("reward_collapse", "collapse")
+    assert runner.restarts == 0
+    assert len(commands) == 2 and commands[1].endswith(UPLOAD)
+
+
+def test_fake_docker_event_source():
+    watcher = FailureWatcher()
+    for event in docker_events(os.path.join(FIXTURES, "fake-docker"), reconnect=0):
+        watcher.on_docker_event(event)
+    assert [kind for _, kind, _ in watcher.alerts] == ["container_exit"]
@@ -0,0 +1,194 @@
+import json, sys
+
+import pytest
+
+from tools import hyperband
+from tools.hyperband import Hyperband, SimulatedLauncher, bracket_order, brackets, promoted, ranking
+
+SPACE = {"lr": {"log_uniform": [0.00001, 0.001]}, "batch_size": [32, 64, 128],
+         "discount_factor": {"uniform": [0.95, 0.999]}, "num_epochs": {"int": [3, 10]}}
+
+
+def spec(**values):
+    return dict({"name": "hb-test", "space": SPACE, "min_minutes": 30, "max_minutes": 270, "eta": 3, "trials": 18,
+                 "parallel": 3}, **values)
+
+
+class ScriptedLauncher:
+    """A training entry and an evaluation of the scripted completion every 5 minutes from the launch."""
+
+    def __init__(self, completions):
+        self.completions = completions
+        self.now = 0.0
+        self.launched = {}
+        self.stopped = {}
+
+    def launch(self, model, parameters):
+        self.launched[model] = self.now
+
+    def error(self, model):
+        return None
+
+    def metrics(self, model):
+        start, end = self.launched[model], self.stopped.get(model, self.now)
+        metrics = []
+        for minute in range(0, int((end - start) / 60) + 1, 5):
+            time = int((start + minute * 60) * 1000)
+            metrics.append({"phase": "training", "metric_time": time, "completion_percentage": 10})
+            metrics.append({"phase": "evaluation", "metric_time": time + 1000,
+                            "completion_percentage": self.completions[model]})
+        return metrics
+
+    def stop(self, model):
+        self.stopped[model] = self.now
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptedLauncher(SimulatedLauncher):
+    """Goes away after a number of polls, like a search stopped with Ctrl-C while its stacks keep training."""
+
+    def __init__(self, polls, **kwargs):
+        super().__init__(**kwargs)
+        self.polls = polls
+
+    def sleep(self, seconds):
+        if self.polls == 0:
+            raise Interrupted()
+        self.polls -= 1
+        super().sleep(seconds)
+
+
+def test_brackets():
+    assert brackets(30, 270, 3) == [{"rungs": [30, 90], "share": 9}, {"rungs": [90], "share": 5},
+                                    {"rungs": [], "share": 3}]
+    assert brackets(30, 270, 3, count=1) == [{"rungs": [30, 90], "share": 9}]
+    # a budget ratio just under a power of eta does not get the deeper bracket
+    assert [bracket["rungs"] for bracket in brackets(31, 270, 3)] == [[90], []]
+    assert brackets(60, 240, 2) == [{"rungs": [60, 120], "share": 4}, {"rungs": [120], "share": 3},
+                                    {"rungs": [], "share": 3}]
+
+
+def test_bracket_order_interleaves_by_share():
+    bracket_list = brackets(30, 270, 3)
+    order = bracket_order(bracket_list)
+    assert len(order) == 17
+    assert [order.count(index) for index in range(3)] == [9, 5, 3]
+    assert order[:5] == [0, 1, 0, 2, 0]
+    # every prefix is close to the shares, a short search still tries every bracket
+    for length in range(1, len(order) + 1):
+        for index, bracket in enumerate(bracket_list):
+            assert abs(order[:length].count(index) - length * bracket["share"] / 17) <= 1
+
+
+def test_promoted():
+    assert promoted((10.0, 0), [(10.0, 0), (90.0, 0)])
+    # the top 1/eta of the scores at the rung, including the new one
+    recorded = [(50.0, -9.0), (80.0, -9.0), (60.0, -9.0)]
+    assert promoted((80.0, -9.0), recorded) and not promoted((60.0, -9.0), recorded)
+    recorded += [(70.0, -8.0), (70.0, -9.5), (20.0, -9.0)]
+    assert promoted((70.0, -8.0), recorded) and not promoted((70.0, -9.5), recorded)
+    assert promoted((70.0, -9.5), recorded, eta=2) and not promoted((60.0, -9.0), recorded, eta=2)
+
+
+def test_rung_decisions():
+    completions = {"hb-test-01": 50, "hb-test-02": 80, "hb-test-03": 60, "hb-test-04": 90, "hb-test-05": 70}
+    launcher = ScriptedLauncher(completions)
+    events = []
+    search = Hyperband(launcher, spec(trials=5, parallel=1, brackets=1, poll_seconds=300), on_event=events.append)
+    trials = {trial["model"]: trial for trial in search.run()}
+
+    def outcome(model):
+        return trials[model]["status"], [rung["minutes"] for rung in trials[model]["rungs"]]
+
+    # the first eta - 1 trials of a rung have nothing to compare with
+    assert outcome("hb-test-01") == ("complete", [30, 90])
+    assert outcome("hb-test-02") == ("complete", [30, 90])
+    assert outcome("hb-test-03") == ("stopped", [30])
+    assert outcome("hb-test-04") == ("complete", [30, 90])
+    assert outcome("hb-test-05") == ("stopped", [30])
+    assert trials["hb-test-03"]["reason"] == "60.0% completion at 30 minutes, not in the top 1/3 of 3"
+    assert 30 <= trials["hb-test-03"]["minutes"] < 90 and trials["hb-test-04"]["minutes"] >= 270
+    assert sorted(launcher.stopped) == sorted(completions)
+    assert [trial["model"] for trial in search.run()][:3] == ["hb-test-04", "hb-test-02", "hb-test-01"]
+    assert "hb-test-04: passed the 90 minute rung with 90.0% completion (3 trials so far)" in events
+
+
+def test_simulated_search():
+    search = Hyperband(SimulatedLauncher(seed=1), spec())
+    trials = search.run()
+    assert len(trials) == 18 and not [trial for trial in trials if trial["status"] == "running"]
+    assert ranking(trials) == trials and trials[0]["status"] == "complete"
+    by_model = {trial["model"]: trial for trial in trials}
+    for index in range(18):
+        assert by_model["hb-test-{:02d}".format(index + 1)]["bracket"] == search.order[index % len(search.order)]
+
+    for trial in trials:
+        rungs = search.brackets[trial["bracket"]]["rungs"]
+        if trial["status"] == "complete":
+            assert trial["minutes"] >= 270 and len(trial["rungs"]) == len(rungs)
+        else:
+            assert trial["status"] == "stopped" and trial["minutes"] < 270
+            # stopped at its last rung, once at least eta trials of the bracket had reached it
+            rung = len(trial["rungs"]) - 1
+            assert trial["minutes"] >= rungs[rung]
+            assert sum(1 for other in trials
+                       if other["bracket"] == trial["bracket"] and len(other["rungs"]) > rung) >= 3
+    assert all(trial["status"] == "complete" for trial in trials if trial["bracket"] == 2)
+    assert sum(trial["status"] == "stopped" for trial in trials) >= 6
+    assert sum(trial["minutes"] for trial in trials) < 0.7 * 18 * 270
+
+    again = Hyperband(SimulatedLauncher(seed=1), spec()).run()
+    assert again == trials
+
+
+def test_failed_launches():
+    trials = Hyperband(SimulatedLauncher(failure_rate=1.0), spec(trials=4, parallel=2)).run()
+    assert [(trial["status"], trial["reason"]) for trial in trials] == [("failed", "simulated launch failure")] * 4
+
+
+def test_resume_continues_the_saved_search(tmp_path):
+    state_file = str(tmp_path / "hyperband.json")
+    finished = Hyperband(SimulatedLauncher(seed=2), spec()).run()
+
+    launcher = InterruptedLauncher(polls=200, seed=2)
+    with pytest.raises(Interrupted):
+        Hyperband(launcher, spec(), state_file=state_file).run()
+    with open(state_file, "r") as f:
+        state = json.load(f)
+    assert state["spec"] == spec() and state["brackets"] == brackets()
+    saved = state["trials"]
+    assert 3 < len(saved) < 18 and [trial["status"] for trial in saved].count("running") == 3
+
+    # the trials that ran on are read again, the new ones sample the same parameters
+    launcher.polls = -1
+    resumed = Hyperband(launcher, spec(), saved, state_file).run()
+    assert resumed == finished
+    assert len(launcher.trials) == 18
+    with open(state_file, "r") as f:
+        assert ranking(json.load(f)["trials"]) == resumed
+
+
+def test_main_simulates_a_search(tmp_path, monkeypatch, capsys):
+    spec_file = tmp_path / "search.json"
+    spec_file.write_text(json.dumps(spec(seed=3)))
+    monkeypatch.setattr(sys, "argv", ["hyperband", str(spec_file), "--simulate", "--trials", "6", "--brackets", "2",
+                                      "--sweeps-dir", str(tmp_path / "sweeps")])
+    hyperband.main()
+    output = capsys.readouterr().out
+    assert "bracket 0: rungs at 30, 90 minutes, 9 of every 14 trials" in output
+    assert "bracket 1: rungs at 90 minutes, 5 of every 14 trials" in output
+    assert "6 trials, " in output and "best trial has simulated quality" in output
+    assert not (tmp_path / "sweeps").exists()
+
+    monkeypatch.setattr(sys, "argv", ["hyperband", str(spec_file), "--simulate", "--resume"])
+    with pytest.raises(SystemExit):
+        hyperband.main()
@@ -0,0 +1,175 @@
+import json, os
+
+import pytest
+
+from tools import log_collector
+from tools.log_collector import Collector
+
+FAKE_DOCKER = os.path.join(os.path.dirname(__file__), "fixtures", "log_collector", "fake-docker")
+LINE = len("Training> line 0001\n")
+
+
+def test_container_logs_are_rotated_at_the_cap(tmp_path):
+    collector = Collector(str(tmp_path), str(tmp_path / "state.json"), str(tmp_path / "run.env"), FAKE_DOCKER,
+                          max_log_bytes=30 * LINE)
+    collector.poll(False)
+
+    log = tmp_path / "deepracer-0_sagemaker.log"
+    rotated = (tmp_path / "deepracer-0_sagemaker.log.1").read_text().splitlines()
+    # 100 lines: three full files of 30, the third kept as .1, and the last 10 lines
+    assert rotated == ["Training> line {:04d}".format(i) for i in range(61, 91)]
+    assert log.read_text().splitlines() == ["Training> line {:04d}".format(i) for i in range(91, 101)]
+    assert len(collector.state["training"]) == 10
+
+
+SAGEMAKER = "s0 deepracer-0_algo-1-x7 awsdeepracercommunity/deepracer-sagemaker:5.2.1-gpu"
+ROBOMAKER_1 = "r1 deepracer-0_robomaker.1.ab awsdeepracercommunity/deepracer-robomaker:5.2.1-cpu-avx2"
+ROBOMAKER_2 = "r2 deepracer-0_robomaker.2.cd awsdeepracercommunity/deepracer-robomaker:5.2.1-cpu-avx2"
+STOPPED = "r9 deepracer-robomaker_old awsdeepracercommunity/deepracer-robomaker:5.2.1-cpu-avx2"
+
+
+def timestamp(second):
+    return "2026-10-17T10:{:02d}:{:02d}.000000000Z".format(second // 60, second % 60)
+
+
+def step(episode, steps, status="in_progress", tstamp=0.0):
+    return ("SIM_TRACE_LOG:{},{},1.0,2.0,90.0,0.0,2.0,3,1.5,{},True,50.0,5,17.7,{:.3f},{},0.0"
+            .format(episode, steps, status != "in_progress", tstamp, status))
+
+
+class FakeDocker:
+    """Containers and logs of the fake docker, kept in its FAKE_DOCKER_DIR."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.clock = 0
+
+    def containers(self, running, stopped=()):
+        (self.directory / "running").write_text("".join(line + "\n" for line in running))
+        (self.directory / "stopped").write_text("".join(line + "\n" for line in stopped))
+
+    def add(self, container, lines):
+        """Append lines to a container log, one second apart."""
+        with open(self.directory / (container.split()[0] + ".log"), "a") as f:
+            for line in lines:
+                self.clock += 1
+                f.write("{} {}\n".format(timestamp(self.clock), line))
+
+    def calls(self):
+        return (self.directory / "calls").read_text().splitlines()
+
+
+@pytest.fixture
+def docker(tmp_path, monkeypatch):
+    directory = tmp_path / "docker"
+    directory.mkdir()
+    monkeypatch.setenv("FAKE_DOCKER_DIR", str(directory))
+    return FakeDocker(directory)
+
+
+def collector(tmp_path):
+    return Collector(str(tmp_path), str(tmp_path / "state.json"), str(tmp_path / "run.env"), FAKE_DOCKER)
+
+
+def test_a_restarted_collector_reads_only_the_new_lines(tmp_path, docker):
+    docker.containers([SAGEMAKER])
+    docker.add(SAGEMAKER, ["Training> line {}".format(i) for i in range(1, 6)])
+    first = collector(tmp_path)
+    first.poll(False)
+    first.save_state()
+    assert first.state["offsets"] == {"s0": timestamp(5)}
+
+    docker.add(SAGEMAKER, ["Training> line {}".format(i) for i in range(6, 9)])
+    second = collector(tmp_path)
+    second.poll(False)
+    assert "logs --timestamps --since {} s0".format(timestamp(5)) in docker.calls()
+    expected = ["Training> line {}".format(i) for i in range(1, 9)]
+    # the line at the --since timestamp is sent again by docker and skipped
+    assert (tmp_path / "deepracer-0_algo-1-x7.log").read_text().splitlines() == expected
+    assert second.state["training"] == expected
+    assert second.state["offsets"] == {"s0": timestamp(8)}
+
+
+def test_each_container_keeps_its_own_tail(tmp_path, docker, monkeypatch):
+    monkeypatch.setattr(log_collector, "TAIL_LINES", 3)
+    docker.containers([ROBOMAKER_2, SAGEMAKER, ROBOMAKER_1])
+    docker.add(ROBOMAKER_1, ["worker 1 line {}".format(i) for i in range(5)] + ["Testing> worker 1",
+                                                                               step(1, 1), step(1, 2)])
+    docker.add(ROBOMAKER_2, ["worker 2 line {}".format(i) for i in range(5)] + ["Testing> worker 2", step(1, 1)])
+    docker.add(SAGEMAKER, ["sagemaker line {}".format(i) for i in range(5)])
+    instance = collector(tmp_path)
+    instance.poll(False)
+
+    state = instance.state
+    # the first robomaker by name is the main worker, logged to robomaker1.log
+    assert state["robomaker_tail"] == ["Testing> worker 1", step(1, 1), step(1, 2)]
+    assert state["sagemaker_tail"] == ["sagemaker line {}".format(i) for i in range(2, 5)]
+    assert state["testing"] == {"deepracer-0_robomaker.1.ab": ["Testing> worker 1"],
+                                "deepracer-0_robomaker.2.cd": ["Testing> worker 2"]}
+    assert state["steps"] == {"deepracer-0_robomaker.1.ab": 2, "deepracer-0_robomaker.2.cd": 1}
+    assert (tmp_path / "robomaker1.log").read_text().splitlines()[0] == "worker 1 line 0"
+    assert (tmp_path / "deepracer-0_robomaker.2.cd.log").read_text().splitlines()[-1] == step(1, 1)
+    assert not (tmp_path / "deepracer-0_robomaker.1.ab.log").exists()
+
+
+def test_completed_laps_keep_the_fastest_across_restarts(tmp_path, docker, monkeypatch):
+    monkeypatch.setattr(log_collector, "MAX_LAPS", 3)
+    docker.containers([ROBOMAKER_1])
+    docker.add(ROBOMAKER_1, [step(episode, steps, "lap_complete")
+                             for episode, steps in enumerate([120, 90, 150, 80, 100])])
+    first = collector(tmp_path)
+    first.tick(False)
+    assert (tmp_path / "completedlaps.txt").read_text().splitlines() == [
+        step(3, 80, "lap_complete"), step(1, 90, "lap_complete"), step(4, 100, "lap_complete")]
+
+    docker.add(ROBOMAKER_1, [step(5, 85, "lap_complete"), step(6, 200, "lap_complete")])
+    second = collector(tmp_path)
+    second.tick(False)
+    assert second.state["lap_count"] == 7
+    assert (tmp_path / "completedlaps.txt").read_text().splitlines() == [
+        step(3, 80, "lap_complete"), step(5, 85, "lap_complete"), step(1, 90, "lap_complete")]
+
+
+def test_output_txt_lists_the_sections_of_the_monitoring_page(tmp_path, docker):
+    (tmp_path / "run.env").write_text("DR_WORLD_NAME=reInvent2019_track\nDR_LOCAL_S3_MODEL_PREFIX=my-model\n")
+    docker.containers([SAGEMAKER, ROBOMAKER_1], [STOPPED])
+    docker.add(SAGEMAKER, ["Training> iteration 1", "Best checkpoint number: 1, Last checkpoint number: 2",
+                           "Policy training> took a while", "GPU ran out of memory"])
+    docker.add(ROBOMAKER_1, ["Testing> done", step(1, 1), step(1, 90, "lap_complete"), step(2, 95, "off_track")])
+    collector(tmp_path).tick(False)
+
+    out = (tmp_path / "output.txt").read_text().splitlines()
+    assert out[1] == "DR_LOCAL_S3_MODEL_PREFIX=my-model"
+    headings = [line for line in out if line.startswith("=====")]
+    assert headings == ["=====Robomaker (main Worker)=====", "=====Sagemaker policy training=====",
+                        "=====GPU performance=====", "=====Storage Availability=====",
+                        "=====Docker containers status=====", "=====CPU average load (1min / 5min / 15min avg)=====",
+                        "=====Memory usage=====", "=====Robomaker Testing result logs (all Workers)=====",
+                        "=====Sagemaker training logs=====", "=====Robomaker Top 10 completed laps (all Workers)=====",
+                        "=====Robomaker (main Worker) - OutputLog: ====="]
+    assert "  ########### ERROR ------> GPU RAN OUT OF MEMORY !!!!!!  ###########" in out
+    assert "  ########### ERROR ------> At least one required DOCKER CONTAINER EXITED !!!!!!  ###########" in out
+
+    def section(heading):
+        start = out.index(heading) + 1
+        end = next(i for i in range(start, len(out)) if out[i].startswith("=====") or out[i].startswith("####"))
+        return out[start:end]
+
+    assert section("=====Robomaker (main Worker)=====") == [step(1, 90, "lap_complete"), step(2, 95, "off_track")]
+    assert section("=====Sagemaker policy training=====") == ["Policy training> took a while"]
+    assert section("=====Robomaker Testing result logs (all Workers)=====") == ["Testing> done"]
+    assert section("=====Sagemaker training logs=====") == ["Training> iteration 1"]
+    assert section("=====Robomaker Top 10 completed laps (all Workers)=====") == [
+        "Number of completed laps: 1", step(1, 90, "lap_complete")]
+    assert out[-1] == "###################"
+    assert (tmp_path / "OutputLog.txt").read_text() == (tmp_path / "robomaker.txt").read_text()
+
+
+def test_offsets_of_removed_containers_are_dropped(tmp_path, docker):
+    docker.containers([SAGEMAKER], [STOPPED])
+    docker.add(SAGEMAKER, ["Training> line 1"])
+    (tmp_path / "state.json").write_text(json.dumps({"offsets": {"gone": timestamp(0), "r9": timestamp(0)}}))
+    instance = collector(tmp_path)
+    instance.poll(False)
+    # a stopped container may start again and continue its log
+    assert instance.state["offsets"] == {"r9": timestamp(0), "s0": timestamp(1)}
@@ -0,0 +1,141 @@
+import asyncio, json, threading
+
+import pytest
+
+from tools import metrics_server
+from tools.log_collector import new_state
+from tools.metrics_server import RATE_WINDOW, MetricsServer
+
+
+class Collector:
+    """The parts of LogCollector the metrics server reads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = new_state()
+        self.system = {}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(metrics_server.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def server():
+    return MetricsServer(Collector())
+
+
+def test_rates_cover_the_last_window_of_snapshots(server, clock):
+    steps = server.collector.state["steps"]
+    assert server.rates() == {}
+    for second in range(0, 3 * RATE_WINDOW + 1, 5):
+        clock[0] = 1000.0 + second
+        # 10 steps per second for the first two windows, then 2 per second
+        steps["robomaker-1"] = 10 * min(second, 2 * RATE_WINDOW) + 2 * max(second - 2 * RATE_WINDOW, 0)
+        server.snapshot()
+    assert server.snapshots[0][0] == 1000.0 + 2 * RATE_WINDOW
+    assert server.rates() == {"robomaker-1": 2.0}
+
+    # a worker that appears later starts from zero, a restarted counter does not go negative
+    clock[0] += 5
+    steps["robomaker-2"] = 50
+    steps["robomaker-1"] = 0
+    server.snapshot()
+    rates = server.rates()
+    assert rates["robomaker-1"] == 0
+    assert rates["robomaker-2"] == pytest.approx(50 / RATE_WINDOW)
+
+
+def test_prometheus_text_describes_each_metric_once_and_escapes_labels(server, clock):
+    state = server.collector.state
+    state["steps"] = {"robomaker-1": 120, "robomaker-2": 80}
+    state["episodes"] = {"robomaker-1": 3, "robomaker-2": 2}
+    state["lap_count"] = 1
+    state["best_lap_time"] = 12.5
+    state["best_checkpoint"] = "Best checkpoint number: 4, Last checkpoint number: 6"
+    server.collector.system = {"gpu_memory_used": 2, "containers": {'odd"name\\': 0, "robomaker-1": 1}}
+
+    lines = server.prometheus().splitlines()
+    assert lines.count("# HELP deepracer_steps_total Simulation steps of each robomaker worker") == 1
+    assert lines.count("# TYPE deepracer_steps_total counter") == 1
+    assert lines.count("# TYPE deepracer_checkpoint gauge") == 1
+    assert 'deepracer_steps_total{worker="robomaker-1"} 120' in lines
+    assert 'deepracer_steps_total{worker="robomaker-2"} 80' in lines
+    assert 'deepracer_checkpoint{kind="best"} 4' in lines
+    assert 'deepracer_checkpoint{kind="last"} 6' in lines
+    assert "deepracer_laps_completed_total 1" in lines
+    assert "deepracer_best_lap_seconds 12.5" in lines
+    assert "deepracer_gpu_memory_used_bytes 2097152" in lines
+    assert 'deepracer_container_up{name="odd\\"name\\\\"} 0' in lines
+    # values without a measurement are left out, not reported as 0
+    assert not any(line.startswith("deepracer_policy_training_seconds") for line in lines)
+    assert not any(line.startswith("deepracer_steps_per_second") for line in lines)
+
+    # the HELP and TYPE lines come right before the first sample of their metric
+    help_index = lines.index("# HELP deepracer_steps_total Simulation steps of each robomaker worker")
+    assert lines[help_index + 2].startswith("deepracer_steps_total{")
+
+
+def test_json_keys_labelled_metrics_by_their_label(server, clock):
+    state = server.collector.state
+    state["steps"] = {"robomaker-1": 10}
+    state["out_of_memory"] = 2
+    state["checkpoint"] = "Saved checkpoint 7_Step-7000.ckpt"
+    server.snapshot()
+    clock[0] += 10
+    state["steps"]["robomaker-1"] = 30
+    server.snapshot()
+
+    # a labelled metric without samples, like the episodes here, is left out
+    assert json.loads(server.json()) == {
+        "deepracer_steps_total": {"robomaker-1": 30},
+        "deepracer_steps_per_second": {"robomaker-1": 2.0},
+        "deepracer_laps_completed_total": 0,
+        "deepracer_out_of_memory_total": 2,
+        "deepracer_checkpoint": {"last": 7},
+    }
+
+
+def request(server, raw):
+    """Send raw bytes to handle() over a local socket, return (status line, headers, body)."""
+
+    async def exchange():
+        listener = await asyncio.start_server(server.handle, "127.0.0.1", 0)
+        async with listener:
+            port = listener.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(raw)
+            await writer.drain()
+            response = await asyncio.wait_for(reader.read(), 10)
+            writer.close()
+            return response
+
+    head, _, body = asyncio.run(exchange()).decode().partition("\r\n\r\n")
+    status, *headers = head.split("\r\n")
+    return status, dict(header.split(": ", 1) for header in headers), body
+
+
+def test_handle_serves_both_formats_and_rejects_the_rest(server):
+    server.collector.state["lap_count"] = 3
+
+    status, headers, body = request(server, b"GET /metrics?x=1 HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    assert status == "HTTP/1.1 200 OK"
+    assert headers["Content-Type"] == "text/plain; version=0.0.4"
+    assert int(headers["Content-Length"]) == len(body.encode())
+    assert "deepracer_laps_completed_total 3\n" in body
+
+    status, headers, body = request(server, b"GET /metrics.json HTTP/1.1\r\n\r\n")
+    assert status == "HTTP/1.1 200 OK"
+    assert headers["Content-Type"] == "application/json"
+    assert json.loads(body)["deepracer_laps_completed_total"] == 3
+
+    status, _, body = request(server, b"GET /favicon.ico HTTP/1.1\r\n\r\n")
+    assert status == "HTTP/1.1 404 Not Found"
+    assert body == "/metrics or /metrics.json\n"
+
+    status, _, body = request(server, b"POST /metrics HTTP/1.1\r\nContent-Length: 0\r\n\r\n")
+    assert status == "HTTP/1.1 405 Method Not Allowed"
+    assert body == "GET only\n"
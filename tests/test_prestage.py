@@ -0,0 +1,70 @@
+import json, os
+
+import pytest
+
+from tools.prestage import MIN_PART, Prestager
+
+BUCKET = "prestage-test"
+
+
+@pytest.fixture
+def client(s3_client):
+    s3_client.create_bucket(Bucket=BUCKET)
+    s3_client.put_object(Bucket=BUCKET, Key="model/model/deepracer_checkpoints.json",
+                         Body=json.dumps({"best_checkpoint": {"name": "3_Step-3000.ckpt"},
+                                          "last_checkpoint": {"name": "4_Step-4000.ckpt"}}).encode())
+    return s3_client
+
+
+def test_flush_continues_from_a_stage_of_another_instance(client, tmp_path):
+    log = tmp_path / "robomaker1.log"
+    log.write_bytes(b"x" * (MIN_PART + 100) + b"\n")
+    uploads = []
+    state_file = str(tmp_path / "prestage.json")
+
+    def prestager():
+        return Prestager(BUCKET, "model", str(tmp_path / "*.log"), state_file, client,
+                         upload_best=lambda: uploads.append(1))
+
+    # both exist before either stages, like the training loop and interrupt_spot.sh
+    loop, interrupt = prestager(), prestager()
+    assert loop.stage()["best_uploaded"]
+    with open(log, "ab") as f:
+        f.write(b"last lines\n")
+    report = interrupt.stage(interrupted=True)
+
+    assert len(uploads) == 1
+    assert not report["best_uploaded"]
+    # only the tail is sent, appended to the object with a server side copy
+    assert report["log_bytes"] == len(b"last lines\n")
+    body = client.get_object(Bucket=BUCKET, Key="model/logs/robomaker1.log")["Body"].read()
+    assert body == log.read_bytes()
+    manifest = json.loads(client.get_object(Bucket=BUCKET, Key="model/resume.json")["Body"].read())
+    assert manifest["interrupted"] and manifest["logs"]["robomaker1.log"] == len(body)
+
+
+def test_rotated_logs_keep_every_line_in_s3(client, tmp_path):
+    log = tmp_path / "deepracer-0_sagemaker.log"
+    prestager = Prestager(BUCKET, "model", str(tmp_path / "*.log"), str(tmp_path / "prestage.json"), client,
+                          upload_best=lambda: None)
+    segments = []
+    for rotation in range(3):
+        staged = b"x" * (MIN_PART + 100) + b" staged %d\n" % rotation
+        log.write_bytes(staged)
+        prestager.stage()
+        # lines written after the stage, then the collector moves the full log away and the new one is
+        # already longer than the staged offset
+        with open(log, "ab") as f:
+            f.write(b"written before rotation %d\n" % rotation)
+        segments.append(log.read_bytes())
+        os.replace(log, str(log) + ".1")
+    log.write_bytes(b"y" * (MIN_PART + 200) + b"\n")
+    prestager.stage()
+
+    def body(key):
+        return client.get_object(Bucket=BUCKET, Key="model/logs/" + key)["Body"].read()
+
+    assert [body("deepracer-0_sagemaker.log.{}".format(n)) for n in (1, 2, 3)] == segments
+    assert body("deepracer-0_sagemaker.log") == log.read_bytes()
+    # a stage without changes sends nothing
+    assert prestager.stage()["log_bytes"] == 0
@@ -0,0 +1,28 @@
+import numpy as np
+
+from tools.racing_line import compute
+
+
+def oval_track(count=150, close_centre=True, close_borders=True):
+    angles = np.linspace(0, 2 * np.pi, count, endpoint=False)
+    directions = np.stack([np.cos(angles), np.sin(angles)], axis=1)
+    centre, inner, outer = 5 * directions, 4.5 * directions, 5.5 * directions
+    columns = []
+    for points, close in [(centre, close_centre), (inner, close_borders), (outer, close_borders)]:
+        # an unclosed column gets a last point just short of its first one instead
+        columns.append(np.vstack([points, points[:1] if close else points[:1] * 1.001 + 0.01]))
+    return np.hstack(columns)
+
+
+def test_one_row_per_centre_waypoint_when_only_the_centre_repeats_its_first_point():
+    line = compute(oval_track(close_borders=False))
+    assert line.shape == (150, 4)
+    assert np.all(np.abs(line[:, 3]) <= 0.5)
+
+
+def test_closed_track():
+    line = compute(oval_track())
+    assert line.shape == (150, 4)
+    # the same offset all around a circle
+    assert np.allclose(line[:, 3], line[0, 3], atol=1e-3)
+    assert np.all(line[:, 2] > 0)
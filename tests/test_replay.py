@@ -0,0 +1,84 @@
+import os, sys
+
+import numpy as np
+import pytest
+
+from tools import replay as replay_module
+from tools.replay import reads_objects, replay, replay_objects
+from tools.sim_trace import make_params_builder, parse_line, synthetic_rows
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLES = os.path.join(ROOT, "custom-files", "reward-fn-examples")
+NOT_CRASHING = os.path.join(EXAMPLES, "reward-fn-stay-on-lane-not-crashing.py")
+CENTRE_LINE = os.path.join(EXAMPLES, "reward-fn-follow-the-center-line.py")
+VARIABLES = {"DR_OA_NUMBER_OF_OBSTACLES": "4", "DR_H2B_NUMBER_OF_BOT_CARS": "2", "DR_H2B_BOT_CAR_SPEED": "0.5"}
+
+
+@pytest.fixture
+def track(tmp_path):
+    angles = np.linspace(0, 2 * np.pi, 120, endpoint=False)
+    directions = np.stack([np.cos(angles), np.sin(angles)], axis=1)
+    columns = [np.vstack([points, points[:1]]) for points in (5 * directions, 4.5 * directions, 5.5 * directions)]
+    path = str(tmp_path / "oval.npy")
+    np.save(path, np.hstack(columns))
+    return path
+
+
+@pytest.fixture
+def trace(tmp_path, track):
+    waypoints = [tuple(point) for point in np.load(track)[:-1, 0:2]]
+    path = tmp_path / "robomaker.log"
+    with open(path, "w") as f:
+        for row in synthetic_rows(600, waypoints):
+            f.write("SIM_TRACE_LOG:" + ",".join(str(value) for value in row) + "\n")
+    return str(path)
+
+
+def test_objects_of_each_race_type(track):
+    assert replay_objects("TIME_TRIAL", track, VARIABLES) is None
+    obstacles = replay_objects("OBJECT_AVOIDANCE", track, VARIABLES)
+    assert len(obstacles) == 4 and [o[5] for o in obstacles] == [0.0] * 4
+    assert [o[0] for o in obstacles] == sorted(o[0] for o in obstacles)
+    bots = replay_objects("HEAD_TO_BOT", track, VARIABLES)
+    assert len(bots) == 2 and [o[5] for o in bots] == [0.5, 0.5]
+    # in a lane, half way between the centre line and a border
+    assert all(abs(np.hypot(o[1], o[2]) - 5) == pytest.approx(0.25, abs=0.01) for o in obstacles + bots)
+    with pytest.raises(ValueError):
+        replay_objects("OBJECT_AVOIDANCE", None, VARIABLES)
+
+
+def test_params_have_the_objects(track):
+    objects = replay_objects("OBJECT_AVOIDANCE", track, VARIABLES)
+    waypoints = [tuple(point) for point in np.load(track)[:, 0:2]]
+    build = make_params_builder(waypoints, None, objects)
+    row = parse_line("SIM_TRACE_LOG:0,10,5.0,0.5,90.0,0.0,2.0,3,1.0,False,True,40.0,6,31.4,1.0,in_progress,0.0")
+    params = build(row)
+    assert params["objects_distance"] == [o[0] for o in objects]
+    assert len(params["objects_location"]) == len(params["objects_left_of_center"]) == 4
+    # 40% of 31.4m is 12.56m, past the obstacles at 0 and 7.85m, before the one at 15.7m
+    assert params["closest_objects"] == [1, 2]
+    assert make_params_builder(waypoints)(row)["objects_distance"] == []
+
+
+def test_object_avoidance_reward_replays_with_objects(trace, track):
+    assert reads_objects(NOT_CRASHING) and not reads_objects(CENTRE_LINE)
+    *_, rewards, errors = replay(NOT_CRASHING, [trace], track, workers=1)
+    assert errors == 600 and not rewards
+
+    objects = replay_objects("OBJECT_AVOIDANCE", track, VARIABLES)
+    episodes, waypoints, rewards, errors = replay(NOT_CRASHING, [trace], track, workers=1, objects=objects)
+    assert errors == 0 and len(rewards) == 600 and len(episodes) == 3
+
+
+def test_time_trial_replay_of_an_object_avoidance_reward_stops(trace, track, tmp_path, monkeypatch, capsys):
+    run_env = tmp_path / "run.env"
+    run_env.write_text("DR_RACE_TYPE=TIME_TRIAL\nDR_OA_NUMBER_OF_OBSTACLES=4\n")
+    monkeypatch.setattr(sys, "argv", ["replay", NOT_CRASHING, trace, "--track", track, "--run-env", str(run_env),
+                                      "--workers", "1"])
+    with pytest.raises(SystemExit) as stopped:
+        replay_module.main()
+    assert "reads the objects_* params, which are empty in a TIME_TRIAL replay" in str(stopped.value)
+
+    monkeypatch.setattr(sys, "argv", sys.argv + ["--race-type", "OBJECT_AVOIDANCE"])
+    replay_module.main()
+    assert "Scored 600 steps from 3 episodes" in capsys.readouterr().out
@@ -0,0 +1,97 @@
+import os, random
+
+import pytest
+
+from tools.replay import replay
+from tools.reward_batch import build_columns, compile_batch, iter_params
+from tools.rewards import load_reward_module
+from tools.sim_trace import make_params_builder, synthetic_rows, track_objects
+from tools.tracks import oval_waypoints
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NOT_CRASHING = os.path.join(ROOT, "custom-files", "reward-fn-examples", "reward-fn-stay-on-lane-not-crashing.py")
+
+
+def same(expected, actual):
+    if isinstance(expected, (list, tuple)):
+        return len(expected) == len(actual) and all(same(e, a) for e, a in zip(expected, actual))
+    return actual == pytest.approx(expected, abs=1e-9)
+
+
+@pytest.mark.parametrize("race_type", ["TIME_TRIAL", "OBJECT_AVOIDANCE", "HEAD_TO_BOT"])
+def test_columns_match_the_scalar_params(race_type):
+    waypoints = oval_waypoints()
+    widths = [1.07] * len(waypoints)
+    objects = None
+    if race_type != "TIME_TRIAL":
+        objects = track_objects(race_type, waypoints, widths, 5, random.Random(0), 0.3)
+    rows = synthetic_rows(500, waypoints[:-1], seed=1)
+    build = make_params_builder(waypoints, widths, objects)
+
+    rows_params = list(iter_params(build_columns(rows, waypoints, widths, objects)))
+    for row, params in zip(rows, rows_params):
+        expected = build(row)
+        assert sorted(params) == sorted(expected)
+        for key, value in expected.items():
+            assert same(value, params[key]), key
+    # steps between different objects
+    if objects:
+        assert len({tuple(params["closest_objects"]) for params in rows_params}) > 2
+
+
+def test_columns_without_a_track():
+    rows = synthetic_rows(50, seed=2)
+    build = make_params_builder()
+    for row, params in zip(rows, iter_params(build_columns(rows))):
+        assert sorted(params) == sorted(build(row))
+        assert params["closest_objects"] == [0, 0] and params["objects_distance"] == []
+
+
+def test_object_avoidance_reward_in_batches():
+    waypoints = oval_waypoints()
+    widths = [1.07] * len(waypoints)
+    objects = track_objects("OBJECT_AVOIDANCE", waypoints, widths, 6, random.Random(0))
+    rows = synthetic_rows(300, waypoints[:-1], seed=3)
+    batch, _ = compile_batch(load_reward_module(NOT_CRASHING), build_columns(rows, waypoints, widths, objects))
+    rewards = batch(build_columns(rows, waypoints, widths, objects))
+    build = make_params_builder(waypoints, widths, objects)
+    reward_function = load_reward_module(NOT_CRASHING).reward_function
+    assert rewards.tolist() == pytest.approx([reward_function(build(row)) for row in rows])
+
+
+def test_batch_replay_scores_object_avoidance_steps(tmp_path):
+    import numpy as np
+    waypoints = oval_waypoints()
+    track = np.array([[x, y, 0.9 * x, 0.9 * y, 1.1 * x, 1.1 * y] for x, y in waypoints])
+    np.save(str(tmp_path / "oval.npy"), track)
+    trace = tmp_path / "robomaker.log"
+    trace.write_text("".join("SIM_TRACE_LOG:" + ",".join(map(str, row)) + "\n"
+                             for row in synthetic_rows(400, waypoints[:-1], seed=4)))
+    objects = track_objects("OBJECT_AVOIDANCE", waypoints, [1.0] * len(waypoints), 4, random.Random(0))
+
+    scalar = replay(NOT_CRASHING, [str(trace)], str(tmp_path / "oval.npy"), workers=1, objects=objects)
+    batch = replay(NOT_CRASHING, [str(trace)], str(tmp_path / "oval.npy"), workers=1, batch=True, objects=objects)
+    assert batch[3] == scalar[3] == 0
+    assert list(batch[2]) == pytest.approx(list(scalar[2]))
+
+
+def test_main_places_the_objects_of_the_race_type(tmp_path, monkeypatch, capsys):
+    import sys
+    import numpy as np
+    from tools import reward_batch
+    waypoints = oval_waypoints()
+    np.save(str(tmp_path / "oval.npy"), np.array([[x, y, 0.9 * x, 0.9 * y, 1.1 * x, 1.1 * y] for x, y in waypoints]))
+    (tmp_path / "run.env").write_text("DR_RACE_TYPE=TIME_TRIAL\n")
+    argv = ["reward_batch", NOT_CRASHING, "--track", str(tmp_path / "oval.npy"), "--steps", "3000",
+            "--run-env", str(tmp_path / "run.env")]
+    monkeypatch.setattr(sys, "argv", argv)
+    with pytest.raises(SystemExit) as stopped:
+        reward_batch.main()
+    assert "reads the objects_* params, which are empty in a TIME_TRIAL run" in str(stopped.value)
+
+    (tmp_path / "run.env").write_text("DR_RACE_TYPE=OBJECT_AVOIDANCE\nDR_OA_NUMBER_OF_OBSTACLES=3\n")
+    reward_batch.main()
+    assert ", 0 steps raised," in capsys.readouterr().out.splitlines()[-1]
+    monkeypatch.setattr(sys, "argv", argv + ["--race-type", "HEAD_TO_BOT"])
+    reward_batch.main()
+    assert ", 0 steps raised," in capsys.readouterr().out.splitlines()[-1]
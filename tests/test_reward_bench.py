@@ -0,0 +1,26 @@
+import math
+
+from tools.reward_bench import params_stream, run_variables
+
+VARIABLES = {"DR_OA_NUMBER_OF_OBSTACLES": "4", "DR_H2B_NUMBER_OF_BOT_CARS": "2", "DR_H2B_BOT_CAR_SPEED": "0.5"}
+
+
+def test_objects_come_from_the_run_env_variables():
+    assert all(params["objects_distance"] == [] for params in params_stream("TIME_TRIAL", 20, variables=VARIABLES))
+    obstacles = params_stream("OBJECT_AVOIDANCE", 20, variables=VARIABLES)
+    assert {tuple(params["objects_distance"]) for params in obstacles} == {tuple(obstacles[0]["objects_distance"])}
+    assert len(obstacles[0]["objects_distance"]) == 4 and obstacles[0]["objects_speed"] == [0.0] * 4
+
+    bots = params_stream("HEAD_TO_BOT", 20, variables=VARIABLES)
+    assert all(len(params["objects_distance"]) == 2 and params["objects_speed"] == [0.5, 0.5] for params in bots)
+    assert len({tuple(params["objects_distance"]) for params in bots}) > 1
+    # the defaults of a missing run.env
+    assert len(params_stream("HEAD_TO_BOT", 1)[0]["objects_speed"]) == 3
+
+
+def test_run_variables(tmp_path):
+    assert run_variables(str(tmp_path / "run.env")) == {}
+    (tmp_path / "run.env").write_text("DR_RACE_TYPE=HEAD_TO_BOT\nDR_H2B_BOT_CAR_SPEED=0.4\n")
+    assert run_variables(str(tmp_path / "run.env"))["DR_H2B_BOT_CAR_SPEED"] == "0.4"
+    assert math.isclose(params_stream("HEAD_TO_BOT", 1, variables=run_variables(str(tmp_path / "run.env")))[0]
+                        ["objects_speed"][0], 0.4)
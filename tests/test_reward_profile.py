@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+from tools.reward_profile import EXTRA, REWARD, WAYPOINT, instrument
+from tools.rewards import load_reward_module
+from tools.sim_trace import make_params_builder, synthetic_rows
+from tools.tracks import oval_waypoints
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+REWARD_FILE = '''import math
+
+
+def reward_function(params):
+    if not params["all_wheels_on_track"]:
+        return 1e-3
+    reward = 1.0
+    if params["speed"] > 2.0:
+        reward += 0.5 * params["speed"]
+    reward *= 1.0 - params["distance_from_center"] / params["track_width"]
+    if abs(params["steering_angle"]) > 15:
+        reward *= 0.7
+    return float(reward)
+'''
+
+
+@pytest.fixture
+def reward_function(tmp_path):
+    path = tmp_path / "reward_function.py"
+    path.write_text(REWARD_FILE)
+    return load_reward_module(str(path)).reward_function
+
+
+def params_stream(steps):
+    waypoints = oval_waypoints()
+    build = make_params_builder(waypoints, [1.07] * len(waypoints))
+    stream = [build(row) for row in synthetic_rows(steps, waypoints[:-1], seed=5)]
+    # some steps off the track for the early return
+    for params in stream[::7]:
+        params["all_wheels_on_track"] = False
+    return stream
+
+
+def test_terms_add_up_to_the_returned_reward(reward_function):
+    instrumented, profile = instrument(reward_function, flush_steps=10000)
+    assert profile.terms == ["L6 return 1e-3", "L7 reward = 1.0", "L9 reward += 0.5 * params[\"speed\"]",
+                             "L10 reward *= 1.0 - params[\"distance_from_center\"] / params[\"track_width\"]",
+                             "L12 reward *= 0.7", "L13 return float(reward)"]
+    stream = params_stream(500)
+    returned = [instrumented(params) for params in stream]
+    assert returned == [reward_function(params) for params in stream]
+    rows = profile.rows()
+    assert rows[:, EXTRA:].sum(axis=1).tolist() == pytest.approx(returned)
+    assert rows[:, REWARD].tolist() == pytest.approx(returned)
+    # every term but the final return (which does not change the reward) fired on some step, the
+    # multiplicative ones take reward away
+    assert (rows[:, EXTRA:] != 0).any(axis=0).tolist() == [True] * 5 + [False]
+    assert (rows[:, EXTRA + 4] <= 0).all() and (rows[:, EXTRA + 4] < 0).any()
+
+
+def test_terms_are_named_after_the_lines_of_the_reward_file():
+    reward_function = load_reward_module(os.path.join(ROOT, "custom-files", "reward_function.py")).reward_function
+    _, profile = instrument(reward_function)
+    with open(os.path.join(ROOT, "custom-files", "reward_function.py"), "r") as f:
+        lines = f.read().splitlines()
+    for term in profile.terms:
+        number, text = term.split(" ", 1)
+        assert lines[int(number[1:]) - 1].strip() == text
+
+
+def test_flush_folds_the_rows_into_the_aggregates(reward_function):
+    stream = params_stream(120)
+    # the rows of every step, in a ring large enough to hold them all
+    reference, reference_profile = instrument(reward_function, capacity=1000, flush_steps=1000)
+    returned = [reference(params) for params in stream]
+    rows = reference_profile.rows()
+
+    flushes = []
+    instrumented, profile = instrument(reward_function, capacity=64, flush_steps=50,
+                                       on_flush=lambda profile: flushes.append(profile.steps))
+    for params in stream:
+        instrumented(params)
+    assert flushes == [50, 100] and profile.pending == 20
+    profile.flush()
+    assert flushes == [50, 100, 120] and profile.pending == 0
+    assert profile.moments["n"] == 120 and profile.moments["reward"] == pytest.approx(sum(returned))
+    assert profile.totals["sum"] == pytest.approx(rows[:, EXTRA:].sum(axis=0).tolist())
+    assert profile.totals["fires"] == (rows[:, EXTRA:] != 0).sum(axis=0).tolist()
+
+    summary = {term["term"]: term for term in profile.summary()}
+    assert sum(term["share"] for term in summary.values()) == pytest.approx(100.0)
+    off_track = sum(not params["all_wheels_on_track"] for params in stream)
+    assert summary["L6 return 1e-3"]["fires"] == pytest.approx(100.0 * off_track / 120)
+    assert summary["L6 return 1e-3"]["mean"] == pytest.approx(1e-3 * off_track / 120)
+
+    means = profile.waypoint_means()
+    waypoints = rows[:, WAYPOINT].astype(int)
+    assert sorted(means) == sorted(set(waypoints.tolist()))
+    for waypoint, values in means.items():
+        assert values == pytest.approx(rows[waypoints == waypoint, EXTRA:].mean(axis=0).tolist())
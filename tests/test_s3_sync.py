@@ -0,0 +1,137 @@
+import json, os, random
+
+import pytest
+
+from tools.s3_sync import S3Sync
+
+BUCKET = "s3-sync-test"
+PART = 64 * 1024
+
+
+@pytest.fixture
+def client(s3_client):
+    s3_client.create_bucket(Bucket=BUCKET)
+    return s3_client
+
+
+@pytest.fixture
+def gets(client):
+    """(key, Range or None) of every GetObject call."""
+    calls = []
+    client.meta.events.register("provide-client-params.s3.GetObject",
+                                lambda params, **kwargs: calls.append((params["Key"], params.get("Range"))))
+    return calls
+
+
+def put(client, key, body):
+    client.put_object(Bucket=BUCKET, Key="my-model/" + key, Body=body)
+
+
+def syncer(client, tmp_path):
+    return S3Sync(BUCKET, "/my-model/", str(tmp_path / "cache"), client, workers=4, part_size=PART,
+                  range_threshold=2 * PART)
+
+
+def test_unchanged_etags_are_not_downloaded_again(client, gets, tmp_path):
+    put(client, "metrics/TrainingMetrics.json", b'{"metrics": []}')
+    put(client, "model/deepracer_checkpoints.json", b'{"last_checkpoint": {"name": "1_Step-1.ckpt"}}')
+    put(client, "model/model_metadata.json", b'{"action_space": []}')
+    put(client, "ip/done", b"")
+
+    paths, downloaded = syncer(client, tmp_path).sync(["metrics/*", "model/*.json"])
+    assert downloaded == ["metrics/TrainingMetrics.json", "model/deepracer_checkpoints.json",
+                          "model/model_metadata.json"]
+    assert sorted(paths) == downloaded
+    with open(paths["model/model_metadata.json"], "rb") as f:
+        assert f.read() == b'{"action_space": []}'
+
+    # a new instance reads the index and the cached bodies of the last one
+    put(client, "metrics/TrainingMetrics.json", b'{"metrics": [{"episode": 1}]}')
+    put(client, "model/model_metadata.json", b'{"action_space": []}')
+    del gets[:]
+    paths, downloaded = syncer(client, tmp_path).sync(["metrics/*", "model/*.json"])
+    assert downloaded == ["metrics/TrainingMetrics.json"]
+    assert gets == [("my-model/metrics/TrainingMetrics.json", None)]
+    with open(paths["metrics/TrainingMetrics.json"], "r") as f:
+        assert json.load(f) == {"metrics": [{"episode": 1}]}
+
+    del gets[:]
+    assert syncer(client, tmp_path).sync(["metrics/*", "model/*.json"])[1] == [] and gets == []
+
+
+def test_identical_bodies_are_fetched_once(client, gets, tmp_path):
+    put(client, "model/model_1.pb", b"weights")
+    put(client, "model/model_2.pb", b"weights")
+
+    paths, downloaded = syncer(client, tmp_path).sync()
+    assert downloaded == ["model/model_1.pb", "model/model_2.pb"] and len(gets) == 1
+    assert os.path.samefile(paths["model/model_1.pb"], paths["model/model_2.pb"])
+
+
+def test_large_objects_are_fetched_in_ranges(client, gets, tmp_path):
+    body = random.Random(0).randbytes(5 * PART + 123)
+    put(client, "model/1_Step-100.ckpt.data-00000-of-00001", body)
+    put(client, "model/small.json", b"{}")
+
+    paths, _ = syncer(client, tmp_path).sync()
+    ranges = sorted(byte_range for key, byte_range in gets if key.endswith(".data-00000-of-00001"))
+    assert ranges == sorted("bytes={}-{}".format(start, min(start + PART, len(body)) - 1)
+                            for start in range(0, len(body), PART))
+    assert ("my-model/model/small.json", None) in gets
+    with open(paths["model/1_Step-100.ckpt.data-00000-of-00001"], "rb") as f:
+        assert f.read() == body
+    assert not [name for name in os.listdir(os.path.join(tmp_path, "cache", BUCKET, "my-model", "objects"))
+                if name.endswith(".part")]
+
+
+def test_deleted_objects_are_pruned(client, tmp_path):
+    put(client, "model/model_1.pb", b"first")
+    put(client, "model/model_2.pb", b"second")
+    paths, _ = syncer(client, tmp_path).sync()
+
+    client.delete_object(Bucket=BUCKET, Key="my-model/model/model_1.pb")
+    sync = syncer(client, tmp_path)
+    assert list(sync.sync()[0]) == ["model/model_2.pb"]
+    assert not os.path.exists(paths["model/model_1.pb"]) and list(sync.index) == ["model/model_2.pb"]
+    assert len(os.listdir(os.path.join(sync.cache_dir, "objects"))) == 1
+
+
+def test_an_object_overwritten_during_the_download_starts_again(client, gets, tmp_path):
+    key = "model/1_Step-100.ckpt.data-00000-of-00001"
+    first, second = random.Random(1).randbytes(5 * PART), random.Random(2).randbytes(4 * PART + 7)
+    put(client, key, first)
+    put(client, "model/model_1.pb", b"weights")
+    conditions = []
+
+    def overwrite(params, **kwargs):
+        conditions.append((params["Key"], params["IfMatch"]))
+        # the training writes a new version after the first part was requested
+        if len(conditions) == 1 and params["Key"].endswith(key):
+            put(client, key, second)
+        if params["Key"].endswith("model_1.pb"):
+            client.delete_object(Bucket=BUCKET, Key=params["Key"])
+
+    client.meta.events.register("provide-client-params.s3.GetObject", overwrite)
+    sync = syncer(client, tmp_path)
+    paths, downloaded = sync.sync()
+    assert downloaded == [key]
+    assert list(paths) == [key]
+    with open(paths[key], "rb") as f:
+        assert f.read() == second
+    etag = client.head_object(Bucket=BUCKET, Key="my-model/" + key)["ETag"]
+    assert sync.index[key]["etag"] == etag
+    # every part of the second download asked for the new version
+    restarted = [condition for _, condition in conditions if condition == etag]
+    assert len(restarted) == 5
+    assert len({condition for name, condition in conditions if name.endswith(key)}) == 2
+    assert not [name for name in os.listdir(os.path.join(sync.cache_dir, "objects")) if name.endswith(".part")]
+
+
+def test_an_object_that_keeps_changing_fails_the_sync(client, tmp_path):
+    key = "model/deepracer_checkpoints.json"
+    put(client, key, b"0")
+    versions = iter(range(1, 100))
+    client.meta.events.register("provide-client-params.s3.GetObject",
+                                lambda params, **kwargs: put(client, key, str(next(versions)).encode()))
+    with pytest.raises(IOError, match="model/deepracer_checkpoints.json kept changing while downloading"):
+        syncer(client, tmp_path).sync()
@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from tools.surrogate import CAR_HALF_WIDTH, MAX_SPEED, REVERSE_PROGRESS, STATUSES, Surrogate
+from tools.tracks import oval_waypoints
+
+WAYPOINTS = oval_waypoints(150, 5.0, 3.0)
+WIDTH = 1.0
+
+
+@pytest.fixture
+def surrogate():
+    return Surrogate(WAYPOINTS, [WIDTH] * len(WAYPOINTS), [-15.0, 0.0, 15.0] * 2, [1.0] * 3 + [2.0] * 3)
+
+
+def brute_force(points, x, y):
+    """Nearest segment and distance of every point, checking all segments."""
+    a = np.asarray(points, dtype=float)
+    d = np.roll(a, -1, axis=0) - a
+    t = np.clip(((x[:, None] - a[:, 0]) * d[:, 0] + (y[:, None] - a[:, 1]) * d[:, 1]) / (d ** 2).sum(axis=1), 0, 1)
+    distances = np.hypot(x[:, None] - a[:, 0] - t * d[:, 0], y[:, None] - a[:, 1] - t * d[:, 1])
+    return distances.argmin(axis=1), distances.min(axis=1)
+
+
+def test_locate_matches_the_nearest_of_all_segments(surrogate):
+    rng = np.random.default_rng(5)
+    state = surrogate.start(rng.uniform(0, 1, 5000))
+    # a step away from the previous position, in any direction, on and off the track
+    reach = MAX_SPEED * surrogate.dt
+    angle = rng.uniform(-np.pi, np.pi, 5000)
+    radius = rng.uniform(0, reach, 5000)
+    lateral = rng.uniform(-WIDTH, WIDTH, 5000)
+    x = state["x"] + radius * np.cos(angle) - lateral * np.sin(state["heading"])
+    y = state["y"] + radius * np.sin(angle) + lateral * np.cos(state["heading"])
+
+    segment, distance, left, position = surrogate.locate(x, y, state["segment"])
+    nearest, expected = brute_force(WAYPOINTS[:-1], x, y)
+    assert distance == pytest.approx(expected, abs=1e-9)
+    # ties are the shared waypoint of two segments
+    assert np.isin((segment - nearest) % surrogate.n, [0, 1, surrogate.n - 1]).all()
+    # the oval runs counter clockwise, the inside is on the left
+    inside = (x / 5.0) ** 2 + (y / 3.0) ** 2 < 1
+    # the centre line cuts the ellipse by less than a centimetre
+    clear = distance > 0.01
+    assert (left[clear] == inside[clear]).all()
+    assert ((position >= 0) & (position <= surrogate.track_length)).all()
+
+
+def state(surrogate, count, **values):
+    """A state of count cars half way round, on the centre line, overridden by values."""
+    result = surrogate.start(np.full(count, 0.5))
+    result["travelled"] = np.full(count, 0.5 * surrogate.track_length)
+    result["best"] = np.full(count, 50.0)
+    result.update({key: np.asarray(value) for key, value in values.items()})
+    return result
+
+
+def test_outcome_ends_the_episodes_like_the_simulator(surrogate):
+    length = surrogate.track_length
+    limit = WIDTH / 2 + CAR_HALF_WIDTH
+    cars = state(surrogate, 7,
+                 distance=[0.0, limit - 0.01, limit + 0.01, 0.0, 0.0, 0.0, limit + 0.01],
+                 travelled=[0.5 * length] * 3 + [(0.5 - (REVERSE_PROGRESS - 0.1) / 100) * length,
+                                                 (0.5 - (REVERSE_PROGRESS + 0.1) / 100) * length,
+                                                 1.001 * length, 1.001 * length],
+                 steps=[0, 0, 0, 0, 0, 0, surrogate.max_steps])
+    assert [STATUSES[s] if s >= 0 else "running" for s in surrogate.outcome(cars)] == [
+        "running", "running", "off_track", "running", "reversed", "lap_complete", "lap_complete"]
+
+    # off track wins over reversed, which wins over the time limit
+    cars = state(surrogate, 3, distance=[limit + 0.01, 0.0, 0.0],
+                 travelled=[0.4 * length, 0.4 * length, 0.5 * length],
+                 steps=[surrogate.max_steps] * 3)
+    assert [STATUSES[s] for s in surrogate.outcome(cars)] == ["off_track", "reversed", "timeout"]
+    cars = state(surrogate, 1, steps=[surrogate.max_steps - 1])
+    assert surrogate.outcome(cars).tolist() == [-1]
+
+
+def test_a_car_driving_along_the_centre_line_completes_the_lap(surrogate):
+    cars, rng, statuses = surrogate.start(np.zeros(1)), np.random.default_rng(0), []
+    while not statuses or statuses[-1] < 0:
+        choice = surrogate.pursuit(cars, rng, epsilon=0.0)
+        cars = surrogate.move(cars, surrogate.steering[choice], surrogate.speed[choice])
+        statuses.append(int(surrogate.outcome(cars)[0]))
+    assert STATUSES[statuses[-1]] == "lap_complete"
+    assert set(statuses[:-1]) == {-1}
@@ -0,0 +1,119 @@
+import json, os, sys, time
+
+import pytest
+
+from tools import sweep
+from tools.config_session import ConfigSession
+from tools.hyperband import StackLauncher
+from tools.sweep import plan, run_sweep
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUB = os.path.join(ROOT, "tests", "fixtures", "sweep", "stub-create.sh")
+
+
+def spec(**values):
+    return dict({"name": "lr-sweep", "base_stack": "base", "instance": "spot", "time_to_live": 90,
+                 "custom_files": os.path.join(ROOT, "custom-files"),
+                 "grid": {"lr": [0.0003, 0.0001], "instance_type": ["g4dn.2xlarge"]},
+                 "set": {"DR_WORLD_NAME": "reInvent2019_wide", "batch_size": 128}}, **values)
+
+
+def read_env(directory, variable):
+    with ConfigSession() as config:
+        return config.get(os.path.join(directory, "run.env"), variable)
+
+
+def test_plan():
+    assert plan(spec()) == [
+        ("lr-sweep-01", {"DR_WORLD_NAME": "reInvent2019_wide", "batch_size": 128, "instance_type": "g4dn.2xlarge",
+                         "lr": 0.0003}),
+        ("lr-sweep-02", {"DR_WORLD_NAME": "reInvent2019_wide", "batch_size": 128, "instance_type": "g4dn.2xlarge",
+                         "lr": 0.0001})]
+    with pytest.raises(ValueError):
+        plan(spec(name="lr_sweep"))
+
+
+def test_launch_runs_the_create_script_on_the_custom_files_of_each_model(tmp_path):
+    results = run_sweep(spec(), parallel=2, create_script=STUB, sweeps_dir=str(tmp_path))
+    assert {model: code for model, (_, _, code) in results.items()} == {"lr-sweep-01": 0, "lr-sweep-02": 0}
+    assert results["lr-sweep-01"][1] == [STUB, "base", "lr-sweep-01", "90"]
+
+    root = tmp_path / "lr-sweep"
+    for model, lr in (("lr-sweep-01", 0.0003), ("lr-sweep-02", 0.0001)):
+        directory = root / model
+        with open(directory / "hyperparameters.json", "r") as f:
+            assert json.load(f)["lr"] == lr
+        assert read_env(directory, "DR_LOCAL_S3_MODEL_PREFIX") == "training/$DR_WORLD_NAME/" + model
+        assert read_env(directory, "DR_WORLD_NAME") == "reInvent2019_wide"
+
+        log = (root / (model + ".launch.log")).read_text()
+        assert "stack: {}\n".format(model) in log and "time to live: 90\n" in log
+        assert "instance type: g4dn.2xlarge\n" in log and "validation: ok\n" in log
+        assert "would upload {}:\n".format(directory) in log and "./hyperparameters.json\n" in log
+        # the log is written while the script uploads the directory, it is not part of it
+        assert "launch.log" not in log and not [name for name in os.listdir(directory) if name.endswith(".log")]
+
+    with open(root / "sweep.json", "r") as f:
+        assert json.load(f)["models"]["lr-sweep-02"]["exit_code"] == 0
+
+
+def test_failed_launch(tmp_path, monkeypatch, capsys):
+    spec_file = tmp_path / "sweep.json"
+    spec_file.write_text(json.dumps(spec(grid={"lr": [0.0003]})))
+    monkeypatch.setenv("STUB_CREATE_EXIT", "3")
+    monkeypatch.setattr(sys, "argv", ["sweep", str(spec_file), "--create-script", STUB,
+                                      "--sweeps-dir", str(tmp_path / "sweeps")])
+    with pytest.raises(SystemExit):
+        sweep.main()
+    assert "lr-sweep-01                    FAILED (3)" in capsys.readouterr().out
+
+
+def test_custom_files_failing_validation_are_not_launched(tmp_path, monkeypatch):
+    reward_file = tmp_path / "broken_reward.py"
+    reward_file.write_text("def reward_function(params)\n    return 1.0\n")
+    results = run_sweep(spec(grid={"lr": [0.0003]}, set={"reward_file": str(reward_file)}), create_script=STUB,
+                        sweeps_dir=str(tmp_path / "sweeps"))
+    assert results["lr-sweep-01"][2] == 1
+    log = (tmp_path / "sweeps" / "lr-sweep" / "lr-sweep-01.launch.log").read_text()
+    assert "validation: errors\nvalidation answer: n\n" in log and "would upload" not in log
+
+    # a trial of the search frees its slot at the next poll instead of after the startup time
+    launcher = StackLauncher(spec(name="hb"), str(tmp_path), bucket="hb-bucket", create_script=STUB, client=object())
+    launcher.launch("hb-01", {"lr": 0.0002, "reward_file": str(reward_file)})
+    deadline = time.time() + 30
+    while launcher.error("hb-01") is None and time.time() < deadline:
+        time.sleep(0.05)
+    assert launcher.error("hb-01").startswith("create script exited with 1")
+
+
+def test_dry_run_does_not_launch(tmp_path):
+    results = run_sweep(spec(), dry_run=True, create_script=STUB, sweeps_dir=str(tmp_path))
+    assert [code for _, _, code in results.values()] == [None, None]
+    assert sorted(os.listdir(tmp_path / "lr-sweep")) == ["lr-sweep-01", "lr-sweep-02", "sweep.json"]
+
+
+def test_stack_launcher_reports_a_failed_create_script(tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_CREATE_EXIT", "1")
+    launcher = StackLauncher(spec(name="hb"), str(tmp_path), bucket="hb-bucket", create_script=STUB, client=object())
+    launcher.launch("hb-01", {"lr": 0.0002})
+    deadline = time.time() + 30
+    while launcher.error("hb-01") is None and time.time() < deadline:
+        time.sleep(0.05)
+    assert launcher.error("hb-01") == "create script exited with 1, see {}".format(tmp_path / "hb" / "hb-01.launch.log")
+    assert "stack: hb-01\n" in (tmp_path / "hb" / "hb-01.launch.log").read_text()
+
+
+def test_stack_launcher_reads_the_metrics_under_the_expanded_model_prefix(tmp_path):
+    import boto3
+    from moto import mock_aws
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="hb-bucket")
+        metrics = [{"phase": "training", "metric_time": 1, "completion_percentage": 40}]
+        client.put_object(Bucket="hb-bucket", Key="training/reInvent2019_wide/hb-01/metrics/TrainingMetrics.json",
+                          Body=json.dumps({"metrics": metrics}))
+        launcher = StackLauncher(spec(name="hb"), str(tmp_path), bucket="hb-bucket", client=client)
+        sweep.materialize(launcher.spec, "hb-01", {"DR_WORLD_NAME": "reInvent2019_wide", "lr": 0.0002},
+                          launcher.directory("hb-01"))
+        assert launcher.metrics("hb-01") == metrics
+        assert launcher.metrics("hb-02") == []
@@ -0,0 +1,108 @@
+import json
+
+import pytest
+
+from tools import trace_store
+from tools.trace_store import TraceStore, last_line_end
+
+
+def trace_line(episode, step, status="in_progress"):
+    return ("SIM_TRACE_LOG:{},{},1.0,2.0,90.0,0.0,2.0,3,1.5,False,True,{:.1f},{},17.7,{:.3f},{},0.0\n"
+            .format(episode, step, step, step % 100, episode * 100 + step / 15, status))
+
+
+def write_log(path, episodes, steps):
+    with open(path, "w") as f:
+        for episode in range(episodes):
+            for step in range(1, steps + 1):
+                f.write(trace_line(episode, step, "lap_complete" if step == steps else "in_progress"))
+
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(trace_store, "SEGMENT_ROWS", 100)
+    monkeypatch.setattr(trace_store, "CHUNK_BYTES", 2000)
+
+
+def test_last_line_end_reads_backwards_in_blocks(tmp_path):
+    path = tmp_path / "a.log"
+    path.write_bytes(b"one\ntwo\nthree")
+    assert last_line_end(str(path), 0, 13, block=2) == 8
+    assert last_line_end(str(path), 8, 13, block=2) == 8
+
+
+def test_one_file_is_split_into_segments_and_episodes_span_them(tmp_path, small_segments):
+    log = tmp_path / "robomaker1.log"
+    write_log(log, episodes=4, steps=75)
+    store = TraceStore(str(tmp_path / "store"))
+    assert store.ingest([str(log)], episodes_per_iteration=2) == 300
+    assert len(store.manifest["segments"]) > 1
+    episode = store.episode(0, 1)
+    assert list(episode["steps"]) == list(range(1, 76))
+    assert list(store.summary["steps"]) == [75] * 4
+    assert list(store.summary["iteration"]) == [0, 0, 1, 1]
+    assert list(store.completion_rate()[2]) == [1.0, 1.0]
+
+
+def test_manifest_is_saved_with_every_segment(tmp_path, small_segments, monkeypatch):
+    log = tmp_path / "robomaker1.log"
+    write_log(log, episodes=4, steps=75)
+    store = TraceStore(str(tmp_path / "store"))
+    write_segment = store._write_segment
+
+    def interrupted(columns):
+        if len(store.manifest["segments"]) == 1:
+            raise KeyboardInterrupt
+        return write_segment(columns)
+
+    monkeypatch.setattr(store, "_write_segment", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        store.ingest([str(log)], episodes_per_iteration=2)
+    with open(tmp_path / "store" / "manifest.json") as f:
+        saved = json.load(f)
+    assert len(saved["segments"]) == 1
+    assert 0 < saved["sources"][str(log)] < log.stat().st_size
+
+    resumed = TraceStore(str(tmp_path / "store"))
+    resumed.ingest([str(log)], episodes_per_iteration=2)
+    assert resumed.summary["steps"].sum() == 300
+
+
+def test_growing_log_only_adds_complete_new_lines(tmp_path):
+    log = tmp_path / "robomaker1.log"
+    write_log(log, episodes=1, steps=10)
+    with open(log, "a") as f:
+        f.write(trace_line(1, 1)[:20])
+    store = TraceStore(str(tmp_path / "store"))
+    assert store.ingest([str(log)]) == 10
+    with open(log, "a") as f:
+        f.write(trace_line(1, 1)[20:] + trace_line(1, 2))
+    assert TraceStore(str(tmp_path / "store")).ingest([str(log)]) == 2
+
+
+def test_log_and_simtrace_steps_of_a_worker_are_not_counted_twice(tmp_path, monkeypatch):
+    write_log(tmp_path / "robomaker1.log", 3, 40)
+    simtrace = tmp_path / "training-simtrace"
+    simtrace.mkdir()
+    with open(tmp_path / "robomaker1.log", "r") as log, open(simtrace / "0-iteration.csv", "w") as csv:
+        csv.write("episode,steps,X,Y,yaw,steer,throttle,action,reward,done,all_wheels_on_track,progress,"
+                  "closest_waypoint,track_len,tstamp,episode_status,pause_duration\n")
+        csv.writelines(line[len("SIM_TRACE_LOG:"):] for line in log)
+
+    store = TraceStore(str(tmp_path / "store"))
+    store.ingest([str(tmp_path / "robomaker1.log")], episodes_per_iteration=20)
+    with pytest.raises(ValueError):
+        store.ingest([str(simtrace)], episodes_per_iteration=20)
+    assert len(store.summary) == 3 and list(store.summary["steps"]) == [40, 40, 40]
+
+    # a restarted ingest reads the kinds from the manifest, the csv files of another worker are fine
+    store = TraceStore(str(tmp_path / "store"))
+    with pytest.raises(ValueError):
+        store.ingest([str(simtrace)], episodes_per_iteration=20)
+    assert store.ingest([str(simtrace)], episodes_per_iteration=20, worker=1) == 120
+    assert len(store.summary) == 6
+
+    monkeypatch.setattr("sys.argv", ["trace_store", "ingest", str(tmp_path / "store"), str(simtrace)])
+    with pytest.raises(SystemExit) as stopped:
+        trace_store.main()
+    assert "would count its episodes twice" in str(stopped.value)
@@ -0,0 +1,29 @@
+from tools import track_geometry
+from tools.track_geometry import fingerprint, get_geometry
+from tools.track_index import get_index
+from tools.tracks import oval_waypoints
+
+
+def test_tracks_differing_between_sampled_waypoints_have_their_own_geometry():
+    waypoints = oval_waypoints()
+    moved = list(waypoints)
+    # same length, first, second, middle and last waypoints
+    moved[15] = (moved[15][0] + 0.5, moved[15][1])
+    assert fingerprint(moved) != fingerprint(waypoints)
+
+    assert get_geometry(waypoints) is not get_geometry(moved)
+    assert get_geometry(moved).fingerprint == fingerprint(moved)
+    assert get_index(waypoints) is not get_index(moved)
+    # a copy of the same track is the same entry
+    assert get_geometry(list(waypoints)) is get_geometry(waypoints)
+
+
+def test_a_new_list_of_the_same_track_is_not_hashed_again(monkeypatch):
+    waypoints = oval_waypoints(count=90)
+    geometry = get_geometry(waypoints)
+    hashed = []
+    monkeypatch.setattr(track_geometry, "fingerprint", lambda waypoints: hashed.append(1) or fingerprint(waypoints))
+    for _ in range(100):
+        assert get_geometry([tuple(point) for point in waypoints]) is geometry
+    assert hashed == []
+    assert get_geometry(oval_waypoints(count=90, half_width=2.0)) is not geometry and hashed
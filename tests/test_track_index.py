@@ -0,0 +1,57 @@
+import math
+
+import numpy as np
+import pytest
+
+from tools.track_index import TrackIndex
+
+WAVY = [((3 + 1.2 * math.sin(5 * a)) * math.cos(a), (3 + 1.2 * math.sin(5 * a)) * math.sin(a))
+        for a in np.linspace(0, 2 * math.pi, 200, endpoint=False)]
+
+
+def brute_force(waypoints, xs, ys):
+    """Distances from every point to every segment, (nearest segment, distance, margin to the runner-up)."""
+    points = np.asarray(waypoints, dtype=float)
+    a, b = points, np.roll(points, -1, axis=0)
+    d = b - a
+    length2 = (d ** 2).sum(axis=1)
+    t = np.clip(((xs[:, None] - a[:, 0]) * d[:, 0] + (ys[:, None] - a[:, 1]) * d[:, 1]) / length2, 0, 1)
+    distances = np.hypot(xs[:, None] - a[:, 0] - t * d[:, 0], ys[:, None] - a[:, 1] - t * d[:, 1])
+    nearest = distances.argmin(axis=1)
+    ordered = np.sort(distances, axis=1)
+    return nearest, ordered[:, 0], ordered[:, 1] - ordered[:, 0]
+
+
+@pytest.mark.parametrize("cell_size", [None, 0.1, 1.5])
+def test_query_many_finds_the_nearest_segment(cell_size):
+    index = TrackIndex(WAVY, cell_size)
+    rng = np.random.default_rng(7)
+    # around the track, far inside the loop and outside of the grid
+    xs = np.concatenate([rng.uniform(-7, 7, 20000), [p[0] for p in WAVY], [0.0, 30.0]])
+    ys = np.concatenate([rng.uniform(-7, 7, 20000), [p[1] for p in WAVY], [0.0, -30.0]])
+    segment, distance, offset, progress = index.query_many(xs, ys, chunk=1000)
+    nearest, expected, margin = brute_force(WAVY, xs, ys)
+
+    assert distance == pytest.approx(expected, abs=1e-9)
+    unique = margin > 1e-9
+    assert (segment[unique] == nearest[unique]).all()
+    assert np.abs(offset) == pytest.approx(distance)
+
+    for i in rng.choice(len(xs), 300):
+        one = index.query(xs[i], ys[i])
+        assert one[1] == pytest.approx(distance[i], abs=1e-9)
+        if unique[i]:
+            assert one[0] == segment[i]
+            assert one[2] == pytest.approx(offset[i], abs=1e-9)
+            assert one[3] == pytest.approx(progress[i], abs=1e-9)
+
+
+def test_offset_and_progress_of_known_positions():
+    square = [(0.0, 0.0), (4.0, 0.0), (4.0, 4.0), (0.0, 4.0)]
+    index = TrackIndex(square)
+    segment, distance, offset, progress = index.query_many([1.0, 3.0, 5.0], [0.5, -0.25, 2.0])
+    assert segment.tolist() == [0, 0, 1]
+    assert distance.tolist() == pytest.approx([0.5, 0.25, 1.0])
+    # counter clockwise, the inside of the square is on the left
+    assert offset.tolist() == pytest.approx([0.5, -0.25, -1.0])
+    assert progress.tolist() == pytest.approx([100 * 1 / 16, 100 * 3 / 16, 100 * 6 / 16])
@@ -0,0 +1,82 @@
+import json, math
+
+import numpy as np
+import pytest
+
+from tools.track_sweep import MAX_GAP, flag, sweep
+from tools.tracks import oval_waypoints
+
+NARROW = range(10, 16)
+
+
+def result(**values):
+    result = {"reward_file": "reward.py", "track": "oval.npy", "direction": "forward", "completion": 80.0,
+              "pursuit_completion": 90.0, "raised": 0, "off_track_kinds": {}, "hot_spots": []}
+    result.update(values)
+    return result
+
+
+def test_flag_reasons():
+    assert flag(result(), 80.0) == []
+    assert flag(result(error="KeyError: 'x'"), 80.0) == ["cannot run: KeyError: 'x'"]
+    assert flag(result(completion=10.0, pursuit_completion=15.0), 0.0) == [
+        "the action space does not lap it either (15% following the centre line)"]
+    assert flag(result(raised=3), 80.0) == ["raises on 3 steps"]
+    assert flag(result(completion=90.0 - MAX_GAP - 1), 80.0) == ["69% laps vs 90% following the centre line"]
+    assert flag(result(completion=35.0, pursuit_completion=40.0), 80.0) == ["under 50% of its best track (80%)"]
+    # the best track does not complete laps either, nothing to compare with
+    assert flag(result(completion=5.0, pursuit_completion=20.0), 15.0) == []
+
+    reasons = flag(result(completion=30.0, off_track_kinds={"left": 3, "straight": 1}, hot_spots=[12, 40]), 80.0)
+    assert reasons == ["30% laps vs 90% following the centre line", "under 50% of its best track (80%)",
+                       "off track in left (75% of 4), most at waypoints 12, 40"]
+    # the breakdown only comes with a flag
+    assert flag(result(off_track_kinds={"left": 3}, hot_spots=[12]), 80.0) == []
+
+
+def save_track(path, narrow=()):
+    """Oval track of 120 waypoints, 1m wide except at the narrow waypoints."""
+    rows = []
+    for i, (x, y) in enumerate(oval_waypoints(120, 5.0, 3.0)):
+        width = 0.12 if i in narrow else 1.0
+        normal_x, normal_y = x / 25.0, y / 9.0
+        length = math.hypot(normal_x, normal_y)
+        dx, dy = normal_x / length * width / 2, normal_y / length * width / 2
+        rows.append([x, y, x - dx, y - dy, x + dx, y + dy])
+    np.save(str(path), np.array(rows))
+    return str(path)
+
+
+@pytest.fixture
+def files(tmp_path):
+    reward = tmp_path / "reward.py"
+    reward.write_text("def reward_function(params):\n    return 1.0 if params['all_wheels_on_track'] else 1e-3\n")
+    broken = tmp_path / "broken.py"
+    broken.write_text("import no_such_module\n\ndef reward_function(params):\n    return 1.0\n")
+    metadata = tmp_path / "model_metadata.json"
+    metadata.write_text(json.dumps({"action_space": [{"steering_angle": steering, "speed": speed}
+                                                     for steering in (-30, -15, 0, 15, 30) for speed in (1.0, 2.0)]}))
+    tracks = [save_track(tmp_path / "narrow.npy", NARROW), save_track(tmp_path / "oval.npy")]
+    return str(reward), str(broken), str(metadata), tracks
+
+
+def test_sweep_runs_every_track_and_direction(files):
+    reward, broken, metadata, tracks = files
+    results = sweep([reward, broken], tracks, metadata, episodes=40, workers=1)
+    assert [(r["reward_file"], r["track"], r["direction"]) for r in results] == [
+        (file, track, direction) for track in tracks for direction in ("forward", "reverse")
+        for file in (reward, broken)]
+
+    for row in results:
+        if row["reward_file"] == broken:
+            assert row["flags"] == ["cannot run: ModuleNotFoundError: No module named 'no_such_module'"]
+        else:
+            assert row["episodes"] == 40
+            assert row["pursuit_completion"] >= MAX_GAP
+            assert sum(row["off_track_kinds"].values()) == row["ends"]["off_track"]
+
+    # the narrow waypoints are where the cars leave the track most, in the numbering of the track file
+    # whichever way it is driven
+    narrow = {r["direction"]: r["hot_spots"] for r in results if r["track"] == tracks[0] and r["reward_file"] == reward}
+    assert narrow["forward"][0] in NARROW
+    assert narrow["reverse"][0] in NARROW
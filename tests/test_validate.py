@@ -0,0 +1,23 @@
+from tools.validate import check_reward
+
+REWARD = """
+def reward_function(params):
+    assert len(params["objects_location"]) == 2, "{} objects".format(len(params["objects_location"]))
+    return 1.0
+"""
+
+
+def test_reward_sees_the_objects_of_the_validated_run_env(tmp_path):
+    path = tmp_path / "reward_function.py"
+    path.write_text(REWARD)
+    errors = []
+    check_reward(str(path), {"DR_RACE_TYPE": "OBJECT_AVOIDANCE", "DR_OA_NUMBER_OF_OBSTACLES": "2"}, errors, steps=50)
+    check_reward(str(path), {"DR_RACE_TYPE": "HEAD_TO_BOT", "DR_H2B_NUMBER_OF_BOT_CARS": "2"}, errors, steps=50)
+    assert errors == []
+
+    check_reward(str(path), {"DR_RACE_TYPE": "OBJECT_AVOIDANCE"}, errors, steps=50)
+    assert errors == ["reward_function failed on 50 of 50 sampled steps: AssertionError: 6 objects"]
+
+    errors = []
+    check_reward(str(path), {"DR_RACE_TYPE": "HEAD_TO_BOT", "DR_H2B_BOT_CAR_SPEED": "fast"}, errors, steps=50)
+    assert errors[0].startswith("the obstacle and bot car variables in run.env must be numbers")
@@ -0,0 +1 @@
+# Local tooling for DeepRacer on the Spot. Run modules from the repo root, e.g. python3 -m tools.replay
@@ -0,0 +1,165 @@
+"""Design a discrete action space from the track geometry and recorded steps.
+
+For every waypoint of the track the curvature-speed envelope gives the steering angle that
+follows the (smoothed) centre line and the highest speed the lateral grip allows in that curve.
+Those optimal (steering, speed) pairs, weighted by the length of track they cover, are pooled
+with the (steering, speed) pairs of recorded steps (from completed laps when there are any) and
+clustered with weighted k-means into the requested number of actions. The recorded steps are
+counted in a histogram of STEERING_CELL by SPEED_CELL cells, so k-means sees one weighted point
+per cell and memory does not grow with the length of the traces.
+
+Example:
+    python3 -m tools.action_space --size 12 --traces robomaker1.log --write
+"""
+import argparse, json
+
+from .config_session import ConfigSession
+from .sim_trace import find_trace_files, iter_chunks
+from .tracks import closed_loop, curvature, load_track, track_path
+
+RUN_ENV = "custom-files/run.env"
+MODEL_METADATA = "custom-files/model_metadata.json"
+WHEELBASE = 0.165
+MAX_STEERING = 30.0
+MIN_SPEED = 0.5
+MAX_SPEED = 4.0
+LATERAL_ACCELERATION = 3.0
+SMOOTHING = 5
+# resolution of the histogram the recorded steps are counted in, degrees and m/s
+STEERING_CELL = 0.5
+SPEED_CELL = 0.05
+
+
+def speed_envelope(track_curvature, lateral_acceleration=LATERAL_ACCELERATION, min_speed=MIN_SPEED,
+                   max_speed=MAX_SPEED):
+    """Highest speed at each waypoint that keeps v^2 * |curvature| within the lateral acceleration."""
+    import numpy as np
+    limit = np.sqrt(lateral_acceleration / np.maximum(np.abs(track_curvature), 1e-9))
+    return np.clip(limit, min_speed, max_speed)
+
+
+def optimal_pairs(waypoints, smoothing=SMOOTHING, wheelbase=WHEELBASE, max_steering=MAX_STEERING, **envelope):
+    """(steering angles in degrees, speeds, weights) following the centre line at the envelope speed."""
+    import numpy as np
+    points = closed_loop(waypoints)
+    track_curvature = curvature(points)
+    if smoothing > 1:
+        # the car cuts across the waypoints, average the curvature over neighbouring waypoints
+        kernel = np.ones(smoothing) / smoothing
+        padded = np.concatenate([track_curvature[-smoothing:], track_curvature, track_curvature[:smoothing]])
+        track_curvature = np.convolve(padded, kernel, mode="same")[smoothing:-smoothing]
+    steering = np.clip(np.degrees(np.arctan(wheelbase * track_curvature)), -max_steering, max_steering)
+    speeds = speed_envelope(track_curvature, **envelope)
+    weights = np.linalg.norm(np.roll(points, -1, axis=0) - points, axis=1)
+    return steering, speeds, weights
+
+
+def _cell(steering, speed):
+    return round(steering / STEERING_CELL) * STEERING_CELL, round(speed / SPEED_CELL) * SPEED_CELL
+
+
+def observed_pairs(trace_paths):
+    """(steering, speed, step count) of the histogram cells of recorded steps, only from completed laps when
+    the traces have some."""
+    import numpy as np
+    from collections import Counter
+    cells, complete = Counter(), Counter()
+    for path in find_trace_files(trace_paths):
+        # cells of the episodes still running, merged into complete when they finish the lap
+        episodes = {}
+        for rows in iter_chunks(path):
+            for row in rows:
+                cell = _cell(row[5], row[6])
+                cells[cell] += 1
+                episode = episodes.setdefault(row[0], Counter())
+                episode[cell] += 1
+                if row[15] == "lap_complete":
+                    complete.update(episode)
+                if row[9] or row[15] == "lap_complete":
+                    del episodes[row[0]]
+    histogram = complete or cells
+    pairs = np.array([(steering, speed, count) for (steering, speed), count in histogram.items()],
+                     dtype=float).reshape(-1, 3)
+    return pairs[:, 0], pairs[:, 1], pairs[:, 2]
+
+
+def weighted_kmeans(points, weights, k, iterations=100, seed=0):
+    """Cluster centres of weighted points, k-means++ initialisation."""
+    import numpy as np
+    rng = np.random.default_rng(seed)
+    probabilities = weights / weights.sum()
+    centres = [points[rng.choice(len(points), p=probabilities)]]
+    for _ in range(1, k):
+        distance = np.min(((points[:, None, :] - np.array(centres)[None]) ** 2).sum(axis=2), axis=1)
+        scores = distance * weights
+        if scores.sum() == 0:
+            break
+        centres.append(points[rng.choice(len(points), p=scores / scores.sum())])
+    centres = np.array(centres)
+    for _ in range(iterations):
+        labels = np.argmin(((points[:, None, :] - centres[None]) ** 2).sum(axis=2), axis=1)
+        totals = np.bincount(labels, weights=weights, minlength=len(centres))
+        updated = centres.copy()
+        for axis in range(points.shape[1]):
+            sums = np.bincount(labels, weights=weights * points[:, axis], minlength=len(centres))
+            updated[:, axis] = np.where(totals > 0, sums / np.maximum(totals, 1e-12), centres[:, axis])
+        if np.allclose(updated, centres):
+            break
+        centres = updated
+    return centres
+
+
+def design(waypoints, size, observed=None, optimal_weight=0.5, max_steering=MAX_STEERING, max_speed=MAX_SPEED,
+           **options):
+    """Action space list of {"steering_angle", "speed"} with at most size entries."""
+    import numpy as np
+    steering, speeds, weights = optimal_pairs(waypoints, max_steering=max_steering, max_speed=max_speed, **options)
+    weights = weights / weights.sum() * optimal_weight
+    if observed is not None and len(observed[0]):
+        steering = np.concatenate([steering, observed[0]])
+        speeds = np.concatenate([speeds, observed[1]])
+        weights = np.concatenate([weights, observed[2] / observed[2].sum() * (1 - optimal_weight)])
+    # scale both axes to [-1, 1] / [0, 1] so neither dominates the distance
+    points = np.column_stack([steering / max_steering, speeds / max_speed])
+    centres = weighted_kmeans(points, weights, size)
+    actions = {(round(float(s) * max_steering, 1), round(float(v) * max_speed, 2)) for s, v in centres}
+    return [{"steering_angle": s, "speed": v} for s, v in sorted(actions)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Design a discrete action space from track curvature and recorded steps")
+    parser.add_argument("--track", help="DR_WORLD_NAME or path to a track .npy (default: DR_WORLD_NAME in run.env)")
+    parser.add_argument("--traces", nargs="*", help="SIM_TRACE_LOG files or directories with recorded steps")
+    parser.add_argument("--size", type=int, default=10, help="number of actions")
+    parser.add_argument("--optimal-weight", type=float, default=0.5,
+                        help="share of the track envelope against the recorded steps (0-1)")
+    parser.add_argument("--max-steering", type=float, default=MAX_STEERING)
+    parser.add_argument("--min-speed", type=float, default=MIN_SPEED)
+    parser.add_argument("--max-speed", type=float, default=MAX_SPEED)
+    parser.add_argument("--lateral-acceleration", type=float, default=LATERAL_ACCELERATION, help="m/s^2")
+    parser.add_argument("--smoothing", type=int, default=SMOOTHING, help="waypoints averaged for the curvature")
+    parser.add_argument("--metadata", default=MODEL_METADATA)
+    parser.add_argument("--write", action="store_true", help="replace the action space in the metadata file")
+    args = parser.parse_args()
+
+    config = ConfigSession()
+    name = args.track or config.get(RUN_ENV, "DR_WORLD_NAME")
+    try:
+        track = load_track(name)
+    except FileNotFoundError:
+        raise SystemExit("No track file {}, download it from deepracer-race-data (raw_data/tracks/npy)".format(
+            track_path(name)))
+    observed = observed_pairs(args.traces) if args.traces else None
+    actions = design(track[:, 0:2], args.size, observed, args.optimal_weight, args.max_steering, args.max_speed,
+                     smoothing=args.smoothing, min_speed=args.min_speed,
+                     lateral_acceleration=args.lateral_acceleration)
+    print(json.dumps(actions, indent=2))
+    if args.write:
+        config.set(args.metadata, "action_space", actions)
+        config.set(args.metadata, "action_space_type", "discrete")
+        config.commit()
+        print("{} actions written to {}".format(len(actions), args.metadata))
+
+
+if __name__ == "__main__":
+    main()
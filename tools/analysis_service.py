@@ -0,0 +1,200 @@
+"""Incremental training analysis, run inside the deepracer-analysis container.
+
+web_monitoring.sh used to execute import_from_s3.ipynb every 5 minutes, loading the whole
+training trace from S3 again, and then re-executed every analysis notebook. This service keeps
+the trace dataframe in memory and on every tick loads only the simtrace files it has not loaded
+yet, appends their episodes to simulation_agg, saves df, simulation_agg, complete_ones and track
+for the notebooks' `%store -r` the same way import_from_s3.ipynb did, and re-executes a notebook
+only when the data it shows has changed.
+
+Simtrace files are written once per iteration and not modified afterwards, so each file is
+read once.
+
+Every tick prints one line to the log, web_monitoring.sh executes the notebooks itself as before
+when the log has not been written for 15 minutes.
+
+Example (inside the container, from /workspace):
+    python3 -m tools.analysis_service --bucket my-bucket --prefix my-model --region us-east-1 --track reInvent2019_wide
+"""
+import argparse, os, subprocess, time
+
+# notebook -> inputs it shows, a notebook is executed again when one of them changes
+NOTEBOOKS = {
+    "Training_progress": ("simulation_agg",),
+    "Quintiles": ("simulation_agg",),
+    "Heatmap": ("df", "track"),
+    "Data_tables": ("simulation_agg",),
+    "Path_for_complete_laps": ("top_laps", "track"),
+    "Training_and_Evaluation_Overview": ("metrics",),
+}
+STORE_DB = os.path.expanduser("~/.ipython/profile_default/db")
+# objects of the model prefix the analysis reads when it runs from the local S3 cache
+SYNC_INCLUDE = ["training-simtrace/*", "model/model_metadata.json", "ip/hyperparameters.json", "metrics/*"]
+TRACE_PATTERN = "simtrace"
+TOP_LAPS = 5
+
+
+def changed_notebooks(inputs, signatures):
+    """{notebook: signature of its inputs} of the notebooks whose inputs changed since they were rendered."""
+    changed = {}
+    for notebook, names in NOTEBOOKS.items():
+        signature = tuple(inputs[name] for name in names)
+        if signature != signatures.get(notebook):
+            changed[notebook] = signature
+    return changed
+
+
+class NewFilesHandler:
+    """Wraps a deepracer-utils file handler so trace listings only return files not loaded yet."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.loaded = set()
+        self.listed = []
+
+    def list_files(self, *args, **kwargs):
+        files = self.handler.list_files(*args, **kwargs)
+        traces = [f for f in files if TRACE_PATTERN in f]
+        if not traces:
+            return files
+        self.listed = [f for f in traces if f not in self.loaded]
+        return [f for f in files if TRACE_PATTERN not in f] + self.listed
+
+    def __getattr__(self, name):
+        return getattr(self.handler, name)
+
+
+class AnalysisService:
+
+    def __init__(self, bucket, prefix, region, track_name, workdir=".", cache_dir=None):
+        self.bucket, self.prefix, self.region = bucket, prefix, region
+        self.workdir = workdir
+        self.s3_sync = None
+        if cache_dir:
+            import boto3
+            from deepracer.logs import FSFileHandler
+            from .s3_sync import S3Sync
+            self.s3_sync = S3Sync(bucket, prefix, cache_dir, boto3.client("s3", region_name=region))
+            handler = FSFileHandler(model_folder=self.s3_sync.path(""))
+        else:
+            from deepracer.logs import S3FileHandler
+            handler = S3FileHandler(bucket=bucket, prefix=prefix, region=region)
+        self.files = NewFilesHandler(handler)
+        self.df = self.simulation_agg = self.complete_ones = None
+        self.track = self.load_track(track_name)
+        self.signatures = {}
+
+    def load_track(self, track_name):
+        from deepracer.tracks import TrackIO
+        try:
+            return TrackIO().load_track(track_name)
+        except Exception:
+            print("Track not currently included in the solution.  Copy track into the tracks folder or check you're using the latest deepracer-analysis image.")
+            return None
+
+    def load_new(self):
+        """Append the episodes of trace files not loaded yet. Returns True when there were any."""
+        import pandas as pd
+        from deepracer.logs import AnalysisUtils as au, DeepRacerLog
+        log = DeepRacerLog(filehandler=self.files)
+        try:
+            log.load_training_trace()
+            new = log.dataframe()
+        except Exception:
+            # no new files yet (or training not far enough advanced for the first ones)
+            return False
+        if new is None or new.empty:
+            return False
+        self.files.loaded.update(self.files.listed)
+        new_agg = au.simulation_agg(new, secondgroup="unique_episode")
+        if self.df is None:
+            self.df, self.simulation_agg = new, new_agg
+        else:
+            self.df = pd.concat([self.df, new], ignore_index=True)
+            self.simulation_agg = pd.concat([self.simulation_agg, new_agg], ignore_index=True)
+        self.complete_ones = self.simulation_agg[self.simulation_agg["progress"] == 100]
+        return True
+
+    def metrics_etag(self):
+        if self.s3_sync:
+            return self.s3_sync.index.get("metrics/TrainingMetrics.json", {}).get("etag")
+        import boto3
+        try:
+            return boto3.client("s3", region_name=self.region).head_object(
+                Bucket=self.bucket, Key=self.prefix + "/metrics/TrainingMetrics.json")["ETag"]
+        except Exception:
+            return None
+
+    def inputs(self):
+        top_laps = ()
+        if self.complete_ones is not None and len(self.complete_ones):
+            top_laps = (tuple(self.complete_ones.nsmallest(TOP_LAPS, "time")["unique_episode"]),
+                        tuple(self.complete_ones.nlargest(TOP_LAPS, "reward")["unique_episode"]))
+        return {
+            "df": 0 if self.df is None else len(self.df),
+            "simulation_agg": 0 if self.simulation_agg is None else len(self.simulation_agg),
+            "track": self.track is not None,
+            "top_laps": top_laps,
+            "metrics": self.metrics_etag(),
+        }
+
+    def store(self, names):
+        """Save variables where `%store -r` in the notebooks reads them."""
+        from pickleshare import PickleShareDB
+        db = PickleShareDB(STORE_DB)
+        for name in names:
+            value = getattr(self, name)
+            if value is not None:
+                db["autorestore/" + name] = value
+
+    def render(self, notebook):
+        result = subprocess.run(["jupyter", "nbconvert", "--no-input", "--to", "html", "--execute", notebook + ".ipynb"],
+                                cwd=self.workdir)
+        return result.returncode == 0
+
+    def tick(self):
+        start = time.time()
+        if self.s3_sync:
+            self.s3_sync.sync(SYNC_INCLUDE)
+        if self.load_new():
+            self.store(["df", "simulation_agg", "complete_ones"])
+        if "track" not in self.signatures:
+            self.store(["track"])
+            self.signatures["track"] = True
+        inputs = self.inputs()
+        rendered = []
+        for notebook, signature in changed_notebooks(inputs, self.signatures).items():
+            # a failed render is tried again at the next tick
+            if self.render(notebook):
+                self.signatures[notebook] = signature
+                rendered.append(notebook)
+        print("{} steps, {} episodes, rendered {} in {:.1f}s".format(
+            inputs["df"], inputs["simulation_agg"], ", ".join(rendered) or "nothing", time.time() - start), flush=True)
+
+    def run(self, interval):
+        while True:
+            self.tick()
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep the training analysis notebooks current with only the new trace files")
+    parser.add_argument("--bucket", required=True)
+    parser.add_argument("--prefix", required=True, help="DR_LOCAL_S3_MODEL_PREFIX")
+    parser.add_argument("--region", required=True)
+    parser.add_argument("--track", required=True, help="DR_WORLD_NAME")
+    parser.add_argument("--workdir", default=".", help="directory with the .ipynb notebooks")
+    parser.add_argument("--cache-dir", help="read the traces from a local ETag cache of the prefix (see tools.s3_sync)")
+    parser.add_argument("--interval", type=int, default=120, help="seconds between ticks")
+    parser.add_argument("--once", action="store_true")
+    args = parser.parse_args()
+
+    service = AnalysisService(args.bucket, args.prefix, args.region, args.track, args.workdir, args.cache_dir)
+    if args.once:
+        service.tick()
+    else:
+        service.run(args.interval)
+
+
+if __name__ == "__main__":
+    main()
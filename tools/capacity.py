@@ -0,0 +1,268 @@
+"""Instance type and worker count planner from the throughput of earlier trainings.
+
+On the instance, tools.log_collector appends a sample to capacity.jsonl every minute. A sample
+holds the cumulative SIM_TRACE_LOG steps of each robomaker, the 1 minute load average, the GPU
+memory in use and the number of "ran out of memory" errors so far. The file is uploaded with the
+other logs to s3://<bucket>/<model prefix>/logs/capacity.jsonl. Each run gives one observation:
+instance type, workers, steps per second per worker, load and peak GPU memory.
+
+The model fitted to the observations is simple:
+
+    load     = base_load + load_per_worker * workers
+    steps/s  = workers * worker_rate * min(1, cpus / load)
+    memory   = base_memory + memory_per_worker * workers   (must fit the GPU, no earlier OOM)
+
+Parts the history cannot determine (e.g. a single worker count) fall back to PRIOR. Every
+instance type and worker count is then priced (on-demand, or with the spot discount). The
+recommendation is the fastest configuration that reaches the target steps per dollar, or the
+cheapest per step without a target. num_episodes_between_training is set so that
+num_episodes_between_training / DR_WORKERS * DR_TRAIN_ROUND_ROBIN_ADVANCE_DIST = 1.
+
+--benchmark replays the captured runs: each run is predicted by a model fitted on the others.
+
+Example:
+    aws s3 sync s3://<bucket>/ capacity/ --exclude "*" --include "*/logs/capacity.jsonl"
+    python3 -m tools.capacity capacity --spot --target-steps-per-dollar 40000
+"""
+import argparse, json, os, statistics, time
+
+from .config_session import ConfigSession
+
+CAPACITY_DIR = os.environ.get("DOTS_CAPACITY_DIR", "capacity")
+RUN_ENV = "custom-files/run.env"
+SYSTEM_ENV = "custom-files/system.env"
+HYPERPARAMETERS = "custom-files/hyperparameters.json"
+MAX_WORKERS = 8
+SPOT_DISCOUNT = 0.35
+GPU_MEMORY_HEADROOM = 0.9
+WARMUP_SECONDS = 300
+
+# vCPUs, MiB of memory of the GPU sagemaker trains on, on-demand USD per hour (us-east-1)
+INSTANCES = {
+    "g4dn.2xlarge": (8, 15360, 0.752),
+    "g4dn.4xlarge": (16, 15360, 1.204),
+    "g4dn.8xlarge": (32, 15360, 2.176),
+    "g4dn.12xlarge": (48, 15360, 3.912),
+    "g5.2xlarge": (8, 23028, 1.212),
+    "g5.4xlarge": (16, 23028, 1.624),
+    "g5.8xlarge": (32, 23028, 2.448),
+    "g5.12xlarge": (48, 23028, 5.672),
+}
+
+PRIOR = {"base_load": 2.0, "load_per_worker": 1.5, "worker_rate": 14.0, "base_memory": 4000.0,
+         "memory_per_worker": 0.0}
+
+
+def find_sample_files(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files += [os.path.join(root, name) for name in names if name.endswith(".jsonl")]
+        elif os.path.exists(path):
+            files.append(path)
+    return sorted(files)
+
+
+def load_samples(path):
+    samples = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                samples.append(json.loads(line))
+            except ValueError:
+                continue
+    return sorted(samples, key=lambda sample: sample["time"])
+
+
+def observe(samples, warmup=WARMUP_SECONDS):
+    """One observation of a run, None when it has too few samples with progress."""
+    if not samples:
+        return None
+    start = samples[0]["time"] + warmup
+    rates, loads = [], []
+    for before, after in zip(samples, samples[1:]):
+        elapsed = after["time"] - before["time"]
+        if after["time"] < start or elapsed <= 0:
+            continue
+        # only workers that were running in both samples, a restarted container starts from zero
+        deltas = [after["steps"][name] - before["steps"][name] for name in after["steps"]
+                  if name in before["steps"] and after["steps"][name] >= before["steps"][name]]
+        if deltas and sum(deltas) > 0:
+            rates.append(sum(deltas) / elapsed / len(deltas))
+            loads.append(after["load"])
+    if not rates:
+        return None
+    last = samples[-1]
+    memory = [s["gpu_memory_used"] for s in samples if s.get("gpu_memory_used") is not None]
+    return {
+        "instance_type": last.get("instance_type") or "unknown",
+        "cpus": last.get("cpus") or INSTANCES.get(last.get("instance_type"), (8,))[0],
+        "workers": len(last["steps"]),
+        "worker_rate": statistics.median(rates),
+        "load": statistics.median(loads),
+        "gpu_memory": max(memory) if memory else None,
+        "gpu_memory_total": last.get("gpu_memory_total"),
+        "out_of_memory": bool(last.get("out_of_memory")),
+    }
+
+
+def _line(points):
+    """Least squares (intercept, slope) of (x, y) points, None with fewer than two distinct x."""
+    xs = [x for x, _ in points]
+    if len(set(xs)) < 2:
+        return None
+    mean_x, mean_y = statistics.fmean(xs), statistics.fmean(y for _, y in points)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in points) / sum((x - mean_x) ** 2 for x in xs)
+    return mean_y - slope * mean_x, slope
+
+
+def fit(observations):
+    """Model parameters from observations, with PRIOR for what they do not determine."""
+    model = dict(PRIOR, out_of_memory={}, runs=len(observations))
+    if not observations:
+        return model
+    load = _line([(o["workers"], o["load"]) for o in observations])
+    if load and load[1] > 0:
+        model["base_load"], model["load_per_worker"] = max(load[0], 0.0), load[1]
+    else:
+        model["load_per_worker"] = statistics.median(
+            max(o["load"] - model["base_load"], 0.1) / o["workers"] for o in observations)
+    # undo the CPU contention of each run to get the rate of a worker with a free CPU
+    model["worker_rate"] = statistics.median(
+        o["worker_rate"] / min(1.0, o["cpus"] / max(o["load"], 1e-9)) for o in observations)
+    memory = [(o["workers"], o["gpu_memory"]) for o in observations if o["gpu_memory"] is not None]
+    fitted = _line(memory)
+    if fitted:
+        model["base_memory"], model["memory_per_worker"] = max(fitted[0], 0.0), max(fitted[1], 0.0)
+    elif memory:
+        model["base_memory"] = max(m for _, m in memory)
+    for o in observations:
+        if o["out_of_memory"]:
+            fewest = model["out_of_memory"].get(o["instance_type"], o["workers"])
+            model["out_of_memory"][o["instance_type"]] = min(fewest, o["workers"])
+    return model
+
+
+def predict(model, instance_type, workers, instances=INSTANCES):
+    """(steps per second, load, GPU memory MiB, feasible) of a configuration."""
+    cpus, gpu_memory, _ = instances[instance_type]
+    load = model["base_load"] + model["load_per_worker"] * workers
+    rate = workers * model["worker_rate"] * min(1.0, cpus / load)
+    memory = model["base_memory"] + model["memory_per_worker"] * workers
+    # a run that ran out of memory rules out as many workers on any GPU that is not larger
+    failed = any(workers >= fewest and instances[failed_type][1] >= gpu_memory
+                 for failed_type, fewest in model["out_of_memory"].items() if failed_type in instances)
+    feasible = memory <= gpu_memory * GPU_MEMORY_HEADROOM and not failed
+    return rate, load, memory, feasible
+
+
+def episodes_between_training(workers, advance=0.05):
+    """(num_episodes_between_training, DR_TRAIN_ROUND_ROBIN_ADVANCE_DIST) with episodes / workers * advance = 1."""
+    episodes = round(workers / advance, 6)
+    if episodes == int(episodes) and 1 <= episodes <= 100:
+        return int(episodes), advance
+    episodes = min(100, 20 * workers)
+    return episodes, workers / episodes
+
+
+def plan(model, spot=False, max_workers=MAX_WORKERS, instances=INSTANCES, discount=SPOT_DISCOUNT):
+    """Every configuration with its predicted throughput and cost, fastest first."""
+    rows = []
+    for instance_type, (_, _, price) in instances.items():
+        hourly = price * discount if spot else price
+        for workers in range(1, max_workers + 1):
+            rate, load, memory, feasible = predict(model, instance_type, workers, instances)
+            rows.append({"instance_type": instance_type, "workers": workers, "steps_per_second": rate,
+                         "load": load, "gpu_memory": memory, "feasible": feasible, "usd_per_hour": hourly,
+                         "steps_per_dollar": rate * 3600 / hourly})
+    return sorted(rows, key=lambda row: -row["steps_per_second"])
+
+
+def recommend(rows, target_steps_per_dollar=None):
+    feasible = [row for row in rows if row["feasible"]]
+    if target_steps_per_dollar:
+        reaching = [row for row in feasible if row["steps_per_dollar"] >= target_steps_per_dollar]
+        if reaching:
+            return max(reaching, key=lambda row: (row["steps_per_second"], row["steps_per_dollar"]))
+    return max(feasible, key=lambda row: row["steps_per_dollar"]) if feasible else None
+
+
+def benchmark(observations):
+    """Leave-one-out replay: (observation, predicted steps per second per worker) for every run."""
+    results = []
+    for i, observation in enumerate(observations):
+        model = fit(observations[:i] + observations[i + 1:])
+        instances = dict(INSTANCES)
+        instances.setdefault(observation["instance_type"], (observation["cpus"], 0, 1.0))
+        rate, _, _, _ = predict(model, observation["instance_type"], observation["workers"], instances)
+        results.append((observation, rate / observation["workers"]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recommend instance type, workers and episodes per training iteration")
+    parser.add_argument("paths", nargs="*", default=[CAPACITY_DIR], help="capacity.jsonl files or directories")
+    parser.add_argument("--target-steps-per-dollar", type=float, help="fastest configuration reaching this")
+    parser.add_argument("--spot", action="store_true", help="price with the spot discount")
+    parser.add_argument("--spot-discount", type=float, default=SPOT_DISCOUNT, help="spot price / on-demand price")
+    parser.add_argument("--max-workers", type=int, default=MAX_WORKERS)
+    parser.add_argument("--advance", type=float, help="DR_TRAIN_ROUND_ROBIN_ADVANCE_DIST (default: from run.env)")
+    parser.add_argument("--top", type=int, default=10, help="configurations listed")
+    parser.add_argument("--benchmark", action="store_true", help="replay the captured runs against the model")
+    parser.add_argument("--write", action="store_true",
+                        help="set DR_WORKERS, num_episodes_between_training and the advance distance")
+    args = parser.parse_args()
+
+    started = time.time()
+    observations = [o for o in (observe(load_samples(path)) for path in find_sample_files(args.paths)) if o]
+    if args.benchmark:
+        results = benchmark(observations)
+        print("{:<16} {:>7} {:>13} {:>13} {:>7}".format("Instance", "Workers", "Observed/s", "Predicted/s", "Error"))
+        for observation, predicted in results:
+            error = (predicted - observation["worker_rate"]) / observation["worker_rate"]
+            print("{:<16} {:>7} {:>13.2f} {:>13.2f} {:>6.1f}%".format(
+                observation["instance_type"], observation["workers"], observation["worker_rate"], predicted, 100 * error))
+        if results:
+            print("Mean absolute error {:.1f}% over {} runs".format(100 * statistics.fmean(
+                abs(p - o["worker_rate"]) / o["worker_rate"] for o, p in results), len(results)))
+        print("Replayed in {:.3f}s".format(time.time() - started))
+        return
+
+    model = fit(observations)
+    print("Model from {} runs: load {:.1f} + {:.2f}/worker, {:.1f} steps/s per worker with a free CPU, "
+          "GPU memory {:.0f} + {:.0f} MiB/worker{}".format(
+              model["runs"], model["base_load"], model["load_per_worker"], model["worker_rate"],
+              model["base_memory"], model["memory_per_worker"], "" if observations else " (no history, defaults)"))
+    rows = plan(model, args.spot, args.max_workers, discount=args.spot_discount)
+    if args.top:
+        print("{:<16} {:>7} {:>9} {:>6} {:>9} {:>8} {:>12}".format(
+            "Instance", "Workers", "Steps/s", "Load", "GPU MiB", "USD/h", "Steps/USD"))
+        for row in [row for row in rows if row["feasible"]][:args.top]:
+            print("{:<16} {:>7} {:>9.1f} {:>6.1f} {:>9.0f} {:>8.3f} {:>12.0f}".format(
+                row["instance_type"], row["workers"], row["steps_per_second"], row["load"], row["gpu_memory"],
+                row["usd_per_hour"], row["steps_per_dollar"]))
+    best = recommend(rows, args.target_steps_per_dollar)
+    if best is None:
+        print("No configuration fits the GPU memory")
+        raise SystemExit(1)
+    config = ConfigSession()
+    advance = args.advance or float(config.get(RUN_ENV, "DR_TRAIN_ROUND_ROBIN_ADVANCE_DIST", "0.05"))
+    episodes, advance = episodes_between_training(best["workers"], advance)
+    if args.target_steps_per_dollar and best["steps_per_dollar"] < args.target_steps_per_dollar:
+        print("No configuration reaches {:.0f} steps per dollar, cheapest per step instead".format(
+            args.target_steps_per_dollar))
+    print("Recommended: {} with DR_WORKERS={}, num_episodes_between_training={}, "
+          "DR_TRAIN_ROUND_ROBIN_ADVANCE_DIST={:g} ({:.1f} steps/s, {:.0f} steps per dollar)".format(
+              best["instance_type"], best["workers"], episodes, advance, best["steps_per_second"],
+              best["steps_per_dollar"]))
+    if args.write:
+        config.set(SYSTEM_ENV, "DR_WORKERS", best["workers"])
+        config.set(RUN_ENV, "DR_TRAIN_ROUND_ROBIN_ADVANCE_DIST", "{:g}".format(advance))
+        config.set(HYPERPARAMETERS, "num_episodes_between_training", episodes)
+        config.commit()
+        print("Written to {}, {} and {}".format(SYSTEM_ENV, RUN_ENV, HYPERPARAMETERS))
+
+
+if __name__ == "__main__":
+    main()
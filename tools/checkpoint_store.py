@@ -0,0 +1,285 @@
+"""Deduplicated checkpoint uploads: content defined chunks in S3 and one manifest per checkpoint.
+
+regular_upload.sh used to copy the whole model with dr-upload-model -f every DR_REGULAR_UPLOAD
+minutes, about 75MB each time. This splits the files of one checkpoint into content defined
+chunks (a gear rolling hash over WINDOW bytes cuts where its low bits are zero, so an insert
+only changes the chunks around it), stores each chunk once under <prefix>/chunks/<sha256> and
+writes <prefix>/manifests/<checkpoint>.json with the chunk list of every file. Only chunks the
+bucket does not have yet are uploaded, in parallel. The graph (.meta), metadata, reward function
+and hyperparameters are shared by all checkpoints of a training and are stored once.
+
+restore rebuilds the usual model layout of a checkpoint (model/<n>_Step-<steps>.ckpt.*,
+model/model_<n>.pb, model/checkpoint, ...) in a directory, or under an S3 prefix with parallel
+multipart uploads, ready for dr-upload-model style imports.
+
+The model files are read from a local directory, or mirrored from the training prefix with
+tools.s3_sync, which only downloads files whose ETag changed.
+
+Example:
+    python3 -m tools.checkpoint_store upload my-bucket my-model-upload-checkpoints --from-s3 my-bucket/my-model --checkpoint last
+    python3 -m tools.checkpoint_store list my-bucket my-model-upload-checkpoints
+    python3 -m tools.checkpoint_store restore my-bucket my-model-upload-checkpoints 12 --to-prefix my-model-restored
+"""
+import argparse, glob, hashlib, json, mmap, os, re, time
+from concurrent.futures import ThreadPoolExecutor
+
+MIN_CHUNK = 256 * 1024
+AVERAGE_BITS = 20
+MAX_CHUNK = 4 * 1024 * 1024
+WINDOW = 32
+BLOCK = 16 * 1024 * 1024
+WORKERS = 16
+# fixed forever, changing it changes every chunk boundary
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "little") for i in range(256)]
+CHECKPOINT_NAME = re.compile(r"^(\d+)_Step-(\d+)")
+# files shared by the checkpoints of a training, relative to the model prefix
+SHARED_FILES = ["model/model_metadata.json", "ip/hyperparameters.json", "reward_function.py", "training_params*.yaml"]
+
+
+def _cut_candidates(data):
+    """Offsets after which the rolling hash of the last WINDOW bytes has AVERAGE_BITS low zero bits."""
+    import numpy as np
+    gear = np.array(GEAR, dtype=np.uint32)
+    mask = np.uint32((1 << AVERAGE_BITS) - 1)
+    candidates = []
+    for start in range(0, len(data), BLOCK):
+        # WINDOW - 1 bytes of the previous block so the hash of the first positions is complete
+        lead = min(start, WINDOW - 1)
+        values = gear[np.frombuffer(data[start - lead:start + BLOCK], dtype=np.uint8)]
+        # h(i) = sum over k < WINDOW of gear[b(i - k)] << k, built by doubling the window
+        width = 1
+        while width < WINDOW:
+            values[width:] += values[:-width] << np.uint32(width)
+            width *= 2
+        hits = np.flatnonzero((values[lead:] & mask) == 0)
+        candidates.extend((hits + start + 1).tolist())
+    return candidates
+
+
+def chunk_boundaries(data):
+    """End offsets of the chunks of data, MIN_CHUNK <= size <= MAX_CHUNK except for the last."""
+    ends, last = [], 0
+    for candidate in _cut_candidates(data) if len(data) > MIN_CHUNK else []:
+        while candidate - last > MAX_CHUNK:
+            last += MAX_CHUNK
+            ends.append(last)
+        if candidate - last >= MIN_CHUNK:
+            ends.append(candidate)
+            last = candidate
+    while len(data) - last > MAX_CHUNK:
+        last += MAX_CHUNK
+        ends.append(last)
+    if last < len(data):
+        ends.append(len(data))
+    return ends
+
+
+def checkpoint_files(model_dir, checkpoint="last"):
+    """(checkpoint name, [relative paths]) of a checkpoint: "best", "last" or its number."""
+    if checkpoint in ("best", "last"):
+        with open(os.path.join(model_dir, "model", "deepracer_checkpoints.json"), "r") as f:
+            name = json.load(f)[checkpoint + "_checkpoint"]["name"]
+    else:
+        indexes = glob.glob(os.path.join(model_dir, "model", "{}_Step-*.ckpt.index".format(int(checkpoint))))
+        if not indexes:
+            raise ValueError("no checkpoint {} in {}".format(checkpoint, os.path.join(model_dir, "model")))
+        name = os.path.basename(indexes[0])[:-len(".index")]
+    number = CHECKPOINT_NAME.match(name).group(1)
+    files = glob.glob(os.path.join(model_dir, "model", glob.escape(name) + ".*"))
+    files += glob.glob(os.path.join(model_dir, "model", "model_{}.pb".format(number)))
+    for pattern in SHARED_FILES:
+        files += glob.glob(os.path.join(model_dir, pattern))
+    if not any(file.endswith(".index") for file in files):
+        raise ValueError("checkpoint {} is not complete in {}".format(name, model_dir))
+    return name, sorted(os.path.relpath(file, model_dir) for file in files)
+
+
+class CheckpointStore:
+
+    def __init__(self, bucket, prefix, client=None, workers=WORKERS):
+        if client is None:
+            import boto3
+            client = boto3.client("s3")
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.workers = workers
+
+    def key(self, *parts):
+        return "/".join((self.prefix,) + parts)
+
+    def stored_chunks(self):
+        """sha256 of every chunk in the bucket, listed once per upload."""
+        chunks = set()
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.key("chunks") + "/"):
+            chunks.update(item["Key"].rsplit("/", 1)[1] for item in page.get("Contents", []))
+        return chunks
+
+    def checkpoints(self):
+        """{checkpoint name: manifest key} of the stored checkpoints."""
+        names = {}
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.key("manifests") + "/"):
+            for item in page.get("Contents", []):
+                names[item["Key"].rsplit("/", 1)[1][:-len(".json")]] = item["Key"]
+        return dict(sorted(names.items(), key=lambda entry: int(CHECKPOINT_NAME.match(entry[0]).group(1))))
+
+    def upload(self, model_dir, checkpoint="last"):
+        """Upload the chunks of a checkpoint the bucket does not have and its manifest. Returns the manifest."""
+        started = time.time()
+        name, relative_paths = checkpoint_files(model_dir, checkpoint)
+        stored = self.stored_chunks()
+        manifest = {"checkpoint": name, "created": int(time.time()), "files": {}, "inline": {},
+                    "size": 0, "uploaded": 0, "chunks": 0, "new_chunks": 0}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = []
+            for relative in relative_paths:
+                with open(os.path.join(model_dir, relative), "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+                file_hash, chunks, start = hashlib.sha256(), [], 0
+                for end in chunk_boundaries(data):
+                    chunk = data[start:end]
+                    digest = hashlib.sha256(chunk).hexdigest()
+                    file_hash.update(chunk)
+                    chunks.append([digest, end - start])
+                    if digest not in stored:
+                        stored.add(digest)
+                        manifest["new_chunks"] += 1
+                        manifest["uploaded"] += end - start
+                        futures.append(pool.submit(self.client.put_object, Bucket=self.bucket,
+                                                   Key=self.key("chunks", digest), Body=chunk))
+                    start = end
+                if size:
+                    data.close()
+                manifest["files"][relative] = {"size": size, "sha256": file_hash.hexdigest(), "chunks": chunks}
+                manifest["size"] += size
+                manifest["chunks"] += len(chunks)
+            for future in futures:
+                future.result()
+        # written for the restored checkpoint instead of copied, like dr-upload-model does
+        entry, checkpoints_file = {"name": name}, os.path.join(model_dir, "model", "deepracer_checkpoints.json")
+        if os.path.exists(checkpoints_file):
+            with open(checkpoints_file, "r") as f:
+                entry = next((c for c in json.load(f).values() if c.get("name") == name), entry)
+        manifest["inline"]["model/deepracer_checkpoints.json"] = json.dumps({"best_checkpoint": entry, "last_checkpoint": entry})
+        manifest["inline"]["model/checkpoint"] = 'model_checkpoint_path: "{0}"\nall_model_checkpoint_paths: "{0}"\n'.format(name)
+        manifest["inline"]["model/.coach_checkpoint"] = name
+        manifest["seconds"] = round(time.time() - started, 2)
+        # the manifest goes last, a checkpoint is listed only once all its chunks are stored
+        self.client.put_object(Bucket=self.bucket, Key=self.key("manifests", name[:-len(".ckpt")] + ".json"),
+                               Body=json.dumps(manifest).encode())
+        return manifest
+
+    def manifest(self, checkpoint):
+        """Manifest of a checkpoint given by number, name or "last"."""
+        names = self.checkpoints()
+        if not names:
+            raise ValueError("no checkpoints in s3://{}/{}".format(self.bucket, self.prefix))
+        if checkpoint == "last":
+            key = list(names.values())[-1]
+        else:
+            key = next((key for name, key in names.items()
+                        if name == checkpoint or CHECKPOINT_NAME.match(name).group(1) == str(checkpoint)), None)
+            if key is None:
+                raise ValueError("no checkpoint {} in s3://{}/{}, stored: {}".format(
+                    checkpoint, self.bucket, self.prefix, " ".join(names)))
+        return json.loads(self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read())
+
+    def _restore_file(self, relative, entry, target_dir):
+        path = os.path.join(target_dir, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file_hash = hashlib.sha256()
+        with open(path + ".part", "wb") as f:
+            for digest, size in entry["chunks"]:
+                chunk = self.client.get_object(Bucket=self.bucket, Key=self.key("chunks", digest))["Body"].read()
+                if len(chunk) != size or hashlib.sha256(chunk).hexdigest() != digest:
+                    raise IOError("chunk {} of {} is corrupt".format(digest, relative))
+                file_hash.update(chunk)
+                f.write(chunk)
+        if file_hash.hexdigest() != entry["sha256"]:
+            raise IOError("{} does not match its manifest".format(relative))
+        os.replace(path + ".part", path)
+        return path
+
+    def restore(self, checkpoint, target_dir):
+        """Write the files of a checkpoint into target_dir, files in parallel. Returns the manifest."""
+        manifest = self.manifest(checkpoint)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for future in [pool.submit(self._restore_file, relative, entry, target_dir)
+                           for relative, entry in manifest["files"].items()]:
+                future.result()
+        for relative, text in manifest["inline"].items():
+            os.makedirs(os.path.dirname(os.path.join(target_dir, relative)), exist_ok=True)
+            with open(os.path.join(target_dir, relative), "w") as f:
+                f.write(text)
+        return manifest
+
+    def restore_to_prefix(self, checkpoint, bucket, prefix, work_dir):
+        """Restore a checkpoint and upload it as a plain model prefix with parallel multipart uploads."""
+        from boto3.s3.transfer import TransferConfig
+        manifest = self.restore(checkpoint, work_dir)
+        config = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=self.workers)
+        relative_paths = list(manifest["files"]) + list(manifest["inline"])
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            for future in [pool.submit(self.client.upload_file, os.path.join(work_dir, relative), bucket,
+                                       prefix.strip("/") + "/" + relative, Config=config)
+                           for relative in relative_paths]:
+                future.result()
+        return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload checkpoints as deduplicated chunks and restore them")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for command in ("upload", "list", "restore"):
+        sub = commands.add_parser(command)
+        sub.add_argument("bucket")
+        sub.add_argument("prefix", help="where the chunks and manifests are stored, e.g. <DR_UPLOAD_S3_PREFIX>-checkpoints, next to the upload prefix")
+        sub.add_argument("--endpoint-url", help="S3 compatible endpoint, e.g. a local minio")
+        sub.add_argument("--workers", type=int, default=WORKERS)
+        if command == "upload":
+            source = sub.add_mutually_exclusive_group(required=True)
+            source.add_argument("--from-dir", help="local copy of the model prefix")
+            source.add_argument("--from-s3", help="bucket/prefix of the training, mirrored with tools.s3_sync")
+            sub.add_argument("--checkpoint", default="last", help="best, last or a checkpoint number")
+            sub.add_argument("--cache-dir", help="tools.s3_sync cache for --from-s3")
+        if command == "restore":
+            sub.add_argument("checkpoint", help="checkpoint number, name or last")
+            target = sub.add_mutually_exclusive_group(required=True)
+            target.add_argument("--to-dir")
+            target.add_argument("--to-prefix", help="model prefix to write the plain checkpoint files to")
+            sub.add_argument("--to-bucket", help="default: the store bucket")
+    args = parser.parse_args()
+
+    import boto3
+    client = boto3.client("s3", endpoint_url=args.endpoint_url)
+    store = CheckpointStore(args.bucket, args.prefix, client, args.workers)
+    if args.command == "list":
+        for name, key in store.checkpoints().items():
+            print(name)
+    elif args.command == "upload":
+        model_dir = args.from_dir
+        if args.from_s3:
+            from .s3_sync import DEFAULT_CACHE_DIR, S3Sync
+            bucket, _, prefix = args.from_s3.partition("/")
+            syncer = S3Sync(bucket, prefix, args.cache_dir or DEFAULT_CACHE_DIR, client, args.workers)
+            syncer.sync(["model/*"] + [pattern for pattern in SHARED_FILES if not pattern.startswith("model/")])
+            model_dir = syncer.path("")
+        manifest = store.upload(model_dir, args.checkpoint)
+        print("{}: {} files, {:.1f}MB, {} of {} chunks new, {:.1f}MB uploaded in {}s".format(
+            manifest["checkpoint"], len(manifest["files"]), manifest["size"] / 1e6, manifest["new_chunks"],
+            manifest["chunks"], manifest["uploaded"] / 1e6, manifest["seconds"]))
+    elif args.to_dir:
+        manifest = store.restore(args.checkpoint, args.to_dir)
+        print("restored {} into {}".format(manifest["checkpoint"], args.to_dir))
+    else:
+        import tempfile
+        with tempfile.TemporaryDirectory() as work_dir:
+            manifest = store.restore_to_prefix(args.checkpoint, args.to_bucket or args.bucket, args.to_prefix, work_dir)
+        print("restored {} to s3://{}/{}".format(manifest["checkpoint"], args.to_bucket or args.bucket, args.to_prefix))
+
+
+if __name__ == "__main__":
+    main()
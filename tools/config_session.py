@@ -0,0 +1,119 @@
+"""Batched, atomic editing of run.env style and JSON config files.
+
+A ConfigSession parses each file once and keeps it until the file's mtime changes. Edits are
+collected in memory and commit() writes every edited file once, to a temporary file that is then
+renamed over the original, so a reader never sees a half written config. If a file changed on
+disk since it was read, its pending edits are applied on top of the new content.
+
+Example:
+    with ConfigSession() as config:
+        config.set("custom-files/run.env", "DR_WORLD_NAME", "reInvent2019_wide")
+        config.set("custom-files/hyperparameters.json", "lr", 0.0003)
+"""
+import json, os, tempfile
+
+
+class ConfigSession:
+
+    def __init__(self):
+        self._files = {}
+        self._edits = {}
+
+    def _entry(self, file):
+        mtime = os.stat(file).st_mtime_ns
+        entry = self._files.get(file)
+        if entry is None or entry["mtime"] != mtime:
+            with open(file, "r") as f:
+                text = f.read()
+            if file.endswith(".json"):
+                data = json.loads(text)
+            else:
+                lines = text.splitlines(True)
+                data = {"lines": lines, "values": {}}
+                for i, line in enumerate(lines):
+                    name, sep, value = line.partition("=")
+                    if sep and name not in data["values"]:
+                        data["values"][name] = (i, value.strip())
+            entry = self._files[file] = {"mtime": mtime, "data": data}
+        return entry
+
+    def get(self, file, key, default=None):
+        """Current value of a key, including edits not committed yet."""
+        edits = self._edits.get(file, {})
+        if key in edits:
+            return edits[key]
+        data = self._entry(file)["data"]
+        if file.endswith(".json"):
+            return data.get(key, default)
+        value = data["values"].get(key)
+        return value[1] if value else default
+
+    def data(self, file):
+        """Parsed content of a JSON file with the pending edits applied."""
+        data = dict(self._entry(file)["data"])
+        data.update(self._edits.get(file, {}))
+        return data
+
+    def variables(self, file):
+        """Variables of a run.env style file with the pending edits applied."""
+        values = {name: value for name, (_, value) in self._entry(file)["data"]["values"].items()}
+        values.update(self._edits.get(file, {}))
+        return values
+
+    def set(self, file, key, value):
+        self._edits.setdefault(file, {})[key] = value
+
+    def pending(self):
+        return {file: dict(edits) for file, edits in self._edits.items() if edits}
+
+    def discard(self):
+        self._edits = {}
+
+    def _render(self, file, edits):
+        data = self._entry(file)["data"]
+        if file.endswith(".json"):
+            content = dict(data)
+            content.update(edits)
+            return json.dumps(content, indent=2)
+        lines = list(data["lines"])
+        for key, value in edits.items():
+            line = "{}={}\n".format(key, value)
+            if key in data["values"]:
+                lines[data["values"][key][0]] = line
+            else:
+                if lines and not lines[-1].endswith("\n"):
+                    lines[-1] += "\n"
+                lines.append(line)
+        return "".join(lines)
+
+    def commit(self):
+        """Write each edited file once, atomically. Returns the list of files written."""
+        written = []
+        for file, edits in self._edits.items():
+            if not edits:
+                continue
+            content = self._render(file, edits)
+            directory = os.path.dirname(os.path.abspath(file))
+            descriptor, temporary = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(file) + ".")
+            try:
+                with os.fdopen(descriptor, "w") as f:
+                    f.write(content)
+                os.chmod(temporary, os.stat(file).st_mode & 0o777)
+                os.replace(temporary, file)
+            except BaseException:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+                raise
+            self._files.pop(file, None)
+            written.append(file)
+        self._edits = {}
+        return written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
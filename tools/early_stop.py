@@ -0,0 +1,179 @@
+"""Stop a training once it stopped improving, instead of running until TimeToLiveInMinutes.
+
+web_monitoring.sh downloads TrainingMetrics.json and deepracer_checkpoints.json every loop and
+then runs this module. Each run reads the metrics entries it has not seen yet (the count is kept
+in a state file), folds every evaluation (a run of consecutive evaluation entries, one per
+checkpoint) into:
+
+  the rolling mean completion of the last ROLLING evaluations,
+  the fastest complete evaluation lap,
+  the avg_eval_metric of the best checkpoint in deepracer_checkpoints.json,
+
+and remembers when one of them last improved by more than the minimum: MIN_COMPLETION_GAIN
+percentage points, MIN_LAP_GAIN of the lap time, MIN_CHECKPOINT_GAIN of the eval metric. Times
+are the metric timestamps, so --dry-run over the metrics of a finished training shows where it
+would have stopped. When nothing improved for the window (DR_EARLY_STOP_MINUTES) after MIN_EVALUATIONS
+evaluations, the training is stopped the way the end of TimeToLiveInMinutes stops it:
+safe_termination.sh uploads the best model, imports it and stops the training, then the stack is
+deleted and the SNS topic notified.
+
+Example:
+    python3 -m tools.early_stop --workdir ~/deepracer-for-cloud --window 120
+    python3 -m tools.early_stop --metrics TrainingMetrics.json --window 90 --dry-run
+"""
+import argparse, json, os, subprocess
+
+ROLLING = 3
+MIN_EVALUATIONS = 5
+MIN_COMPLETION_GAIN = 1.0
+MIN_LAP_GAIN = 0.01
+MIN_CHECKPOINT_GAIN = 0.01
+
+STOP = ("/home/ubuntu/bin/safe_termination.sh; "
+        'aws sns publish --topic-arn $MY_SNS_TOPIC --region $DEEPRACER_REGION --message '
+        '"Training for $STACK_NAME in region $DEEPRACER_REGION stopped early: {reason}"; '
+        "aws cloudformation delete-stack --stack-name $STACK_NAME --region $DEEPRACER_REGION")
+
+
+def new_state():
+    return {
+        "seen": 0,
+        "evaluation": None,
+        "evaluations": 0,
+        "completions": [],
+        "best_completion": None,
+        "best_lap": None,
+        "best_checkpoint": None,
+        "last_improvement": None,
+        "last_time": None,
+        "stop": None,
+    }
+
+
+def _improved(state, key, value, better):
+    best = state[key]
+    if best is None or better(value, best):
+        state[key] = value
+        return True
+    return False
+
+
+def end_evaluation(state):
+    """Fold the evaluation collected in state["evaluation"] into the plateau state."""
+    evaluation, state["evaluation"] = state["evaluation"], None
+    if not evaluation or not evaluation["episodes"]:
+        return
+    state["evaluations"] += 1
+    completions = state["completions"] = (state["completions"] + [evaluation["completion"] / evaluation["episodes"]])[-ROLLING:]
+    improved = False
+    if len(completions) == ROLLING:
+        rolling = sum(completions) / ROLLING
+        improved |= _improved(state, "best_completion", rolling, lambda new, best: new > best + MIN_COMPLETION_GAIN)
+    if evaluation["lap"] is not None:
+        improved |= _improved(state, "best_lap", evaluation["lap"], lambda new, best: new < best * (1 - MIN_LAP_GAIN))
+    if improved or state["last_improvement"] is None:
+        state["last_improvement"] = evaluation["time"]
+
+
+def ingest_metric(state, metric):
+    """One entry of the TrainingMetrics.json "metrics" list. An evaluation ends with the next training entry."""
+    time = metric.get("metric_time", 0) / 1000
+    state["last_time"] = max(state["last_time"] or time, time)
+    if metric.get("phase") != "evaluation":
+        end_evaluation(state)
+        return
+    evaluation = state["evaluation"]
+    if evaluation is None:
+        evaluation = state["evaluation"] = {"episodes": 0, "completion": 0.0, "lap": None, "time": time}
+    completion = metric.get("completion_percentage", 0)
+    evaluation["episodes"] += 1
+    evaluation["completion"] += completion
+    evaluation["time"] = time
+    if completion >= 100 and metric.get("elapsed_time_in_milliseconds"):
+        lap = metric["elapsed_time_in_milliseconds"] / 1000
+        evaluation["lap"] = min(evaluation["lap"] or lap, lap)
+
+
+def ingest_checkpoints(state, checkpoints):
+    """deepracer_checkpoints.json: a better best checkpoint counts as an improvement."""
+    best = (checkpoints or {}).get("best_checkpoint") or {}
+    metric = best.get("avg_eval_metric")
+    if metric is None:
+        return
+    if _improved(state, "best_checkpoint", metric,
+                 lambda new, old: new > old + abs(old) * MIN_CHECKPOINT_GAIN) and state["last_time"] is not None:
+        state["last_improvement"] = state["last_time"]
+
+
+def check(state, window_minutes):
+    """Reason to stop, or None."""
+    if state["evaluations"] < MIN_EVALUATIONS or state["last_improvement"] is None:
+        return None
+    idle = state["last_time"] - state["last_improvement"]
+    if idle < window_minutes * 60:
+        return None
+    lap = "{:.2f}s".format(state["best_lap"]) if state["best_lap"] is not None else "none"
+    return "no improvement for {:.0f} minutes after {} evaluations, best rolling completion {:.1f}%, best lap {}".format(
+        idle / 60, state["evaluations"], state["best_completion"] or 0, lap)
+
+
+def update(state, metrics, checkpoints, window_minutes):
+    """Consume the new entries of the metrics list, return the reason to stop or None."""
+    if len(metrics) < state["seen"]:
+        # a new or continued training rewrote the metrics
+        state.clear()
+        state.update(new_state())
+    for metric in metrics[state["seen"]:]:
+        state["seen"] += 1
+        ingest_metric(state, metric)
+        reason = check(state, window_minutes)
+        if reason:
+            return reason
+    ingest_checkpoints(state, checkpoints)
+    return check(state, window_minutes)
+
+
+def _load(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stop the training when the evaluations stopped improving")
+    parser.add_argument("--workdir", default=os.path.expanduser("~/deepracer-for-cloud"))
+    parser.add_argument("--metrics", help="default: <workdir>/TrainingMetrics.json")
+    parser.add_argument("--checkpoints", help="default: <workdir>/deepracer_checkpoints.json")
+    parser.add_argument("--state-file", help="default: <workdir>/early_stop_state.json")
+    parser.add_argument("--window", type=float, default=float(os.environ.get("DR_EARLY_STOP_MINUTES") or 0),
+                        help="minutes without improvement before stopping, default DR_EARLY_STOP_MINUTES, 0 disables")
+    parser.add_argument("--dry-run", action="store_true", help="print the decision, do not stop")
+    args = parser.parse_args()
+    if args.window <= 0:
+        return
+
+    metrics_file = args.metrics or os.path.join(args.workdir, "TrainingMetrics.json")
+    state_file = args.state_file or os.path.join(args.workdir, "early_stop_state.json")
+    state = new_state() if args.dry_run else (_load(state_file) or new_state())
+    if state["stop"]:
+        return
+    metrics = (_load(metrics_file) or {}).get("metrics", [])
+    checkpoints = _load(args.checkpoints or os.path.join(args.workdir, "deepracer_checkpoints.json"))
+    reason = update(state, metrics, checkpoints, args.window)
+    if args.dry_run:
+        print(json.dumps({key: value for key, value in state.items() if key != "evaluation"}, indent=2))
+        print("stop: " + reason if reason else "continue")
+        return
+    state["stop"] = reason
+    with open(state_file + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(state_file + ".tmp", state_file)
+    if reason:
+        print("stopping: " + reason, flush=True)
+        subprocess.run(["bash", "-lc", STOP.format(reason=reason)])
+
+
+if __name__ == "__main__":
+    main()
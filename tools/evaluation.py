@@ -0,0 +1,375 @@
+"""Evaluate several models or checkpoints in parallel and rank them on a leaderboard.
+
+Each model is a model prefix, or <model prefix>@<checkpoint> for a checkpoint kept by
+tools.checkpoint_store, which is restored to <model prefix>-eval-<checkpoint> first. The
+evaluations run on --workers slots at the same time, each with its own DR_RUN_ID, with the
+DR_EVAL_* settings of run.env (--trials overrides DR_EVAL_NUMBER_OF_TRIALS). Their robomaker log
+is parsed as it is written: the SIM_TRACE_LOG steps of a trial give its progress, off track count
+and lap time, and the Testing> line that ends it gives its reward and steps. Every trial is
+appended to the results table (a csv) as soon as it ends, and models that already have all their
+trials there are skipped, so an interrupted run continues where it stopped.
+
+The leaderboard ranks the models by completed trials, then by median lap time, with the 10th, 50th
+and 90th lap time percentiles, a bootstrap CONFIDENCE interval of the mean lap time and a Wilson
+interval of the completion rate. A log without SIM_TRACE_LOG lines only has the Testing> lines,
+its lap times are steps / STEPS_PER_SECOND and its completion is unknown.
+
+--replay is a stub evaluator for running this locally: it replays recorded logs, <model>.log or
+<model>@<checkpoint>.log of a directory (docker logs, output.txt or robomaker logs), instead of
+starting dr-start-evaluation. Recorded evaluations are in tests/fixtures/evaluation.
+
+Example (on the instance):
+    cd ~/deepracer-for-cloud/custom_files && python3 -m tools.evaluation model-a model-b model-b@12 --workers 2
+Example (locally):
+    python3 -m tools.evaluation model-a model-b model-c --replay tests/fixtures/evaluation --results evaluations.csv
+"""
+import argparse, csv, json, math, os, queue, random, re, subprocess, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+from .config_session import ConfigSession
+from .failure_watcher import ACTIVATE
+from .log_collector import STEPS_PER_SECOND
+from .sim_trace import parse_line
+
+TESTING_FIELD = re.compile(r"([A-Za-z][A-Za-z ]*)=([^,]+)")
+RESULT_COLUMNS = ["model", "trial", "reward", "steps", "progress", "off_track", "complete", "lap_time"]
+PERCENTILES = (10, 50, 90)
+CONFIDENCE = 0.95
+BOOTSTRAP_SAMPLES = 2000
+CONTAINER_WAIT = 600
+RUN_ENV = "custom-files/run.env"
+TRIALS = 3
+
+START = "export DR_RUN_ID={slot} DR_LOCAL_S3_MODEL_PREFIX={prefix} DR_EVAL_NUMBER_OF_TRIALS={trials}; dr-start-evaluation -q"
+STOP = "export DR_RUN_ID={slot}; dr-stop-evaluation"
+
+
+def parse_testing(text):
+    """Fields of a `Testing> Name=main_level/agent, Worker=0, Episode=1, Total reward=..., Steps=...` line."""
+    position = text.find("Testing>")
+    if position < 0:
+        return None
+    fields = {name.strip(): value.strip() for name, value in TESTING_FIELD.findall(text[position + 8:])}
+    try:
+        return {"reward": float(fields["Total reward"]), "steps": int(float(fields["Steps"]))}
+    except (KeyError, ValueError):
+        return None
+
+
+class TrialParser:
+    """Turns the log lines of one evaluation into trials, one per Testing> line."""
+
+    def __init__(self):
+        self.trials = []
+        self.reset()
+
+    def reset(self):
+        self.start = self.last = None
+        self.progress = None
+        self.off_track = 0
+        self.complete = False
+
+    def feed(self, text):
+        """Fold one line in, return the trial it ended or None."""
+        row = parse_line(text)
+        if row is not None:
+            steps, progress, tstamp, status = row[1], row[11], row[14], row[15]
+            if self.start is None:
+                # the first step is logged one step after the episode started
+                self.start = tstamp - steps / STEPS_PER_SECOND
+            self.last = tstamp
+            self.progress = max(self.progress or 0.0, progress)
+            self.off_track += status == "off_track"
+            self.complete |= status == "lap_complete"
+            return None
+        testing = parse_testing(text)
+        if testing is None:
+            return None
+        if self.start is None:
+            lap_time, complete = testing["steps"] / STEPS_PER_SECOND, None
+        else:
+            lap_time, complete = (round(self.last - self.start, 3) if self.complete else None), self.complete
+        trial = dict(testing, trial=len(self.trials) + 1, progress=self.progress, off_track=self.off_track,
+                     complete=complete, lap_time=lap_time)
+        self.trials.append(trial)
+        self.reset()
+        return trial
+
+
+class ReplayEvaluator:
+    """Stub evaluator: the lines of a recorded log, with delay seconds after every Testing> line."""
+
+    def __init__(self, directory, delay=0.0):
+        self.directory = directory
+        self.delay = delay
+
+    def __call__(self, model, slot, trials):
+        prefix, _, _ = model.partition("@")
+        for name in (model, prefix):
+            path = os.path.join(self.directory, name + ".log")
+            if os.path.exists(path):
+                break
+        else:
+            raise FileNotFoundError("no recorded evaluation {}.log in {}".format(model, self.directory))
+        with open(path, "r", errors="replace") as f:
+            for line in f:
+                yield line
+                if self.delay and "Testing>" in line:
+                    time.sleep(self.delay)
+
+
+class DockerEvaluator:
+    """Runs dr-start-evaluation with DR_RUN_ID=slot and follows the log of its robomaker container."""
+
+    def __init__(self, bucket=None, store=None, docker="docker"):
+        self.bucket = bucket
+        self.store = store
+        self.docker = docker
+        self.lock = threading.Lock()
+
+    def prefix(self, model):
+        """Model prefix to evaluate, restoring a checkpoint from the checkpoint store first."""
+        prefix, _, checkpoint = model.partition("@")
+        if not checkpoint:
+            return prefix
+        import tempfile
+        import boto3
+        from .checkpoint_store import CheckpointStore
+        store_bucket, _, store_prefix = self.store.partition("/")
+        target = "{}-eval-{}".format(prefix, checkpoint)
+        with tempfile.TemporaryDirectory() as work_dir:
+            CheckpointStore(store_bucket, store_prefix, boto3.client("s3")).restore_to_prefix(
+                checkpoint, self.bucket, target, work_dir)
+        return target
+
+    def container(self, slot):
+        deadline = time.time() + CONTAINER_WAIT
+        while time.time() < deadline:
+            names = subprocess.run([self.docker, "ps", "--filter", "name=deepracer-eval-{}".format(slot),
+                                    "--format", "{{.Names}}"], capture_output=True, text=True).stdout.split()
+            robomaker = [name for name in names if "robomaker" in name]
+            if robomaker:
+                return robomaker[0]
+            time.sleep(5)
+        raise TimeoutError("no robomaker container for evaluation {} after {}s".format(slot, CONTAINER_WAIT))
+
+    def __call__(self, model, slot, trials):
+        prefix = self.prefix(model)
+        with self.lock:
+            # dr-start-evaluation uploads the custom files and reads the environment, one at a time
+            subprocess.run(["bash", "-lc", ACTIVATE + START.format(slot=slot, prefix=prefix, trials=trials)],
+                           check=True)
+        process = subprocess.Popen([self.docker, "logs", "--follow", self.container(slot)],
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors="replace")
+        try:
+            yield from process.stdout
+        finally:
+            process.kill()
+            process.wait()
+            subprocess.run(["bash", "-lc", ACTIVATE + STOP.format(slot=slot)])
+
+
+def load_results(path):
+    """Rows of a results table, with the numbers parsed back."""
+    if not os.path.exists(path):
+        return []
+    rows = []
+    with open(path, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            for key in ("reward", "progress", "lap_time"):
+                row[key] = float(row[key]) if row[key] else None
+            for key in ("trial", "steps", "off_track"):
+                row[key] = int(row[key])
+            row["complete"] = {"True": True, "False": False}.get(row["complete"])
+            rows.append(row)
+    return rows
+
+
+class Orchestrator:
+    """Schedules the evaluations on worker slots and streams their trials into the results table."""
+
+    def __init__(self, evaluator, results_file, trials, workers=1, on_trial=None):
+        self.evaluator = evaluator
+        self.results_file = results_file
+        self.trials = trials
+        self.workers = workers
+        self.on_trial = on_trial or (lambda row: None)
+        self.lock = threading.Lock()
+        self.slots = queue.Queue()
+        for slot in range(workers):
+            self.slots.put(slot)
+
+    def record(self, row):
+        with self.lock:
+            new = not os.path.exists(self.results_file) or os.path.getsize(self.results_file) == 0
+            with open(self.results_file, "a", newline="") as f:
+                writer = csv.DictWriter(f, RESULT_COLUMNS)
+                if new:
+                    writer.writeheader()
+                writer.writerow(row)
+            self.on_trial(row)
+
+    def evaluate(self, model, done=0):
+        """Run one evaluation on a free slot, recording the trials after the done ones. Returns the trial count."""
+        slot = self.slots.get()
+        try:
+            parser = TrialParser()
+            lines = self.evaluator(model, slot, self.trials)
+            try:
+                for line in lines:
+                    trial = parser.feed(line)
+                    if trial is None:
+                        continue
+                    if trial["trial"] > done:
+                        self.record(dict({key: trial[key] for key in RESULT_COLUMNS if key != "model"}, model=model))
+                    if trial["trial"] >= self.trials:
+                        break
+            finally:
+                lines.close()
+            return len(parser.trials)
+        finally:
+            self.slots.put(slot)
+
+    def run(self, models):
+        """Evaluate the models that do not have all their trials in the results table yet."""
+        done = {}
+        for row in load_results(self.results_file):
+            done[row["model"]] = max(done.get(row["model"], 0), row["trial"])
+        pending = [model for model in models if done.get(model, 0) < self.trials]
+        errors = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {model: pool.submit(self.evaluate, model, done.get(model, 0)) for model in pending}
+            for model, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    errors[model] = "{}: {}".format(type(e).__name__, e)
+        return errors
+
+
+def percentile(ordered, p):
+    """Linear interpolation percentile of a sorted list."""
+    if not ordered:
+        return None
+    position = (len(ordered) - 1) * p / 100.0
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def bootstrap_interval(values, confidence=CONFIDENCE, samples=BOOTSTRAP_SAMPLES, seed=0):
+    """Percentile bootstrap interval of the mean."""
+    if len(values) < 2:
+        return None, None
+    rng = random.Random(seed)
+    means = sorted(sum(rng.choices(values, k=len(values))) / len(values) for _ in range(samples))
+    tail = (1 - confidence) / 2 * 100
+    return percentile(means, tail), percentile(means, 100 - tail)
+
+
+def wilson_interval(successes, count, z=1.96):
+    """Wilson score interval of a proportion, in percent."""
+    if not count:
+        return None, None
+    p = successes / count
+    centre = (p + z * z / (2 * count)) / (1 + z * z / count)
+    half = z * math.sqrt(p * (1 - p) / count + z * z / (4 * count * count)) / (1 + z * z / count)
+    return 100 * (centre - half), 100 * (centre + half)
+
+
+def leaderboard(rows, models=None):
+    """One summary per model, best first."""
+    by_model = {}
+    for row in rows:
+        if models is None or row["model"] in models:
+            by_model.setdefault(row["model"], []).append(row)
+    board = []
+    for model, trials in by_model.items():
+        known = [t for t in trials if t["complete"] is not None]
+        completed = sum(1 for t in known if t["complete"])
+        laps = sorted(t["lap_time"] for t in trials if t["lap_time"] is not None and t["complete"] is not False)
+        low, high = bootstrap_interval(laps)
+        completion_low, completion_high = wilson_interval(completed, len(known))
+        board.append({
+            "model": model,
+            "trials": len(trials),
+            "completion": 100.0 * completed / len(known) if known else None,
+            "completion_interval": [completion_low, completion_high],
+            "laps": len(laps),
+            "lap_percentiles": {str(p): percentile(laps, p) for p in PERCENTILES},
+            "mean_lap": sum(laps) / len(laps) if laps else None,
+            "mean_lap_interval": [low, high],
+            "mean_reward": sum(t["reward"] for t in trials) / len(trials),
+            "off_track_per_trial": sum(t["off_track"] for t in trials) / len(trials),
+        })
+    return sorted(board, key=lambda entry: (-(entry["completion"] if entry["completion"] is not None else 100.0),
+                                            entry["lap_percentiles"]["50"] or math.inf))
+
+
+def _number(value, digits=2):
+    return "-" if value is None else "{:.{}f}".format(value, digits)
+
+
+def print_leaderboard(board):
+    print("{:<4} {:<36} {:>6} {:>15} {:>7} {:>7} {:>7} {:>20} {:>9} {:>9}".format(
+        "#", "Model", "trials", "complete %", "p10 s", "p50 s", "p90 s", "mean lap s (95% CI)", "reward", "off/trial"))
+    for rank, entry in enumerate(board, start=1):
+        low, high = entry["completion_interval"]
+        completion = "-" if entry["completion"] is None else "{:.0f} ({:.0f}-{:.0f})".format(entry["completion"], low, high)
+        low, high = entry["mean_lap_interval"]
+        mean = _number(entry["mean_lap"]) + ("" if low is None else " ({:.2f}-{:.2f})".format(low, high))
+        laps = entry["lap_percentiles"]
+        print("{:<4} {:<36} {:>6} {:>15} {:>7} {:>7} {:>7} {:>20} {:>9.1f} {:>9.2f}".format(
+            rank, entry["model"][:36], entry["trials"], completion, _number(laps["10"]), _number(laps["50"]),
+            _number(laps["90"]), mean, entry["mean_reward"], entry["off_track_per_trial"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate models and checkpoints in parallel and rank them")
+    parser.add_argument("models", nargs="+", help="model prefix or <model prefix>@<checkpoint>")
+    parser.add_argument("--workers", type=int, default=1, help="evaluations running at the same time")
+    parser.add_argument("--trials", type=int, help="trials per model, default DR_EVAL_NUMBER_OF_TRIALS")
+    parser.add_argument("--run-env", default=RUN_ENV)
+    parser.add_argument("--results", default="evaluations.csv", help="results table, one row per trial")
+    parser.add_argument("--json", help="also write the leaderboard to this file")
+    parser.add_argument("--replay", help="stub evaluator: directory with recorded <model>.log evaluations")
+    parser.add_argument("--replay-delay", type=float, default=0.0, help="seconds the stub takes per trial")
+    parser.add_argument("--bucket", default=os.environ.get("DR_LOCAL_S3_BUCKET"),
+                        help="bucket of the model prefixes, default DR_LOCAL_S3_BUCKET")
+    parser.add_argument("--store", help="bucket/prefix of the checkpoint store for model@checkpoint, "
+                                        "default $DR_UPLOAD_S3_BUCKET/$DR_UPLOAD_S3_PREFIX-checkpoints")
+    args = parser.parse_args()
+
+    trials = args.trials
+    if not trials:
+        variables = ConfigSession().variables(args.run_env) if os.path.exists(args.run_env) else {}
+        trials = int(variables.get("DR_EVAL_NUMBER_OF_TRIALS", TRIALS))
+    if args.replay:
+        evaluator = ReplayEvaluator(args.replay, args.replay_delay)
+    else:
+        store = args.store or "{}/{}-checkpoints".format(os.environ.get("DR_UPLOAD_S3_BUCKET"),
+                                                         os.environ.get("DR_UPLOAD_S3_PREFIX"))
+        evaluator = DockerEvaluator(args.bucket, store)
+
+    def on_trial(row):
+        print("{} trial {}: {}, reward {:.1f}, {} off track".format(
+            row["model"], row["trial"],
+            "lap {:.2f}s".format(row["lap_time"]) if row["lap_time"] is not None else
+            "progress {}%".format(_number(row["progress"], 1)), row["reward"], row["off_track"]), flush=True)
+
+    started = time.time()
+    errors = Orchestrator(evaluator, args.results, trials, args.workers, on_trial).run(args.models)
+    for model, error in errors.items():
+        print("{}: evaluation failed: {}".format(model, error))
+    board = leaderboard(load_results(args.results), set(args.models))
+    print("{} models evaluated in {:.1f}s".format(len(board), time.time() - started))
+    print_leaderboard(board)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(board, f, indent=2)
+    if errors:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
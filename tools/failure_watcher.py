@@ -0,0 +1,292 @@
+"""Event driven detection of failed trainings: out of memory, exited containers, stalls, reward collapse.
+
+error_monitoring.sh checks once an hour and web_monitoring.sh every 5 minutes. The watcher instead
+reacts to each event as it arrives:
+
+  out_of_memory     "ran out of memory" in the sagemaker log, or a docker "oom" event
+  container_exit    a docker "die" event of a sagemaker, rlcoach or robomaker container that was
+                    not stopped (docker sends "kill" first for dr-stop-training and docker stop)
+  stalled           no step from any robomaker and no policy training for STALL_SECONDS, or one
+                    worker without a step for STALL_SECONDS while the others keep going
+  reward_collapse   the mean reward of the last COLLAPSE_WINDOW episodes drops under
+                    COLLAPSE_RATIO of the best such mean, or rewards are NaN
+
+Docker events come from `docker events`, log lines from the log collector, which calls
+on_log_line() for every line it reads. An alert publishes to the SNS topic and runs the flow of
+the start and spot interruption scripts: upload the best model with dr-upload-model -bf, then
+restart the training with dr-stop-training / dr-start-training, at most MAX_RESTARTS times. Each
+alert kind is muted for COOLDOWN_SECONDS after it fired.
+
+--replay feeds recorded logs (`docker logs --timestamps` output, one <container name>.log per
+container) and an events.jsonl through the same detection with their own timestamps, printing
+the alerts with the time they were raised instead of acting on them. A fake docker whose
+`events` prints recorded events can stand in for docker with --docker. Recorded cases are in
+tests/fixtures/failure_watcher, with such a fake docker.
+
+Example:
+    python3 -m tools.failure_watcher --replay tests/fixtures/failure_watcher/oom
+    python3 -m tools.log_collector --workdir ~/deepracer-for-cloud --watch
+"""
+import argparse, heapq, json, math, os, subprocess, threading, time
+from collections import deque
+
+from .log_collector import EXITED_CONTAINER, container_kind, epoch, split_timestamp
+from .sim_trace import parse_line
+
+STALL_SECONDS = 120
+COLLAPSE_WINDOW = 20
+COLLAPSE_RATIO = 0.3
+MIN_EPISODES = 3 * COLLAPSE_WINDOW
+COOLDOWN_SECONDS = 900
+MAX_RESTARTS = 3
+
+ACTIVATE = "cd ~/deepracer-for-cloud && source bin/activate.sh > /dev/null 2>&1 && source /etc/profile.d/dots_vars.sh; "
+UPLOAD = "dr-upload-model -bf"
+RESTART = "dr-stop-training; sleep 60; echo y | docker container prune; dr-reload; dr-start-training -qwv"
+NOTIFY = ('aws sns publish --topic-arn $MY_SNS_TOPIC --region $DEEPRACER_REGION --message '
+          '"Training problem detected for $STACK_NAME in region $DEEPRACER_REGION: {message}"')
+# what each alert runs after the notification
+ACTIONS = {
+    "out_of_memory": [UPLOAD, RESTART],
+    "container_exit": [UPLOAD, RESTART],
+    "stalled": [UPLOAD, RESTART],
+    "reward_collapse": [UPLOAD],
+}
+
+
+class FailureWatcher:
+
+    def __init__(self, on_alert=None, stall_seconds=STALL_SECONDS, collapse_window=COLLAPSE_WINDOW,
+                 collapse_ratio=COLLAPSE_RATIO, cooldown=COOLDOWN_SECONDS, since=None):
+        self.on_alert = on_alert or (lambda kind, message, when: None)
+        self.stall_seconds = stall_seconds
+        self.collapse_window = collapse_window
+        self.collapse_ratio = collapse_ratio
+        self.cooldown = cooldown
+        # log lines older than this are history read again after a restart of the collector
+        self.since = since
+        self.lock = threading.Lock()
+        self.last_step = {}
+        self.last_activity = None
+        self.episode_reward = {}
+        self.episodes = deque(maxlen=collapse_window)
+        self.episode_count = 0
+        self.best_mean = None
+        self.stopping = set()
+        self.fired = {}
+        self.alerts = []
+
+    def alert(self, kind, message, when):
+        last = self.fired.get(kind)
+        if last is not None and when - last < self.cooldown:
+            return
+        self.fired[kind] = when
+        self.alerts.append((when, kind, message))
+        self.on_alert(kind, message, when)
+
+    def on_docker_event(self, event):
+        """A `docker events --format '{{json .}}'` record of a container."""
+        action = event.get("Action") or event.get("status", "")
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        name, image = attributes.get("name", ""), attributes.get("image", event.get("from", ""))
+        when = event.get("timeNano", 0) / 1e9 or event.get("time", time.time())
+        with self.lock:
+            if action == "oom":
+                self.alert("out_of_memory", "container {} ran out of memory".format(name), when)
+            elif action == "kill":
+                self.stopping.add(name)
+            elif action == "die" and EXITED_CONTAINER.search(image + " " + name):
+                if name in self.stopping or attributes.get("exitCode") == "0":
+                    # stopped on purpose, the training is over or being restarted
+                    self.stopping.discard(name)
+                    self.last_step.pop(name, None)
+                    self.last_activity = None
+                else:
+                    self.alert("container_exit", "container {} exited with code {}".format(
+                        name, attributes.get("exitCode", "?")), when)
+            elif action == "start" and container_kind(image, name) == "robomaker":
+                # a restarted worker gets the full stall period before it counts as stalled
+                self.last_step[name] = when
+
+    def on_log_line(self, kind, name, text, when):
+        """One log line of a container, when is its timestamp in seconds."""
+        if when is None or (self.since is not None and when < self.since):
+            return
+        with self.lock:
+            if kind == "sagemaker":
+                if "ran out of memory" in text:
+                    self.alert("out_of_memory", "sagemaker: " + text.strip()[:200], when)
+                if text.startswith("Policy training") or text.startswith("Training>"):
+                    self.last_activity = when
+                return
+            if kind != "robomaker" or not text.startswith("SIM_TRACE_LOG"):
+                return
+            row = parse_line(text)
+            if row is None:
+                return
+            self.last_step[name] = self.last_activity = when
+            reward = row[8]
+            self.episode_reward[name] = self.episode_reward.get(name, 0.0) + reward
+            if math.isnan(reward):
+                self.alert("reward_collapse", "{} returned a NaN reward".format(name), when)
+            if row[9]:
+                self.end_episode(self.episode_reward.pop(name), when)
+
+    def end_episode(self, total, when):
+        self.episodes.append(total)
+        self.episode_count += 1
+        if len(self.episodes) < self.collapse_window:
+            return
+        mean = sum(self.episodes) / len(self.episodes)
+        if self.best_mean is None or mean > self.best_mean:
+            self.best_mean = mean
+        elif (self.episode_count >= MIN_EPISODES and self.best_mean > 0
+              and mean < self.collapse_ratio * self.best_mean):
+            self.alert("reward_collapse", "mean reward of the last {} episodes is {:.1f}, the best was {:.1f}".format(
+                len(self.episodes), mean, self.best_mean), when)
+
+    def check(self, now):
+        """Time based checks, called every few seconds (or for every replayed event)."""
+        with self.lock:
+            if self.last_activity is not None and now - self.last_activity > self.stall_seconds:
+                self.alert("stalled", "no simulation step and no policy training for {:.0f}s".format(
+                    now - self.last_activity), now)
+                return
+            active = [name for name, last in self.last_step.items() if now - last <= self.stall_seconds]
+            stalled = [name for name, last in self.last_step.items() if now - last > self.stall_seconds]
+            if active and stalled:
+                self.alert("stalled", "no simulation step for {:.0f}s from {} while other workers run".format(
+                    now - min(self.last_step[name] for name in stalled), ", ".join(sorted(stalled))), now)
+
+
+class FlowRunner:
+    """Publishes alerts and runs the upload / restart commands of the instance, one at a time."""
+
+    def __init__(self, actions=ACTIONS, max_restarts=MAX_RESTARTS, dry_run=False):
+        self.actions = actions
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        self.dry_run = dry_run
+        self.lock = threading.Lock()
+
+    def __call__(self, kind, message, when):
+        print("{} ALERT {}: {}".format(time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(when)), kind, message), flush=True)
+        threading.Thread(target=self.run, args=(kind, message), daemon=True).start()
+
+    def run(self, kind, message):
+        with self.lock:
+            commands = [NOTIFY.format(message=message.replace('"', "'"))]
+            for command in self.actions.get(kind, []):
+                if command == RESTART:
+                    if self.restarts >= self.max_restarts:
+                        commands[0] = NOTIFY.format(message="{}, not restarting after {} restarts".format(
+                            message.replace('"', "'"), self.restarts))
+                        continue
+                    self.restarts += 1
+                commands.append(command)
+            for command in commands:
+                if self.dry_run:
+                    print("would run: " + command, flush=True)
+                else:
+                    subprocess.run(["bash", "-lc", ACTIVATE + command])
+
+
+def docker_events(docker="docker", reconnect=5):
+    """Yield container events from `docker events`, started again when it stops unless reconnect is 0."""
+    while True:
+        process = subprocess.Popen([docker, "events", "--filter", "type=container", "--format", "{{json .}}"],
+                                   stdout=subprocess.PIPE, text=True)
+        try:
+            for line in process.stdout:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+        finally:
+            process.kill()
+            process.wait()
+        if not reconnect:
+            return
+        time.sleep(reconnect)
+
+
+def watch_events(watcher, events, interval=5):
+    """Feed events to the watcher from a thread and run the time based checks every interval."""
+    def feed():
+        for event in events:
+            watcher.on_docker_event(event)
+
+    def tick():
+        while True:
+            watcher.check(time.time())
+            time.sleep(interval)
+
+    for target in (feed, tick):
+        threading.Thread(target=target, daemon=True).start()
+
+
+def _replay_logs(path, name):
+    kind = container_kind(name, name)
+    with open(path, "r", errors="replace") as f:
+        for line in f:
+            timestamp, text = split_timestamp(line)
+            when = epoch(timestamp)
+            if when is not None:
+                yield when, 1, ("log", kind, name, text)
+
+
+def _replay_events(path):
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            yield event.get("timeNano", 0) / 1e9 or event.get("time", 0), 0, ("event", event)
+
+
+def replay(directory, watcher):
+    """Run recorded logs and events of a directory through a watcher in timestamp order."""
+    streams = []
+    for file in sorted(os.listdir(directory)):
+        path = os.path.join(directory, file)
+        if file == "events.jsonl":
+            streams.append(_replay_events(path))
+        elif file.endswith(".log"):
+            streams.append(_replay_logs(path, file[:-4]))
+    for when, _, item in heapq.merge(*streams, key=lambda entry: entry[:2]):
+        if item[0] == "event":
+            watcher.on_docker_event(item[1])
+        else:
+            watcher.on_log_line(item[1], item[2], item[3], when)
+        watcher.check(when)
+    return watcher.alerts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detect failed trainings from docker events and container logs")
+    parser.add_argument("--replay", help="directory with recorded <container>.log files and events.jsonl")
+    parser.add_argument("--docker", default="docker", help="docker executable")
+    parser.add_argument("--stall-seconds", type=float, default=STALL_SECONDS)
+    parser.add_argument("--collapse-ratio", type=float, default=COLLAPSE_RATIO)
+    parser.add_argument("--dry-run", action="store_true", help="print the commands instead of running them")
+    args = parser.parse_args()
+
+    if args.replay:
+        watcher = FailureWatcher(stall_seconds=args.stall_seconds, collapse_ratio=args.collapse_ratio)
+        started = time.time()
+        alerts = replay(args.replay, watcher)
+        for when, kind, message in alerts:
+            print("{} {:<16} {}".format(time.strftime("%H:%M:%S", time.gmtime(when)), kind, message))
+        print("{} alerts, replayed in {:.2f}s".format(len(alerts), time.time() - started))
+        return
+    # standalone: docker events only, the log based checks run in the log collector (--watch)
+    watcher = FailureWatcher(FlowRunner(dry_run=args.dry_run), args.stall_seconds,
+                             collapse_ratio=args.collapse_ratio, since=time.time())
+    watch_events(watcher, docker_events(args.docker))
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,469 @@
+"""Hyperparameter search with successive halving (Hyperband) over training stacks.
+
+Instead of trying lr, batch_size, beta_entropy, num_epochs or discount_factor one at a time from
+the menu, a search spec describes ranges to sample:
+
+    {
+      "name": "hb-lr",
+      "base_stack": "base",
+      "instance": "spot",
+      "space": {
+        "lr": {"log_uniform": [0.00001, 0.001]},
+        "beta_entropy": {"log_uniform": [0.001, 0.05]},
+        "discount_factor": {"uniform": [0.95, 0.999]},
+        "num_epochs": {"int": [3, 10]},
+        "batch_size": [32, 64, 128]
+      },
+      "set": {"DR_WORLD_NAME": "2022_may_open_ccw"},
+      "min_minutes": 30, "max_minutes": 270, "eta": 3, "trials": 18, "parallel": 3
+    }
+
+Space and set keys are the tools.sweep grid keys: a list is a choice, a uniform, log_uniform or
+int range is sampled. Every trial is a tools.sweep model (custom files in sweeps/<name>/<model>,
+launched with the create instance script) with a training time budget measured from its first
+TrainingMetrics.json entry, so stack creation does not count.
+
+The trials are spread over Hyperband brackets. A bracket has rungs at max_minutes / eta**k minutes
+of training. The most aggressive bracket starts at min_minutes, the last one runs every trial to
+max_minutes. When a trial reaches a rung, its score (rolling completion of the last evaluations
+then best evaluation lap, as in tools.early_stop) is compared with the trials of its bracket that
+reached the same rung before. Once at least eta trials have, only the top 1/eta keep training:
+the others are stopped with stop-training.sh (which uploads and imports their best model), and
+their slot launches the next trial. This is the asynchronous form of successive halving: a
+training cannot be paused, so a trial never waits for the rest of its rung. Trials that reach
+max_minutes are stopped the same way.
+
+The launcher is pluggable: StackLauncher creates stacks and reads the metrics from S3, while
+SimulatedLauncher generates TrainingMetrics.json entries from learning curves on a virtual clock,
+so a whole search runs locally in seconds and shows how much training time the halving saves.
+
+Example:
+    python3 -m tools.hyperband search.json --simulate
+    python3 -m tools.hyperband search.json --parallel 3 --bucket my-bucket
+"""
+import argparse, json, math, os, random, subprocess, time
+from concurrent.futures import ThreadPoolExecutor
+
+from .config_session import ConfigSession
+from .early_stop import end_evaluation, ingest_metric, new_state
+from .sweep import SWEEPS_DIR, STACK_NAME, launch, launch_command, log_file, materialize
+from .validate import env_variables
+
+MIN_MINUTES = 30
+MAX_MINUTES = 270
+ETA = 3
+TRIALS = 18
+PARALLEL = 2
+POLL_SECONDS = 120
+# stack creation, instance start and the first policy training before the first metrics
+STARTUP_MINUTES = 45
+
+# simulated optimum and width (in natural log units) of each hyperparameter
+SIMULATED_OPTIMA = {"lr": (3e-4, 1.2), "batch_size": (64, 1.0), "beta_entropy": (0.01, 1.5), "num_epochs": (5, 1.0),
+                    "discount_factor": (0.99, 1.5)}
+SIMULATED_STARTUP_MINUTES = 12
+SIMULATED_ITERATION_MINUTES = 5
+SIMULATED_EPISODES = (20, 5)
+SIMULATED_LAP = 10.0
+
+
+def sample(space, rng):
+    """One set of parameters from a search space."""
+    parameters = {}
+    for key in sorted(space):
+        value = space[key]
+        if isinstance(value, list):
+            parameters[key] = rng.choice(value)
+        elif "uniform" in value:
+            parameters[key] = float("{:.6g}".format(rng.uniform(*value["uniform"])))
+        elif "log_uniform" in value:
+            low, high = value["log_uniform"]
+            parameters[key] = float("{:.6g}".format(math.exp(rng.uniform(math.log(low), math.log(high)))))
+        elif "int" in value:
+            parameters[key] = rng.randint(*value["int"])
+        else:
+            raise ValueError("{}: expected a list of values or a uniform, log_uniform or int range".format(key))
+    return parameters
+
+
+def brackets(min_minutes=MIN_MINUTES, max_minutes=MAX_MINUTES, eta=ETA, count=None):
+    """Hyperband brackets, most aggressive first: rung minutes before max_minutes and share of the trials."""
+    deepest = int(math.floor(math.log(max_minutes / min_minutes, eta) + 1e-9))
+    result = []
+    for halvings in range(deepest, -1, -1):
+        result.append({"rungs": [max_minutes / eta ** k for k in range(halvings, 0, -1)],
+                       "share": int(math.ceil((deepest + 1) / (halvings + 1) * eta ** halvings))})
+    return result[:count] if count else result
+
+
+def bracket_order(bracket_list):
+    """Bracket index of each trial in turn, interleaving the brackets by their share."""
+    return [index for _, index in sorted(((j + 0.5) / bracket["share"], index)
+                                         for index, bracket in enumerate(bracket_list)
+                                         for j in range(bracket["share"]))]
+
+
+def training_minutes(metrics):
+    if not metrics:
+        return 0.0
+    return (metrics[-1].get("metric_time", 0) - metrics[0].get("metric_time", 0)) / 60000
+
+
+def score(metrics, minutes=None):
+    """(rolling evaluation completion, best evaluation lap or None) of the first minutes of a training."""
+    state = new_state()
+    start = metrics[0].get("metric_time", 0) if metrics else 0
+    for metric in metrics:
+        if minutes is not None and metric.get("metric_time", 0) - start > minutes * 60000:
+            break
+        ingest_metric(state, metric)
+    end_evaluation(state)
+    completions = state["completions"]
+    return (sum(completions) / len(completions) if completions else 0.0), state["best_lap"]
+
+
+def _key(completion, lap):
+    return completion, -(lap if lap is not None else math.inf)
+
+
+def promoted(key, recorded, eta=ETA):
+    """Whether a score stays in the top 1/eta of the scores recorded at its rung (including itself)."""
+    if len(recorded) < eta:
+        return True
+    keep = max(1, len(recorded) // eta)
+    return key >= sorted(recorded, reverse=True)[keep - 1]
+
+
+class Hyperband:
+    """Launch, score and stop trials on a launcher until the trial budget is used."""
+
+    def __init__(self, launcher, spec, trials=None, state_file=None, on_event=None):
+        self.launcher = launcher
+        self.spec = spec
+        self.min_minutes = spec.get("min_minutes", MIN_MINUTES)
+        self.max_minutes = spec.get("max_minutes", MAX_MINUTES)
+        self.eta = spec.get("eta", ETA)
+        self.total = spec.get("trials", TRIALS)
+        self.parallel = spec.get("parallel", PARALLEL)
+        self.poll = spec.get("poll_seconds", POLL_SECONDS)
+        self.startup_minutes = spec.get("startup_minutes", STARTUP_MINUTES)
+        self.brackets = brackets(self.min_minutes, self.max_minutes, self.eta, spec.get("brackets"))
+        self.order = bracket_order(self.brackets)
+        self.trials = trials or []
+        self.state_file = state_file
+        self.on_event = on_event or (lambda message: None)
+
+    def new_trial(self):
+        index = len(self.trials)
+        model = "{}-{:02d}".format(self.spec["name"], index + 1)
+        if not STACK_NAME.match(model):
+            raise ValueError("{}: model names may only use A-Z, a-z, 0-9 and hyphens, up to 64 characters".format(model))
+        # seeded per trial, so a resumed search samples the same candidates
+        parameters = dict(self.spec.get("set", {}))
+        parameters.update(sample(self.spec["space"], random.Random("{}-{}".format(self.spec.get("seed", 0), index))))
+        trial = {"model": model, "parameters": parameters, "bracket": self.order[index % len(self.order)],
+                 "status": "running", "launched": self.launcher.clock(), "minutes": 0.0, "rungs": [],
+                 "completion": None, "lap": None, "reason": None}
+        self.trials.append(trial)
+        self.launcher.launch(model, parameters)
+        self.on_event("{}: launched in bracket {} with {}".format(model, trial["bracket"], json.dumps(parameters)))
+        return trial
+
+    def finish(self, trial, status, reason):
+        trial["status"], trial["reason"] = status, reason
+        self.launcher.stop(trial["model"])
+        self.on_event("{}: {} after {:.0f} minutes, {}".format(trial["model"], status, trial["minutes"], reason))
+
+    def check(self, trial):
+        """Read the metrics of a running trial and stop it at a rung it does not pass, or at max_minutes."""
+        error = self.launcher.error(trial["model"])
+        if error:
+            return self.finish(trial, "failed", error)
+        metrics = self.launcher.metrics(trial["model"])
+        if not metrics:
+            if self.launcher.clock() - trial["launched"] > self.startup_minutes * 60:
+                self.finish(trial, "failed", "no metrics {} minutes after the launch".format(self.startup_minutes))
+            return
+        trial["minutes"] = training_minutes(metrics)
+        rungs = self.brackets[trial["bracket"]]["rungs"]
+        while len(trial["rungs"]) < len(rungs) and trial["minutes"] >= rungs[len(trial["rungs"])]:
+            rung = len(trial["rungs"])
+            completion, lap = score(metrics, rungs[rung])
+            trial["rungs"].append({"minutes": rungs[rung], "completion": completion, "lap": lap})
+            trial["completion"], trial["lap"] = completion, lap
+            recorded = [_key(other["rungs"][rung]["completion"], other["rungs"][rung]["lap"])
+                        for other in self.trials
+                        if other["bracket"] == trial["bracket"] and len(other["rungs"]) > rung]
+            if not promoted(_key(completion, lap), recorded, self.eta):
+                return self.finish(trial, "stopped", "{:.1f}% completion at {:.0f} minutes, not in the top 1/{} of {}"
+                                   .format(completion, rungs[rung], self.eta, len(recorded)))
+            self.on_event("{}: passed the {:.0f} minute rung with {:.1f}% completion ({} trials so far)".format(
+                trial["model"], rungs[rung], completion, len(recorded)))
+        if trial["minutes"] >= self.max_minutes:
+            trial["completion"], trial["lap"] = score(metrics, self.max_minutes)
+            return self.finish(trial, "complete", "{:.1f}% completion".format(trial["completion"]))
+        trial["completion"], trial["lap"] = score(metrics)
+
+    def save(self):
+        if self.state_file:
+            with open(self.state_file + ".tmp", "w") as f:
+                json.dump({"spec": self.spec, "brackets": self.brackets, "trials": self.trials}, f, indent=2)
+            os.replace(self.state_file + ".tmp", self.state_file)
+
+    def run(self):
+        """Run the search to the end. Returns the trials, best first."""
+        while True:
+            running = [trial for trial in self.trials if trial["status"] == "running"]
+            while len(running) < self.parallel and len(self.trials) < self.total:
+                running.append(self.new_trial())
+            self.save()
+            if not running:
+                break
+            self.launcher.sleep(self.poll)
+            for trial in running:
+                self.check(trial)
+        return ranking(self.trials)
+
+
+def ranking(trials):
+    """Complete trials by score first, then the others by the deepest rung reached and score."""
+    return sorted(trials, key=lambda trial: (trial["status"] == "complete",
+                                             0 if trial["status"] == "complete" else len(trial["rungs"]),
+                                             _key(trial["completion"] or 0.0, trial["lap"])), reverse=True)
+
+
+def base_bucket(base_stack):
+    """The Bucket output of the base resources stack, as the create instance scripts read it."""
+    import boto3
+    outputs = boto3.client("cloudformation").describe_stacks(StackName=base_stack)["Stacks"][0].get("Outputs", [])
+    return next(output["OutputValue"] for output in outputs if output["OutputKey"] == "Bucket")
+
+
+class StackLauncher:
+    """Trials on training stacks, created through tools.sweep and stopped with stop-training.sh."""
+
+    def __init__(self, spec, sweeps_dir=SWEEPS_DIR, bucket=None, create_script=None, stop_script="./stop-training.sh",
+                 client=None):
+        self.spec = spec
+        self.sweeps_dir = sweeps_dir
+        self.bucket = bucket or base_bucket(spec["base_stack"])
+        self.create_script = create_script
+        self.stop_script = stop_script
+        if client is None:
+            import boto3
+            client = boto3.client("s3")
+        self.client = client
+        self.pool = ThreadPoolExecutor(max_workers=spec.get("parallel", PARALLEL))
+        self.launches = {}
+        # run.env of every trial, parsed again only when a trial rewrites it
+        self.config = ConfigSession()
+
+    def directory(self, model):
+        return os.path.join(self.sweeps_dir, self.spec["name"], model)
+
+    def launch(self, model, parameters):
+        directory = self.directory(model)
+        materialize(self.spec, model, parameters, directory)
+        command = launch_command(self.spec, model, parameters, self.create_script)
+        # the create script waits for the stack, keep polling the other trials meanwhile
+        self.launches[model] = self.pool.submit(launch, command, directory,
+                                                parameters.get("instance_type", self.spec.get("instance_type")))
+
+    def error(self, model):
+        future = self.launches.get(model)
+        if future is None or not future.done():
+            return None
+        try:
+            code = future.result()
+        except OSError as e:
+            return "cannot run the create script: {}".format(e)
+        if code:
+            return "create script exited with {}, see {}".format(code, log_file(self.directory(model)))
+        return None
+
+    def metrics(self, model):
+        run_env = os.path.join(self.directory(model), "run.env")
+        if not os.path.exists(run_env):
+            return []
+        run = env_variables(self.config, run_env)
+        prefix = run.get("DR_LOCAL_S3_METRICS_PREFIX") or run.get("DR_LOCAL_S3_MODEL_PREFIX", "") + "/metrics"
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=prefix + "/TrainingMetrics.json")["Body"]
+        except self.client.exceptions.ClientError:
+            return []
+        try:
+            return json.loads(body.read()).get("metrics", [])
+        except ValueError:
+            # caught while the training rewrites it, read it again at the next poll
+            return []
+
+    def stop(self, model):
+        with open(log_file(self.directory(model), "stop"), "a") as log:
+            subprocess.run([self.stop_script, model], stdout=log, stderr=subprocess.STDOUT)
+
+    def clock(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+def simulated_quality(parameters):
+    """Final completion share, between 0.15 and 1, of a training with these parameters in the simulation."""
+    distance = 0.0
+    for key, (optimum, width) in SIMULATED_OPTIMA.items():
+        if key in parameters:
+            if key == "discount_factor":
+                # compare effective horizons, 1 / (1 - discount)
+                value, optimum = 1 / (1 - min(parameters[key], 0.9999)), 1 / (1 - optimum)
+            else:
+                value = parameters[key]
+            distance += (math.log(value / optimum) / width) ** 2
+    return 0.15 + 0.85 * math.exp(-distance)
+
+
+class SimulatedLauncher:
+    """TrainingMetrics.json entries from a learning curve per trial, on a virtual clock that sleep() advances.
+
+    A training reaches its final completion (simulated_quality) with a time constant that shrinks
+    with the learning rate, so a high learning rate looks good at the first rung and loses later.
+    """
+
+    def __init__(self, seed=0, failure_rate=0.0):
+        self.seed = seed
+        self.failure_rate = failure_rate
+        self.now = 0.0
+        self.trials = {}
+
+    def launch(self, model, parameters):
+        rng = random.Random("{}-{}".format(self.seed, model))
+        quality = min(1.0, simulated_quality(parameters) * math.exp(rng.gauss(0, 0.05)))
+        tau = 60 * math.sqrt(3e-4 / parameters.get("lr", 3e-4)) * math.sqrt(parameters.get("batch_size", 64) / 64)
+        self.trials[model] = {"rng": rng, "quality": quality, "tau": tau, "metrics": [], "episode": 0,
+                              "start": self.now + SIMULATED_STARTUP_MINUTES * 60, "iteration": 0, "stopped": None,
+                              "failed": rng.random() < self.failure_rate}
+
+    def _iteration(self, trial):
+        """Training then evaluation episodes of one iteration, timed from the start of the training."""
+        rng, started = trial["rng"], trial["start"] + trial["iteration"] * SIMULATED_ITERATION_MINUTES * 60
+        entries = []
+        for phase, count in zip(["training", "evaluation"], SIMULATED_EPISODES):
+            for i in range(count):
+                minutes = (started - trial["start"]) / 60 + SIMULATED_ITERATION_MINUTES * (
+                    i / count * 0.8 if phase == "training" else 0.8 + i / count * 0.2)
+                share = trial["quality"] * (1 - math.exp(-minutes / trial["tau"])) * (0.7 if phase == "training" else 1)
+                complete = rng.random() < share
+                lap = SIMULATED_LAP * (1.5 - 0.5 * trial["quality"]) * (1 + 0.4 * math.exp(-minutes / trial["tau"]))
+                trial["episode"] += 1
+                entries.append({
+                    "phase": phase,
+                    "episode": trial["episode"],
+                    "trial": i + 1,
+                    "metric_time": int((trial["start"] + minutes * 60) * 1000),
+                    # better policies also get further before they leave the track
+                    "completion_percentage": 100 if complete else int(100 * min(1.0, 2 * share) * rng.random()),
+                    "elapsed_time_in_milliseconds": int(lap * (1 + rng.gauss(0, 0.02)) * 1000) if complete else 0,
+                    "episode_status": "Lap complete" if complete else "Off track",
+                    "reward_score": int(share * 1000),
+                })
+        trial["iteration"] += 1
+        return entries
+
+    def error(self, model):
+        return "simulated launch failure" if self.trials[model]["failed"] else None
+
+    def metrics(self, model):
+        trial = self.trials[model]
+        end = min(self.now, trial["stopped"] if trial["stopped"] is not None else self.now)
+        while trial["start"] + (trial["iteration"] + 1) * SIMULATED_ITERATION_MINUTES * 60 <= end:
+            trial["metrics"] += self._iteration(trial)
+        return list(trial["metrics"])
+
+    def stop(self, model):
+        self.trials[model]["stopped"] = self.now
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def print_trials(trials, launcher=None, fixed=()):
+    simulated = isinstance(launcher, SimulatedLauncher)
+    print("{:<24} {:>7} {:<9} {:>8} {:>6} {:>12} {:>7}{}  {}".format(
+        "Model", "bracket", "status", "minutes", "rungs", "completion %", "lap s", " quality" if simulated else "",
+        "parameters"))
+    for trial in trials:
+        print("{:<24} {:>7} {:<9} {:>8.0f} {:>6} {:>12} {:>7}{}  {}".format(
+            trial["model"][:24], trial["bracket"], trial["status"], trial["minutes"], len(trial["rungs"]),
+            "-" if trial["completion"] is None else "{:.1f}".format(trial["completion"]),
+            "-" if trial["lap"] is None else "{:.2f}".format(trial["lap"]),
+            " {:>7.2f}".format(launcher.trials[trial["model"]]["quality"]) if simulated else "",
+            json.dumps({key: value for key, value in trial["parameters"].items() if key not in fixed})))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hyperparameter search with successive halving over training stacks")
+    parser.add_argument("spec", help="search spec JSON file")
+    parser.add_argument("--trials", type=int, help="trainings to launch in total (default: spec, {})".format(TRIALS))
+    parser.add_argument("--parallel", type=int, help="trainings at the same time (default: spec, {})".format(PARALLEL))
+    parser.add_argument("--min-minutes", type=float, help="first rung of the most aggressive bracket")
+    parser.add_argument("--max-minutes", type=float, help="training minutes of a trial that is never stopped")
+    parser.add_argument("--eta", type=int, help="keep the top 1/eta at each rung")
+    parser.add_argument("--brackets", type=int, help="only the most aggressive brackets, 1 is successive halving")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--resume", action="store_true", help="continue from <sweeps dir>/<name>/hyperband.json")
+    parser.add_argument("--simulate", action="store_true", help="simulated metrics on a virtual clock, no stacks")
+    parser.add_argument("--simulate-failures", type=float, default=0.0, help="share of simulated launches that fail")
+    parser.add_argument("--bucket", help="bucket of the model prefixes, default the Bucket output of the base stack")
+    parser.add_argument("--create-script", help="run this instead of create-<instance>-instance.sh, e.g. a stub")
+    parser.add_argument("--stop-script", default="./stop-training.sh")
+    parser.add_argument("--sweeps-dir", default=SWEEPS_DIR)
+    args = parser.parse_args()
+    if args.resume and args.simulate:
+        parser.error("--resume continues a search on training stacks, a simulated search is not saved")
+
+    with open(args.spec, "r") as f:
+        spec = json.load(f)
+    for key in ["trials", "parallel", "min_minutes", "max_minutes", "eta", "brackets", "seed"]:
+        if getattr(args, key) is not None:
+            spec[key] = getattr(args, key)
+    # stacks end on their own even if this search is interrupted
+    spec.setdefault("time_to_live", int(spec.get("max_minutes", MAX_MINUTES) + STARTUP_MINUTES))
+
+    directory = os.path.join(args.sweeps_dir, spec["name"])
+    state_file = os.path.join(directory, "hyperband.json")
+    trials = None
+    if args.resume and os.path.exists(state_file):
+        with open(state_file, "r") as f:
+            trials = json.load(f)["trials"]
+    if args.simulate:
+        launcher = SimulatedLauncher(spec.get("seed", 0), args.simulate_failures)
+        state_file = None
+    else:
+        os.makedirs(directory, exist_ok=True)
+        launcher = StackLauncher(spec, args.sweeps_dir, args.bucket, args.create_script, args.stop_script)
+    search = Hyperband(launcher, spec, trials, state_file, lambda message: print(message, flush=True))
+    for index, bracket in enumerate(search.brackets):
+        print("bracket {}: rungs at {} minutes, {} of every {} trials".format(
+            index, ", ".join("{:.0f}".format(minutes) for minutes in bracket["rungs"]) or "none",
+            bracket["share"], len(search.order)))
+    started = time.time()
+    trials = search.run()
+
+    print()
+    print_trials(trials, launcher, spec.get("set", {}))
+    used = sum(trial["minutes"] for trial in trials)
+    print("{} trials, {:.0f} training minutes, {:.0f}% of running every trial to {:.0f} minutes".format(
+        len(trials), used, 100 * used / max(len(trials) * search.max_minutes, 1), search.max_minutes))
+    if args.simulate:
+        qualities = sorted((launcher.trials[trial["model"]]["quality"] for trial in trials), reverse=True)
+        if trials:
+            best = launcher.trials[trials[0]["model"]]["quality"]
+            print("best trial has simulated quality {:.2f}, rank {} of {} (searched in {:.1f}s)".format(
+                best, qualities.index(best) + 1, len(qualities), time.time() - started))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+"""Incremental collector for the training container logs.
+
+web_monitoring.sh used to run `docker logs` on the whole history of every container several times
+per loop. This follows each container's log stream once (`docker logs -f --timestamps`), parses
+SIM_TRACE_LOG, Training>, Testing>, checkpoint and error lines into small rolling aggregates as
+they arrive, and rewrites output.txt, completedlaps.txt, OutputLog.txt, sagemaker.txt,
+robomaker.txt and robomaker1.log from that state every interval. The full log of every other
+container is appended to <container name>.log, which tools.prestage copies to S3. A log reaching
+--max-log-mb moves to <file>.1, replacing the one before, and a new file starts. Each interval
+also appends a throughput sample (steps per robomaker, CPU load, GPU memory) to capacity.jsonl for
+tools.capacity. With --watch every line is also passed to tools.failure_watcher, which follows
+`docker events` as well and starts the upload / restart flow when the training fails. The last
+timestamp read from each container and the aggregates are saved in a state file, so a restarted
+collector continues where it stopped instead of re-reading the logs. The timestamps of removed
+containers are dropped from the state.
+
+Example (on the instance):
+    cd ~/deepracer-for-cloud/custom_files && python3 -m tools.log_collector --workdir ~/deepracer-for-cloud
+"""
+import argparse, heapq, json, os, re, shutil, subprocess, threading, time
+from datetime import datetime, timezone
+
+from .metrics_server import MetricsServer
+from .sim_trace import parse_line
+
+TAIL_LINES = 1000
+RECENT_LINES = 10
+MAX_LAPS = 1000
+MAX_LOG_MB = 200
+STEPS_PER_SECOND = 15
+ROBOMAKER_EVENT = re.compile(r"^(SIM_TRACE_LOG.*(omplete|off_)|reward_output)")
+EXITED_CONTAINER = re.compile(r"deepracer-(sagemaker|rlcoach|robomaker)")
+GPU_LINE = re.compile(r"(\d+)MiB\s*/\s*(\d+)MiB\s*\|\s*(\d+)%")
+
+
+def new_state():
+    return {
+        "offsets": {},
+        "out_of_memory": 0,
+        "best_checkpoint": "",
+        "checkpoint": "",
+        "policy_training": "",
+        "training": [],
+        "robomaker_events": [],
+        "testing": {},
+        "sagemaker_tail": [],
+        "robomaker_tail": [],
+        "laps": [],
+        "lap_count": 0,
+        "steps": {},
+        "episodes": {},
+        "episode_start": {},
+        "best_lap_time": None,
+        "last_training_time": None,
+        "policy_training_seconds": None,
+    }
+
+
+def container_kind(image, name):
+    text = image + " " + name
+    if "robomaker" in text:
+        return "robomaker"
+    if "sagemaker" in text:
+        return "sagemaker"
+    return "other"
+
+
+def _push(items, line, limit):
+    items.append(line)
+    if len(items) > limit:
+        del items[:len(items) - limit]
+
+
+def lap_steps(line):
+    try:
+        return float(line.split(",", 2)[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def epoch(timestamp):
+    """Seconds since the epoch of a docker --timestamps value (RFC 3339 in UTC), None if invalid."""
+    seconds, _, fraction = timestamp.rstrip("Z").partition(".")
+    try:
+        value = datetime.strptime(seconds, "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+        return value + float("0." + fraction) if fraction else value
+    except ValueError:
+        return None
+
+
+def ingest_step(state, name, text):
+    row = parse_line(text)
+    if row is None:
+        return
+    state["steps"][name] = state["steps"].get(name, 0) + 1
+    steps, status, tstamp = row[1], row[15], row[14]
+    if steps <= 1:
+        state["episode_start"][name] = tstamp
+    if row[9]:
+        state["episodes"][name] = state["episodes"].get(name, 0) + 1
+    if status == "lap_complete":
+        start = state["episode_start"].get(name)
+        lap_time = tstamp - start if start is not None and tstamp > start else steps / STEPS_PER_SECOND
+        if state["best_lap_time"] is None or lap_time < state["best_lap_time"]:
+            state["best_lap_time"] = lap_time
+
+
+def ingest_line(state, kind, name, is_main, text, timestamp=None):
+    """Fold one log line of a container into the aggregates, timestamp in seconds when known."""
+    if kind == "sagemaker":
+        _push(state["sagemaker_tail"], text, TAIL_LINES)
+        if "ran out of memory" in text:
+            state["out_of_memory"] += 1
+        if "Best checkpoint" in text:
+            state["best_checkpoint"] = text
+        if "Checkpoint" in text:
+            state["checkpoint"] = text
+        if text.startswith("Policy training"):
+            state["policy_training"] = text
+            # the policy is trained after the last episode of the iteration
+            if timestamp and state["last_training_time"]:
+                state["policy_training_seconds"] = timestamp - state["last_training_time"]
+        if text.startswith("Training>"):
+            _push(state["training"], text, RECENT_LINES)
+            state["last_training_time"] = timestamp
+    elif kind == "robomaker":
+        if is_main:
+            _push(state["robomaker_tail"], text, TAIL_LINES)
+            if ROBOMAKER_EVENT.match(text):
+                _push(state["robomaker_events"], text, RECENT_LINES)
+        if text.startswith("Testing>"):
+            _push(state["testing"].setdefault(name, []), text, RECENT_LINES)
+    if kind == "robomaker" and text.startswith("SIM_TRACE_LOG"):
+        ingest_step(state, name, text)
+    if text.startswith("SIM_TRACE_LOG") and "omplete" in text:
+        steps = lap_steps(text)
+        if steps is not None:
+            state["lap_count"] += 1
+            # max-heap on steps keeps the MAX_LAPS fastest laps
+            if len(state["laps"]) < MAX_LAPS:
+                heapq.heappush(state["laps"], (-steps, text))
+            elif -steps > state["laps"][0][0]:
+                heapq.heapreplace(state["laps"], (-steps, text))
+
+
+def gpu_stats(nvidia):
+    """(memory used MiB, memory total MiB, utilisation %) of the first GPU in nvidia-smi output."""
+    for line in nvidia.splitlines():
+        match = GPU_LINE.search(line)
+        if match:
+            return tuple(int(value) for value in match.groups())
+    return None, None, None
+
+
+def container_status(docker_status):
+    """{container name: 1 if up else 0} from `docker ps -a` output."""
+    containers = {}
+    for line in docker_status.splitlines()[1:]:
+        fields = re.split(r"\s{2,}", line.strip())
+        if len(fields) >= 5:
+            containers[fields[-1]] = int(any(field.startswith("Up") for field in fields))
+    return containers
+
+
+def split_timestamp(line):
+    timestamp, _, text = line.rstrip("\n").partition(" ")
+    return timestamp, text
+
+
+class Collector:
+
+    def __init__(self, workdir, state_file, run_env, docker="docker", max_log_bytes=MAX_LOG_MB * 1024 * 1024):
+        self.workdir = workdir
+        self.max_log_bytes = max_log_bytes
+        self.state_file = state_file
+        self.run_env = run_env
+        self.docker = docker
+        self.lock = threading.Lock()
+        self.followers = {}
+        self.system = {}
+        self.watchers = []
+        self.state = new_state()
+        if os.path.exists(state_file):
+            with open(state_file, "r") as f:
+                self.state.update(json.load(f))
+            self.state["laps"] = [tuple(lap) for lap in self.state["laps"]]
+            heapq.heapify(self.state["laps"])
+
+    def path(self, name):
+        return os.path.join(self.workdir, name)
+
+    def containers(self):
+        """(id, name, image) of running containers, robomakers sorted so the main worker is first."""
+        output = subprocess.run([self.docker, "ps", "--format", "{{.ID}} {{.Names}} {{.Image}}"],
+                                capture_output=True, text=True).stdout
+        containers = [tuple(line.split(" ", 2)) for line in output.splitlines() if line.count(" ") >= 2]
+        return sorted(containers, key=lambda c: c[1])
+
+    def container_ids(self):
+        """Ids of all containers, stopped ones included, or None when docker could not list them."""
+        result = subprocess.run([self.docker, "ps", "-a", "--format", "{{.ID}}"], capture_output=True, text=True)
+        return set(result.stdout.split()) if result.returncode == 0 else None
+
+    def prune(self):
+        """Forget the offsets of removed containers, every training starts new ones."""
+        existing = self.container_ids()
+        if existing is None:
+            return
+        with self.lock:
+            offsets = self.state["offsets"]
+            for container_id in [container_id for container_id in offsets if container_id not in existing]:
+                del offsets[container_id]
+        for container_id in [container_id for container_id in self.followers if container_id not in existing]:
+            del self.followers[container_id]
+
+    def main_robomaker(self, containers):
+        return next((c[1] for c in containers if container_kind(c[2], c[1]) == "robomaker"), None)
+
+    def log_file(self, name, is_main):
+        return self.path("robomaker1.log" if is_main else name + ".log")
+
+    def rotate(self, log):
+        """Move a full log to <file>.1 and return a new empty one in its place."""
+        log.close()
+        os.replace(log.name, log.name + ".1")
+        return open(log.name, "w")
+
+    def read(self, container, is_main, follow):
+        """Read new lines of one container, either until it stops (follow) or up to now."""
+        container_id, name, image = container
+        kind = container_kind(image, name)
+        command = [self.docker, "logs", "--timestamps"] + (["--follow"] if follow else [])
+        offset = self.state["offsets"].get(container_id)
+        if offset:
+            command += ["--since", offset]
+        process = subprocess.Popen(command + [container_id], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   text=True, errors="replace")
+        log = open(self.log_file(name, is_main), "a")
+        # characters, not bytes, close enough for a cap
+        written = log.tell()
+        try:
+            for line in process.stdout:
+                timestamp, text = split_timestamp(line)
+                # --since is inclusive, skip what was already read; the timestamps are fixed width
+                if offset and timestamp <= offset:
+                    continue
+                when = epoch(timestamp)
+                with self.lock:
+                    ingest_line(self.state, kind, name, is_main, text, when)
+                    self.state["offsets"][container_id] = offset = timestamp
+                for watcher in self.watchers:
+                    watcher.on_log_line(kind, name, text, when)
+                log.write(text + "\n")
+                written += len(text) + 1
+                if written >= self.max_log_bytes:
+                    log, written = self.rotate(log), 0
+        finally:
+            process.wait()
+            log.close()
+
+    def poll(self, follow):
+        self.prune()
+        containers = self.containers()
+        main = self.main_robomaker(containers)
+        for container in containers:
+            if not follow:
+                self.read(container, container[1] == main, False)
+                continue
+            thread = self.followers.get(container[0])
+            if thread is None or not thread.is_alive():
+                thread = threading.Thread(target=self.read, args=(container, container[1] == main, True), daemon=True)
+                self.followers[container[0]] = thread
+                thread.start()
+
+    def command_output(self, command, file):
+        try:
+            output = subprocess.run(command, capture_output=True, text=True).stdout
+        except OSError as e:
+            output = str(e) + "\n"
+        with open(self.path(file), "w") as f:
+            f.write(output)
+        return output
+
+    def model_prefix_line(self):
+        try:
+            with open(self.run_env, "r") as f:
+                return next((line.rstrip("\n") for line in f if line.startswith("DR_LOCAL_S3_MODEL_PREFIX")), "")
+        except OSError:
+            return ""
+
+    def write_outputs(self):
+        nvidia = self.command_output(["nvidia-smi"], "nvidia-smi.txt")
+        df = self.command_output(["df"], "df.txt")
+        docker_status = self.command_output([self.docker, "ps", "-a"], "dockerstatus.txt")
+        with open("/proc/loadavg", "r") as f:
+            loadavg = f.read()
+        with open("/proc/meminfo", "r") as f:
+            meminfo = "".join(line for line in f if re.match(r"^(MemTotal|MemFree|SwapTotal|SwapFree)", line))
+        used, total, utilisation = gpu_stats(nvidia)
+        self.system = {"gpu_memory_used": used, "gpu_memory_total": total, "gpu_utilisation": utilisation,
+                       "load": float(loadavg.split()[0]), "disk_free": shutil.disk_usage(self.workdir).free,
+                       "containers": container_status(docker_status), "time": time.time()}
+
+        with self.lock:
+            state = json.loads(json.dumps(self.state))
+        laps = [text for _, text in sorted(state["laps"], key=lambda lap: -lap[0])]
+        robomaker_tail = state["robomaker_tail"]
+
+        out = ["-----------------------------------", self.model_prefix_line(),
+               datetime.now(timezone.utc).strftime("%Y-%m-%d_%H:%M:%S_UTC")]
+        if state["out_of_memory"]:
+            out.append("  ########### ERROR ------> GPU RAN OUT OF MEMORY !!!!!!  ###########")
+        out += [line for line in (state["best_checkpoint"], state["checkpoint"]) if line]
+        out.append("=====Robomaker (main Worker)=====")
+        out += state["robomaker_events"]
+        out.append("=====Sagemaker policy training=====")
+        out += [state["policy_training"]] if state["policy_training"] else []
+        out.append("=====GPU performance=====")
+        out += [line for line in nvidia.splitlines() if "Default" in line]
+        out.append("=====Storage Availability=====")
+        out += df.splitlines()
+        out.append("=====Docker containers status=====")
+        out += docker_status.splitlines()
+        if any("xited" in line and EXITED_CONTAINER.search(line) for line in docker_status.splitlines()):
+            out.append("  ########### ERROR ------> At least one required DOCKER CONTAINER EXITED !!!!!!  ###########")
+        out.append("=====CPU average load (1min / 5min / 15min avg)=====")
+        out.append(loadavg.rstrip("\n"))
+        out.append("=====Memory usage=====")
+        out += meminfo.splitlines()
+        out.append("=====Robomaker Testing result logs (all Workers)=====")
+        for name in sorted(state["testing"]):
+            out += state["testing"][name]
+        out.append("=====Sagemaker training logs=====")
+        out += state["training"]
+        out.append("=====Robomaker Top 10 completed laps (all Workers)=====")
+        out.append("Number of completed laps: {}".format(state["lap_count"]))
+        out += laps[:10]
+        out.append("=====Robomaker (main Worker) - OutputLog: =====")
+        out += robomaker_tail[-10:]
+        out.append("###################")
+
+        self.write("output.txt", out)
+        self.write("completedlaps.txt", laps)
+        self.write("OutputLog.txt", robomaker_tail)
+        self.write("robomaker.txt", robomaker_tail)
+        self.write("sagemaker.txt", state["sagemaker_tail"])
+        self.append_capacity_sample(state)
+
+    def append_capacity_sample(self, state):
+        # one line per tick for tools.capacity: cumulative steps per robomaker, load and GPU memory
+        system = self.system
+        sample = {"time": system["time"], "instance_type": os.environ.get("INSTANCE_TYPE", ""),
+                  "cpus": os.cpu_count(), "steps": state["steps"], "load": system["load"],
+                  "gpu_memory_used": system["gpu_memory_used"], "gpu_memory_total": system["gpu_memory_total"],
+                  "gpu_utilisation": system["gpu_utilisation"], "out_of_memory": state["out_of_memory"]}
+        with open(self.path("capacity.jsonl"), "a") as f:
+            f.write(json.dumps(sample) + "\n")
+
+    def write(self, file, lines):
+        temporary = self.path(file + ".tmp")
+        with open(temporary, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temporary, self.path(file))
+
+    def save_state(self):
+        with self.lock:
+            data = json.dumps(self.state)
+        with open(self.state_file + ".tmp", "w") as f:
+            f.write(data)
+        os.replace(self.state_file + ".tmp", self.state_file)
+
+    def tick(self, follow):
+        self.poll(follow)
+        self.write_outputs()
+        self.save_state()
+
+    def run(self, interval):
+        while True:
+            self.tick(True)
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Follow the training container logs and keep the monitoring files current")
+    parser.add_argument("--workdir", default=os.path.expanduser("~/deepracer-for-cloud"))
+    parser.add_argument("--state-file", help="default: <workdir>/log_collector_state.json")
+    parser.add_argument("--run-env", help="default: <workdir>/run.env")
+    parser.add_argument("--interval", type=int, default=60, help="seconds between rewrites of the output files")
+    parser.add_argument("--once", action="store_true", help="read what is new, write the files and exit")
+    parser.add_argument("--docker", default="docker", help="docker executable")
+    parser.add_argument("--max-log-mb", type=float, default=MAX_LOG_MB,
+                        help="size at which a container log is rotated to <file>.1")
+    parser.add_argument("--metrics-port", type=int, default=0, help="serve /metrics and /metrics.json on this port")
+    parser.add_argument("--watch", action="store_true", help="upload and restart the training when it fails")
+    args = parser.parse_args()
+
+    collector = Collector(args.workdir, args.state_file or os.path.join(args.workdir, "log_collector_state.json"),
+                          args.run_env or os.path.join(args.workdir, "run.env"), args.docker,
+                          int(args.max_log_mb * 1024 * 1024))
+    if args.once:
+        collector.tick(False)
+    else:
+        if args.metrics_port:
+            MetricsServer(collector, port=args.metrics_port).start()
+        if args.watch:
+            # imported here, the watcher uses the parsing helpers of this module
+            from .failure_watcher import FailureWatcher, FlowRunner, docker_events, watch_events
+            watcher = FailureWatcher(FlowRunner(), since=time.time())
+            collector.watchers.append(watcher)
+            watch_events(watcher, docker_events(args.docker))
+        collector.run(args.interval)
+
+
+if __name__ == "__main__":
+    main()
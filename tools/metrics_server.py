@@ -0,0 +1,154 @@
+"""Prometheus and JSON metrics endpoint for a running training, served by the log collector.
+
+The log collector already parses every container log line as it arrives, so the metrics are read
+from its state when they are requested instead of from files copied into the viewer container
+every few minutes. GPU, disk and container status are refreshed with the collector interval.
+
+    GET /metrics        Prometheus text format
+    GET /metrics.json   the same values as JSON
+
+Steps per second per worker are computed over the last RATE_WINDOW seconds from snapshots of
+the step counters taken every SNAPSHOT_INTERVAL seconds.
+
+Example (on the instance, started by web_monitoring.sh):
+    python3 -m tools.log_collector --workdir ~/deepracer-for-cloud --metrics-port 8101
+    curl -s localhost:8101/metrics
+"""
+import asyncio, json, re, threading, time
+from collections import deque
+
+RATE_WINDOW = 60
+SNAPSHOT_INTERVAL = 5
+BEST_CHECKPOINT = re.compile(r"Best checkpoint number: (\d+), Last checkpoint number: (\d+)")
+SAVED_CHECKPOINT = re.compile(r"(\d+)_Step-\d+\.ckpt")
+
+# name: (type, help)
+METRICS = {
+    "deepracer_steps_total": ("counter", "Simulation steps of each robomaker worker"),
+    "deepracer_steps_per_second": ("gauge", "Simulation steps per second of each robomaker worker"),
+    "deepracer_episodes_total": ("counter", "Episodes finished by each robomaker worker"),
+    "deepracer_laps_completed_total": ("counter", "Completed laps, all workers"),
+    "deepracer_best_lap_seconds": ("gauge", "Fastest completed lap of the training"),
+    "deepracer_checkpoint": ("gauge", "Last and best checkpoint number"),
+    "deepracer_policy_training_seconds": ("gauge", "Duration of the last policy training"),
+    "deepracer_out_of_memory_total": ("counter", "GPU ran out of memory errors in the sagemaker log"),
+    "deepracer_gpu_utilisation_percent": ("gauge", "GPU utilisation"),
+    "deepracer_gpu_memory_used_bytes": ("gauge", "GPU memory in use"),
+    "deepracer_gpu_memory_total_bytes": ("gauge", "GPU memory"),
+    "deepracer_cpu_load": ("gauge", "1 minute load average"),
+    "deepracer_disk_free_bytes": ("gauge", "Free space on the training volume"),
+    "deepracer_container_up": ("gauge", "1 when the container is running"),
+}
+
+
+class MetricsServer:
+
+    def __init__(self, collector, host="0.0.0.0", port=8101):
+        self.collector = collector
+        self.host = host
+        self.port = port
+        self.snapshots = deque()
+
+    def snapshot(self):
+        with self.collector.lock:
+            steps = dict(self.collector.state["steps"])
+        now = time.monotonic()
+        self.snapshots.append((now, steps))
+        while len(self.snapshots) > 2 and self.snapshots[1][0] <= now - RATE_WINDOW:
+            self.snapshots.popleft()
+
+    def rates(self):
+        if len(self.snapshots) < 2:
+            return {}
+        (start, before), (end, after) = self.snapshots[0], self.snapshots[-1]
+        return {name: max(count - before.get(name, 0), 0) / (end - start) for name, count in after.items()}
+
+    def values(self):
+        """[(metric, labels, value)] of the current state."""
+        with self.collector.lock:
+            state = self.collector.state
+            steps, episodes = dict(state["steps"]), dict(state["episodes"])
+            laps, best_lap, out_of_memory = state["lap_count"], state["best_lap_time"], state["out_of_memory"]
+            policy_training, best_line, checkpoint_line = (
+                state["policy_training_seconds"], state["best_checkpoint"], state["checkpoint"])
+        system = dict(self.collector.system)
+        values = [("deepracer_steps_total", {"worker": name}, count) for name, count in sorted(steps.items())]
+        values += [("deepracer_steps_per_second", {"worker": name}, rate) for name, rate in sorted(self.rates().items())]
+        values += [("deepracer_episodes_total", {"worker": name}, count) for name, count in sorted(episodes.items())]
+        values += [("deepracer_laps_completed_total", {}, laps), ("deepracer_out_of_memory_total", {}, out_of_memory)]
+        best = BEST_CHECKPOINT.search(best_line)
+        saved = SAVED_CHECKPOINT.search(checkpoint_line)
+        if best:
+            values += [("deepracer_checkpoint", {"kind": "best"}, int(best.group(1))),
+                       ("deepracer_checkpoint", {"kind": "last"}, int(best.group(2)))]
+        elif saved:
+            values.append(("deepracer_checkpoint", {"kind": "last"}, int(saved.group(1))))
+        optional = [("deepracer_best_lap_seconds", best_lap), ("deepracer_policy_training_seconds", policy_training),
+                    ("deepracer_gpu_utilisation_percent", system.get("gpu_utilisation")),
+                    ("deepracer_cpu_load", system.get("load")), ("deepracer_disk_free_bytes", system.get("disk_free"))]
+        for name, mebibytes in [("deepracer_gpu_memory_used_bytes", system.get("gpu_memory_used")),
+                                ("deepracer_gpu_memory_total_bytes", system.get("gpu_memory_total"))]:
+            optional.append((name, mebibytes * 1024 * 1024 if mebibytes is not None else None))
+        values += [(name, {}, value) for name, value in optional if value is not None]
+        values += [("deepracer_container_up", {"name": name}, up)
+                   for name, up in sorted(system.get("containers", {}).items())]
+        return values
+
+    def prometheus(self):
+        lines, described = [], set()
+        for name, labels, value in self.values():
+            if name not in described:
+                kind, description = METRICS[name]
+                lines += ["# HELP {} {}".format(name, description), "# TYPE {} {}".format(name, kind)]
+                described.add(name)
+            label_text = ",".join('{}="{}"'.format(key, str(label).replace("\\", "\\\\").replace('"', '\\"'))
+                                  for key, label in labels.items())
+            lines.append("{}{} {}".format(name, "{" + label_text + "}" if label_text else "", value))
+        return "\n".join(lines) + "\n"
+
+    def json(self):
+        document = {}
+        for name, labels, value in self.values():
+            if labels:
+                document.setdefault(name, {})[next(iter(labels.values()))] = value
+            else:
+                document[name] = value
+        return json.dumps(document, indent=2)
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            # the headers are not needed, read them so the client sees a clean response
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b"\n", b""):
+                pass
+            method, path = (request.decode("latin-1").split() + ["", ""])[:2]
+            path = path.split("?", 1)[0]
+            if method != "GET":
+                status, content_type, body = "405 Method Not Allowed", "text/plain", "GET only\n"
+            elif path == "/metrics":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4", self.prometheus()
+            elif path == "/metrics.json":
+                status, content_type, body = "200 OK", "application/json", self.json()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", "/metrics or /metrics.json\n"
+            data = body.encode()
+            writer.write("HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nAccess-Control-Allow-Origin: *\r\n"
+                         "Connection: close\r\n\r\n".format(status, content_type, len(data)).encode() + data)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        async with server:
+            while True:
+                self.snapshot()
+                await asyncio.sleep(SNAPSHOT_INTERVAL)
+
+    def start(self):
+        """Serve from a daemon thread with its own event loop."""
+        thread = threading.Thread(target=asyncio.run, args=(self.serve(),), daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,375 @@
+"""Keep the model upload, the logs and a resume manifest in S3 current so a spot interruption only flushes the tail.
+
+interrupt_spot.sh has about 2 minutes after the interruption notice. It used to start with a
+full dr-upload-model -bf. start_training.sh now runs `stage` every loop instead of copying every
+container log to S3 again. Each stage:
+
+  appends the bytes of each container log (the files the log collector writes) written since the
+  last stage to logs/<file> in the model prefix: a multipart upload whose first part is a server
+  side copy of the object already in S3 and whose second part is the new bytes, or a plain put
+  while the object is smaller than the 5MB minimum part size. When the collector has rotated a log
+  to <file>.1, the unsent end of that file is appended first and the object is kept as
+  logs/<file>.<n>, n counting the rotations from 1, before logs/<file> starts over;
+  runs dr-upload-model -bf when the best checkpoint in deepracer_checkpoints.json changed since the
+  last upload;
+  uploads the files web_monitoring.sh puts in /tmp/logs (output.txt, capacity.jsonl) again when
+  they changed;
+  writes resume.json to the model prefix: last and best checkpoint, the best checkpoint in the
+  upload prefix, the staged log sizes and the time.
+
+`flush` is the same stage marked as interrupted, run by interrupt_spot.sh. It usually only
+has a few seconds of log lines to send and no model to upload. Stages take a lock, so a flush
+waits for a stage in progress to finish instead of racing it.
+
+`benchmark` measures the time from the interruption signal to a safe state, with and without
+pre-staging, against moto (or --endpoint-url). The simulated training appends log lines, saves a
+new checkpoint now and then and can keep --cpu-load cores busy, while a background stage runs
+every --interval seconds. It also estimates both times for a given bandwidth and request latency,
+because a local S3 stand-in does not model them.
+
+Example (on the instance, with run.env and system.env loaded):
+    python3 -m tools.prestage stage --logs "$HOME/deepracer-for-cloud/*.log"
+    python3 -m tools.prestage benchmark --log-mb 100 --model-mb 75 --cpu-load 2
+"""
+import argparse, fcntl, glob, json, os, subprocess, threading, time
+
+MIN_PART = 5 * 1024 * 1024
+# the timestamp keeps safe_termination.sh from starting a second upload of the same model
+UPLOAD_BEST = ("touch /home/ubuntu/bin/uploading_best_model.timestamp; cd ~/deepracer-for-cloud && "
+               "source bin/activate.sh > /dev/null 2>&1 && dr-upload-model -bf > /dev/null 2>&1")
+
+
+def run_upload_command(command=UPLOAD_BEST):
+    """Upload the best model with the deepracer-for-cloud scripts. Returns the bytes sent when known, else 0."""
+    if subprocess.run(["bash", "-lc", command]).returncode != 0:
+        raise RuntimeError("{} failed".format(command))
+    return 0
+
+
+class Prestager:
+
+    def __init__(self, bucket, model_prefix, log_files, state_file, client=None, upload_best=run_upload_command,
+                 upload_prefix=None, copied_files=None):
+        if client is None:
+            import boto3
+            client = boto3.client("s3")
+        self.client = client
+        self.bucket = bucket
+        self.prefix = model_prefix.strip("/")
+        self.upload_prefix = upload_prefix
+        self.log_files = log_files
+        self.copied_files = copied_files
+        self.upload_best = upload_best
+        self.state_file = state_file
+        self.load_state()
+
+    def load_state(self):
+        """Read the offsets, ETags and best checkpoint another stage may have saved since."""
+        self.state = {"logs": {}, "files": {}, "best": None}
+        if os.path.exists(self.state_file):
+            with open(self.state_file, "r") as f:
+                self.state.update(json.load(f))
+
+    def _log_key(self, path):
+        return "{}/logs/{}".format(self.prefix, os.path.basename(path))
+
+    def stage_log(self, path):
+        """Send the bytes appended to one log file since the last stage. Returns (bytes, requests)."""
+        status = os.stat(path)
+        key, size = self._log_key(path), status.st_size
+        staged = self.state["logs"].get(path, {})
+        sent = requests = 0
+        rotated = bool(staged) and (size < staged["size"] or staged.get("inode", status.st_ino) != status.st_ino)
+        if rotated:
+            # rotated (the log collector moved it to <file>.1) or truncated, keep what it had and start over
+            sent, requests = self._archive(path, key, staged)
+            staged = {"segments": staged.get("segments", 0) + 1}
+        offset = staged.get("size", 0)
+        if size == offset and not rotated:
+            return 0, 0
+        etag, tail, more = self._send(path, key, offset, size, staged.get("etag"))
+        self.state["logs"][path] = {"size": size, "etag": etag, "inode": status.st_ino,
+                                    "segments": staged.get("segments", 0)}
+        return sent + tail, requests + more
+
+    def _send(self, path, key, offset, size, etag):
+        """Append bytes offset:size of a file to its object. Returns (ETag, bytes, requests)."""
+        with open(path, "rb") as f:
+            f.seek(offset)
+            tail = f.read(size - offset)
+        appended, requests = None, 0
+        if offset >= MIN_PART:
+            appended, requests = self._append(key, etag, tail), 4
+        if appended is None:
+            with open(path, "rb") as f:
+                body = f.read(size)
+            appended = self.client.put_object(Bucket=self.bucket, Key=key, Body=body)["ETag"]
+            tail, requests = body, requests + 1
+        return appended, len(tail), requests
+
+    def _archive(self, path, key, staged):
+        """Complete the object of a rotated log with its unsent tail and copy it to <key>.<segment>.
+
+        Segments are numbered from 1 in the order they were rotated. Returns (bytes, requests).
+        """
+        sent = requests = 0
+        rotated = path + ".1"
+        if os.path.exists(rotated) and os.stat(rotated).st_ino == staged.get("inode"):
+            size = os.path.getsize(rotated)
+            if size > staged["size"]:
+                _, sent, requests = self._send(rotated, key, staged["size"], size, staged["etag"])
+        self.client.copy_object(Bucket=self.bucket, Key="{}.{}".format(key, staged.get("segments", 0) + 1),
+                                CopySource={"Bucket": self.bucket, "Key": key})
+        return sent, requests + 1
+
+    def stage_file(self, path):
+        """Upload a file that is rewritten rather than appended when it changed. Returns (bytes, requests)."""
+        status = os.stat(path)
+        if self.state["files"].get(path) == [status.st_size, status.st_mtime]:
+            return 0, 0
+        with open(path, "rb") as f:
+            body = f.read()
+        self.client.put_object(Bucket=self.bucket, Key=self._log_key(path), Body=body)
+        self.state["files"][path] = [status.st_size, status.st_mtime]
+        return len(body), 1
+
+    def _append(self, key, etag, tail):
+        """Copy the object in place as part 1 and add the tail as part 2, None when the object changed."""
+        upload = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)["UploadId"]
+        try:
+            copied = self.client.upload_part_copy(Bucket=self.bucket, Key=key, UploadId=upload, PartNumber=1,
+                                                  CopySource={"Bucket": self.bucket, "Key": key},
+                                                  CopySourceIfMatch=etag)["CopyPartResult"]["ETag"]
+            added = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload, PartNumber=2,
+                                            Body=tail)["ETag"]
+            return self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload,
+                MultipartUpload={"Parts": [{"PartNumber": 1, "ETag": copied}, {"PartNumber": 2, "ETag": added}]})["ETag"]
+        except self.client.exceptions.ClientError:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload)
+            return None
+
+    def checkpoints(self):
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=self.prefix + "/model/deepracer_checkpoints.json")["Body"]
+        except self.client.exceptions.ClientError:
+            return {}
+        return json.loads(body.read())
+
+    def stage(self, interrupted=False):
+        """One pass: best model, logs, resume manifest. Returns what was done and how long it took."""
+        started = time.time()
+        lock = open(self.state_file + ".lock", "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # a flush that waited for the training loop's stage continues from what that stage sent
+            self.load_state()
+            waited = time.time() - started
+            report = {"waited": round(waited, 3), "best_uploaded": False, "model_bytes": 0, "log_bytes": 0, "requests": 2}
+            checkpoints = self.checkpoints()
+            best = (checkpoints.get("best_checkpoint") or {}).get("name")
+            if best and best != self.state["best"]:
+                try:
+                    report["model_bytes"] = self.upload_best() or 0
+                    report["best_uploaded"] = True
+                    self.state["best"] = best
+                except Exception as e:
+                    # the logs and the manifest are still worth saving, the next stage tries again
+                    report["error"] = str(e)
+            staged = [(self.stage_log, path) for path in sorted(glob.glob(self.log_files))]
+            staged += [(self.stage_file, path) for path in sorted(glob.glob(self.copied_files or ""))]
+            for stage_path, path in staged:
+                sent, requests = stage_path(path)
+                report["log_bytes"] += sent
+                report["requests"] += requests
+            manifest = {
+                "model_prefix": self.prefix,
+                "upload_prefix": self.upload_prefix,
+                "last_checkpoint": (checkpoints.get("last_checkpoint") or {}).get("name"),
+                "best_checkpoint": best,
+                "best_uploaded": self.state["best"],
+                "logs": {os.path.basename(path): entry["size"] for path, entry in self.state["logs"].items()},
+                "time": int(time.time()),
+                "interrupted": interrupted,
+            }
+            self.client.put_object(Bucket=self.bucket, Key=self.prefix + "/resume.json",
+                                   Body=json.dumps(manifest, indent=2).encode())
+            with open(self.state_file + ".tmp", "w") as f:
+                json.dump(self.state, f)
+            os.replace(self.state_file + ".tmp", self.state_file)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+        report["seconds"] = round(time.time() - started, 3)
+        return report
+
+
+def _burn():
+    while True:
+        sum(i * i for i in range(10000))
+
+
+def benchmark(client, bucket, log_mb=50, model_mb=75, logs=5, line_rate=300, warmup=20, interval=5,
+              checkpoint_every=8, cpu_load=0, bandwidth=50, latency=0.02, directory=None):
+    """Time to safe state after an interruption signal, pre-staged flush against a full upload."""
+    import multiprocessing, random, tempfile
+    directory = directory or tempfile.mkdtemp()
+    prefix, upload_prefix = "bench-model", "bench-upload"
+    rng = random.Random(0)
+    model_files = {"data-00000-of-00001": int(model_mb * 0.7e6), "index": 20000, "meta": int(model_mb * 0.2e6),
+                   "pb": int(model_mb * 0.1e6)}
+    best = {"n": 0}
+
+    def save_checkpoint(n):
+        name = "{}_Step-{}.ckpt".format(n, n * 1000)
+        for suffix, size in model_files.items():
+            key = "model/model_{}.pb".format(n) if suffix == "pb" else "model/{}.{}".format(name, suffix)
+            client.put_object(Bucket=bucket, Key=prefix + "/" + key, Body=rng.randbytes(size))
+        if n % 2:
+            best["n"] = n
+        best_name = "{}_Step-{}.ckpt".format(best["n"], best["n"] * 1000)
+        client.put_object(Bucket=bucket, Key=prefix + "/model/deepracer_checkpoints.json", Body=json.dumps(
+            {"best_checkpoint": {"name": best_name}, "last_checkpoint": {"name": name}}).encode())
+
+    def copy_best():
+        """What dr-upload-model -bf moves: the files of the best checkpoint, downloaded and uploaded again."""
+        sent = 0
+        name = "{}_Step-{}.ckpt".format(best["n"], best["n"] * 1000)
+        for suffix in model_files:
+            key = "model/model_{}.pb".format(best["n"]) if suffix == "pb" else "model/{}.{}".format(name, suffix)
+            body = client.get_object(Bucket=bucket, Key=prefix + "/" + key)["Body"].read()
+            client.put_object(Bucket=bucket, Key=upload_prefix + "/" + key, Body=body)
+            sent += len(body)
+        return sent
+
+    log_paths = [os.path.join(directory, "deepracer-0_robomaker.{}.log".format(i + 1)) for i in range(logs - 1)]
+    log_paths.append(os.path.join(directory, "deepracer-0_sagemaker.log"))
+    line = "SIM_TRACE_LOG:12,85,1.2345,2.3456,-3.1415,0.0000,2.0000,3,1.0000,False,True,14.2857,22,17.67,1234.5,in_progress,0.0\n"
+    for path in log_paths:
+        with open(path, "w") as f:
+            f.write(line * int(log_mb * 1e6 / len(line)))
+    save_checkpoint(1)
+
+    stop = threading.Event()
+    burners = [multiprocessing.Process(target=_burn, daemon=True) for _ in range(cpu_load)]
+    for burner in burners:
+        burner.start()
+
+    def write_logs():
+        while not stop.is_set():
+            for path in log_paths:
+                with open(path, "a") as f:
+                    f.write(line * max(1, line_rate // 10))
+            time.sleep(0.1)
+
+    def train():
+        n = 1
+        while not stop.wait(checkpoint_every):
+            n += 1
+            save_checkpoint(n)
+
+    prestager = Prestager(bucket, prefix, os.path.join(directory, "*.log"), os.path.join(directory, "prestage.json"),
+                          client, copy_best, upload_prefix)
+
+    def stage_loop():
+        while not stop.is_set():
+            prestager.stage()
+            stop.wait(interval)
+
+    threads = [threading.Thread(target=target, daemon=True) for target in (write_logs, train, stage_loop)]
+    for thread in threads:
+        thread.start()
+    time.sleep(warmup)
+
+    # interruption signal: what is left to do with pre-staging
+    signal = time.time()
+    flush = prestager.stage(interrupted=True)
+    flush_seconds = time.time() - signal
+    flush_bytes = flush["log_bytes"] + flush["model_bytes"]
+    flush_requests = flush["requests"] + (2 * len(model_files) if flush["best_uploaded"] else 0)
+
+    # the same moment without it: every log and the best model again
+    signal = time.time()
+    full_bytes = copy_best()
+    for path in log_paths:
+        with open(path, "rb") as f:
+            body = f.read()
+        client.put_object(Bucket=bucket, Key=prefix + "/logs/full/" + os.path.basename(path), Body=body)
+        full_bytes += len(body)
+    full_seconds = time.time() - signal
+    full_requests = 2 * len(model_files) + len(log_paths)
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+    for burner in burners:
+        burner.terminate()
+
+    def estimate(size, requests):
+        return size / (bandwidth * 1e6) + requests * latency
+
+    return {
+        "prestaged": {"seconds": round(flush_seconds, 3), "bytes": flush_bytes, "waited_for_stage": flush["waited"],
+                      "best_uploaded": flush["best_uploaded"],
+                      "estimated_seconds": round(estimate(flush_bytes, flush_requests) + flush["waited"], 2)},
+        "full_upload": {"seconds": round(full_seconds, 3), "bytes": full_bytes,
+                        "estimated_seconds": round(estimate(full_bytes, full_requests), 2)},
+        "bandwidth_mb_per_second": bandwidth,
+        "latency_seconds": latency,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-stage logs and the best model for a fast spot interruption")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for command in ("stage", "flush"):
+        sub = commands.add_parser(command)
+        sub.add_argument("--bucket", default=os.environ.get("DR_LOCAL_S3_BUCKET"))
+        sub.add_argument("--prefix", default=os.environ.get("DR_LOCAL_S3_MODEL_PREFIX"))
+        sub.add_argument("--upload-prefix", default=os.environ.get("DR_UPLOAD_S3_PREFIX"))
+        sub.add_argument("--logs", default=os.path.expanduser("~/deepracer-for-cloud/*.log"), help="glob of the log files")
+        sub.add_argument("--files", default="/tmp/logs/*", help="glob of other files to upload when they changed")
+        sub.add_argument("--state-file", default=os.path.expanduser("~/deepracer-for-cloud/prestage_state.json"))
+        sub.add_argument("--upload-command", default=UPLOAD_BEST, help="uploads the best model")
+        sub.add_argument("--endpoint-url", help="S3 compatible endpoint, e.g. a local minio")
+    sub = commands.add_parser("benchmark")
+    sub.add_argument("--endpoint-url", help="S3 compatible endpoint, default an in-process moto S3")
+    sub.add_argument("--bucket", default="prestage-benchmark")
+    sub.add_argument("--log-mb", type=float, default=50, help="size of each log at the interruption")
+    sub.add_argument("--model-mb", type=float, default=75)
+    sub.add_argument("--logs", type=int, default=5, help="number of container logs")
+    sub.add_argument("--warmup", type=float, default=20, help="seconds of simulated training before the signal")
+    sub.add_argument("--interval", type=float, default=5, help="seconds between background stages")
+    sub.add_argument("--cpu-load", type=int, default=0, help="cores kept busy during the run")
+    sub.add_argument("--bandwidth", type=float, default=50, help="MB/s used for the estimate")
+    sub.add_argument("--latency", type=float, default=0.02, help="seconds per request used for the estimate")
+    args = parser.parse_args()
+
+    import boto3
+    if args.command == "benchmark":
+        def run(client):
+            try:
+                client.create_bucket(Bucket=args.bucket)
+            except client.exceptions.ClientError:
+                pass
+            print(json.dumps(benchmark(client, args.bucket, args.log_mb, args.model_mb, args.logs, warmup=args.warmup,
+                                       interval=args.interval, cpu_load=args.cpu_load, bandwidth=args.bandwidth,
+                                       latency=args.latency), indent=2))
+        if args.endpoint_url:
+            run(boto3.client("s3", endpoint_url=args.endpoint_url))
+        else:
+            from moto import mock_aws
+            with mock_aws():
+                run(boto3.client("s3", region_name="us-east-1"))
+        return
+    if not args.bucket or not args.prefix:
+        parser.error("--bucket and --prefix are needed, or DR_LOCAL_S3_BUCKET and DR_LOCAL_S3_MODEL_PREFIX")
+    client = boto3.client("s3", endpoint_url=args.endpoint_url)
+    prestager = Prestager(args.bucket, args.prefix, args.logs, args.state_file, client,
+                          lambda: run_upload_command(args.upload_command), args.upload_prefix, args.files)
+    report = prestager.stage(interrupted=args.command == "flush")
+    print("{} {}".format(time.strftime("%Y-%m-%d %H:%M:%S"), json.dumps(report)), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Racing line and target speed per track, computed once and cached as a memory-mapped array.
+
+The line keeps one point per centre line waypoint, shifted sideways between the borders, so
+a reward function looks up its target with params["closest_waypoints"][1] in O(1) instead of
+searching. The lateral offsets minimise the sum of squared second differences of the line (its discrete
+curvature) within the track borders, solved as a box constrained least squares problem. The
+target speed is the lateral grip limit in each curve, then limited by acceleration and braking
+along the lap.
+
+Results are cached in racing_lines/ (DOTS_RACING_LINE_DIR) as float32 .npy files with the
+columns x, y, speed and offset from the centre, keyed by track fingerprint and parameters, so a
+later load is a memory-map. Only reward_function.py is uploaded to the training instance, so for
+training use --python prints the line as a literal to paste into the reward function.
+
+Example:
+    python3 -m tools.racing_line 2022_may_open_ccw --python > racing_line_literal.py
+"""
+import argparse, hashlib, json, math, os
+
+from .track_geometry import fingerprint
+from .tracks import closed_loop, curvature, load_track
+
+RACING_LINE_DIR = os.environ.get("DOTS_RACING_LINE_DIR", "racing_lines")
+COLUMNS = ["x", "y", "speed", "offset"]
+DEFAULTS = {
+    "margin": 0.15,
+    "iterations": 100,
+    "lateral_acceleration": 3.0,
+    "acceleration": 2.0,
+    "braking": 3.0,
+    "min_speed": 1.0,
+    "max_speed": 4.0,
+}
+
+
+def optimize_offsets(centre, unit, half_width, iterations=DEFAULTS["iterations"]):
+    """Lateral offsets along unit from the centre, within +-half_width, that minimise the sum of
+    squared second differences of the line. Box constrained least squares solved by an active set
+    iteration: solve for the free offsets, pin the ones that leave the track to the border, and
+    free pinned ones again when the gradient points back inside."""
+    import numpy as np
+    n = len(centre)
+    second = np.roll(np.eye(n), -1, axis=1) - 2 * np.eye(n) + np.roll(np.eye(n), 1, axis=1)
+    matrix = np.vstack([second * unit[:, 0], second * unit[:, 1]])
+    constant = np.concatenate([second @ centre[:, 0], second @ centre[:, 1]])
+    # a tiny pull towards the centre keeps the system well conditioned
+    hessian = matrix.T @ matrix + 1e-9 * np.eye(n)
+    linear = matrix.T @ constant
+    offsets = np.zeros(n)
+    pinned = np.zeros(n, dtype=bool)
+    for _ in range(iterations):
+        free = ~pinned
+        rhs = -(linear[free] + hessian[np.ix_(free, pinned)] @ offsets[pinned])
+        offsets[free] = np.linalg.solve(hessian[np.ix_(free, free)], rhs)
+        outside = free & (np.abs(offsets) > half_width)
+        if outside.any():
+            offsets[outside] = np.clip(offsets[outside], -half_width[outside], half_width[outside])
+            pinned |= outside
+            continue
+        gradient = hessian @ offsets + linear
+        release = pinned & (((offsets >= half_width) & (gradient > 0)) | ((offsets <= -half_width) & (gradient < 0)))
+        if not release.any():
+            break
+        pinned &= ~release
+    return offsets
+
+
+def speed_profile(line, lateral_acceleration, acceleration, braking, min_speed, max_speed):
+    """Target speed at each point: grip limit in curves, then acceleration and braking limits."""
+    import numpy as np
+    grip = np.sqrt(lateral_acceleration / np.maximum(np.abs(curvature(line)), 1e-9))
+    speed = np.clip(grip, min_speed, max_speed)
+    distance = np.linalg.norm(np.roll(line, -1, axis=0) - line, axis=1)
+    n = len(line)
+    # two laps in each direction so the limits carry over the start line
+    for i in range(2 * n):
+        j, k = i % n, (i + 1) % n
+        speed[k] = min(speed[k], math.sqrt(speed[j] ** 2 + 2 * acceleration * distance[j]))
+    for i in range(2 * n, 0, -1):
+        j, k = i % n, (i - 1) % n
+        speed[k] = min(speed[k], math.sqrt(speed[j] ** 2 + 2 * braking * distance[k]))
+    return speed
+
+
+def compute(track, **options):
+    """(n, 4) float32 array of x, y, speed, offset, one row per centre line waypoint."""
+    import numpy as np
+    parameters = dict(DEFAULTS, **options)
+    track = np.asarray(track, dtype=float)
+    # the centre line decides whether the last row repeats the first, for all six columns
+    centre = closed_loop(track[:, 0:2])
+    inner, outer = track[:len(centre), 2:4], track[:len(centre), 4:6]
+    across = outer - inner
+    width = np.linalg.norm(across, axis=1)
+    unit = across / np.maximum(width, 1e-9)[:, None]
+    middle = (inner + outer) / 2
+    half_width = np.maximum(width / 2 - parameters["margin"], 0)
+    offsets = optimize_offsets(middle, unit, half_width, parameters["iterations"])
+    line = middle + offsets[:, None] * unit
+    speed = speed_profile(line, parameters["lateral_acceleration"], parameters["acceleration"],
+                          parameters["braking"], parameters["min_speed"], parameters["max_speed"])
+    # offsets are reported from the centre line waypoints the reward function sees
+    centre_offset = ((line - centre) * unit).sum(axis=1)
+    return np.column_stack([line, speed, centre_offset]).astype(np.float32)
+
+
+def cache_path(track, **options):
+    parameters = json.dumps(dict(DEFAULTS, **options), sort_keys=True)
+    key = hashlib.sha1(parameters.encode()).hexdigest()[:8]
+    return os.path.join(RACING_LINE_DIR, "{}-{}.npy".format(fingerprint(track[:, 0:2].tolist()), key))
+
+
+def get_racing_line(track, **options):
+    """Cached racing line of a track array, memory-mapped, computed and saved on first use."""
+    import numpy as np
+    path = cache_path(track, **options)
+    if not os.path.exists(path):
+        os.makedirs(RACING_LINE_DIR, exist_ok=True)
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            np.save(f, compute(track, **options))
+        os.replace(temporary, path)
+    return np.load(path, mmap_mode="r")
+
+
+def target(racing_line, params):
+    """(x, y, speed) of the racing line at the next waypoint of a reward params dict."""
+    x, y, speed, _ = racing_line[params["closest_waypoints"][1] % len(racing_line)]
+    return float(x), float(y), float(speed)
+
+
+def lap_time(racing_line):
+    import numpy as np
+    line = np.asarray(racing_line[:, 0:2], dtype=float)
+    distance = np.linalg.norm(np.roll(line, -1, axis=0) - line, axis=1)
+    speed = np.asarray(racing_line[:, 2], dtype=float)
+    return float((distance / ((speed + np.roll(speed, -1)) / 2)).sum()), float(distance.sum())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compute and cache the racing line and target speeds of a track")
+    parser.add_argument("track", help="DR_WORLD_NAME or path to a track .npy")
+    for name, value in DEFAULTS.items():
+        parser.add_argument("--" + name.replace("_", "-"), type=type(value), default=value)
+    parser.add_argument("--python", action="store_true", help="print the line as a literal for a reward function")
+    args = parser.parse_args()
+
+    options = {name: getattr(args, name) for name in DEFAULTS}
+    track = load_track(args.track)
+    racing_line = get_racing_line(track, **options)
+    if args.python:
+        print("# racing line of {}: x, y, speed, offset from centre per waypoint (tools.racing_line)".format(args.track))
+        print("RACING_LINE = [")
+        for row in racing_line:
+            print("    ({:.3f}, {:.3f}, {:.2f}, {:.3f}),".format(*row))
+        print("]")
+        return
+    seconds, length = lap_time(racing_line)
+    print("{} points, {:.2f}m, estimated lap time {:.2f}s, cached in {}".format(
+        len(racing_line), length, seconds, cache_path(track, **options)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""Replay a candidate reward function over recorded SIM_TRACE_LOG steps.
+
+SIM_TRACE_LOG does not record obstacles or bot cars. For an OBJECT_AVOIDANCE or HEAD_TO_BOT race
+type (DR_RACE_TYPE of run.env, or --race-type) they are placed on the track as in
+tools.reward_bench, with the DR_OA_NUMBER_OF_OBSTACLES, DR_H2B_NUMBER_OF_BOT_CARS and
+DR_H2B_BOT_CAR_SPEED of run.env, and the same objects are used for every step.
+
+Example:
+    python3 -m tools.replay custom-files/reward_function.py robomaker1.log training-simtrace/ --track 2022_may_open_ccw
+    python3 -m tools.replay custom-files/reward-fn-examples/reward-fn-stay-on-lane-not-crashing.py robomaker1.log --track 2022_may_open_ccw --race-type OBJECT_AVOIDANCE
+"""
+import argparse, csv, os, random, re, time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from .config_session import ConfigSession
+from .rewards import DEFAULT_REWARD_FILE, load_reward_function, load_reward_module
+from .sim_trace import (OBJECT_COUNTS, find_trace_files, make_params_builder, parse_lines, race_objects, read_range,
+                        split_ranges)
+from .tracks import center_waypoints, load_track, track_widths
+
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+RUN_ENV = "custom-files/run.env"
+OBJECT_PARAMS = re.compile(r"objects_|closest_objects")
+
+# per worker process state, filled once by _init_worker
+_worker = {}
+
+
+def _init_worker(reward_file, track, batch=False, objects=None):
+    _worker["reward_file"] = reward_file
+    _worker["reward_function"] = load_reward_function(reward_file)
+    _worker["waypoints"] = _worker["widths"] = None
+    if track:
+        track_array = load_track(track)
+        _worker["waypoints"], _worker["widths"] = center_waypoints(track_array), track_widths(track_array)
+    _worker["objects"] = objects
+    _worker["build"] = make_params_builder(_worker["waypoints"], _worker["widths"], objects)
+    _worker["score"] = _score_batch if batch else _score_scalar
+
+
+def _score_scalar(rows):
+    reward_function, build = _worker["reward_function"], _worker["build"]
+    rewards = []
+    for row in rows:
+        try:
+            rewards.append(float(reward_function(build(row))))
+        except Exception:
+            rewards.append(None)
+    return rewards
+
+
+def _score_batch(rows):
+    from . import reward_batch
+    if not rows:
+        return []
+    if "batch" not in _worker:
+        sample = reward_batch.build_columns(rows[:reward_batch.SAMPLE_SIZE], _worker["waypoints"],
+                                            _worker["widths"], _worker["objects"])
+        module = load_reward_module(_worker["reward_file"])
+        _worker["batch"], _ = reward_batch.compile_batch(module, sample)
+    rewards = _worker["batch"](reward_batch.build_columns(rows, _worker["waypoints"], _worker["widths"],
+                                                          _worker["objects"]))
+    return [None if reward != reward else reward for reward in rewards.tolist()]
+
+
+def score_range(task):
+    """Score one byte range of a trace file; returns partial aggregates for merge_results."""
+    path, start, end = task
+    rows = list(parse_lines(read_range(path, start, end)))
+    episodes, waypoints, rewards, errors = {}, {}, array("d"), 0
+    for row, reward in zip(rows, _worker["score"](rows)):
+        if reward is None:
+            errors += 1
+            continue
+        rewards.append(reward)
+        # episode: steps, new reward, recorded reward, max progress, first tstamp, last tstamp, last status
+        episode = episodes.get((path, row[0]))
+        if episode is None:
+            episodes[(path, row[0])] = [1, reward, row[8], row[11], row[14], row[14], row[15]]
+        else:
+            episode[0] += 1
+            episode[1] += reward
+            episode[2] += row[8]
+            episode[3] = max(episode[3], row[11])
+            episode[4] = min(episode[4], row[14])
+            episode[5] = max(episode[5], row[14])
+            episode[6] = row[15]
+        waypoint = waypoints.get(row[12])
+        if waypoint is None:
+            waypoints[row[12]] = [1, reward]
+        else:
+            waypoint[0] += 1
+            waypoint[1] += reward
+    return episodes, waypoints, rewards, errors
+
+
+def merge_results(results):
+    episodes, waypoints, rewards, errors = {}, {}, array("d"), 0
+    for part_episodes, part_waypoints, part_rewards, part_errors in results:
+        for key, part in part_episodes.items():
+            episode = episodes.get(key)
+            if episode is None:
+                episodes[key] = part
+            else:
+                episode[0] += part[0]
+                episode[1] += part[1]
+                episode[2] += part[2]
+                episode[3] = max(episode[3], part[3])
+                episode[4] = min(episode[4], part[4])
+                episode[5] = max(episode[5], part[5])
+                episode[6] = part[6]
+        for key, part in part_waypoints.items():
+            waypoint = waypoints.setdefault(key, [0, 0.0])
+            waypoint[0] += part[0]
+            waypoint[1] += part[1]
+        rewards.extend(part_rewards)
+        errors += part_errors
+    return episodes, waypoints, rewards, errors
+
+
+def reads_objects(reward_file):
+    """Whether a reward function reads the closest_objects or objects_* params."""
+    with open(reward_file, "r") as f:
+        return bool(OBJECT_PARAMS.search(f.read()))
+
+
+def replay_objects(race_type, track, variables, seed=0):
+    """The objects every step of a replay sees, None for a time trial."""
+    if race_type not in OBJECT_COUNTS:
+        return None
+    if not track:
+        raise ValueError("{} needs --track to place the objects on".format(race_type))
+    track_array = load_track(track)
+    return race_objects(race_type, center_waypoints(track_array), track_widths(track_array), variables,
+                        random.Random(seed))
+
+
+def replay(reward_file, trace_paths, track=None, workers=None, chunk_mb=16, batch=False, objects=None):
+    tasks = []
+    for path in find_trace_files(trace_paths):
+        tasks.extend(split_ranges(path, chunk_mb * 1024 * 1024))
+    args = (reward_file, track, batch, objects)
+    if workers == 1:
+        _init_worker(*args)
+        return merge_results(map(score_range, tasks))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=args) as pool:
+        return merge_results(pool.map(score_range, tasks))
+
+
+def percentiles(values, points=PERCENTILES):
+    ordered = sorted(values)
+    if not ordered:
+        return {p: None for p in points}
+    return {p: ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))] for p in points}
+
+
+def write_episodes(file, episodes):
+    with open(file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["trace", "episode", "steps", "reward", "recorded_reward", "progress", "time", "status"])
+        for (path, episode), (steps, reward, recorded, progress, first, last, status) in sorted(episodes.items()):
+            writer.writerow([path, episode, steps, round(reward, 4), round(recorded, 4), progress, round(last - first, 3), status])
+
+
+def write_waypoints(file, waypoints):
+    with open(file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["waypoint", "steps", "reward_sum", "reward_mean"])
+        for waypoint, (steps, reward) in sorted(waypoints.items()):
+            writer.writerow([waypoint, steps, round(reward, 4), round(reward / steps, 4)])
+
+
+def print_summary(episodes, waypoints, rewards, errors, elapsed, top):
+    steps = len(rewards)
+    print("Scored {} steps from {} episodes in {:.1f}s ({:.0f} steps/s), {} reward errors".format(
+        steps, len(episodes), elapsed, steps / elapsed if elapsed else 0, errors))
+    if not steps:
+        return
+    print("Reward per step: mean={:.4f} ".format(sum(rewards) / steps) + " ".join(
+        "p{}={:.4f}".format(p, v) for p, v in percentiles(rewards).items()))
+    print("Top {} episodes by new reward:".format(top))
+    ranked = sorted(episodes.items(), key=lambda item: item[1][1], reverse=True)[:top]
+    for (path, episode), (count, reward, recorded, progress, first, last, status) in ranked:
+        print("  {} ep {:<6} steps={:<5} reward={:<10.2f} recorded={:<10.2f} progress={:<6.1f} time={:<7.2f} {}".format(
+            os.path.basename(path), episode, count, reward, recorded, progress, last - first, status))
+    worst = sorted(waypoints.items(), key=lambda item: item[1][1] / item[1][0])[:top]
+    print("Lowest mean reward waypoints: " + ", ".join("{}={:.3f}".format(w, r / c) for w, (c, r) in worst))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a reward function over recorded SIM_TRACE_LOG steps")
+    parser.add_argument("reward_file", help="reward function file, e.g. " + DEFAULT_REWARD_FILE)
+    parser.add_argument("traces", nargs="+", help="robomaker logs, simtrace csv files or directories of them")
+    parser.add_argument("--track", help="DR_WORLD_NAME or path to the track .npy, needed for waypoint based rewards")
+    parser.add_argument("--run-env", default=RUN_ENV, help="race type and object counts")
+    parser.add_argument("--race-type", choices=["TIME_TRIAL"] + list(OBJECT_COUNTS),
+                        help="default DR_RACE_TYPE of --run-env")
+    parser.add_argument("--workers", type=int, default=None, help="process pool size (default: all cores)")
+    parser.add_argument("--chunk-mb", type=int, default=16)
+    parser.add_argument("--batch", action="store_true", help="evaluate each chunk with the NumPy batch version (see tools.reward_batch)")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--episodes-csv", help="write per episode results to this file")
+    parser.add_argument("--waypoints-csv", help="write per waypoint results to this file")
+    args = parser.parse_args()
+
+    variables = ConfigSession().variables(args.run_env) if os.path.exists(args.run_env) else {}
+    race_type = args.race_type or variables.get("DR_RACE_TYPE", "TIME_TRIAL")
+    try:
+        objects = replay_objects(race_type, args.track, variables)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    if objects is None and reads_objects(args.reward_file):
+        raise SystemExit("{} reads the objects_* params, which are empty in a {} replay: use --race-type "
+                         "OBJECT_AVOIDANCE or HEAD_TO_BOT with --track".format(args.reward_file, race_type))
+    started = time.time()
+    episodes, waypoints, rewards, errors = replay(args.reward_file, args.traces, args.track, args.workers, args.chunk_mb,
+                                                args.batch, objects)
+    print_summary(episodes, waypoints, rewards, errors, time.time() - started, args.top)
+    if args.episodes_csv:
+        write_episodes(args.episodes_csv, episodes)
+    if args.waypoints_csv:
+        write_waypoints(args.waypoints_csv, waypoints)
+
+
+if __name__ == "__main__":
+    main()
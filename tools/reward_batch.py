@@ -0,0 +1,540 @@
+"""Evaluate reward functions over whole batches of steps with NumPy.
+
+A reward file gets a batch version in one of three ways, tried in this order:
+
+* a declared ``reward_function_batch(params)`` taking the same keys as ``reward_function`` but with
+  column arrays as values,
+* an automatic translation of ``reward_function`` where every if/elif/else ladder is evaluated on
+  all rows under a mask and merged with ``np.where``,
+* a plain loop over the scalar function.
+
+The first two are only used after they reproduce the scalar function on a sample of steps.
+
+Object avoidance and head to bot steps get the obstacles or bot cars a replay places for the
+race type of run.env (or --race-type) on --track.
+
+Example:
+    python3 -m tools.reward_batch custom-files/reward_function_waypoints.py --track 2022_may_open_ccw
+"""
+import argparse, ast, copy, inspect, math, os, textwrap, time
+from array import array
+
+import numpy as np
+
+from .config_session import ConfigSession
+from .replay import RUN_ENV, reads_objects, replay_objects
+from .rewards import load_reward_module
+from .sim_trace import DEFAULT_TRACK_WIDTH, OBJECT_COUNTS, find_trace_files, iter_chunks, synthetic_rows
+from .tracks import center_waypoints, load_track, track_widths
+
+SAMPLE_SIZE = 2000
+
+MATH_FUNCTIONS = {
+    "sqrt": "sqrt", "acos": "arccos", "asin": "arcsin", "atan": "arctan", "atan2": "arctan2",
+    "cos": "cos", "sin": "sin", "tan": "tan", "degrees": "degrees", "radians": "radians",
+    "fabs": "abs", "hypot": "hypot", "exp": "exp", "log": "log", "pow": "power",
+    "floor": "floor", "ceil": "ceil",
+}
+
+BUILTIN_FUNCTIONS = {
+    "abs": "_np.abs", "float": "_float", "int": "_int", "bool": "_truth", "round": "_np.round",
+    "min": "_min", "max": "_max", "len": "len",
+}
+
+
+class TranslationError(Exception):
+    pass
+
+
+class Points:
+    """Waypoint list stand-in: indexing with an index array returns [x array, y array]."""
+
+    def __init__(self, xs, ys):
+        self.xs = xs
+        self.ys = ys
+
+    def __len__(self):
+        return len(self.xs)
+
+    def __getitem__(self, index):
+        return [self.xs[index], self.ys[index]]
+
+
+# Helpers available to translated functions
+
+def _float(value):
+    return np.asarray(value, dtype=float)
+
+
+def _int(value):
+    return np.trunc(value).astype(int)
+
+
+def _truth(value):
+    if isinstance(value, (list, tuple, Points)):
+        return len(value) > 0
+    return np.asarray(value, dtype=bool)
+
+
+def _and(*values):
+    result = _truth(values[0])
+    for value in values[1:]:
+        result = np.logical_and(result, _truth(value))
+    return result
+
+
+def _or(*values):
+    result = _truth(values[0])
+    for value in values[1:]:
+        result = np.logical_or(result, _truth(value))
+    return result
+
+
+def _not(value):
+    return np.logical_not(_truth(value))
+
+
+def _min(*values):
+    values = list(values[0]) if len(values) == 1 else values
+    result = values[0]
+    for value in values[1:]:
+        result = np.minimum(result, value)
+    return result
+
+
+def _max(*values):
+    values = list(values[0]) if len(values) == 1 else values
+    result = values[0]
+    for value in values[1:]:
+        result = np.maximum(result, value)
+    return result
+
+
+def _index(value, key):
+    if isinstance(key, np.ndarray) and isinstance(value, (list, tuple, array)):
+        return np.asarray(value)[key]
+    return value[key]
+
+
+def _get(params, key, default=None):
+    return params.get(key, default)
+
+
+def _select(mask, new, old):
+    if old is None:
+        return new
+    if isinstance(new, (list, tuple)):
+        return type(new)(_select(mask, a, b) for a, b in zip(new, old))
+    return np.where(mask, new, old)
+
+
+def _active(mask, done):
+    return ~done if mask is None else mask & ~done
+
+
+HELPERS = {name: value for name, value in globals().items()
+           if name.startswith("_") and not name.startswith("__") and callable(value)}
+
+
+class _ExpressionTranslator(ast.NodeTransformer):
+
+    def visit_BoolOp(self, node):
+        self.generic_visit(node)
+        name = "_and" if isinstance(node.op, ast.And) else "_or"
+        return ast.Call(func=ast.Name(name, ast.Load()), args=node.values, keywords=[])
+
+    def visit_UnaryOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Not):
+            return ast.Call(func=ast.Name("_not", ast.Load()), args=[node.operand], keywords=[])
+        return node
+
+    def visit_Compare(self, node):
+        self.generic_visit(node)
+        if any(isinstance(op, (ast.In, ast.NotIn, ast.Is, ast.IsNot)) for op in node.ops):
+            raise TranslationError("membership and identity tests are not supported")
+        if len(node.ops) == 1:
+            return node
+        left, pairs = node.left, []
+        for op, right in zip(node.ops, node.comparators):
+            pairs.append(ast.Compare(left=left, ops=[op], comparators=[right]))
+            left = right
+        return ast.Call(func=ast.Name("_and", ast.Load()), args=pairs, keywords=[])
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return ast.Call(func=ast.Attribute(ast.Name("_np", ast.Load()), "where", ast.Load()),
+                        args=[node.test, node.body, node.orelse], keywords=[])
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        func = node.func
+        if isinstance(func, ast.Name) and func.id in BUILTIN_FUNCTIONS:
+            node.func = ast.parse(BUILTIN_FUNCTIONS[func.id], mode="eval").body
+        elif isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == "math":
+            if func.attr not in MATH_FUNCTIONS:
+                raise TranslationError("math.{} is not supported".format(func.attr))
+            node.func = ast.Attribute(ast.Name("_np", ast.Load()), MATH_FUNCTIONS[func.attr], ast.Load())
+        elif isinstance(func, ast.Attribute) and func.attr == "get":
+            node.func = ast.Name("_get", ast.Load())
+            node.args = [func.value] + node.args
+        elif not isinstance(func, ast.Name):
+            # plain names are helpers of the reward file (e.g. per track caches) and are called as is
+            raise TranslationError("call to {} is not supported".format(ast.unparse(func)))
+        return node
+
+    def visit_Subscript(self, node):
+        self.generic_visit(node)
+        if isinstance(node.ctx, ast.Load) and not isinstance(node.slice, ast.Slice):
+            return ast.Call(func=ast.Name("_index", ast.Load()), args=[node.value, node.slice], keywords=[])
+        return node
+
+    def _unsupported(self, node):
+        raise TranslationError("{} is not supported".format(type(node).__name__))
+
+    visit_Lambda = visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = _unsupported
+    visit_Await = visit_Yield = visit_YieldFrom = visit_NamedExpr = _unsupported
+
+
+def _error_checks(node):
+    """Conditions under which evaluating node raises in scalar Python.
+
+    Only always-evaluated positions are inspected: the right hand side of and/or and the branches of
+    a conditional expression may be skipped by the scalar code.
+    """
+    checks = []
+
+    def visit(node):
+        if isinstance(node, ast.BoolOp):
+            visit(node.values[0])
+            return
+        if isinstance(node, ast.IfExp):
+            visit(node.test)
+            return
+        for child in ast.iter_child_nodes(node):
+            visit(child)
+        if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Div, ast.FloorDiv, ast.Mod)):
+            checks.append(ast.Compare(copy.deepcopy(node.right), [ast.Eq()], [ast.Constant(0)]))
+        elif (isinstance(node, ast.Call) and isinstance(node.func, ast.Attribute) and node.args
+              and isinstance(node.func.value, ast.Name) and node.func.value.id == "math"):
+            arg = copy.deepcopy(node.args[0])
+            if node.func.attr in ("acos", "asin"):
+                checks.append(ast.Compare(ast.Call(ast.Name("abs", ast.Load()), [arg], []), [ast.Gt()], [ast.Constant(1)]))
+            elif node.func.attr == "sqrt":
+                checks.append(ast.Compare(arg, [ast.Lt()], [ast.Constant(0)]))
+            elif node.func.attr == "log":
+                checks.append(ast.Compare(arg, [ast.LtE()], [ast.Constant(0)]))
+
+    visit(node)
+    return checks
+
+
+class _FunctionTranslator:
+
+    def __init__(self):
+        self.lines = []
+        self.counter = 0
+        self.may_have_returned = False
+
+    def expression(self, node, mask):
+        # rows where the scalar function would raise (zero division, math domain errors) end up as NaN
+        for check in _error_checks(node):
+            self.emit("_fail = _fail | (_active({}, _done) & _truth({}))".format(mask, self.translate(check)), 1)
+        return self.translate(copy.deepcopy(node))
+
+    def translate(self, node):
+        return ast.unparse(_ExpressionTranslator().visit(ast.fix_missing_locations(node)))
+
+    def emit(self, line, depth):
+        self.lines.append("    " * depth + line)
+
+    def assign(self, name, value, mask):
+        if mask is None and not self.may_have_returned:
+            self.emit("{} = {}".format(name, value), 1)
+        else:
+            self.emit("{0} = _select(_active({1}, _done), {2}, locals().get('{0}'))".format(name, mask, value), 1)
+
+    def statements(self, body, mask):
+        for node in body:
+            self.statement(node, mask)
+
+    def statement(self, node, mask):
+        if isinstance(node, ast.Assign):
+            target = node.targets[0] if len(node.targets) == 1 else None
+            if isinstance(target, ast.Name):
+                self.assign(target.id, self.expression(node.value, mask), mask)
+            elif isinstance(target, (ast.Tuple, ast.List)) and all(isinstance(t, ast.Name) for t in target.elts):
+                self.counter += 1
+                unpacked = "_u{}".format(self.counter)
+                self.emit("{} = {}".format(unpacked, self.expression(node.value, mask)), 1)
+                for i, element in enumerate(target.elts):
+                    self.assign(element.id, "{}[{}]".format(unpacked, i), mask)
+            else:
+                raise TranslationError("only assignments to plain names are supported")
+        elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name) and node.value is not None:
+            self.assign(node.target.id, self.expression(node.value, mask), mask)
+        elif isinstance(node, ast.AugAssign):
+            if not isinstance(node.target, ast.Name):
+                raise TranslationError("only augmented assignments to plain names are supported")
+            value = ast.BinOp(left=ast.Name(node.target.id, ast.Load()), op=node.op, right=node.value)
+            self.assign(node.target.id, self.expression(value, mask), mask)
+        elif isinstance(node, ast.If):
+            self.counter += 1
+            condition, body_mask, else_mask = ("_c{}".format(self.counter), "_m{}".format(self.counter),
+                                               "_e{}".format(self.counter))
+            self.emit("{} = _truth({})".format(condition, self.expression(node.test, mask)), 1)
+            self.emit("{} = {}".format(body_mask, condition if mask is None else "_and({}, {})".format(mask, condition)), 1)
+            self.statements(node.body, body_mask)
+            if node.orelse:
+                self.emit("{} = {}".format(else_mask, "_not({})".format(condition) if mask is None
+                                           else "_and({}, _not({}))".format(mask, condition)), 1)
+                self.statements(node.orelse, else_mask)
+        elif isinstance(node, ast.Return):
+            value = self.expression(node.value, mask) if node.value is not None else "_np.nan"
+            self.emit("_now = _active({}, _done)".format(mask), 1)
+            self.emit("_ret = _np.where(_now, {}, _ret)".format(value), 1)
+            self.emit("_done = _done | _now", 1)
+            self.may_have_returned = True
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            self.emit(ast.unparse(node), 1)
+        elif isinstance(node, (ast.Pass, ast.Assert)):
+            pass
+        elif isinstance(node, ast.Expr) and (isinstance(node.value, ast.Constant) or (
+                isinstance(node.value, ast.Call) and isinstance(node.value.func, ast.Name) and node.value.func.id == "print")):
+            pass
+        else:
+            raise TranslationError("{} statements are not supported".format(type(node).__name__))
+
+
+def translate(function):
+    """Translate a scalar reward function into a batch function over column arrays."""
+    tree = ast.parse(textwrap.dedent(inspect.getsource(function)))
+    definition = tree.body[0]
+    if not isinstance(definition, ast.FunctionDef) or len(definition.args.args) != 1:
+        raise TranslationError("expected a function taking a single params argument")
+    translator = _FunctionTranslator()
+    translator.statements(definition.body, None)
+    params = definition.args.args[0].arg
+    source = "\n".join(["def _batch_reward({}):".format(params),
+                        "    _n = _batch_size({})".format(params),
+                        "    _ret = _np.full(_n, _np.nan)",
+                        "    _done = _np.zeros(_n, dtype=bool)",
+                        "    _fail = _np.zeros(_n, dtype=bool)"]
+                       + translator.lines
+                       + ["    _ret = _np.where(_fail, _np.nan, _ret)",
+                          "    return _np.broadcast_to(_np.asarray(_ret, dtype=float), (_n,))"])
+    namespace = dict(function.__globals__)
+    namespace.update(HELPERS)
+    namespace.update(_np=np, _batch_size=batch_size)
+    exec(compile(source, "<batch {}>".format(function.__name__), "exec"), namespace)
+    batch = namespace["_batch_reward"]
+    batch.source = source
+
+    def run(columns):
+        with np.errstate(all="ignore"):
+            return batch(columns)
+
+    run.source = source
+    return run
+
+
+# Column batches
+
+def batch_size(columns):
+    for value in columns.values():
+        if isinstance(value, np.ndarray) and value.ndim == 1:
+            return len(value)
+    raise ValueError("columns do not contain any array")
+
+
+def row_params(columns, i):
+    params = {}
+    for key, value in columns.items():
+        if isinstance(value, Points):
+            params[key] = list(zip(value.xs.tolist(), value.ys.tolist()))
+        elif isinstance(value, list):
+            params[key] = [v[i].item() if isinstance(v, np.ndarray) else v for v in value]
+        elif isinstance(value, np.ndarray):
+            params[key] = value[i].item()
+        else:
+            params[key] = value
+    return params
+
+
+def iter_params(columns):
+    """Yield the scalar params dicts of a column batch, sharing one waypoints list."""
+    waypoints = {key: list(zip(v.xs.tolist(), v.ys.tolist())) for key, v in columns.items() if isinstance(v, Points)}
+    for i in range(batch_size(columns)):
+        params = row_params({k: v for k, v in columns.items() if k not in waypoints}, i)
+        params.update(waypoints)
+        yield params
+
+
+def scalar_batch(reward_function):
+    """Batch function that loops over the scalar reward, with NaN for steps that raise."""
+    def run(columns):
+        result = []
+        for params in iter_params(columns):
+            try:
+                result.append(float(reward_function(params)))
+            except Exception:
+                result.append(math.nan)
+        return np.array(result, dtype=float)
+
+    return run
+
+
+def build_columns(rows, waypoints=None, widths=None, objects=None):
+    """Vectorized equivalent of sim_trace.make_params_builder over a list of parsed rows, with the same keys.
+
+    The objects_* params are the same for every row, so they stay lists of scalars like in the
+    scalar params; only closest_objects depends on the row.
+    """
+    (_, steps, x, y, heading, steering_angle, speed, _, _, _, all_wheels_on_track, progress,
+     closest, track_len, _, status, _) = zip(*rows)
+    x, y = np.array(x), np.array(y)
+    closest = np.array(closest, dtype=int)
+    status = np.array(status)
+    progress, track_len = np.array(progress), np.array(track_len)
+    if waypoints:
+        points = np.array(waypoints, dtype=float)
+        n = len(points)
+        deltas = np.roll(points, -1, axis=0) - points
+        len2 = (deltas ** 2).sum(axis=1)
+        prev_wp = closest % n
+        along = (x - points[prev_wp, 0]) * deltas[prev_wp, 0] + (y - points[prev_wp, 1]) * deltas[prev_wp, 1]
+        prev_wp = np.where((len2[prev_wp] == 0) | (along < 0), (closest - 1) % n, prev_wp)
+        cross = deltas[prev_wp, 0] * (y - points[prev_wp, 1]) - deltas[prev_wp, 1] * (x - points[prev_wp, 0])
+        with np.errstate(all="ignore"):
+            distance = np.where(len2[prev_wp] > 0, np.abs(cross) / np.sqrt(len2[prev_wp]), 0.0)
+        next_wp = (prev_wp + 1) % n
+        width = np.asarray(widths if widths else [DEFAULT_TRACK_WIDTH] * n, dtype=float)[closest % n]
+        left = cross > 0
+        track = Points(points[:, 0], points[:, 1])
+    else:
+        prev_wp, next_wp = closest, closest + 1
+        distance, left = np.zeros(len(x)), np.ones(len(x), dtype=bool)
+        width = np.full(len(x), DEFAULT_TRACK_WIDTH)
+        track = Points(np.zeros(0), np.zeros(0))
+    projection = progress / 100.0 * track_len
+    if objects:
+        # the first object ahead of the car, the first one of the lap when the car passed them all
+        next_object = np.searchsorted(np.array([o[0] for o in objects]), projection, side="right") % len(objects)
+        closest_objects = [(next_object - 1) % len(objects), next_object]
+    else:
+        objects = []
+        closest_objects = [np.zeros(len(x), dtype=int), np.zeros(len(x), dtype=int)]
+    return {
+        "all_wheels_on_track": np.array(all_wheels_on_track, dtype=bool),
+        "x": x,
+        "y": y,
+        "heading": np.array(heading),
+        "distance_from_center": distance,
+        "is_left_of_center": left,
+        "is_offtrack": status == "off_track",
+        "is_crashed": status == "crashed",
+        "is_reversed": status == "reversed",
+        "progress": progress,
+        "speed": np.array(speed),
+        "steering_angle": np.array(steering_angle),
+        "steps": np.array(steps, dtype=int),
+        "track_length": track_len,
+        "track_width": width,
+        "waypoints": track,
+        "closest_waypoints": [prev_wp, next_wp],
+        "projection_distance": projection,
+        "closest_objects": closest_objects,
+        "objects_distance": [o[0] for o in objects],
+        "objects_heading": [o[4] for o in objects],
+        "objects_left_of_center": [o[3] for o in objects],
+        "objects_location": [(o[1], o[2]) for o in objects],
+        "objects_speed": [o[5] for o in objects],
+    }
+
+
+def check_equivalence(reward_function, batch, columns, rtol=1e-6, atol=1e-9):
+    """Return the indices of rows where the batch function disagrees with the scalar one."""
+    expected = scalar_batch(reward_function)(columns)
+    actual = np.asarray(batch(columns), dtype=float)
+    agree = np.isclose(actual, expected, rtol=rtol, atol=atol, equal_nan=True)
+    return np.flatnonzero(~agree)
+
+
+def compile_batch(module, sample):
+    """Pick the fastest batch version of module.reward_function that matches it on the sample.
+
+    Returns (batch function, description of the version used).
+    """
+    reward_function = module.reward_function
+    declared = getattr(module, "reward_function_batch", None)
+    if callable(declared):
+        mismatches = check_equivalence(reward_function, declared, sample)
+        if not len(mismatches):
+            return declared, "declared reward_function_batch"
+        print("reward_function_batch disagrees with reward_function on {} of {} sample steps, ignoring it".format(
+            len(mismatches), batch_size(sample)))
+    try:
+        translated = translate(reward_function)
+        mismatches = check_equivalence(reward_function, translated, sample)
+    except Exception as e:
+        # translated code evaluates every branch on every row, names bound in one branch only fail here
+        print("Could not translate reward_function to NumPy: {}".format(e))
+    else:
+        if not len(mismatches):
+            return translated, "translated reward_function"
+        print("Translated reward_function disagrees on {} of {} sample steps, ignoring it".format(
+            len(mismatches), batch_size(sample)))
+    return scalar_batch(reward_function), "scalar loop"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check and time the NumPy batch version of a reward function")
+    parser.add_argument("reward_file")
+    parser.add_argument("traces", nargs="*", help="optional robomaker logs or simtrace csv files to evaluate")
+    parser.add_argument("--track", help="DR_WORLD_NAME or path to the track .npy")
+    parser.add_argument("--steps", type=int, default=100000, help="synthetic steps when no traces are given")
+    parser.add_argument("--show-source", action="store_true", help="print the translated function")
+    parser.add_argument("--run-env", default=RUN_ENV, help="race type and object counts")
+    parser.add_argument("--race-type", choices=["TIME_TRIAL"] + list(OBJECT_COUNTS),
+                        help="default: DR_RACE_TYPE in --run-env")
+    args = parser.parse_args()
+
+    # the same objects as a replay of the traces
+    variables = ConfigSession().variables(args.run_env) if os.path.exists(args.run_env) else {}
+    race_type = args.race_type or variables.get("DR_RACE_TYPE", "TIME_TRIAL")
+    try:
+        objects = replay_objects(race_type, args.track, variables)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    if objects is None and reads_objects(args.reward_file):
+        raise SystemExit("{} reads the objects_* params, which are empty in a {} run: use --race-type "
+                         "OBJECT_AVOIDANCE or HEAD_TO_BOT with --track".format(args.reward_file, race_type))
+    waypoints = widths = None
+    if args.track:
+        track = load_track(args.track)
+        waypoints, widths = center_waypoints(track), track_widths(track)
+    if args.traces:
+        rows = [row for path in find_trace_files(args.traces) for chunk in iter_chunks(path) for row in chunk]
+    else:
+        rows = synthetic_rows(args.steps, waypoints)
+    module = load_reward_module(args.reward_file)
+    columns = build_columns(rows, waypoints, widths, objects)
+    batch, how = compile_batch(module, build_columns(rows[:SAMPLE_SIZE], waypoints, widths, objects))
+    print("Using {}".format(how))
+    if args.show_source and hasattr(batch, "source"):
+        print(batch.source)
+
+    started = time.time()
+    rewards = batch(columns)
+    batch_time = time.time() - started
+    scalar_rows = min(len(rows), SAMPLE_SIZE * 10)
+    started = time.time()
+    scalar_batch(module.reward_function)(build_columns(rows[:scalar_rows], waypoints, widths, objects))
+    scalar_time = (time.time() - started) * len(rows) / scalar_rows
+    scored = rewards[~np.isnan(rewards)]
+    print("{} steps: batch {:.3f}s, scalar {:.3f}s (estimated), {} steps raised, mean reward {}".format(
+        len(rows), batch_time, scalar_time, len(rows) - len(scored), round(float(scored.mean()), 4) if len(scored) else None))
+
+
+if __name__ == "__main__":
+    main()
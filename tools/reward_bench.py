@@ -0,0 +1,205 @@
+"""Latency benchmark for reward functions.
+
+Every robomaker worker calls the reward function once per simulation step, so a slow reward
+slows down every worker. This drives a reward file with a params stream for each race type
+(TIME_TRIAL, OBJECT_AVOIDANCE and HEAD_TO_BOT), measures per call latency, memory allocated per
+call and exceptions, and compares it with the examples in custom-files/reward-fn-examples.
+
+The exit code is 1 when the reward function is over the latency budget or raises for the race
+type configured in run.env, which is how menu.py decides whether to warn before saving it. The
+same run.env sets the number of obstacles and bot cars and the bot car speed.
+
+Example:
+    python3 -m tools.reward_bench custom-files/reward_function.py --budget-us 50
+"""
+import argparse, glob, math, os, random, sys, time, tracemalloc
+from array import array
+from collections import Counter
+
+from .config_session import ConfigSession
+from .rewards import DEFAULT_REWARD_FILE, load_reward_function
+from .sim_trace import (DEFAULT_BOT_CAR_SPEED, add_objects, find_trace_files, iter_chunks, make_params_builder,
+                        race_objects, synthetic_rows, track_objects)
+from .tracks import center_waypoints, load_track, oval_waypoints, track_widths
+
+RACE_TYPES = ["TIME_TRIAL", "OBJECT_AVOIDANCE", "HEAD_TO_BOT"]
+EXAMPLES_GLOB = "custom-files/reward-fn-examples/*.py"
+RUN_ENV = "custom-files/run.env"
+DEFAULT_BUDGET_US = float(os.environ.get("DOTS_REWARD_BUDGET_US", 100))
+WARMUP_CALLS = 20
+ALLOCATION_CALLS = 500
+
+
+def run_variables(run_env=RUN_ENV):
+    """Variables of a run.env, empty when there is none (the defaults apply)."""
+    return ConfigSession().variables(run_env) if os.path.exists(run_env) else {}
+
+
+def params_stream(race_type, steps, waypoints=None, widths=None, rows=None, seed=0, variables=None):
+    """List of params dicts for one race type, from recorded rows or synthetic ones.
+
+    The number of obstacles or bot cars and the bot car speed are the run.env variables given.
+    """
+    waypoints = waypoints or oval_waypoints()
+    widths = widths or [1.07] * len(waypoints)
+    rows = rows[:steps] if rows else synthetic_rows(steps, waypoints[:-1], seed)
+    build = make_params_builder(waypoints, widths)
+    rng = random.Random(seed)
+    track_length = sum(math.dist(waypoints[i], waypoints[i + 1]) for i in range(len(waypoints) - 1))
+    variables = variables or {}
+    objects = race_objects(race_type, waypoints, widths, variables, rng)
+    bot_speed = float(variables.get("DR_H2B_BOT_CAR_SPEED", DEFAULT_BOT_CAR_SPEED))
+    stream = []
+    for row in rows:
+        params = build(row)
+        params["track_length"] = track_length
+        params["projection_distance"] = params["progress"] / 100.0 * track_length
+        if objects:
+            if race_type == "HEAD_TO_BOT":
+                # the bots drive, every step sees them somewhere else
+                objects = track_objects(race_type, waypoints, widths, len(objects), rng, bot_speed)
+            add_objects(params, objects)
+        stream.append(params)
+    return stream
+
+
+def _percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))] if ordered else math.nan
+
+
+def measure(reward_function, stream):
+    """Latency (microseconds), allocation and exception statistics of one function over a stream."""
+    errors = Counter()
+    start = time.perf_counter_ns()
+    for params in stream[:WARMUP_CALLS]:
+        try:
+            reward_function(params)
+        except Exception:
+            pass
+        if params is stream[0]:
+            first_call = (time.perf_counter_ns() - start) / 1000.0
+    timings = array("d")
+    for params in stream:
+        start = time.perf_counter_ns()
+        try:
+            reward_function(params)
+        except Exception as e:
+            errors[type(e).__name__] += 1
+        timings.append((time.perf_counter_ns() - start) / 1000.0)
+
+    tracemalloc.start()
+    allocated = 0
+    blocks = sys.getallocatedblocks()
+    sample = stream[:ALLOCATION_CALLS]
+    for params in sample:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        try:
+            reward_function(params)
+        except Exception:
+            pass
+        allocated += tracemalloc.get_traced_memory()[1] - base
+    retained = sys.getallocatedblocks() - blocks
+    tracemalloc.stop()
+
+    ordered = sorted(timings)
+    return {
+        "p50": _percentile(ordered, 50),
+        "p99": _percentile(ordered, 99),
+        "max": ordered[-1] if ordered else math.nan,
+        "first_call": first_call if stream else math.nan,
+        "bytes_per_call": allocated / len(sample) if sample else 0,
+        "retained_blocks": retained,
+        "errors": errors,
+        "calls": len(stream),
+    }
+
+
+def benchmark(reward_files, streams):
+    results = {}
+    for file in reward_files:
+        try:
+            reward_function = load_reward_function(file)
+        except Exception as e:
+            results[file] = "cannot be loaded: {}: {}".format(type(e).__name__, e)
+            continue
+        results[file] = {race_type: measure(reward_function, stream) for race_type, stream in streams.items()}
+    return results
+
+
+def print_results(results):
+    print("{:<45} {:<17} {:>8} {:>8} {:>9} {:>9} {:>10}  {}".format(
+        "Reward function", "Race type", "p50 us", "p99 us", "max us", "first us", "B/call", "exceptions"))
+    for file, by_race in results.items():
+        name = os.path.basename(file)
+        if isinstance(by_race, str):
+            print("{:<45} {}".format(name, by_race))
+            continue
+        for race_type, stats in by_race.items():
+            errors = ", ".join("{} x{}".format(k, v) for k, v in stats["errors"].items()) or "-"
+            print("{:<45} {:<17} {:>8.2f} {:>8.2f} {:>9.1f} {:>9.1f} {:>10.0f}  {}".format(
+                name[:45], race_type, stats["p50"], stats["p99"], stats["max"], stats["first_call"],
+                stats["bytes_per_call"], errors))
+
+
+def check(results, candidate, race_type, budget_us, max_ratio=None):
+    """Return the list of reasons the candidate fails, empty when it passes."""
+    by_race = results[candidate]
+    if isinstance(by_race, str):
+        return ["reward function " + by_race]
+    failures = []
+    for name, stats in by_race.items():
+        if stats["p99"] > budget_us:
+            failures.append("{}: p99 latency {:.1f}us is over the {:.1f}us budget".format(name, stats["p99"], budget_us))
+    stats = by_race.get(race_type)
+    if stats and stats["errors"]:
+        failures.append("{}: raised on {} of {} steps ({})".format(
+            race_type, sum(stats["errors"].values()), stats["calls"], ", ".join(stats["errors"])))
+    baselines = [r[name]["p99"] for f, r in results.items() if f != candidate and not isinstance(r, str)
+                 for name in r]
+    if max_ratio and baselines:
+        slowest = max(baselines)
+        worst = max(stats["p99"] for stats in by_race.values())
+        if worst > slowest * max_ratio:
+            failures.append("p99 latency {:.1f}us is more than {}x the slowest example ({:.1f}us)".format(
+                worst, max_ratio, slowest))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reward function latency against the bundled examples")
+    parser.add_argument("reward_file", nargs="?", default=DEFAULT_REWARD_FILE)
+    parser.add_argument("--race-type", action="append", choices=RACE_TYPES, help="default: all race types")
+    parser.add_argument("--steps", type=int, default=5000, help="params per race type")
+    parser.add_argument("--track", help="DR_WORLD_NAME or path to a track .npy (default: a synthetic oval)")
+    parser.add_argument("--traces", nargs="*", help="use recorded SIM_TRACE_LOG steps instead of synthetic ones")
+    parser.add_argument("--budget-us", type=float, default=DEFAULT_BUDGET_US, help="p99 latency budget per call")
+    parser.add_argument("--max-ratio", type=float, help="fail when p99 is this many times the slowest example")
+    parser.add_argument("--no-baselines", action="store_true", help="skip the reward-fn-examples comparison")
+    parser.add_argument("--run-env", default=RUN_ENV, help="race type, object counts and bot car speed")
+    args = parser.parse_args()
+
+    waypoints = widths = rows = None
+    if args.track:
+        track = load_track(args.track)
+        waypoints, widths = center_waypoints(track), track_widths(track)
+    if args.traces:
+        rows = [row for path in find_trace_files(args.traces) for chunk in iter_chunks(path) for row in chunk]
+    variables = run_variables(args.run_env)
+    streams = {race_type: params_stream(race_type, args.steps, waypoints, widths, rows, variables=variables)
+               for race_type in args.race_type or RACE_TYPES}
+    files = [args.reward_file] + ([] if args.no_baselines else sorted(glob.glob(EXAMPLES_GLOB)))
+    results = benchmark(files, streams)
+    print_results(results)
+
+    failures = check(results, args.reward_file, variables.get("DR_RACE_TYPE", "TIME_TRIAL"),
+                     args.budget_us, args.max_ratio)
+    for failure in failures:
+        print("FAIL " + failure)
+    if failures:
+        sys.exit(1)
+    print("OK {} is within the {:.1f}us p99 budget".format(args.reward_file, args.budget_us))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+"""Attribute the reward of every step to the terms of the reward function.
+
+instrument() rewrites reward_function: every assignment to the variable it returns (reward = 1.0,
+reward += 1.2, reward *= 0.7, ...) and every return statement is a term, named after its line. The
+rewritten function writes the change each term makes to the reward into the row of the step in a
+preallocated ring buffer of RING_STEPS rows of doubles, so the terms of a step add up to the reward
+it returns. A multiplicative term is attributed the change it makes: reward *= 0.7 on a reward of
+3.0 counts as -0.9, and an early `return 1e-3` counts as the difference to the reward so far.
+Every FLUSH_STEPS steps the rows are folded with NumPy into aggregates per term (how often it
+fires, mean, share of the absolute attribution, correlation with speed and with the steering change
+from the previous step) and per waypoint, off the path of the reward function.
+
+A term that goes up with the steering change rewards zig-zag, one that goes down with speed rewards
+slow laps. The per waypoint means of every term are written as an SVG heatmap (terms by waypoints,
+and one track map per term when the track is known) and as a csv.
+
+Example:
+    python3 -m tools.reward_profile custom-files/reward_function.py robomaker1.log --track 2022_may_open_ccw --svg attribution.svg
+"""
+import argparse, ast, inspect, json, math, textwrap, time
+from array import array
+
+from .rewards import load_reward_module
+from .sim_trace import find_trace_files, iter_chunks, make_params_builder, synthetic_rows
+from .tracks import center_waypoints, load_track, track_widths
+
+RING_STEPS = 4096
+FLUSH_STEPS = 4096
+# columns of a ring buffer row before the terms
+WAYPOINT, SPEED, STEERING_CHANGE, REWARD = range(4)
+EXTRA = 4
+CORRELATION_FLAG = 0.2
+SHARE_FLAG = 5.0
+
+
+def _returned_name(definition):
+    """Name of the variable holding the reward: the first assigned name in the value of the last return."""
+    nodes = list(_own_nodes(definition))
+    assigned = {target.id for node in nodes if isinstance(node, (ast.Assign, ast.AugAssign, ast.AnnAssign))
+                for top in (node.targets if isinstance(node, ast.Assign) else [node.target])
+                for target in ast.walk(top) if isinstance(target, ast.Name)}
+    returns = sorted((node for node in nodes if isinstance(node, ast.Return) and node.value is not None),
+                     key=lambda node: node.lineno)
+    for node in reversed(returns):
+        for child in ast.walk(node.value):
+            if isinstance(child, ast.Name) and child.id in assigned:
+                return child.id
+    return "reward"
+
+
+def _own_nodes(definition):
+    """Nodes of a function, without the bodies of nested functions and lambdas."""
+    pending = list(definition.body)
+    while pending:
+        node = pending.pop()
+        yield node
+        for child in ast.iter_child_nodes(node):
+            if not isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda, ast.ClassDef)):
+                pending.append(child)
+
+
+class _Instrumenter(ast.NodeTransformer):
+
+    def __init__(self, name, lines, first_line=1):
+        self.name = name
+        self.lines = lines
+        self.first_line = first_line
+        self.terms = []
+
+    def term(self, node):
+        # node.lineno is a line of the reward file, lines the source of the function from first_line
+        self.terms.append("L{} {}".format(node.lineno, self.lines[node.lineno - self.first_line].strip()))
+        return len(self.terms) - 1
+
+    def record(self, node):
+        call = ast.Call(ast.Name("_rp_set", ast.Load()),
+                        [ast.Constant(self.term(node)), ast.Name(self.name, ast.Load())], [])
+        return [node, ast.copy_location(ast.Expr(call), node)]
+
+    def visit_Assign(self, node):
+        names = [target for top in node.targets for target in ast.walk(top) if isinstance(target, ast.Name)]
+        if any(target.id == self.name for target in names):
+            return self.record(node)
+        return node
+
+    def visit_AugAssign(self, node):
+        if isinstance(node.target, ast.Name) and node.target.id == self.name:
+            return self.record(node)
+        return node
+
+    def visit_AnnAssign(self, node):
+        if isinstance(node.target, ast.Name) and node.target.id == self.name and node.value is not None:
+            return self.record(node)
+        return node
+
+    def visit_Return(self, node):
+        value = node.value if node.value is not None else ast.Constant(None)
+        node.value = ast.Call(ast.Name("_rp_return", ast.Load()), [ast.Constant(self.term(node)), value], [])
+        return node
+
+    def visit_FunctionDef(self, node):
+        # nested functions return to their caller, not from the reward function
+        return node
+
+    visit_AsyncFunctionDef = visit_Lambda = visit_ClassDef = visit_FunctionDef
+
+
+class RewardProfile:
+    """Ring buffer of per step term contributions and the aggregates folded from it."""
+
+    def __init__(self, terms, capacity=RING_STEPS, flush_steps=FLUSH_STEPS, on_flush=None):
+        self.terms = terms
+        self.width = EXTRA + len(terms)
+        self.capacity = capacity
+        self.flush_steps = min(flush_steps, capacity)
+        self.on_flush = on_flush
+        self.ring = array("d", bytes(8 * self.width * capacity))
+        self.zeros = array("d", bytes(8 * len(terms)))
+        self.row = 0
+        self.start = EXTRA
+        self.pending = 0
+        self.current = 0.0
+        self.last_steps = self.last_steering = None
+        self.steps = 0
+        self.errors = 0
+        count = len(terms)
+        self.totals = {key: [0.0] * count for key in ("sum", "sum2", "fires", "speed", "steering")}
+        self.moments = {"n": 0, "speed": 0.0, "speed2": 0.0, "steering": 0.0, "steering2": 0.0, "reward": 0.0}
+        self.waypoint_steps = []
+        self.waypoint_sums = []
+
+    def begin(self, params):
+        """Start the row of a step."""
+        base = self.row * self.width
+        ring = self.ring
+        self.start = base + EXTRA
+        ring[self.start:base + self.width] = self.zeros
+        steering, steps = params.get("steering_angle", 0.0), params.get("steps", 0)
+        ring[base + WAYPOINT] = params.get("closest_waypoints", (0, 0))[0]
+        ring[base + SPEED] = params.get("speed", 0.0)
+        ring[base + STEERING_CHANGE] = (abs(steering - self.last_steering)
+                                        if self.last_steps is not None and steps == self.last_steps + 1 else 0.0)
+        self.last_steps, self.last_steering = steps, steering
+        self.current = 0.0
+
+    def set(self, term, value):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        self.ring[self.start + term] += value - self.current
+        self.current = value
+
+    def end(self, term, value):
+        """Record the return term and close the row, returns value unchanged."""
+        self.set(term, value)
+        self.ring[self.start - EXTRA + REWARD] = self.current
+        self.row = (self.row + 1) % self.capacity
+        self.steps += 1
+        self.pending += 1
+        if self.pending >= self.flush_steps:
+            self.flush()
+        return value
+
+    def rows(self):
+        """The rows not folded into the aggregates yet, oldest first, as an array."""
+        import numpy as np
+        ring = np.frombuffer(self.ring, dtype=float).reshape(self.capacity, self.width)
+        return ring[(np.arange(self.row - self.pending, self.row)) % self.capacity]
+
+    def flush(self):
+        """Fold the pending rows into the aggregates."""
+        import numpy as np
+        if not self.pending:
+            return
+        rows = self.rows()
+        self.pending = 0
+        terms, speed, steering = rows[:, EXTRA:], rows[:, SPEED], rows[:, STEERING_CHANGE]
+        for key, values in (("sum", terms.sum(axis=0)), ("sum2", (terms ** 2).sum(axis=0)),
+                            ("fires", (terms != 0).sum(axis=0)), ("speed", (terms * speed[:, None]).sum(axis=0)),
+                            ("steering", (terms * steering[:, None]).sum(axis=0))):
+            self.totals[key] = [a + b for a, b in zip(self.totals[key], values.tolist())]
+        moments = self.moments
+        moments["n"] += len(rows)
+        moments["speed"] += float(speed.sum())
+        moments["speed2"] += float((speed ** 2).sum())
+        moments["steering"] += float(steering.sum())
+        moments["steering2"] += float((steering ** 2).sum())
+        moments["reward"] += float(rows[:, REWARD].sum())
+        waypoints = rows[:, WAYPOINT].astype(int)
+        size = int(waypoints.max()) + 1
+        if size > len(self.waypoint_steps):
+            grow = size - len(self.waypoint_steps)
+            self.waypoint_steps.extend([0] * grow)
+            self.waypoint_sums.extend([[0.0] * len(self.terms) for _ in range(grow)])
+        counts = np.bincount(waypoints, minlength=size)
+        sums = np.zeros((size, len(self.terms)))
+        np.add.at(sums, waypoints, terms)
+        for waypoint in np.flatnonzero(counts).tolist():
+            self.waypoint_steps[waypoint] += int(counts[waypoint])
+            self.waypoint_sums[waypoint] = [a + b for a, b in zip(self.waypoint_sums[waypoint], sums[waypoint].tolist())]
+        if self.on_flush:
+            self.on_flush(self)
+
+    def summary(self):
+        """Per term statistics, largest share of the absolute attribution first."""
+        n = self.moments["n"]
+        if not n:
+            return []
+
+        def correlation(cross, key):
+            mean = self.moments[key] / n
+            spread = self.moments[key + "2"] / n - mean ** 2
+            variance = totals["sum2"][i] / n - (totals["sum"][i] / n) ** 2
+            if spread <= 1e-12 or variance <= 1e-12:
+                return None
+            return (cross / n - mean * totals["sum"][i] / n) / math.sqrt(spread * variance)
+
+        totals = self.totals
+        total = sum(abs(value) for value in totals["sum"]) or 1.0
+        terms = []
+        for i, name in enumerate(self.terms):
+            terms.append({
+                "term": name,
+                "fires": 100.0 * totals["fires"][i] / n,
+                "mean": totals["sum"][i] / n,
+                "share": 100.0 * abs(totals["sum"][i]) / total,
+                "rms": math.sqrt(totals["sum2"][i] / n),
+                "speed_correlation": correlation(totals["speed"][i], "speed"),
+                "steering_correlation": correlation(totals["steering"][i], "steering"),
+            })
+        return sorted(terms, key=lambda term: -term["share"])
+
+    def waypoint_means(self):
+        """{waypoint: [mean contribution of every term per step]}."""
+        return {waypoint: [value / steps for value in sums]
+                for waypoint, (steps, sums) in enumerate(zip(self.waypoint_steps, self.waypoint_sums)) if steps}
+
+    def to_json(self):
+        return {"steps": self.steps, "errors": self.errors, "mean_reward": self.moments["reward"] / max(self.moments["n"], 1),
+                "terms": self.summary(),
+                "waypoints": {str(waypoint): means for waypoint, means in self.waypoint_means().items()}}
+
+
+def instrument(reward_function, capacity=RING_STEPS, flush_steps=FLUSH_STEPS, on_flush=None):
+    """Return (instrumented reward function, RewardProfile collecting its terms)."""
+    lines, first_line = inspect.getsourcelines(reward_function)
+    source = textwrap.dedent("".join(lines))
+    tree = ast.parse(source)
+    # the terms are named after the lines of the reward file, not of the dedented function
+    ast.increment_lineno(tree, first_line - 1)
+    definition = tree.body[0]
+    if not isinstance(definition, ast.FunctionDef):
+        raise ValueError("expected a function definition")
+    instrumenter = _Instrumenter(_returned_name(definition), source.splitlines(), first_line)
+    body = []
+    for node in definition.body:
+        result = instrumenter.visit(node)
+        body.extend(result if isinstance(result, list) else [result])
+    definition.body = body
+    tree = ast.fix_missing_locations(tree)
+    profile = RewardProfile(instrumenter.terms, capacity, flush_steps, on_flush)
+    namespace = dict(reward_function.__globals__)
+    namespace.update(_rp_set=profile.set, _rp_return=profile.end)
+    exec(compile(tree, "<instrumented {}>".format(reward_function.__name__), "exec"), namespace)
+    instrumented = namespace[definition.name]
+
+    def run(params):
+        profile.begin(params)
+        try:
+            return instrumented(params)
+        except Exception:
+            profile.errors += 1
+            raise
+
+    return run, profile
+
+
+def _color(value, scale):
+    """Diverging colour: red for positive, blue for negative contributions, white for zero."""
+    if value is None:
+        return "#dddddd"
+    v = max(-1.0, min(1.0, value / scale)) if scale else 0.0
+    fade = int(255 * (1 - abs(v)))
+    return "#ff{0:02x}{0:02x}".format(fade) if v >= 0 else "#{0:02x}{0:02x}ff".format(fade)
+
+
+def _escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def heatmap_svg(profile, waypoints=None, cell=6, label_width=360, map_size=220):
+    """SVG of the per waypoint mean contribution of every term, rows of terms and track maps."""
+    means = profile.waypoint_means()
+    columns = max(len(waypoints or []), max(means, default=-1) + 1)
+    scale = max((abs(v) for values in means.values() for v in values), default=0.0)
+    order = [profile.terms.index(term["term"]) for term in profile.summary()] or list(range(len(profile.terms)))
+    row_height = 16
+    width = label_width + columns * cell + 20
+    parts = ['<text x="5" y="15" font-size="12">mean contribution per step by waypoint, scale +-{:.3g} '
+             '(red adds reward, blue takes it away)</text>'.format(scale)]
+    for row, term in enumerate(order):
+        y = 25 + row * row_height
+        parts.append('<text x="5" y="{}" font-size="11" font-family="monospace">{}</text>'.format(
+            y + 11, _escape(profile.terms[term][:55])))
+        for waypoint in range(columns):
+            value = means[waypoint][term] if waypoint in means else None
+            parts.append('<rect x="{}" y="{}" width="{}" height="{}" fill="{}"/>'.format(
+                label_width + waypoint * cell, y, cell, row_height - 2, _color(value, scale)))
+    height = 35 + len(order) * row_height
+    if waypoints:
+        xs, ys = [p[0] for p in waypoints], [p[1] for p in waypoints]
+        span = max(max(xs) - min(xs), max(ys) - min(ys)) or 1.0
+        per_row = max(1, width // (map_size + 10))
+        for i, term in enumerate(order):
+            left = 10 + (i % per_row) * (map_size + 10)
+            top = height + (i // per_row) * (map_size + 30)
+            parts.append('<text x="{}" y="{}" font-size="11" font-family="monospace">{}</text>'.format(
+                left, top + 12, _escape(profile.terms[term][:32])))
+            for waypoint, (x, y) in enumerate(waypoints):
+                value = means[waypoint][term] if waypoint in means else None
+                parts.append('<circle cx="{:.1f}" cy="{:.1f}" r="3" fill="{}"/>'.format(
+                    left + 10 + (x - min(xs)) / span * (map_size - 20),
+                    top + 20 + (max(ys) - y) / span * (map_size - 20), _color(value, scale)))
+        height += ((len(order) + per_row - 1) // per_row) * (map_size + 30)
+    return ('<svg xmlns="http://www.w3.org/2000/svg" width="{}" height="{}">'
+            '<rect width="100%" height="100%" fill="white"/>{}</svg>'.format(width, height, "".join(parts)))
+
+
+def write_waypoints_csv(file, profile):
+    import csv
+    with open(file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["waypoint", "steps"] + profile.terms)
+        for waypoint, means in profile.waypoint_means().items():
+            writer.writerow([waypoint, profile.waypoint_steps[waypoint]] + [round(value, 6) for value in means])
+
+
+def _number(value):
+    return "-" if value is None else "{:+.2f}".format(value)
+
+
+def print_summary(profile, elapsed, overhead):
+    print("{} steps in {:.2f}s, {} raised, mean reward {:.4f}, instrumentation overhead {}".format(
+        profile.steps, elapsed, profile.errors, profile.moments["reward"] / max(profile.moments["n"], 1),
+        "{:.2f}us per step".format(overhead) if overhead is not None else "-"))
+    print("{:<58} {:>7} {:>10} {:>8} {:>10} {:>10}".format(
+        "Term", "fires %", "mean/step", "share %", "vs speed", "vs steer"))
+    for term in profile.summary():
+        notes = []
+        if term["share"] >= SHARE_FLAG and (term["steering_correlation"] or 0) >= CORRELATION_FLAG:
+            notes.append("rewards steering changes (zig-zag)")
+        if term["share"] >= SHARE_FLAG and (term["speed_correlation"] or 0) <= -CORRELATION_FLAG:
+            notes.append("rewards slow driving")
+        print("{:<58} {:>7.1f} {:>10.4f} {:>8.1f} {:>10} {:>10}  {}".format(
+            term["term"][:58], term["fires"], term["mean"], term["share"], _number(term["speed_correlation"]),
+            _number(term["steering_correlation"]), ", ".join(notes)))
+
+
+def _overhead(reward_function, instrumented, stream, repeat=3):
+    """Extra microseconds per call of the instrumented function on a sample of params."""
+    def timed(function):
+        best = math.inf
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for params in stream:
+                try:
+                    function(params)
+                except Exception:
+                    pass
+            best = min(best, time.perf_counter() - start)
+        return best
+    return (timed(instrumented) - timed(reward_function)) * 1e6 / len(stream) if stream else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Attribute the reward of every step to the terms of the reward function")
+    parser.add_argument("reward_file")
+    parser.add_argument("traces", nargs="*", help="robomaker logs or simtrace csv files, synthetic steps when none")
+    parser.add_argument("--track", help="DR_WORLD_NAME or path to the track .npy")
+    parser.add_argument("--steps", type=int, default=100000, help="synthetic steps when no traces are given")
+    parser.add_argument("--flush-steps", type=int, default=FLUSH_STEPS)
+    parser.add_argument("--json", help="aggregates written at every flush")
+    parser.add_argument("--svg", help="per waypoint attribution heatmap")
+    parser.add_argument("--csv", help="per waypoint mean contribution of every term")
+    args = parser.parse_args()
+
+    waypoints = widths = None
+    if args.track:
+        track = load_track(args.track)
+        waypoints, widths = center_waypoints(track), track_widths(track)
+    build = make_params_builder(waypoints, widths)
+    if args.traces:
+        rows = (row for path in find_trace_files(args.traces) for chunk in iter_chunks(path) for row in chunk)
+    else:
+        rows = iter(synthetic_rows(args.steps, waypoints))
+
+    def write_json(profile):
+        with open(args.json, "w") as f:
+            json.dump(profile.to_json(), f)
+
+    reward_function = load_reward_module(args.reward_file).reward_function
+    instrumented, profile = instrument(reward_function, flush_steps=args.flush_steps,
+                                       on_flush=write_json if args.json else None)
+    started = time.time()
+    sample = []
+    for row in rows:
+        params = build(row)
+        if len(sample) < 2000:
+            sample.append(params)
+        try:
+            instrumented(params)
+        except Exception:
+            pass
+    profile.flush()
+    elapsed = time.time() - started
+    # a separate profile for the timing, so the sample is not counted twice
+    timing_function, _ = instrument(reward_function)
+    print_summary(profile, elapsed, _overhead(reward_function, timing_function, sample))
+    if args.svg:
+        with open(args.svg, "w") as f:
+            f.write(heatmap_svg(profile, waypoints))
+    if args.csv:
+        write_waypoints_csv(args.csv, profile)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+import importlib.util, os
+
+DEFAULT_REWARD_FILE = "custom-files/reward_function.py"
+
+
+def load_reward_module(path=DEFAULT_REWARD_FILE):
+    """Import a reward function file as a standalone module, the same way robomaker does."""
+    name = "reward_" + os.path.splitext(os.path.basename(path))[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_reward_function(path=DEFAULT_REWARD_FILE):
+    module = load_reward_module(path)
+    if not callable(getattr(module, "reward_function", None)):
+        raise AttributeError("{} does not define reward_function(params)".format(path))
+    return module.reward_function
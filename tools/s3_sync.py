@@ -0,0 +1,211 @@
+"""Sync of an S3 model prefix into a local cache keyed by ETag.
+
+The prefix is listed once per sync. Objects whose ETag is already in the cache are not
+downloaded again, new or changed ones are fetched on a bounded thread pool, and objects larger
+than the range threshold are split into ranged GETs that are fetched in parallel. Every GET is
+conditional on the listed ETag, so the parts of an object overwritten meanwhile are not mixed:
+the object is started again with its new version, up to RESTARTS times. Object bodies are
+stored once per ETag under <cache>/objects, and <cache>/files mirrors the prefix with links to
+them so analysis code can read plain local paths.
+
+Any boto3 S3 client can be passed in, for example one with endpoint_url pointing at minio or a
+moto server.
+
+Example:
+    python3 -m tools.s3_sync my-bucket my-model --include "metrics/*" --include "model/*.json" --copy-to .
+"""
+import argparse, fnmatch, json, os, shutil
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.dots_s3_cache")
+PART_SIZE = 8 * 1024 * 1024
+RANGE_THRESHOLD = 16 * 1024 * 1024
+WORKERS = 8
+RESTARTS = 3
+
+
+def _etag_name(etag):
+    return etag.strip('"').replace("/", "_")
+
+
+class S3Sync:
+
+    def __init__(self, bucket, prefix, cache_dir=DEFAULT_CACHE_DIR, client=None, workers=WORKERS,
+                 part_size=PART_SIZE, range_threshold=RANGE_THRESHOLD):
+        if client is None:
+            import boto3
+            client = boto3.client("s3")
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.cache_dir = os.path.join(cache_dir, bucket, self.prefix)
+        self.workers = workers
+        self.part_size = part_size
+        self.range_threshold = range_threshold
+        self.index_file = os.path.join(self.cache_dir, "index.json")
+        self.index = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file, "r") as f:
+                self.index = json.load(f)
+
+    def object_path(self, etag):
+        return os.path.join(self.cache_dir, "objects", _etag_name(etag))
+
+    def path(self, relative_key):
+        """Local path of an object, relative to the prefix, in the mirrored tree."""
+        return os.path.join(self.cache_dir, "files", relative_key)
+
+    def list(self, include=None):
+        """{relative key: (etag, size)} of the objects under the prefix matching the include patterns."""
+        objects = {}
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + "/"):
+            for item in page.get("Contents", []):
+                relative = item["Key"][len(self.prefix) + 1:]
+                if not relative or (include and not any(fnmatch.fnmatch(relative, p) for p in include)):
+                    continue
+                objects[relative] = (item["ETag"], item["Size"])
+        return objects
+
+    def _parts(self, size):
+        if size <= self.range_threshold:
+            return [None]
+        return [(start, min(start + self.part_size, size) - 1) for start in range(0, size, self.part_size)]
+
+    def _fetch(self, key, etag, part, temporary):
+        """Write one part of the listed version of an object, False when it was overwritten or deleted since."""
+        arguments = {"Bucket": self.bucket, "Key": key, "IfMatch": etag}
+        if part:
+            arguments["Range"] = "bytes={}-{}".format(*part)
+        try:
+            body = self.client.get_object(**arguments)["Body"]
+        except self.client.exceptions.ClientError as e:
+            if e.response["ResponseMetadata"].get("HTTPStatusCode") in (404, 412):
+                return False
+            raise
+        with open(temporary, "r+b") as f:
+            f.seek(part[0] if part else 0)
+            for data in iter(lambda: body.read(1024 * 1024), b""):
+                f.write(data)
+        return True
+
+    def _current(self, key):
+        """(etag, size) of an object now, None when it was deleted."""
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.ClientError as e:
+            if e.response["ResponseMetadata"].get("HTTPStatusCode") == 404:
+                return None
+            raise
+        return head["ETag"], head["ContentLength"]
+
+    def _download(self, bodies):
+        """Fetch {etag: (relative key, size)} into the cache. Returns {relative key: (etag, size) or None}
+        of the objects that changed or were deleted since they were listed, their parts are discarded."""
+        tasks = []
+        for etag, (relative, size) in bodies.items():
+            temporary = self.object_path(etag) + ".part"
+            with open(temporary, "wb") as f:
+                f.truncate(size)
+            tasks += [(self.prefix + "/" + relative, etag, part, temporary) for part in self._parts(size)]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            fetched = [future.result() for future in [pool.submit(self._fetch, *task) for task in tasks]]
+        # a part of another version would mix two bodies in one file
+        stale = {task[1] for task, ok in zip(tasks, fetched) if not ok}
+
+        moved = {}
+        for etag, (relative, size) in bodies.items():
+            temporary = self.object_path(etag) + ".part"
+            if etag in stale:
+                os.remove(temporary)
+                moved[relative] = self._current(self.prefix + "/" + relative)
+                continue
+            if os.path.getsize(temporary) != size:
+                raise IOError("{}: expected {} bytes, got {}".format(relative, size, os.path.getsize(temporary)))
+            os.replace(temporary, self.object_path(etag))
+        return moved
+
+    def _link(self, relative, etag):
+        target = self.path(relative)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(self.object_path(etag), target)
+        except OSError:
+            shutil.copyfile(self.object_path(etag), target)
+
+    def sync(self, include=None):
+        """Download new and changed objects. Returns (paths of all matching objects, relative keys downloaded)."""
+        listed = self.list(include)
+        changed = {relative: (etag, size) for relative, (etag, size) in listed.items()
+                   if not os.path.exists(self.object_path(etag))}
+        os.makedirs(os.path.join(self.cache_dir, "objects"), exist_ok=True)
+        for attempt in range(RESTARTS + 2):
+            # identical content is stored and downloaded once
+            bodies = {etag: (relative, size) for relative, (etag, size) in changed.items()
+                      if not os.path.exists(self.object_path(etag))}
+            if not bodies:
+                break
+            if attempt > RESTARTS:
+                raise IOError("{} kept changing while downloading".format(", ".join(sorted(
+                    relative for relative, _ in bodies.values()))))
+            # objects overwritten while they were downloaded start again with their new version
+            for relative, current in self._download(bodies).items():
+                if current is None:
+                    del listed[relative], changed[relative]
+                else:
+                    listed[relative] = changed[relative] = current
+        for relative, (etag, size) in listed.items():
+            if self.index.get(relative, {}).get("etag") != etag or not os.path.exists(self.path(relative)):
+                self._link(relative, etag)
+            self.index[relative] = {"etag": etag, "size": size}
+        self._prune(include, listed)
+        self._save_index()
+        return {relative: self.path(relative) for relative in listed}, sorted(changed)
+
+    def _prune(self, include, listed):
+        """Forget objects deleted from S3 and delete cached bodies no key refers to anymore."""
+        for relative in list(self.index):
+            if relative not in listed and (not include or any(fnmatch.fnmatch(relative, p) for p in include)):
+                del self.index[relative]
+                if os.path.exists(self.path(relative)):
+                    os.remove(self.path(relative))
+        used = {_etag_name(entry["etag"]) for entry in self.index.values()}
+        directory = os.path.join(self.cache_dir, "objects")
+        for name in os.listdir(directory):
+            if name not in used and not name.endswith(".part"):
+                os.remove(os.path.join(directory, name))
+
+    def _save_index(self):
+        temporary = self.index_file + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.index, f)
+        os.replace(temporary, self.index_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download new and changed objects of an S3 prefix into a local ETag cache")
+    parser.add_argument("bucket")
+    parser.add_argument("prefix", help="for example DR_LOCAL_S3_MODEL_PREFIX")
+    parser.add_argument("--include", action="append", help="glob on the key relative to the prefix, repeatable")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--endpoint-url", help="S3 compatible endpoint, e.g. a local minio")
+    parser.add_argument("--copy-to", help="also copy the matching files (by file name) into this directory")
+    args = parser.parse_args()
+
+    import boto3
+    client = boto3.client("s3", endpoint_url=args.endpoint_url)
+    syncer = S3Sync(args.bucket, args.prefix, args.cache_dir, client, args.workers)
+    paths, downloaded = syncer.sync(args.include)
+    for relative in downloaded:
+        print("downloaded " + relative)
+    print("{} objects, {} downloaded, cache {}".format(len(paths), len(downloaded), syncer.cache_dir))
+    if args.copy_to:
+        for path in paths.values():
+            shutil.copyfile(path, os.path.join(args.copy_to, os.path.basename(path)))
+
+
+if __name__ == "__main__":
+    main()
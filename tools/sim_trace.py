@@ -0,0 +1,258 @@
+import math, os, random
+
+# SIM_TRACE_LOG step records, as printed by robomaker and stored in training-simtrace/*.csv
+
+TRACE_PREFIX = "SIM_TRACE_LOG:"
+
+COLUMNS = ["episode", "steps", "x", "y", "heading", "steering_angle", "speed", "action", "reward",
+           "done", "all_wheels_on_track", "progress", "closest_waypoint", "track_len", "tstamp",
+           "episode_status", "pause_duration"]
+
+TRACE_EXTENSIONS = (".log", ".csv", ".txt")
+
+
+def _to_bool(value):
+    return value in ("True", "true", "1")
+
+
+def _to_action(value):
+    try:
+        return int(value)
+    except ValueError:
+        # continuous action spaces log the action as a bracketed list
+        return -1
+
+
+def _split_fields(body):
+    parts = body.split(",")
+    if len(parts) > len(COLUMNS) and "[" in body:
+        start = next(i for i, p in enumerate(parts) if "[" in p)
+        end = next(i for i in range(start, len(parts)) if "]" in parts[i])
+        parts[start:end + 1] = [",".join(parts[start:end + 1])]
+    return parts
+
+
+def parse_line(line):
+    """Parse one SIM_TRACE_LOG line (log or csv form) into a tuple ordered as COLUMNS, or None."""
+    pos = line.find(TRACE_PREFIX)
+    if pos >= 0:
+        body = line[pos + len(TRACE_PREFIX):]
+    elif line[:1].isdigit():
+        body = line
+    else:
+        return None
+    parts = _split_fields(body.split("\t", 1)[0].strip())
+    if len(parts) < len(COLUMNS) - 1:
+        return None
+    try:
+        return (
+            int(parts[0]),
+            int(float(parts[1])),
+            float(parts[2]),
+            float(parts[3]),
+            float(parts[4]),
+            float(parts[5]),
+            float(parts[6]),
+            _to_action(parts[7]),
+            float(parts[8]),
+            _to_bool(parts[9]),
+            _to_bool(parts[10]),
+            float(parts[11]),
+            int(parts[12]),
+            float(parts[13]),
+            float(parts[14]),
+            parts[15],
+            float(parts[16]) if len(parts) > 16 else 0.0,
+        )
+    except ValueError:
+        return None
+
+
+def parse_lines(lines):
+    for line in lines:
+        row = parse_line(line)
+        if row is not None:
+            yield row
+
+
+def find_trace_files(paths):
+    """Expand files and directories into the list of trace files they contain."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, n) for n in sorted(names) if n.endswith(TRACE_EXTENSIONS))
+        else:
+            files.append(path)
+    return files
+
+
+def split_ranges(path, chunk_bytes, start=0, size=None):
+    """Split a file, or its bytes from start to size (both on line boundaries), into (path, start, end)
+    byte ranges that begin and end on line boundaries."""
+    size = os.path.getsize(path) if size is None else size
+    ranges = []
+    with open(path, "rb") as f:
+        while start < size:
+            end = min(start + chunk_bytes, size)
+            if end < size:
+                f.seek(end)
+                f.readline()
+                end = min(f.tell(), size)
+            ranges.append((path, start, end))
+            start = end
+    return ranges
+
+
+def read_range(path, start, end):
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return data.decode("utf-8", errors="replace").splitlines()
+
+
+def iter_chunks(path, chunk_bytes=8 * 1024 * 1024):
+    """Stream a trace file chunk by chunk, yielding lists of parsed rows."""
+    for _, start, end in split_ranges(path, chunk_bytes):
+        rows = list(parse_lines(read_range(path, start, end)))
+        if rows:
+            yield rows
+
+
+DEFAULT_TRACK_WIDTH = 1.07
+# run.env variable and default of the number of objects on the track, per race type
+OBJECT_COUNTS = {"OBJECT_AVOIDANCE": ("DR_OA_NUMBER_OF_OBSTACLES", 6), "HEAD_TO_BOT": ("DR_H2B_NUMBER_OF_BOT_CARS", 3)}
+DEFAULT_BOT_CAR_SPEED = 0.2
+
+
+def track_objects(race_type, waypoints, widths, count, rng, bot_speed=0.0):
+    """(distance along track, x, y, left of center, heading, speed) of obstacles or bot cars.
+
+    Obstacles are spread evenly along the track, bot cars are placed at random waypoints and
+    drive at bot_speed. Both sit in the middle of the left or right lane.
+    """
+    n = len(waypoints) - 1
+    cumulative = [0.0]
+    for i in range(n):
+        cumulative.append(cumulative[-1] + math.dist(waypoints[i], waypoints[i + 1]))
+    objects = []
+    for k in range(count):
+        if race_type == "HEAD_TO_BOT":
+            index, speed = rng.randrange(n), bot_speed
+        else:
+            index, speed = (k * n) // count, 0.0
+        (x0, y0), (x1, y1) = waypoints[index], waypoints[index + 1]
+        heading = math.atan2(y1 - y0, x1 - x0)
+        left = rng.random() < 0.5
+        offset = (0.25 if left else -0.25) * widths[index]
+        objects.append((cumulative[index], x0 - offset * math.sin(heading), y0 + offset * math.cos(heading),
+                        left, math.degrees(heading), speed))
+    return sorted(objects)
+
+
+def race_objects(race_type, waypoints, widths, variables, rng):
+    """Objects of a race type with the counts of the run.env variables, None for a time trial."""
+    if race_type not in OBJECT_COUNTS:
+        return None
+    variable, default = OBJECT_COUNTS[race_type]
+    count = int(variables.get(variable, default))
+    bot_speed = float(variables.get("DR_H2B_BOT_CAR_SPEED", DEFAULT_BOT_CAR_SPEED))
+    return track_objects(race_type, waypoints, widths, count, rng, bot_speed) if count else None
+
+
+def add_objects(params, objects):
+    """Set closest_objects and the objects_* params from objects sorted by distance along the track."""
+    car = params["projection_distance"]
+    next_object = next((i for i, o in enumerate(objects) if o[0] > car), 0)
+    params["closest_objects"] = [(next_object - 1) % len(objects), next_object]
+    params["objects_distance"] = [o[0] for o in objects]
+    params["objects_location"] = [(o[1], o[2]) for o in objects]
+    params["objects_left_of_center"] = [o[3] for o in objects]
+    params["objects_heading"] = [o[4] for o in objects]
+    params["objects_speed"] = [o[5] for o in objects]
+
+
+def make_params_builder(waypoints=None, widths=None, objects=None):
+    """Return a function turning a parsed row into the params dict a reward function receives.
+
+    Segment geometry is precomputed per waypoint so each step only costs a couple of dot products.
+    Without waypoints the track-relative fields fall back to neutral values. The trace does not
+    record obstacles or bot cars, objects (from track_objects) stand in for them; without them the
+    objects_* params are empty, as in a time trial.
+    """
+    waypoints = list(waypoints or [])
+    n = len(waypoints)
+    segments = []
+    for i in range(n):
+        x0, y0 = waypoints[i]
+        x1, y1 = waypoints[(i + 1) % n]
+        segments.append((x0, y0, x1 - x0, y1 - y0, (x1 - x0) ** 2 + (y1 - y0) ** 2))
+    widths = list(widths or [DEFAULT_TRACK_WIDTH] * max(n, 1))
+
+    def locate(x, y, closest):
+        # the trace only records the closest waypoint, pick the segment the car is projected onto
+        prev_wp = closest % n
+        x0, y0, dx, dy, len2 = segments[prev_wp]
+        if len2 == 0 or (x - x0) * dx + (y - y0) * dy < 0:
+            prev_wp = (closest - 1) % n
+            x0, y0, dx, dy, len2 = segments[prev_wp]
+        cross = dx * (y - y0) - dy * (x - x0)
+        distance = abs(cross) / len2 ** 0.5 if len2 else 0.0
+        return prev_wp, (prev_wp + 1) % n, distance, cross > 0
+
+    def build(row):
+        (_, steps, x, y, heading, steering_angle, speed, _, _, _, all_wheels_on_track, progress,
+         closest, track_len, _, status, _) = row
+        if n:
+            prev_wp, next_wp, distance, left = locate(x, y, closest)
+            width = widths[closest % n]
+        else:
+            prev_wp, next_wp, distance, left = closest, closest + 1, 0.0, True
+            width = widths[0]
+        params = {
+            "all_wheels_on_track": all_wheels_on_track,
+            "x": x,
+            "y": y,
+            "heading": heading,
+            "distance_from_center": distance,
+            "is_left_of_center": left,
+            "is_offtrack": status == "off_track",
+            "is_crashed": status == "crashed",
+            "is_reversed": status == "reversed",
+            "progress": progress,
+            "speed": speed,
+            "steering_angle": steering_angle,
+            "steps": steps,
+            "track_length": track_len,
+            "track_width": width,
+            "waypoints": waypoints,
+            "closest_waypoints": [prev_wp, next_wp],
+            "projection_distance": progress / 100.0 * track_len,
+            "closest_objects": [0, 0],
+            "objects_distance": [],
+            "objects_heading": [],
+            "objects_left_of_center": [],
+            "objects_location": [],
+            "objects_speed": [],
+        }
+        if objects:
+            add_objects(params, objects)
+        return params
+
+    return build
+
+
+def synthetic_rows(count, waypoints=None, seed=0):
+    """Random but plausible trace rows spread over the track, for sampling and benchmarks."""
+    rng = random.Random(seed)
+    n = len(waypoints) if waypoints else 0
+    rows = []
+    for i in range(count):
+        closest = rng.randrange(n) if n else rng.randrange(200)
+        cx, cy = waypoints[closest] if n else (0.0, 0.0)
+        status = rng.choices(["in_progress", "off_track", "lap_complete", "crashed"], [90, 6, 3, 1])[0]
+        rows.append((i // 200, 1 + i % 200, cx + rng.uniform(-0.5, 0.5), cy + rng.uniform(-0.5, 0.5),
+                     rng.uniform(-180, 180), rng.choice([-30, -20, -15, -10, -5, 0, 5, 10, 15, 20, 30]),
+                     rng.uniform(0.5, 4.0), 0, 0.0, False, status != "off_track" and rng.random() > 0.05,
+                     rng.uniform(0, 100), closest, 17.71, i / 15.0, status, 0.0))
+    return rows
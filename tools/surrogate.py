@@ -0,0 +1,383 @@
+"""Kinematic surrogate of the simulator to rank reward functions and action spaces before training.
+
+A training run costs a spot instance with Gazebo robomaker workers for hours. This runs thousands of
+time trial episodes at once on the CPU instead: every car is a kinematic bicycle (WHEELBASE of
+tools.action_space) on the centre line of the track .npy, stepped STEPS_PER_SECOND times a second
+with the discrete action_space of a model_metadata.json (a continuous one is sampled on a grid).
+The speed follows the action with a SPEED_TIME_CONSTANT lag and the yaw rate is limited by the
+LATERAL_ACCELERATION the speed envelope of tools.action_space assumes, so fast and sharp actions
+understeer. Episodes end like in the simulator when the car is off track (all wheels off), reversed,
+completes the lap or runs out of time, and the reward function gets the params of every step, as
+column arrays through tools.reward_batch (iter_params() turns them into the scalar params dicts).
+
+There is no trained policy, two drivers stand in for one:
+
+  greedy   tries every action for --horizon steps and takes the one with the highest reward (with
+           --epsilon exploration), which drives the way the reward function asks to be driven
+  pursuit  follows the centre line at the speed envelope with the nearest action, independent of
+           the reward function, which ranks action spaces
+
+Each reward function and action space pair is ranked by lap completion, then lap time. The numbers
+only compare candidates with each other: a real car is trained from camera images, not greedy.
+
+Example:
+    python3 -m tools.surrogate custom-files/reward_function.py custom-files/reward-fn-examples/*.py --track 2022_may_open_ccw
+    python3 -m tools.surrogate --model-metadata fast.json --model-metadata safe.json --policy pursuit
+"""
+import argparse, json, math, os, time
+
+import numpy as np
+
+from .action_space import LATERAL_ACCELERATION, MAX_SPEED, MODEL_METADATA, WHEELBASE, speed_envelope
+from .reward_batch import SAMPLE_SIZE, Points, compile_batch
+from .rewards import DEFAULT_REWARD_FILE, load_reward_module
+from .tracks import center_waypoints, closed_loop, curvature, load_track, oval_waypoints, track_widths
+
+STEPS_PER_SECOND = 15
+SPEED_TIME_CONSTANT = 0.25
+CAR_HALF_WIDTH = 0.1
+REVERSE_PROGRESS = 2.0
+MAX_SECONDS = 120
+EPISODES = 1000
+HORIZON = 3
+EPSILON = 0.1
+PURSUIT_LOOKAHEAD = 0.6
+STEERING_BINS = 7
+SPEED_BINS = 4
+STATUSES = ["lap_complete", "off_track", "reversed", "timeout"]
+
+
+def load_actions(path):
+    """(steering angles in degrees, speeds) of the action space of a model_metadata.json."""
+    with open(path, "r") as f:
+        metadata = json.load(f)
+    space = metadata["action_space"]
+    if metadata.get("action_space_type") == "continuous" or isinstance(space, dict):
+        steering = np.linspace(space["steering_angle"]["low"], space["steering_angle"]["high"], STEERING_BINS)
+        speed = np.linspace(space["speed"]["low"], space["speed"]["high"], SPEED_BINS)
+        steering, speed = np.meshgrid(steering, speed)
+        return steering.ravel(), speed.ravel()
+    return (np.array([float(a["steering_angle"]) for a in space]),
+            np.array([float(a["speed"]) for a in space]))
+
+
+class Surrogate:
+    """Vectorized bicycle model cars on one track. States are dicts of arrays, one entry per car."""
+
+    def __init__(self, waypoints, widths, steering, speed, steps_per_second=STEPS_PER_SECOND,
+                 max_seconds=MAX_SECONDS):
+        points = closed_loop(waypoints)
+        n = self.n = len(points)
+        deltas = np.roll(points, -1, axis=0) - points
+        self.ax, self.ay = points[:, 0], points[:, 1]
+        self.dx, self.dy = deltas[:, 0], deltas[:, 1]
+        self.length = np.hypot(self.dx, self.dy)
+        self.len2 = np.where(self.length > 0, self.length ** 2, 1.0)
+        self.along = np.concatenate([[0.0], np.cumsum(self.length)[:-1]])
+        self.track_length = float(self.length.sum())
+        self.widths = np.asarray(widths, dtype=float)[:n]
+        self.waypoints = Points(np.asarray(waypoints, dtype=float)[:, 0], np.asarray(waypoints, dtype=float)[:, 1])
+        self.envelope = speed_envelope(curvature(points))
+        self.steering, self.speed = np.asarray(steering, dtype=float), np.asarray(speed, dtype=float)
+        self.dt = 1.0 / steps_per_second
+        self.max_steps = int(max_seconds * steps_per_second)
+        # segments a car can pass in one step
+        shortest = float(self.length[self.length > 0].min())
+        self.walk = min(n, int(math.ceil(MAX_SPEED * self.dt / shortest)) + 2)
+
+    def start(self, fractions):
+        """Cars standing on the centre line at fractions of the track length, facing the driving direction."""
+        along = np.asarray(fractions, dtype=float) % 1.0 * self.track_length
+        segment = np.clip(np.searchsorted(self.along, along, side="right") - 1, 0, self.n - 1)
+        t = (along - self.along[segment]) / np.where(self.length[segment] > 0, self.length[segment], 1.0)
+        count = len(along)
+        return {
+            "x": self.ax[segment] + t * self.dx[segment],
+            "y": self.ay[segment] + t * self.dy[segment],
+            "heading": np.arctan2(self.dy[segment], self.dx[segment]),
+            "velocity": np.zeros(count),
+            "segment": segment,
+            "distance": np.zeros(count),
+            "left": np.ones(count, dtype=bool),
+            "position": along,
+            "travelled": np.zeros(count),
+            "best": np.zeros(count),
+            "steps": np.zeros(count, dtype=int),
+        }
+
+    def _along_segment(self, x, y, segment):
+        return ((x - self.ax[segment]) * self.dx[segment] + (y - self.ay[segment]) * self.dy[segment]) / self.len2[segment]
+
+    def locate(self, x, y, hint):
+        """(segment, distance, left of centre, distance along the track), walking from the previous segment.
+
+        A car moves less than a few segments per step, so it is projected on its previous segment and
+        only the ones that fall past its ends move on to the next or previous segment, up to
+        self.walk times.
+        """
+        segment = hint.copy()
+        t = self._along_segment(x, y, segment)
+        moving = np.flatnonzero((t > 1) | (t < 0))
+        for _ in range(self.walk):
+            if not len(moving):
+                break
+            forward = t[moving] > 1
+            segment[moving] = (segment[moving] + np.where(forward, 1, -1)) % self.n
+            t[moving] = self._along_segment(x[moving], y[moving], segment[moving])
+            # stop in the wedge outside a corner, where a point is past the end of both segments
+            moving = moving[np.where(forward, t[moving] > 1, t[moving] < 0)]
+        # inside a curve the projections of neighbouring segments overlap, take the nearest of them
+        candidates = (segment[:, None] + np.array([-1, 0, 1])) % self.n
+        dx, dy = self.dx[candidates], self.dy[candidates]
+        px, py = x[:, None] - self.ax[candidates], y[:, None] - self.ay[candidates]
+        t = np.clip((px * dx + py * dy) / self.len2[candidates], 0.0, 1.0)
+        distances = np.hypot(px - t * dx, py - t * dy)
+        nearest = distances.argmin(axis=1)
+        rows = np.arange(len(x))
+        segment, t = candidates[rows, nearest], t[rows, nearest]
+        cross = dx[rows, nearest] * py[rows, nearest] - dy[rows, nearest] * px[rows, nearest]
+        return segment, distances[rows, nearest], cross > 0, self.along[segment] + t * self.length[segment]
+
+    def move(self, state, steering, speed):
+        """New state after one step with the given actions."""
+        target = speed
+        velocity = target + (state["velocity"] - target) * math.exp(-self.dt / SPEED_TIME_CONSTANT)
+        yaw_rate = velocity * np.tan(np.radians(steering)) / WHEELBASE
+        grip = LATERAL_ACCELERATION / np.maximum(velocity, 1e-6)
+        yaw_rate = np.clip(yaw_rate, -grip, grip)
+        middle = state["heading"] + 0.5 * yaw_rate * self.dt
+        distance = 0.5 * (state["velocity"] + velocity) * self.dt
+        x = state["x"] + distance * np.cos(middle)
+        y = state["y"] + distance * np.sin(middle)
+        segment, offset, left, position = self.locate(x, y, state["segment"])
+        half = self.track_length / 2
+        travelled = state["travelled"] + (position - state["position"] + half) % self.track_length - half
+        progress = 100 * travelled / self.track_length
+        return {
+            "x": x,
+            "y": y,
+            "heading": (state["heading"] + yaw_rate * self.dt + math.pi) % (2 * math.pi) - math.pi,
+            "velocity": velocity,
+            "segment": segment,
+            "distance": offset,
+            "left": left,
+            "position": position,
+            "travelled": travelled,
+            "best": np.maximum(state["best"], progress),
+            "steps": state["steps"] + 1,
+        }
+
+    def outcome(self, state):
+        """Index into STATUSES of the cars whose episode ended with this step, -1 for running ones."""
+        progress = 100 * state["travelled"] / self.track_length
+        half_width = self.widths[state["segment"]] / 2
+        status = np.full(len(progress), -1)
+        status[state["steps"] >= self.max_steps] = 3
+        status[progress < state["best"] - REVERSE_PROGRESS] = 2
+        status[state["distance"] - CAR_HALF_WIDTH > half_width] = 1
+        status[progress >= 100] = 0
+        return status
+
+    def columns(self, state, steering, speed):
+        """The params of a time trial step as column arrays, the format of reward_batch.build_columns."""
+        count = len(state["x"])
+        segment = state["segment"]
+        width = self.widths[segment]
+        progress = np.clip(100 * state["travelled"] / self.track_length, 0.0, 100.0)
+        status = self.outcome(state)
+        no_objects = np.zeros(count, dtype=int)
+        return {
+            "all_wheels_on_track": state["distance"] + CAR_HALF_WIDTH <= width / 2,
+            "x": state["x"],
+            "y": state["y"],
+            "heading": np.degrees(state["heading"]),
+            "distance_from_center": state["distance"],
+            "is_left_of_center": state["left"],
+            "is_offtrack": status == 1,
+            "is_crashed": np.zeros(count, dtype=bool),
+            "is_reversed": status == 2,
+            "progress": progress,
+            "speed": np.broadcast_to(speed, (count,)).astype(float),
+            "steering_angle": np.broadcast_to(steering, (count,)).astype(float),
+            "steps": state["steps"],
+            "track_length": np.full(count, self.track_length),
+            "track_width": width,
+            "waypoints": self.waypoints,
+            "closest_waypoints": [segment, (segment + 1) % self.n],
+            "projection_distance": state["position"],
+            "closest_objects": [no_objects, no_objects],
+            "objects_distance": [],
+            "objects_heading": [],
+            "objects_left_of_center": [],
+            "objects_location": [],
+            "objects_speed": [],
+        }
+
+    def sample(self, count=SAMPLE_SIZE, seed=0):
+        """Columns of random cars around the track, for reward_batch.compile_batch to check against."""
+        rng = np.random.default_rng(seed)
+        state = self.start(rng.random(count))
+        state["velocity"] = rng.uniform(0, self.speed.max(), count)
+        state["heading"] = state["heading"] + rng.normal(0, 0.3, count)
+        state["travelled"] = rng.uniform(0, self.track_length, count)
+        choice = rng.integers(len(self.steering), size=count)
+        state = self.move(state, self.steering[choice], self.speed[choice])
+        state["x"] = state["x"] + rng.normal(0, 0.2, count)
+        state["segment"], state["distance"], state["left"], _ = self.locate(state["x"], state["y"], state["segment"])
+        return self.columns(state, self.steering[choice], self.speed[choice])
+
+    def greedy(self, state, reward, rng, horizon=HORIZON, epsilon=EPSILON):
+        """Action index per car: the highest reward over horizon steps of holding each action."""
+        count, actions = len(state["x"]), len(self.steering)
+        candidates = {key: np.repeat(value, actions) for key, value in state.items()}
+        steering, speed = np.tile(self.steering, count), np.tile(self.speed, count)
+        score = np.zeros(count * actions)
+        running = np.ones(count * actions, dtype=bool)
+        for _ in range(horizon):
+            candidates = self.move(candidates, steering, speed)
+            rewards = np.nan_to_num(np.asarray(reward(self.columns(candidates, steering, speed)), dtype=float))
+            score += np.where(running, rewards, 0.0)
+            running &= self.outcome(candidates) < 0
+        # ties (a flat reward) are broken at random instead of always taking the first action
+        score = score.reshape(count, actions)
+        best = score == score.max(axis=1, keepdims=True)
+        choice = np.where(best, rng.random((count, actions)), -1.0).argmax(axis=1)
+        explore = rng.random(count) < epsilon
+        choice[explore] = rng.integers(actions, size=int(explore.sum()))
+        return choice
+
+    def pursuit(self, state, rng, epsilon=EPSILON):
+        """Action index per car: the nearest action to pure pursuit of the centre line at the envelope speed."""
+        ahead = (state["position"] + PURSUIT_LOOKAHEAD) % self.track_length
+        segment = np.clip(np.searchsorted(self.along, ahead, side="right") - 1, 0, self.n - 1)
+        t = (ahead - self.along[segment]) / np.where(self.length[segment] > 0, self.length[segment], 1.0)
+        tx, ty = self.ax[segment] + t * self.dx[segment], self.ay[segment] + t * self.dy[segment]
+        alpha = np.arctan2(ty - state["y"], tx - state["x"]) - state["heading"]
+        lookahead = np.maximum(np.hypot(tx - state["x"], ty - state["y"]), 1e-6)
+        steering = np.degrees(np.arctan2(2 * WHEELBASE * np.sin(alpha), lookahead))
+        speed = np.minimum(self.envelope[segment], self.envelope[state["segment"]])
+        cost = (((self.steering[None] - steering[:, None]) / 30.0) ** 2
+                + 0.25 * ((self.speed[None] - speed[:, None]) / MAX_SPEED) ** 2)
+        choice = cost.argmin(axis=1)
+        explore = rng.random(len(choice)) < epsilon
+        choice[explore] = rng.integers(len(self.steering), size=int(explore.sum()))
+        return choice
+
+    def run(self, reward, episodes=EPISODES, batch=EPISODES, policy="greedy", horizon=HORIZON,
+            epsilon=EPSILON, seed=0):
+        """Run episodes from start positions spread around the track, batch cars at a time.
+
+        Returns per episode arrays: status (index into STATUSES), steps, progress, total reward, the
+        number of steps where the reward function raised and the segment where the episode ended.
+        """
+        rng = np.random.default_rng(seed)
+        results = {"status": np.zeros(episodes, dtype=int), "steps": np.zeros(episodes, dtype=int),
+                   "segment": np.zeros(episodes, dtype=int),
+                   "progress": np.zeros(episodes), "reward": np.zeros(episodes),
+                   "raised": np.zeros(episodes, dtype=int)}
+        for first in range(0, episodes, batch):
+            ids = np.arange(first, min(first + batch, episodes))
+            state = self.start(ids / episodes)
+            while len(ids):
+                if policy == "greedy":
+                    choice = self.greedy(state, reward, rng, horizon, epsilon)
+                else:
+                    choice = self.pursuit(state, rng, epsilon)
+                steering, speed = self.steering[choice], self.speed[choice]
+                state = self.move(state, steering, speed)
+                rewards = np.asarray(reward(self.columns(state, steering, speed)), dtype=float)
+                raised = np.isnan(rewards)
+                results["reward"][ids] += np.where(raised, 0.0, rewards)
+                results["raised"][ids] += raised
+                status = self.outcome(state)
+                ended = status >= 0
+                results["status"][ids[ended]] = status[ended]
+                results["steps"][ids[ended]] = state["steps"][ended]
+                results["segment"][ids[ended]] = state["segment"][ended]
+                results["progress"][ids[ended]] = np.clip(100 * state["travelled"][ended] / self.track_length, 0, 100)
+                ids = ids[~ended]
+                state = {key: value[~ended] for key, value in state.items()}
+        return results
+
+
+def summarize(results, dt, seconds):
+    status, steps = results["status"], results["steps"]
+    laps = steps[status == 0] * dt
+    total_steps = int(steps.sum())
+    return {
+        "episodes": len(status),
+        "completion": 100.0 * float(np.mean(status == 0)),
+        "progress": float(results["progress"].mean()),
+        "lap": float(laps.mean()) if len(laps) else None,
+        "best_lap": float(laps.min()) if len(laps) else None,
+        "reward_per_step": float(results["reward"].sum() / max(total_steps, 1)),
+        "raised": int(results["raised"].sum()),
+        "ends": {name: int((status == i).sum()) for i, name in enumerate(STATUSES)},
+        "episodes_per_second": len(status) / max(seconds, 1e-9),
+        "steps_per_second": total_steps / max(seconds, 1e-9),
+    }
+
+
+def rank(rows):
+    """Sort (reward file, action space, summary) rows: most completed laps first, then the fastest."""
+    return sorted(rows, key=lambda row: (-round(row[2]["completion"], 1), row[2]["lap"] or math.inf,
+                                         -row[2]["progress"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rank reward functions and action spaces on a kinematic surrogate")
+    parser.add_argument("reward_files", nargs="*", default=[DEFAULT_REWARD_FILE])
+    parser.add_argument("--model-metadata", action="append", help="action space(s) to compare, default " + MODEL_METADATA)
+    parser.add_argument("--track", help="DR_WORLD_NAME or path to the track .npy (default: a synthetic oval)")
+    parser.add_argument("--episodes", type=int, default=EPISODES)
+    parser.add_argument("--batch", type=int, default=EPISODES, help="cars simulated at once")
+    parser.add_argument("--policy", choices=["greedy", "pursuit"], default="greedy")
+    parser.add_argument("--horizon", type=int, default=HORIZON, help="steps the greedy driver looks ahead")
+    parser.add_argument("--epsilon", type=float, default=EPSILON, help="share of random actions")
+    parser.add_argument("--max-seconds", type=float, default=MAX_SECONDS, help="episode time limit")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    if args.track:
+        track = load_track(args.track)
+        waypoints, widths = center_waypoints(track), track_widths(track)
+    else:
+        waypoints = oval_waypoints()
+        widths = [1.07] * len(waypoints)
+    spaces = {path: load_actions(path) for path in args.model_metadata or [MODEL_METADATA]}
+    surrogates = {path: Surrogate(waypoints, widths, *space, max_seconds=args.max_seconds)
+                  for path, space in spaces.items()}
+
+    rows = []
+    for file in args.reward_files:
+        try:
+            module = load_reward_module(file)
+            reward, how = compile_batch(module, next(iter(surrogates.values())).sample(seed=args.seed))
+        except Exception as e:
+            print("{}: cannot be loaded: {}: {}".format(file, type(e).__name__, e))
+            continue
+        print("{}: using {}".format(file, how))
+        for path, surrogate in surrogates.items():
+            started = time.time()
+            results = surrogate.run(reward, args.episodes, args.batch, args.policy, args.horizon, args.epsilon,
+                                    args.seed)
+            rows.append((file, path, summarize(results, surrogate.dt, time.time() - started)))
+
+    print("{:<40} {:<28} {:>7} {:>9} {:>8} {:>8} {:>10} {:>9}".format(
+        "Reward function", "Action space", "laps %", "progress", "lap s", "best s", "reward/st", "eps/s"))
+    for file, path, summary in rank(rows):
+        print("{:<40} {:<28} {:>7.1f} {:>9.1f} {:>8} {:>8} {:>10.3f} {:>9.0f}{}".format(
+            os.path.basename(file)[:40], os.path.basename(path)[:28], summary["completion"], summary["progress"],
+            "-" if summary["lap"] is None else "{:.2f}".format(summary["lap"]),
+            "-" if summary["best_lap"] is None else "{:.2f}".format(summary["best_lap"]),
+            summary["reward_per_step"], summary["episodes_per_second"],
+            "  ({} steps raised)".format(summary["raised"]) if summary["raised"] else ""))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([{"reward_file": file, "model_metadata": path, **summary} for file, path, summary in rows],
+                      f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
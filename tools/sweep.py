@@ -0,0 +1,167 @@
+"""Headless launch of a grid of trainings.
+
+A sweep spec is a JSON file:
+
+    {
+      "name": "lr-sweep",
+      "base_stack": "base",
+      "instance": "spot",
+      "time_to_live": 120,
+      "grid": {
+        "lr": [0.0003, 0.0001],
+        "batch_size": [64, 128],
+        "action_space": ["custom-files/model_metadata.json", "custom-files/model_metadata_ec-46-25secs.json"],
+        "reward_file": ["custom-files/reward_function.py"],
+        "instance_type": ["g4dn.2xlarge"]
+      },
+      "set": {"DR_WORLD_NAME": "2022_may_open_ccw"}
+    }
+
+Grid and set keys are hyperparameters.json keys, DR_* run.env variables, action_space (a
+model_metadata.json file or an inline list), reward_file, instance (spot or standard) or
+instance_type. Every combination gets its own model name and a copy of custom-files under
+sweeps/<name>/<model> with unique model, custom files and upload prefixes, and is launched with
+create-<instance>-instance.sh on a bounded pool of subprocesses whose output goes to
+sweeps/<name>/<model>.launch.log, next to the custom files the script uploads. A stub create
+script that only checks and records its arguments is in tests/fixtures/sweep.
+
+Example:
+    python3 -m tools.sweep sweep.json --parallel 2 --dry-run
+    python3 -m tools.sweep sweep.json --create-script tests/fixtures/sweep/stub-create.sh
+"""
+import argparse, itertools, json, os, re, shutil, subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from .config_session import ConfigSession
+
+CUSTOM_FILES = "custom-files"
+SWEEPS_DIR = "sweeps"
+STACK_NAME = re.compile(r"^[-0-9a-zA-Z]{1,64}$")
+PREFIX_VARIABLES = ["DR_LOCAL_S3_MODEL_PREFIX", "DR_LOCAL_S3_CUSTOM_FILES_PREFIX", "DR_UPLOAD_S3_PREFIX"]
+LAUNCH_KEYS = ["instance", "instance_type"]
+
+
+def combinations(grid):
+    keys = sorted(grid)
+    for values in itertools.product(*(grid[key] for key in keys)):
+        yield dict(zip(keys, values))
+
+
+def _prefix(value, model):
+    return value.rsplit("/", 1)[0] + "/" + model if value and "/" in value else model
+
+
+def materialize(spec, model, parameters, directory):
+    """Copy custom-files for one model and apply its parameters in one write per file."""
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    shutil.copytree(spec.get("custom_files", CUSTOM_FILES), directory,
+                    ignore=shutil.ignore_patterns("__pycache__", "*.pyc"))
+    run_env = os.path.join(directory, "run.env")
+    hyperparameters = os.path.join(directory, "hyperparameters.json")
+    metadata = os.path.join(directory, "model_metadata.json")
+    with ConfigSession() as config:
+        for variable in PREFIX_VARIABLES:
+            config.set(run_env, variable, _prefix(config.get(run_env, variable), model))
+        for key, value in parameters.items():
+            if key in LAUNCH_KEYS:
+                continue
+            if key == "reward_file":
+                shutil.copyfile(value, os.path.join(directory, "reward_function.py"))
+            elif key == "action_space":
+                if isinstance(value, str):
+                    with open(value, "r") as f:
+                        value = json.load(f)["action_space"]
+                config.set(metadata, "action_space", value)
+            elif key.startswith("DR_"):
+                config.set(run_env, key, str(value))
+            elif config.get(hyperparameters, key) is not None:
+                config.set(hyperparameters, key, value)
+            else:
+                raise KeyError("{}: not a hyperparameter, run.env variable or sweep key".format(key))
+
+
+def plan(spec):
+    """List of (model name, parameters) for every combination of the grid."""
+    name = spec["name"]
+    models = []
+    for i, combination in enumerate(combinations(spec.get("grid", {})), start=1):
+        parameters = dict(spec.get("set", {}))
+        parameters.update(combination)
+        model = "{}-{:02d}".format(name, i)
+        if not STACK_NAME.match(model):
+            raise ValueError("{}: model names may only use A-Z, a-z, 0-9 and hyphens, up to 64 characters".format(model))
+        models.append((model, parameters))
+    return models
+
+
+def launch_command(spec, model, parameters, create_script=None):
+    instance = parameters.get("instance", spec.get("instance", "spot"))
+    script = create_script or "./create-{}-instance.sh".format(instance)
+    return [script, spec["base_stack"], model, str(spec.get("time_to_live", 60))]
+
+
+def log_file(directory, kind="launch"):
+    """Log of a model next to its custom files directory, which the create script uploads as a whole."""
+    return "{}.{}.log".format(directory.rstrip(os.sep), kind)
+
+
+def launch(command, directory, instance_type):
+    env = dict(os.environ, DOTS_CUSTOM_FILES_DIR=directory)
+    if instance_type:
+        env["DEEPRACER_INSTANCE_TYPE"] = instance_type
+    with open(log_file(directory), "w") as log:
+        # answer "n" if validation.sh finds errors, there is nobody to ask: the create script exits with 1
+        result = subprocess.run(command, input="n\n", stdout=log, stderr=subprocess.STDOUT, text=True, env=env)
+    return result.returncode
+
+
+def run_sweep(spec, parallel=2, dry_run=False, create_script=None, sweeps_dir=SWEEPS_DIR):
+    """Materialize and launch every model of a sweep. Returns {model: (parameters, command, exit code)}."""
+    root = os.path.join(sweeps_dir, spec["name"])
+    jobs = {}
+    for model, parameters in plan(spec):
+        directory = os.path.join(root, model)
+        materialize(spec, model, parameters, directory)
+        jobs[model] = (parameters, directory, launch_command(spec, model, parameters, create_script))
+    results = {}
+    if dry_run:
+        for model, (parameters, directory, command) in jobs.items():
+            results[model] = (parameters, command, None)
+    else:
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            futures = {model: pool.submit(launch, command, directory,
+                                          parameters.get("instance_type", spec.get("instance_type")))
+                       for model, (parameters, directory, command) in jobs.items()}
+            for model, future in futures.items():
+                parameters, _, command = jobs[model]
+                results[model] = (parameters, command, future.result())
+    with open(os.path.join(root, "sweep.json"), "w") as f:
+        json.dump({"spec": spec, "models": {model: {"parameters": p, "command": c, "exit_code": code}
+                                            for model, (p, c, code) in results.items()}}, f, indent=2)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Launch a grid of trainings without the interactive menu")
+    parser.add_argument("spec", help="sweep spec JSON file")
+    parser.add_argument("--parallel", type=int, default=2, help="stacks created at the same time")
+    parser.add_argument("--dry-run", action="store_true", help="write the custom files and print the commands only")
+    parser.add_argument("--create-script", help="run this instead of create-<instance>-instance.sh, e.g. a stub")
+    parser.add_argument("--sweeps-dir", default=SWEEPS_DIR)
+    args = parser.parse_args()
+
+    with open(args.spec, "r") as f:
+        spec = json.load(f)
+    results = run_sweep(spec, args.parallel, args.dry_run, args.create_script, args.sweeps_dir)
+    failed = 0
+    for model, (parameters, command, code) in results.items():
+        status = "dry run" if code is None else ("ok" if code == 0 else "FAILED ({})".format(code))
+        failed += bool(code)
+        print("{:<30} {:<10} {}  {}".format(model, status, " ".join(command), json.dumps(parameters)))
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
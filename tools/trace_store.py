@@ -0,0 +1,344 @@
+"""Columnar on-disk store of SIM_TRACE_LOG steps with a per-episode index and summary.
+
+Each ingest appends the new steps of the given logs or simtrace csv files as one segment
+directory of .npy columns with compact dtypes, sorted so every episode is a contiguous row range.
+Next to the segments the store keeps an index of (worker, iteration, episode) -> (segment, start,
+stop) and a summary table with one row per episode (steps, reward sum, progress, lap time, final
+status), so top N laps and completion rates are read from the summary, and the steps of selected
+episodes or iterations are memory-mapped slices instead of a rescan of every log.
+
+Logs are read in chunks of complete lines from the offset of the last ingest and a segment is
+written every SEGMENT_ROWS steps, even within one file, so a multi-GB log is ingested in bounded
+memory. The manifest keeps the byte offset each source reached and is saved with every segment, so
+ingesting a growing log again (or after an interrupted ingest) only adds its new lines.
+
+The robomaker logs and the simtrace csv files of a training hold the same steps, and csv names
+carry no worker number, so a store takes one kind of source per worker: ingesting the other kind
+for a worker that already has steps is refused instead of counting its episodes twice.
+
+Example:
+    python3 -m tools.trace_store ingest store robomaker1.log
+    python3 -m tools.trace_store ingest simtrace-store training-simtrace/
+    python3 -m tools.trace_store top store -n 10
+    python3 -m tools.trace_store completion store
+"""
+import argparse, json, os, re
+
+from .sim_trace import COLUMNS, find_trace_files, parse_lines, read_range, split_ranges
+
+STATUSES = ["prepare", "in_progress", "lap_complete", "off_track", "crashed", "reversed", "immobilized",
+            "time_up", "pause", "park", "unknown"]
+LAP_COMPLETE = STATUSES.index("lap_complete")
+
+DTYPES = {
+    "worker": "u1", "iteration": "u4", "episode": "u4", "steps": "u4", "x": "f4", "y": "f4", "heading": "f4",
+    "steering_angle": "f4", "speed": "f4", "action": "i2", "reward": "f4", "done": "?",
+    "all_wheels_on_track": "?", "progress": "f4", "closest_waypoint": "u2", "track_len": "f4", "tstamp": "f8",
+    "episode_status": "u1", "pause_duration": "f4",
+}
+INDEX_DTYPE = [("worker", "u1"), ("iteration", "u4"), ("episode", "u4"), ("segment", "u4"), ("start", "u4"),
+               ("stop", "u4")]
+SUMMARY_DTYPE = [("worker", "u1"), ("iteration", "u4"), ("episode", "u4"), ("steps", "u4"), ("reward", "f8"),
+                 ("progress", "f4"), ("start", "f8"), ("end", "f8"), ("lap_time", "f8"), ("status", "u1")]
+SEGMENT_ROWS = 2000000
+CHUNK_BYTES = 8 * 1024 * 1024
+HYPERPARAMETERS = "custom-files/hyperparameters.json"
+WORKER_PATTERN = re.compile(r"robomaker[._-]?(\d+)")
+ITERATION_PATTERN = re.compile(r"(\d+)-iteration")
+
+
+def default_episodes_per_iteration():
+    try:
+        with open(HYPERPARAMETERS, "r") as f:
+            return int(json.load(f)["num_episodes_between_training"])
+    except (OSError, KeyError, ValueError):
+        return 20
+
+
+def source_worker(path):
+    """Worker index from robomaker log names (robomaker1.log, deepracer-0_robomaker.2.<id>.log), else 0."""
+    match = WORKER_PATTERN.search(os.path.basename(path))
+    return max(int(match.group(1)) - 1, 0) if match else 0
+
+
+def source_kind(path):
+    return "simtrace" if path.endswith(".csv") else "log"
+
+
+def source_iteration(path):
+    match = ITERATION_PATTERN.search(os.path.basename(path))
+    return int(match.group(1)) if match else None
+
+
+def _status_code(status):
+    try:
+        return STATUSES.index(status)
+    except ValueError:
+        return len(STATUSES) - 1
+
+
+def last_line_end(path, start, end, block=64 * 1024):
+    """Offset just past the last newline between start and end, read backwards a block at a time."""
+    with open(path, "rb") as f:
+        while end > start:
+            begin = max(start, end - block)
+            f.seek(begin)
+            found = f.read(end - begin).rfind(b"\n")
+            if found >= 0:
+                return begin + found + 1
+            end = begin
+    return start
+
+
+def _columns(rows, worker, iteration, episodes_per_iteration):
+    """Compact column arrays of parsed rows, with the worker and iteration columns."""
+    import numpy as np
+    columns = {"worker": np.full(len(rows), worker, dtype=DTYPES["worker"])}
+    for i, name in enumerate(COLUMNS):
+        values = [row[i] for row in rows]
+        if name == "episode_status":
+            values = [_status_code(v) for v in values]
+        columns[name] = np.array(values, dtype=DTYPES[name])
+    columns["iteration"] = (columns["episode"] // episodes_per_iteration if iteration is None else
+                            np.full(len(rows), iteration)).astype(DTYPES["iteration"])
+    return columns
+
+
+class TraceStore:
+
+    def __init__(self, path):
+        self.path = path
+        self.manifest_file = os.path.join(path, "manifest.json")
+        self.manifest = {"segments": [], "sources": {}}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, "r") as f:
+                self.manifest = json.load(f)
+        self._index = self._summary = None
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @property
+    def index(self):
+        import numpy as np
+        if self._index is None:
+            file = self._file("index.npy")
+            self._index = np.load(file) if os.path.exists(file) else np.zeros(0, dtype=INDEX_DTYPE)
+        return self._index
+
+    @property
+    def summary(self):
+        import numpy as np
+        if self._summary is None:
+            file = self._file("summary.npy")
+            self._summary = np.load(file) if os.path.exists(file) else np.zeros(0, dtype=SUMMARY_DTYPE)
+        return self._summary
+
+    def column(self, segment, name):
+        """Memory-mapped column of one segment."""
+        import numpy as np
+        return np.load(os.path.join(self.path, "segment-{:06d}".format(segment), name + ".npy"), mmap_mode="r")
+
+    def _new_chunks(self, path, episodes_per_iteration, worker=None):
+        """Column arrays of the complete lines of a source file past its stored offset, one chunk at a
+        time, each with the offset it reaches."""
+        offset = self.manifest["sources"].get(path, 0)
+        size = os.path.getsize(path)
+        if size < offset:
+            # the file was replaced or truncated, read it again from the start
+            offset = 0
+        end = last_line_end(path, offset, size)
+        worker = source_worker(path) if worker is None else worker
+        iteration = source_iteration(path)
+        for _, start, stop in split_ranges(path, CHUNK_BYTES, offset, end):
+            rows = list(parse_lines(read_range(path, start, stop)))
+            yield (_columns(rows, worker, iteration, episodes_per_iteration) if rows else None), stop
+
+    def ingest(self, paths, episodes_per_iteration=None, worker=None):
+        """Append the new steps of the given files as segments of about SEGMENT_ROWS steps. Returns the
+        number of steps added."""
+        episodes_per_iteration = episodes_per_iteration or default_episodes_per_iteration()
+        files = find_trace_files(paths)
+        kinds = dict(self.manifest.get("kinds", {}))
+        for path in files:
+            key, kind = str(source_worker(path) if worker is None else worker), source_kind(path)
+            if kinds.setdefault(key, kind) != kind:
+                raise ValueError("{} has {} steps, the store has the {} steps of worker {} already and would count "
+                                 "its episodes twice, ingest it into another store".format(path, kind, kinds[key], key))
+        self.manifest["kinds"] = kinds
+        chunks, offsets = [], {}
+        buffered = added = 0
+        for path in files:
+            for columns, stop in self._new_chunks(path, episodes_per_iteration, worker):
+                if columns is not None:
+                    chunks.append(columns)
+                    buffered += len(columns["worker"])
+                offsets[path] = stop
+                if buffered >= SEGMENT_ROWS:
+                    added += self._flush(chunks, offsets)
+                    chunks, offsets, buffered = [], {}, 0
+        added += self._flush(chunks, offsets)
+        return added
+
+    def _flush(self, chunks, offsets):
+        """Write the buffered chunks as one segment, then the source offsets they reach."""
+        import numpy as np
+        added = 0
+        if chunks:
+            added = self._write_segment({name: np.concatenate([chunk[name] for chunk in chunks])
+                                         for name in chunks[0]})
+        self.manifest["sources"].update(offsets)
+        self._save("manifest.json", None)
+        return added
+
+    def _write_segment(self, columns):
+        import numpy as np
+        names = ["worker", "iteration"] + COLUMNS
+        order = np.lexsort((columns["tstamp"], columns["steps"], columns["episode"], columns["worker"]))
+        segment = len(self.manifest["segments"])
+        directory = self._file("segment-{:06d}".format(segment))
+        os.makedirs(directory, exist_ok=True)
+        for name in names:
+            columns[name] = columns[name][order]
+            np.save(os.path.join(directory, name + ".npy"), columns[name])
+
+        key = columns["worker"].astype("u8") << 32 | columns["episode"]
+        starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+        stops = np.r_[starts[1:], len(key)]
+        index = np.zeros(len(starts), dtype=INDEX_DTYPE)
+        for name in ("worker", "iteration", "episode"):
+            index[name] = columns[name][starts]
+        index["segment"], index["start"], index["stop"] = segment, starts, stops
+        self._index = np.concatenate([self.index, index])
+        self._index.sort(order=["worker", "episode", "segment"])
+
+        partial = np.zeros(len(starts), dtype=SUMMARY_DTYPE)
+        for name in ("worker", "iteration", "episode"):
+            partial[name] = columns[name][starts]
+        partial["steps"] = stops - starts
+        partial["reward"] = np.add.reduceat(columns["reward"].astype("f8"), starts)
+        partial["progress"] = np.maximum.reduceat(columns["progress"], starts)
+        partial["start"] = np.minimum.reduceat(columns["tstamp"], starts)
+        partial["end"] = np.maximum.reduceat(columns["tstamp"], starts)
+        partial["status"] = columns["episode_status"][stops - 1]
+        self._summary = merge_summaries(np.concatenate([self.summary, partial]))
+
+        self.manifest["segments"].append({"rows": len(order)})
+        self._save("index.npy", self._index)
+        self._save("summary.npy", self._summary)
+        return len(order)
+
+    def _save(self, name, array):
+        import numpy as np
+        os.makedirs(self.path, exist_ok=True)
+        temporary = self._file(name + ".tmp")
+        with open(temporary, "wb") as f:
+            if array is None:
+                f.write(json.dumps(self.manifest).encode())
+            else:
+                np.save(f, array)
+        os.replace(temporary, self._file(name))
+
+    def episode(self, worker, episode):
+        """Dict of column arrays with the steps of one episode."""
+        import numpy as np
+        entries = self.index[(self.index["worker"] == worker) & (self.index["episode"] == episode)]
+        names = ["worker", "iteration"] + COLUMNS
+        return {name: np.concatenate([self.column(e["segment"], name)[e["start"]:e["stop"]] for e in entries])
+                if len(entries) else np.zeros(0, dtype=DTYPES[name]) for name in names}
+
+    def steps(self, names, iterations=None, episodes=None):
+        """Concatenated columns of the steps of the selected iterations and/or (worker, episode) pairs."""
+        import numpy as np
+        entries = self.index
+        if iterations is not None:
+            entries = entries[np.isin(entries["iteration"], list(iterations))]
+        if episodes is not None:
+            keys = np.array([(int(w) << 32) | int(e) for w, e in episodes], dtype="u8")
+            entries = entries[np.isin(entries["worker"].astype("u8") << 32 | entries["episode"], keys)]
+        result = {}
+        for name in names:
+            parts = [self.column(e["segment"], name)[e["start"]:e["stop"]] for e in entries]
+            result[name] = np.concatenate(parts) if parts else np.zeros(0, dtype=DTYPES[name])
+        return result
+
+    def top_laps(self, count=10):
+        """Completed episodes sorted by lap time."""
+        import numpy as np
+        laps = self.summary[self.summary["status"] == LAP_COMPLETE]
+        return laps[np.argsort(laps["lap_time"], kind="stable")][:count]
+
+    def completion_rate(self):
+        """(iterations, episodes per iteration, completed lap fraction per iteration)."""
+        import numpy as np
+        iterations, inverse, counts = np.unique(self.summary["iteration"], return_inverse=True, return_counts=True)
+        completed = np.bincount(inverse, weights=self.summary["status"] == LAP_COMPLETE, minlength=len(iterations))
+        return iterations, counts, completed / np.maximum(counts, 1)
+
+    def heatmap(self, bins=100, iterations=None, complete_only=False):
+        """2D histogram of car positions, optionally for some iterations or completed laps only."""
+        import numpy as np
+        episodes = None
+        if complete_only:
+            laps = self.summary[self.summary["status"] == LAP_COMPLETE]
+            episodes = zip(laps["worker"], laps["episode"])
+        columns = self.steps(["x", "y"], iterations, episodes)
+        return np.histogram2d(columns["x"], columns["y"], bins=bins)
+
+
+def merge_summaries(summary):
+    """Combine summary rows of the same (worker, episode) written by different segments."""
+    import numpy as np
+    order = np.lexsort((summary["end"], summary["episode"], summary["worker"]))
+    summary = summary[order]
+    key = summary["worker"].astype("u8") << 32 | summary["episode"]
+    starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    stops = np.r_[starts[1:], len(key)]
+    merged = summary[starts].copy()
+    merged["iteration"] = np.minimum.reduceat(summary["iteration"], starts)
+    merged["steps"] = np.add.reduceat(summary["steps"], starts)
+    merged["reward"] = np.add.reduceat(summary["reward"], starts)
+    merged["progress"] = np.maximum.reduceat(summary["progress"], starts)
+    merged["start"] = np.minimum.reduceat(summary["start"], starts)
+    merged["end"] = np.maximum.reduceat(summary["end"], starts)
+    merged["status"] = summary["status"][stops - 1]
+    merged["lap_time"] = merged["end"] - merged["start"]
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar store of SIM_TRACE_LOG steps with an episode index")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ingest = commands.add_parser("ingest", help="add the new steps of logs or simtrace files")
+    ingest.add_argument("store")
+    ingest.add_argument("traces", nargs="+", help="robomaker logs, simtrace csv files or directories")
+    ingest.add_argument("--episodes-per-iteration", type=int,
+                        help="default: num_episodes_between_training from " + HYPERPARAMETERS)
+    ingest.add_argument("--worker", type=int, help="worker index of the files (default: from the file name)")
+    top = commands.add_parser("top", help="fastest completed laps")
+    top.add_argument("store")
+    top.add_argument("-n", type=int, default=10)
+    completion = commands.add_parser("completion", help="completed lap rate per iteration")
+    completion.add_argument("store")
+    args = parser.parse_args()
+
+    store = TraceStore(args.store)
+    if args.command == "ingest":
+        try:
+            added = store.ingest(args.traces, args.episodes_per_iteration, args.worker)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        print("Added {} steps, {} episodes in {} segments".format(added, len(store.summary), len(store.manifest["segments"])))
+    elif args.command == "top":
+        print("{:>6} {:>9} {:>8} {:>6} {:>10} {:>10}".format("worker", "iteration", "episode", "steps", "lap time", "reward"))
+        for lap in store.top_laps(args.n):
+            print("{:>6} {:>9} {:>8} {:>6} {:>10.3f} {:>10.2f}".format(
+                lap["worker"], lap["iteration"], lap["episode"], lap["steps"], lap["lap_time"], lap["reward"]))
+    else:
+        print("{:>9} {:>9} {:>10}".format("iteration", "episodes", "completed"))
+        for iteration, count, rate in zip(*store.completion_rate()):
+            print("{:>9} {:>9} {:>9.1f}%".format(iteration, count, rate * 100))
+
+
+if __name__ == "__main__":
+    main()
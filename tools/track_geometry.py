@@ -0,0 +1,125 @@
+"""Per-track waypoint geometry, computed once and looked up by waypoint index.
+
+Reward functions and the local tools keep asking the same questions about a track that never
+changes (how sharp is the turn at this waypoint, which way does it go, what heading does the
+centre line have). get_geometry() answers them for every waypoint on first use and caches the
+result per track, so each later step is a couple of array lookups.
+
+Only the standard library is used so the module can be copied next to a reward function.
+"""
+import hashlib, math
+from array import array
+
+LOOKAHEAD = 5
+SAMPLES = 8
+
+_cache = {}
+# the last waypoints list seen, its samples() and its fingerprint()
+_last = (None, None, None)
+
+
+def fingerprint(waypoints):
+    """Stable identifier of a track, independent of float noise below a millimetre."""
+    digest = hashlib.sha1()
+    for x, y in waypoints:
+        digest.update("{:.3f},{:.3f};".format(x, y).encode())
+    return digest.hexdigest()[:16]
+
+
+def samples(waypoints):
+    """Length and a few evenly spaced waypoints, a cheap check that a new list holds the same track."""
+    n = len(waypoints)
+    return n, tuple(tuple(waypoints[i]) for i in range(0, n, max(1, n // SAMPLES))), tuple(waypoints[-1])
+
+
+def track_key(waypoints):
+    """fingerprint() of a waypoints list without hashing it on every step.
+
+    The same list object is the same track. A new list is compared on its samples() first and only
+    hashed when they differ from those of the last list, so a fresh copy of the track every step
+    stays O(1).
+    """
+    global _last
+    last, sampled, key = _last
+    if waypoints is not last:
+        sample = samples(waypoints)
+        if sample != sampled:
+            key = fingerprint(waypoints)
+        _last = (waypoints, sample, key)
+    return key
+
+
+def _signed_angle(ax, ay, bx, by):
+    return math.atan2(ax * by - ay * bx, ax * bx + ay * by)
+
+
+class TrackGeometry:
+    """Arrays indexed by waypoint. Segment i runs from waypoint i to waypoint i + 1 (wrapping).
+
+    heading[i]      direction of segment i in degrees, same convention as params['heading']
+    length[i]       length of segment i in metres
+    distance[i]     distance along the centre line from waypoint 0 to waypoint i
+    turn_angle[i]   unsigned angle in radians between segment i - 1 and segment i
+    direction[i]    1 for a left turn at waypoint i, -1 for a right turn, 0 when straight
+    curvature[i]    signed turn angle per metre at waypoint i
+    lookahead[i]    signed heading change in degrees from segment i to segment i + lookahead
+    """
+
+    def __init__(self, waypoints, lookahead=LOOKAHEAD):
+        n = len(waypoints)
+        self.n = n
+        self.fingerprint = fingerprint(waypoints)
+        self.lookahead_steps = lookahead
+        vectors = [(waypoints[(i + 1) % n][0] - waypoints[i][0], waypoints[(i + 1) % n][1] - waypoints[i][1])
+                   for i in range(n)]
+        self.length = array("d", (math.hypot(dx, dy) for dx, dy in vectors))
+        # zero length segments (closed tracks repeat their first waypoint) borrow the previous direction
+        valid = [i for i in range(n) if self.length[i] > 0]
+        if valid:
+            last = vectors[valid[-1]]
+            for i in range(n):
+                if self.length[i] > 0:
+                    last = vectors[i]
+                else:
+                    vectors[i] = last
+        self.heading = array("d", (math.degrees(math.atan2(dy, dx)) for dx, dy in vectors))
+        self.distance = array("d", [0.0] * n)
+        for i in range(1, n):
+            self.distance[i] = self.distance[i - 1] + self.length[i - 1]
+        self.turn_angle = array("d", [0.0] * n)
+        self.direction = array("b", [0] * n)
+        self.curvature = array("d", [0.0] * n)
+        self.lookahead = array("d", [0.0] * n)
+        for i in range(n):
+            ax, ay = vectors[i - 1]
+            bx, by = vectors[i]
+            angle = _signed_angle(ax, ay, bx, by)
+            cross = ax * by - ay * bx
+            self.turn_angle[i] = abs(angle)
+            self.direction[i] = (cross > 0) - (cross < 0)
+            span = (self.length[i - 1] + self.length[i]) / 2
+            self.curvature[i] = angle / span if span > 0 else 0.0
+            fx, fy = vectors[(i + lookahead) % n]
+            self.lookahead[i] = math.degrees(_signed_angle(bx, by, fx, fy))
+
+    @property
+    def track_length(self):
+        return self.distance[-1] + self.length[-1]
+
+    def turn(self, index):
+        """(unsigned turn angle in radians, direction) at a waypoint index."""
+        index %= self.n
+        return self.turn_angle[index], self.direction[index]
+
+    def heading_error(self, index, heading):
+        """Signed difference in degrees between a car heading and segment index of the centre line."""
+        return (heading - self.heading[index % self.n] + 180) % 360 - 180
+
+
+def get_geometry(waypoints, lookahead=LOOKAHEAD):
+    """Return the cached TrackGeometry for a waypoints list, building it on first use."""
+    key = (track_key(waypoints), lookahead)
+    geometry = _cache.get(key)
+    if geometry is None:
+        geometry = _cache[key] = TrackGeometry(waypoints, lookahead)
+    return geometry
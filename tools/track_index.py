@@ -0,0 +1,213 @@
+"""Nearest centre line segment of arbitrary (x, y) positions, through a uniform grid index.
+
+The index covers the track with square cells and stores, for every cell, the few segments that
+can be the nearest one to a point inside it: a segment is kept when its distance to the cell
+centre, minus half the cell diagonal, is not larger than the smallest distance from any segment
+to the farthest corner of the cell. A query is then one cell lookup and a distance check against
+those candidates, either one point at a time in plain Python (query(), cheap enough per step in a
+reward function) or for millions of trace points at once with NumPy (query_many()). Points
+outside the grid fall back to checking every segment.
+
+Segment i runs from waypoint i to waypoint i + 1 (wrapping), like in track_geometry, so the
+waypoint indices match params["waypoints"]. The index is built with NumPy, once per track.
+
+Example:
+    python3 -m tools.track_index 2022_may_open_ccw --traces robomaker1.log --csv positions.csv
+"""
+import argparse, csv, math, time
+
+from .sim_trace import find_trace_files, iter_chunks
+from .track_geometry import track_key
+from .tracks import load_track
+
+CELLS_PER_SEGMENT = 16
+MARGIN = 2.0
+CHUNK = 1 << 16
+
+_cache = {}
+
+
+def _segment_distances(px, py, ax, ay, dx, dy, len2):
+    """Distances and projection parameters of points to segments, broadcasting NumPy arrays."""
+    import numpy as np
+    with np.errstate(all="ignore"):
+        t = np.where(len2 > 0, ((px - ax) * dx + (py - ay) * dy) / len2, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    return np.hypot(px - ax - t * dx, py - ay - t * dy), t
+
+
+class TrackIndex:
+    """Grid index over the centre line segments of a track.
+
+    A query returns (segment, distance, offset, progress): the index of the nearest segment (its
+    waypoints are segment and segment + 1), the distance to it in metres, the signed distance
+    (positive left of the driving direction) and the progress in percent along the centre line
+    of the projected point.
+    """
+
+    def __init__(self, waypoints, cell_size=None, margin=MARGIN):
+        import numpy as np
+        points = np.asarray(waypoints, dtype=float)
+        n = self.n = len(points)
+        deltas = np.roll(points, -1, axis=0) - points
+        self.ax, self.ay = points[:, 0], points[:, 1]
+        self.dx, self.dy = deltas[:, 0], deltas[:, 1]
+        self.len2 = (deltas ** 2).sum(axis=1)
+        length = np.sqrt(self.len2)
+        self.distance = np.concatenate([[0.0], np.cumsum(length)[:-1]])
+        self.track_length = float(length.sum())
+        # plain floats for query(), indexing NumPy arrays one element at a time is slow
+        self._segments = list(zip(self.ax.tolist(), self.ay.tolist(), self.dx.tolist(), self.dy.tolist(),
+                                  self.len2.tolist(), self.distance.tolist()))
+
+        low, high = points.min(axis=0) - margin, points.max(axis=0) + margin
+        if cell_size is None:
+            area = float(np.prod(high - low))
+            cell_size = math.sqrt(area / (CELLS_PER_SEGMENT * n))
+        self.cell_size = cell_size
+        self.x0, self.y0 = float(low[0]), float(low[1])
+        self.columns, self.rows = (np.ceil((high - low) / cell_size).astype(int) + 1).tolist()
+
+        # candidates of every cell, one grid row at a time to bound the memory
+        half_diagonal = cell_size * math.sqrt(2) / 2
+        cx = self.x0 + (np.arange(self.columns) + 0.5) * cell_size
+        corners = [(-0.5, -0.5), (-0.5, 0.5), (0.5, -0.5), (0.5, 0.5)]
+        segment = (self.ax[None], self.ay[None], self.dx[None], self.dy[None], self.len2[None])
+        self.candidates = []
+        for row in range(self.rows):
+            cy = np.full(self.columns, self.y0 + (row + 0.5) * cell_size)
+            centre, _ = _segment_distances(cx[:, None], cy[:, None], *segment)
+            farthest = np.max([_segment_distances((cx + sx * cell_size)[:, None], (cy + sy * cell_size)[:, None],
+                                                  *segment)[0] for sx, sy in corners], axis=0)
+            bound = farthest.min(axis=1, keepdims=True)
+            keep = centre - half_diagonal <= bound
+            self.candidates.extend(np.flatnonzero(mask).tolist() for mask in keep)
+        self._table = None
+
+    def cell(self, x, y):
+        """Cell number of a position, None outside the grid."""
+        column = int((x - self.x0) // self.cell_size)
+        row = int((y - self.y0) // self.cell_size)
+        if 0 <= column < self.columns and 0 <= row < self.rows:
+            return row * self.columns + column
+        return None
+
+    def query(self, x, y):
+        """(segment, distance, offset, progress) of one position, plain Python."""
+        cell = self.cell(x, y)
+        candidates = self.candidates[cell] if cell is not None else range(self.n)
+        best, best_distance, best_t = 0, math.inf, 0.0
+        segments = self._segments
+        for i in candidates:
+            ax, ay, dx, dy, len2, _ = segments[i]
+            t = ((x - ax) * dx + (y - ay) * dy) / len2 if len2 > 0 else 0.0
+            t = 0.0 if t < 0 else 1.0 if t > 1 else t
+            distance = math.hypot(x - ax - t * dx, y - ay - t * dy)
+            if distance < best_distance:
+                best, best_distance, best_t = i, distance, t
+        ax, ay, dx, dy, len2, along = segments[best]
+        cross = dx * (y - ay) - dy * (x - ax)
+        offset = best_distance if cross > 0 else -best_distance
+        along += best_t * math.sqrt(len2)
+        return best, best_distance, offset, 100 * along / self.track_length
+
+    def _candidate_table(self):
+        # candidate lists padded to the same length by repeating their first segment, so the
+        # first k columns are a valid candidate list for every cell with at most k candidates
+        import numpy as np
+        if self._table is None:
+            width = max(len(c) for c in self.candidates)
+            table = np.zeros((len(self.candidates), width), dtype=np.int32)
+            for cell, candidates in enumerate(self.candidates):
+                if candidates:
+                    table[cell] = candidates + candidates[:1] * (width - len(candidates))
+            counts = np.array([len(c) for c in self.candidates])
+            self._table = table, counts
+        return self._table
+
+    def _nearest(self, x, y, candidates):
+        import numpy as np
+        d, t = _segment_distances(x[:, None], y[:, None], self.ax[candidates], self.ay[candidates],
+                                  self.dx[candidates], self.dy[candidates], self.len2[candidates])
+        nearest = d.argmin(axis=1)
+        rows = np.arange(len(x))
+        return np.broadcast_to(candidates, d.shape)[rows, nearest], d[rows, nearest], t[rows, nearest]
+
+    def query_many(self, xs, ys, chunk=CHUNK):
+        """Arrays (segment, distance, offset, progress) of many positions, with NumPy."""
+        import numpy as np
+        xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+        table, counts = self._candidate_table()
+        segment = np.zeros(len(xs), dtype=np.int32)
+        distance, t = np.zeros(len(xs)), np.zeros(len(xs))
+        column = np.floor((xs - self.x0) / self.cell_size).astype(np.int64)
+        row = np.floor((ys - self.y0) / self.cell_size).astype(np.int64)
+        inside = (column >= 0) & (column < self.columns) & (row >= 0) & (row < self.rows)
+        cells = np.where(inside, row * self.columns + column, 0)
+        # points are grouped by the power of two above their candidate count, so a few cells with
+        # many candidates (far inside a loop) do not widen the distance matrix of every point
+        widths = np.where(inside, 2 ** np.ceil(np.log2(np.maximum(counts[cells], 1))).astype(int), 0)
+        for width in np.unique(widths):
+            points = np.flatnonzero(widths == width)
+            for start in range(0, len(points), chunk):
+                part = points[start:start + chunk]
+                if width:
+                    candidates = table[cells[part], :min(width, table.shape[1])]
+                else:
+                    candidates = np.arange(self.n)[None]
+                segment[part], distance[part], t[part] = self._nearest(xs[part], ys[part], candidates)
+        cross = self.dx[segment] * (ys - self.ay[segment]) - self.dy[segment] * (xs - self.ax[segment])
+        offset = np.where(cross > 0, distance, -distance)
+        progress = 100 * (self.distance[segment] + t * np.sqrt(self.len2[segment])) / self.track_length
+        return segment, distance, offset, progress
+
+
+def get_index(waypoints, cell_size=None):
+    """Return the cached TrackIndex for a waypoints list, building it on first use."""
+    key = (track_key(waypoints), cell_size)
+    index = _cache.get(key)
+    if index is None:
+        index = _cache[key] = TrackIndex(waypoints, cell_size)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Locate positions on a track: nearest segment, offset and progress")
+    parser.add_argument("track", help="DR_WORLD_NAME or path to a track .npy")
+    parser.add_argument("--traces", nargs="*", default=[], help="SIM_TRACE_LOG files or directories to locate")
+    parser.add_argument("--point", nargs=2, type=float, action="append", default=[], metavar=("X", "Y"))
+    parser.add_argument("--csv", help="write x, y, segment, distance, offset and progress of every trace step")
+    args = parser.parse_args()
+
+    import numpy as np
+    track = load_track(args.track)
+    started = time.time()
+    index = get_index([tuple(p) for p in track[:, 0:2].tolist()])
+    print("Index of {} segments, {}x{} cells of {:.2f}m, up to {} candidates per cell, built in {:.2f}s".format(
+        index.n, index.columns, index.rows, index.cell_size, max(map(len, index.candidates)), time.time() - started))
+    for x, y in args.point:
+        print("({}, {}): segment {}, distance {:.3f}m, offset {:.3f}m, progress {:.2f}%".format(
+            x, y, *index.query(x, y)))
+    if not args.traces:
+        return
+    xs, ys = [], []
+    for path in find_trace_files(args.traces):
+        for rows in iter_chunks(path):
+            xs.extend(row[2] for row in rows)
+            ys.extend(row[3] for row in rows)
+    started = time.time()
+    segment, distance, offset, progress = index.query_many(xs, ys)
+    elapsed = time.time() - started
+    print("{} steps located in {:.2f}s, mean distance from the centre line {:.3f}m, {:.1f}% left of it".format(
+        len(xs), elapsed, float(distance.mean()) if len(xs) else 0.0, 100 * float((offset > 0).mean()) if len(xs) else 0.0))
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["x", "y", "segment", "distance", "offset", "progress"])
+            for row in zip(xs, ys, segment.tolist(), np.round(distance, 4).tolist(), np.round(offset, 4).tolist(),
+                           np.round(progress, 3).tolist()):
+                writer.writerow(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""Run reward functions and an action space on every cached track, in both directions.
+
+Reward files are usually tuned on one track (DR_WORLD_NAME) and find out about the others in the
+middle of a training. This runs the tools.surrogate episodes of each reward function on every
+track .npy of the tracks directory, forward and reversed (the waypoints in reverse order, which is
+what DR_TRAIN_ALTERNATE_DRIVING_DIRECTION does every other episode), on a process pool with one
+task per track and direction. Each worker keeps the reward functions it compiled and the
+geometry of the tracks it ran (tools.track_geometry), so nothing is computed twice.
+
+Next to the reward driven (greedy) episodes, the same track is driven by the pursuit driver, which
+only depends on the action space: it tells whether the action space can drive the track at all.
+A track and direction is flagged when
+
+  the reward function raises on it (for example a waypoint table of another track),
+  its completion is more than MAX_GAP points below the pursuit driver's,
+  its completion is below RELATIVE_FLOOR of the best track of the same reward function (when that
+  one completes at least MAX_GAP percent of the laps),
+  neither the reward function nor the pursuit driver complete MAX_GAP percent of the laps (the
+  action space is the problem there, not the reward),
+
+and the off track ends are broken down by the kind of waypoint they happen at (straight, left or
+right turn, sharp when the heading changes more than SHARP_TURN degrees over the next LOOKAHEAD
+segments), with the waypoints where it happens most, numbered as in the track file in both
+directions.
+
+Example:
+    python3 -m tools.track_sweep custom-files/reward_function.py --episodes 200
+    python3 -m tools.track_sweep custom-files/reward_function.py custom-files/reward-fn-examples/*.py --tracks reInvent2019_wide 2022_may_open_ccw --csv sweep.csv
+"""
+import argparse, csv, glob, json, os, time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from .action_space import MODEL_METADATA
+from .track_geometry import LOOKAHEAD, get_geometry
+from .tracks import TRACKS_DIR, center_waypoints, load_track, track_widths
+
+EPISODES = 200
+MAX_GAP = 20.0
+RELATIVE_FLOOR = 0.5
+STRAIGHT_TURN = 10.0
+SHARP_TURN = 45.0
+HOT_SPOTS = 3
+DIRECTIONS = ["forward", "reverse"]
+
+# per worker process state, filled once by _init_worker
+_worker = {}
+
+
+def _init_worker(model_metadata, episodes, horizon, epsilon, seed):
+    from .surrogate import load_actions
+    _worker.update(actions=load_actions(model_metadata), episodes=episodes, horizon=horizon, epsilon=epsilon,
+                   seed=seed, rewards={}, surrogates={})
+
+
+def track_files(directory=TRACKS_DIR, names=None):
+    """Track .npy files of the tracks directory, or the named ones."""
+    if names:
+        return [name if name.endswith(".npy") else os.path.join(directory, name + ".npy") for name in names]
+    return sorted(glob.glob(os.path.join(directory, "*.npy")))
+
+
+def _surrogate(path, direction):
+    key = (path, direction)
+    if key not in _worker["surrogates"]:
+        from .surrogate import Surrogate
+        track = load_track(path)
+        if direction == "reverse":
+            track = track[::-1]
+        waypoints, widths = center_waypoints(track), track_widths(track)
+        surrogate = Surrogate(waypoints, widths, *_worker["actions"])
+        _worker["surrogates"][key] = (surrogate, get_geometry(waypoints, LOOKAHEAD), surrogate.sample(seed=_worker["seed"]))
+    return _worker["surrogates"][key]
+
+
+def _reward(reward_file, sample):
+    """Batch reward of a file, compiled once per worker and checked on the sample of every track."""
+    import contextlib, io
+    from .reward_batch import check_equivalence, compile_batch, scalar_batch
+    from .rewards import load_reward_module
+    if reward_file not in _worker["rewards"]:
+        module = load_reward_module(reward_file)
+        with contextlib.redirect_stdout(io.StringIO()):
+            batch, how = compile_batch(module, sample)
+        _worker["rewards"][reward_file] = (module.reward_function, batch, how)
+    reward_function, batch, how = _worker["rewards"][reward_file]
+    if how != "scalar loop" and len(check_equivalence(reward_function, batch, sample)):
+        # the batch version only matched on the track it was compiled on
+        return scalar_batch(reward_function)
+    return batch
+
+
+def turn_kind(geometry, waypoint):
+    """straight, left, right, sharp left or sharp right, from the heading change over the next segments."""
+    change = geometry.lookahead[waypoint % geometry.n]
+    if abs(change) < STRAIGHT_TURN:
+        return "straight"
+    side = "left" if change > 0 else "right"
+    return "sharp " + side if abs(change) >= SHARP_TURN else side
+
+
+def run_task(task):
+    """All reward files on one track and direction. Returns one result dict per reward file."""
+    import numpy as np
+    from .surrogate import STATUSES, summarize
+    reward_files, path, direction = task
+    started = time.time()
+    surrogate, geometry, sample = _surrogate(path, direction)
+    episodes, horizon, epsilon, seed = (_worker[key] for key in ("episodes", "horizon", "epsilon", "seed"))
+    pursuit = surrogate.run(lambda columns: np.zeros(len(columns["x"])), episodes, episodes, "pursuit", epsilon=epsilon,
+                            seed=seed)
+    baseline = summarize(pursuit, surrogate.dt, 1.0)
+    off_track = STATUSES.index("off_track")
+    results = []
+    for reward_file in reward_files:
+        task_started = time.time()
+        try:
+            reward = _reward(reward_file, sample)
+        except Exception as e:
+            results.append({"reward_file": reward_file, "track": path, "direction": direction,
+                            "error": "{}: {}".format(type(e).__name__, e)})
+            continue
+        outcome = surrogate.run(reward, episodes, episodes, "greedy", horizon, epsilon, seed)
+        summary = summarize(outcome, surrogate.dt, time.time() - task_started)
+        ends = outcome["segment"][outcome["status"] == off_track].tolist()
+        hot_spots = [waypoint for waypoint, _ in Counter(ends).most_common(HOT_SPOTS)]
+        if direction == "reverse":
+            # numbered from the other end on the reversed track, report them as in the track file
+            hot_spots = [(geometry.n - 1 - waypoint) % surrogate.n for waypoint in hot_spots]
+        results.append(dict(summary, reward_file=reward_file, track=path, direction=direction,
+                            track_length=surrogate.track_length,
+                            pursuit_completion=baseline["completion"], pursuit_lap=baseline["lap"],
+                            off_track_kinds=dict(Counter(turn_kind(geometry, waypoint) for waypoint in ends)),
+                            hot_spots=hot_spots,
+                            seconds=time.time() - started))
+    return results
+
+
+def flag(result, best_completion):
+    """Reasons a track and direction breaks the reward function, empty when it does not."""
+    if "error" in result:
+        return ["cannot run: " + result["error"]]
+    reasons = []
+    if result["pursuit_completion"] < MAX_GAP and result["completion"] < MAX_GAP:
+        reasons.append("the action space does not lap it either ({:.0f}% following the centre line)".format(
+            result["pursuit_completion"]))
+    if result["raised"]:
+        reasons.append("raises on {} steps".format(result["raised"]))
+    if result["completion"] < result["pursuit_completion"] - MAX_GAP:
+        reasons.append("{:.0f}% laps vs {:.0f}% following the centre line".format(
+            result["completion"], result["pursuit_completion"]))
+    # comparing with the best track only says something when the best track does complete laps
+    if best_completion >= MAX_GAP and result["completion"] < RELATIVE_FLOOR * best_completion:
+        reasons.append("under {:.0f}% of its best track ({:.0f}%)".format(100 * RELATIVE_FLOOR, best_completion))
+    kinds = result["off_track_kinds"]
+    total = sum(kinds.values())
+    if reasons and total:
+        kind, count = max(kinds.items(), key=lambda item: item[1])
+        reasons.append("off track in {} ({:.0f}% of {}), most at waypoints {}".format(
+            kind, 100.0 * count / total, total, ", ".join(map(str, result["hot_spots"]))))
+    return reasons
+
+
+def sweep(reward_files, paths, model_metadata=MODEL_METADATA, directions=DIRECTIONS, episodes=EPISODES, horizon=3,
+          epsilon=0.1, seed=0, workers=None):
+    """Result dicts of every reward file on every track and direction, with their flags."""
+    tasks = [(list(reward_files), path, direction) for path in paths for direction in directions]
+    args = (model_metadata, episodes, horizon, epsilon, seed)
+    if workers == 1:
+        _init_worker(*args)
+        parts = map(run_task, tasks)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=args)
+        with pool:
+            parts = list(pool.map(run_task, tasks))
+    results = [result for part in parts for result in part]
+    best = {}
+    for result in results:
+        if "error" not in result:
+            best[result["reward_file"]] = max(best.get(result["reward_file"], 0.0), result["completion"])
+    for result in results:
+        result["flags"] = flag(result, best.get(result["reward_file"], 0.0))
+    return results
+
+
+def _number(value, pattern="{:.2f}"):
+    return "-" if value is None else pattern.format(value)
+
+
+def print_results(results):
+    by_file = {}
+    for result in results:
+        by_file.setdefault(result["reward_file"], []).append(result)
+    for reward_file, rows in by_file.items():
+        broken = sum(1 for row in rows if row["flags"])
+        print("\n{}: {} of {} track directions flagged".format(reward_file, broken, len(rows)))
+        print("  {:<32} {:<8} {:>7} {:>9} {:>8} {:>10} {:>9}  {}".format(
+            "Track", "dir", "laps %", "progress", "lap s", "pursuit %", "pursuit s", "flags"))
+        rows.sort(key=lambda row: (not row["flags"], row.get("completion", -1) - row.get("pursuit_completion", 0)))
+        for row in rows:
+            name = os.path.splitext(os.path.basename(row["track"]))[0]
+            if "error" in row:
+                print("  {:<32} {:<8} {}".format(name[:32], row["direction"], "; ".join(row["flags"])))
+                continue
+            print("  {:<32} {:<8} {:>7.1f} {:>9.1f} {:>8} {:>10.1f} {:>9}  {}".format(
+                name[:32], row["direction"], row["completion"], row["progress"], _number(row["lap"]),
+                row["pursuit_completion"], _number(row["pursuit_lap"]), "; ".join(row["flags"]) or "ok"))
+
+
+def write_csv(file, results):
+    columns = ["reward_file", "track", "direction", "completion", "progress", "lap", "best_lap", "reward_per_step",
+               "raised", "pursuit_completion", "pursuit_lap", "flags"]
+    with open(file, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for result in results:
+            writer.writerow(["; ".join(result["flags"]) if column == "flags" else result.get(column)
+                             for column in columns])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run reward functions on every cached track in both directions")
+    parser.add_argument("reward_files", nargs="+")
+    parser.add_argument("--model-metadata", default=MODEL_METADATA, help="action space to drive with")
+    parser.add_argument("--tracks-dir", default=TRACKS_DIR)
+    parser.add_argument("--tracks", nargs="*", help="track names or .npy paths, default every .npy of --tracks-dir")
+    parser.add_argument("--directions", choices=["both", "forward", "reverse"], default="both")
+    parser.add_argument("--episodes", type=int, default=EPISODES, help="episodes per track, direction and reward")
+    parser.add_argument("--horizon", type=int, default=3, help="steps the greedy driver looks ahead")
+    parser.add_argument("--epsilon", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None, help="process pool size (default: all cores)")
+    parser.add_argument("--csv", help="write one row per reward file, track and direction")
+    parser.add_argument("--json", help="write the full results")
+    args = parser.parse_args()
+
+    paths = track_files(args.tracks_dir, args.tracks)
+    if not paths:
+        raise SystemExit("No track .npy files in {}, download them from deepracer-race-data (raw_data/tracks/npy)".format(
+            args.tracks_dir))
+    directions = DIRECTIONS if args.directions == "both" else [args.directions]
+    started = time.time()
+    results = sweep(args.reward_files, paths, args.model_metadata, directions, args.episodes, args.horizon,
+                    args.epsilon, args.seed, args.workers)
+    print("{} tracks x {} directions x {} reward files in {:.1f}s".format(
+        len(paths), len(directions), len(args.reward_files), time.time() - started))
+    print_results(results)
+    if args.csv:
+        write_csv(args.csv, results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if any(result["flags"] for result in results):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
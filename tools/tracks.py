@@ -0,0 +1,53 @@
+import math, os
+
+# Track files are the .npy arrays from deepracer-race-data (raw_data/tracks/npy), one row per
+# waypoint: center x, center y, inner x, inner y, outer x, outer y.
+
+TRACKS_DIR = os.environ.get("DOTS_TRACKS_DIR", "tracks")
+
+
+def track_path(name_or_path):
+    if name_or_path.endswith(".npy") or os.sep in name_or_path:
+        return name_or_path
+    return os.path.join(TRACKS_DIR, name_or_path + ".npy")
+
+
+def load_track(name_or_path):
+    """Load a track .npy by file path or by DR_WORLD_NAME from the local tracks directory."""
+    import numpy as np
+    return np.load(track_path(name_or_path)).astype(float)
+
+
+def center_waypoints(track):
+    return [(float(x), float(y)) for x, y in track[:, 0:2]]
+
+
+def track_widths(track):
+    return [math.hypot(ix - ox, iy - oy) for ix, iy, ox, oy in track[:, 2:6]]
+
+
+def oval_waypoints(count=120, half_length=5.0, half_width=3.0):
+    """Closed oval centre line, repeating its first waypoint like the real track files do."""
+    points = [(half_length * math.cos(2 * math.pi * i / count), half_width * math.sin(2 * math.pi * i / count))
+              for i in range(count)]
+    return points + points[:1]
+
+
+def closed_loop(points):
+    """Points of a closed track as an array without the repeated first waypoint at the end."""
+    import numpy as np
+    points = np.asarray(points, dtype=float)
+    if len(points) > 1 and np.allclose(points[0], points[-1]):
+        points = points[:-1]
+    return points
+
+
+def curvature(points):
+    """Signed curvature (1/m, positive turning left) at every point of a closed loop, from the
+    circle through each point and its neighbours."""
+    import numpy as np
+    a, b, c = np.roll(points, 1, axis=0), points, np.roll(points, -1, axis=0)
+    ab, bc, ac = b - a, c - b, c - a
+    cross = ab[:, 0] * bc[:, 1] - ab[:, 1] * bc[:, 0]
+    lengths = np.linalg.norm(ab, axis=1) * np.linalg.norm(bc, axis=1) * np.linalg.norm(ac, axis=1)
+    return np.divide(2 * cross, lengths, out=np.zeros(len(points)), where=lengths > 0)
@@ -0,0 +1,299 @@
+"""Pre-flight validation of the custom files, offline.
+
+Loads run.env, system.env, hyperparameters.json and model_metadata.json once, checks the values
+against the ranges documented in custom-files/README.md, smoke-runs reward_function on sampled
+params for the configured race type and checks DR_WORLD_NAME against a track manifest cached in
+the tracks directory. The manifest is downloaded once from deepracer-race-data when it is
+missing (or with --refresh-tracks), every later run needs no network.
+
+The S3 checks (model prefix not used yet, pretrained model present) are the only ones that need
+AWS and only run when --bucket is given.
+
+The exit code is 1 when any check fails, which is what the create instance scripts look at.
+
+Example:
+    python3 -m tools.validate --custom-files custom-files --bucket my-bucket
+"""
+import argparse, json, math, os, re, sys, time, urllib.request
+from collections import Counter
+
+from .config_session import ConfigSession
+from .rewards import load_reward_function
+from .tracks import TRACKS_DIR
+
+TRACKS_API = "https://api.github.com/repos/aws-deepracer-community/deepracer-race-data/contents/raw_data/tracks/npy"
+MANIFEST = os.path.join(TRACKS_DIR, "manifest.txt")
+SMOKE_STEPS = 200
+
+RACE_TYPES = ["TIME_TRIAL", "OBJECT_AVOIDANCE", "HEAD_TO_BOT"]
+CAR_COLORS = ["Black", "Grey", "Blue", "Red", "Orange", "White", "Purple"]
+BATCH_SIZES = [32, 64, 128, 256, 512]
+LOSS_TYPES = ["huber", "mean squared error"]
+EXPLORATION = {"clipped_ppo": "categorical", "sac": "additive_noise"}
+NEURAL_NETWORKS = ["DEEP_CONVOLUTIONAL_NETWORK_SHALLOW", "DEEP_CONVOLUTIONAL_NETWORK"]
+SENSORS = ["FRONT_FACING_CAMERA", "STEREO_CAMERAS", "LIDAR"]
+MAX_STEERING = 30.0
+MAX_SPEED = 4.0
+
+# (key, low, high, integer) from custom-files/README.md
+HYPERPARAMETER_RANGES = [
+    ("beta_entropy", 0, 1, False),
+    ("discount_factor", 0, 1, False),
+    ("lr", 0.00000001, 0.001, False),
+    ("num_episodes_between_training", 1, 100, True),
+    ("num_epochs", 3, 10, True),
+    ("term_cond_avg_score", 35000.0, 100000.0, False),
+]
+
+OPENGL_SETTINGS = """either set DR_HOST_X=False to disable OpenGL GPU training, or apply the following settings in system.env:
+DR_DISPLAY=:99
+DR_DOCKER_STYLE=compose
+DR_SAGEMAKER_IMAGE=5.2.1-gpu, or latest version
+DR_SAGEMAKER_CUDA_DEVICES=0
+DR_ROBOMAKER_CUDA_DEVICES=0"""
+
+
+def expand(value, variables):
+    """Expand $VAR and ${VAR} references the way sourcing the env file does."""
+    def replace(match):
+        name = match.group(1) or match.group(2)
+        return expand(variables.get(name, os.environ.get(name, "")), variables)
+    return re.sub(r"\$(?:\{(\w+)\}|(\w+))", replace, value or "")
+
+
+def env_variables(config, file):
+    raw = config.variables(file)
+    return {name: expand(value, raw) for name, value in raw.items()}
+
+
+def load_manifest(path=MANIFEST, refresh=False):
+    """Track names from the cached manifest, fetched from GitHub once. None when unavailable."""
+    if refresh or not os.path.exists(path):
+        try:
+            with urllib.request.urlopen(urllib.request.Request(
+                    TRACKS_API, headers={"Accept": "application/vnd.github.v3+json"}), timeout=10) as response:
+                names = sorted(os.path.splitext(entry["name"])[0] for entry in json.load(response)
+                               if entry["name"].endswith(".npy"))
+        except (OSError, ValueError, KeyError) as e:
+            print("WARNING could not download the track list: {}".format(e))
+            if not os.path.exists(path):
+                return None
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                f.write("\n".join(names) + "\n")
+            os.replace(path + ".tmp", path)
+    with open(path, "r") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def _number(value, integer):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and (not integer or value == int(value))
+
+
+def check_hyperparameters(hyperparameters, errors):
+    if hyperparameters.get("batch_size") not in BATCH_SIZES:
+        errors.append("batch_size={} in hyperparameters.json must be one of {}".format(
+            hyperparameters.get("batch_size"), BATCH_SIZES))
+    for key, low, high, integer in HYPERPARAMETER_RANGES:
+        if key not in hyperparameters:
+            continue
+        value = hyperparameters[key]
+        if not _number(value, integer) or not low <= value <= high:
+            errors.append("{}={} in hyperparameters.json must be {} between {} and {}".format(
+                key, value, "an integer" if integer else "a number", low, high))
+    if "loss_type" in hyperparameters and hyperparameters["loss_type"] not in LOSS_TYPES:
+        errors.append("loss_type={} in hyperparameters.json must be one of {}".format(
+            hyperparameters["loss_type"], LOSS_TYPES))
+
+
+def _range(name, value, low, high, errors):
+    if not _number(value, False) or not low <= value <= high:
+        errors.append("{}={} in model_metadata.json must be between {} and {}".format(name, value, low, high))
+
+
+def check_metadata(metadata, hyperparameters, errors):
+    algorithm = metadata.get("training_algorithm", "clipped_ppo")
+    if algorithm not in EXPLORATION:
+        errors.append("training_algorithm={} in model_metadata.json must be one of {}".format(
+            algorithm, list(EXPLORATION)))
+    elif hyperparameters.get("exploration_type", EXPLORATION[algorithm]) != EXPLORATION[algorithm]:
+        errors.append("exploration_type={} in hyperparameters.json does not match training_algorithm={}, use {}".format(
+            hyperparameters.get("exploration_type"), algorithm, EXPLORATION[algorithm]))
+    if metadata.get("neural_network") not in NEURAL_NETWORKS:
+        errors.append("neural_network={} in model_metadata.json must be one of {}".format(
+            metadata.get("neural_network"), NEURAL_NETWORKS))
+    sensor = metadata.get("sensor")
+    cameras = [s for s in sensor or [] if s in ("FRONT_FACING_CAMERA", "STEREO_CAMERAS")]
+    if not isinstance(sensor, list) or len(cameras) != 1 or any(s not in SENSORS for s in sensor):
+        errors.append("sensor={} in model_metadata.json must hold FRONT_FACING_CAMERA or STEREO_CAMERAS and "
+                      "optionally LIDAR".format(sensor))
+    if str(metadata.get("version")) != "5":
+        errors.append("version={} in model_metadata.json must be 5".format(metadata.get("version")))
+
+    space_type, space = metadata.get("action_space_type", "discrete"), metadata.get("action_space")
+    if space_type == "discrete":
+        if not isinstance(space, list) or not space:
+            errors.append("action_space in model_metadata.json must be a non empty list for a discrete action space")
+            return
+        for i, action in enumerate(space):
+            if not isinstance(action, dict):
+                errors.append("action_space[{}] in model_metadata.json is not an object".format(i))
+                continue
+            _range("action_space[{}].steering_angle".format(i), action.get("steering_angle"),
+                   -MAX_STEERING, MAX_STEERING, errors)
+            _range("action_space[{}].speed".format(i), action.get("speed"), 0.1, MAX_SPEED, errors)
+        pairs = [(a.get("steering_angle"), a.get("speed")) for a in space if isinstance(a, dict)]
+        if len(set(pairs)) != len(pairs):
+            errors.append("action_space in model_metadata.json has duplicate actions")
+    elif space_type == "continuous":
+        try:
+            steering, speed = space["steering_angle"], space["speed"]
+            _range("action_space.steering_angle.low", steering["low"], -MAX_STEERING, steering["high"], errors)
+            _range("action_space.steering_angle.high", steering["high"], steering["low"], MAX_STEERING, errors)
+            _range("action_space.speed.low", speed["low"], 0.1, speed["high"], errors)
+            _range("action_space.speed.high", speed["high"], speed["low"], MAX_SPEED, errors)
+        except (KeyError, TypeError):
+            errors.append("action_space in model_metadata.json must have steering_angle and speed with low and high "
+                          "for a continuous action space")
+    else:
+        errors.append("action_space_type={} in model_metadata.json must be continuous or discrete".format(space_type))
+
+
+def check_environment(run, system, hyperparameters, metadata, manifest, errors, warnings):
+    world = run.get("DR_WORLD_NAME")
+    if manifest is None:
+        warnings.append("no track list cached in {}, DR_WORLD_NAME not checked".format(MANIFEST))
+    elif world not in manifest:
+        errors.append("DR_WORLD_NAME={} TRACK IN run.env DOES NOT EXIST. VALID TRACKS ARE {}".format(
+            world, " ".join(sorted(manifest))))
+    if run.get("DR_RACE_TYPE") not in RACE_TYPES:
+        errors.append("DR_RACE_TYPE={} in run.env DOES NOT MATCH THE ALLOWED RACE TYPES {}".format(
+            run.get("DR_RACE_TYPE"), RACE_TYPES))
+    if run.get("DR_CAR_COLOR") not in CAR_COLORS:
+        errors.append("DR_CAR_COLOR={} in run.env DOES NOT MATCH THE ALLOWED COLORS {}".format(
+            run.get("DR_CAR_COLOR"), CAR_COLORS))
+    if run.get("DR_LOCAL_S3_PRETRAINED") == "True" and not run.get("DR_LOCAL_S3_PRETRAINED_PREFIX"):
+        errors.append("DR_LOCAL_S3_PRETRAINED=True needs DR_LOCAL_S3_PRETRAINED_PREFIX in run.env")
+    if not run.get("DR_EARLY_STOP_MINUTES", "0").isdigit():
+        errors.append("DR_EARLY_STOP_MINUTES={} in run.env must be a whole number of minutes, 0 disables it".format(
+            run.get("DR_EARLY_STOP_MINUTES")))
+
+    if system.get("DR_HOST_X") == "True" and (
+            not system.get("DR_DISPLAY") or "gpu" not in system.get("DR_SAGEMAKER_IMAGE", "")
+            or system.get("DR_SAGEMAKER_CUDA_DEVICES") != "0" or system.get("DR_ROBOMAKER_CUDA_DEVICES") != "0"
+            or system.get("DR_DOCKER_STYLE") != "compose"):
+        errors.append("Incorrect settings for OpenGL in system.env, " + OPENGL_SETTINGS)
+
+    try:
+        workers = int(system.get("DR_WORKERS", "1"))
+    except ValueError:
+        errors.append("DR_WORKERS={} in system.env must be an integer".format(system.get("DR_WORKERS")))
+        return
+    if metadata.get("training_algorithm") == "sac" and workers != 1:
+        errors.append("DR_WORKERS={} in system.env, the sac training_algorithm only supports DR_WORKERS=1".format(workers))
+    # the evaluation start positions only line up when a round robin pass covers the whole lap
+    episodes = hyperparameters.get("num_episodes_between_training")
+    if run.get("DR_TRAIN_CHANGE_START_POSITION", "True") == "True" and _number(episodes, True):
+        try:
+            advance = float(run.get("DR_TRAIN_ROUND_ROBIN_ADVANCE_DIST", "0.05"))
+        except ValueError:
+            errors.append("DR_TRAIN_ROUND_ROBIN_ADVANCE_DIST={} in run.env must be a number".format(
+                run.get("DR_TRAIN_ROUND_ROBIN_ADVANCE_DIST")))
+        else:
+            if not math.isclose(episodes / workers * advance, 1.0, rel_tol=1e-6):
+                errors.append("num_episodes_between_training / DR_WORKERS * DR_TRAIN_ROUND_ROBIN_ADVANCE_DIST = "
+                              "{} / {} * {} = {:g}, it must be 1.0 (e.g. num_episodes_between_training={:g})".format(
+                                  episodes, workers, advance, episodes / workers * advance, workers / advance))
+
+
+def check_reward(path, run, errors, steps=SMOKE_STEPS):
+    """Call reward_function on sampled params and check it returns a finite number.
+
+    The params are those of the race type, obstacles and bot cars of the run.env being validated.
+    """
+    from .reward_bench import params_stream
+    try:
+        reward_function = load_reward_function(path)
+    except Exception as e:
+        errors.append("error in reward_function.py: {}: {}".format(type(e).__name__, e))
+        return
+    race_type = run.get("DR_RACE_TYPE")
+    try:
+        stream = params_stream(race_type if race_type in RACE_TYPES else "TIME_TRIAL", steps, variables=run)
+    except ValueError as e:
+        errors.append("the obstacle and bot car variables in run.env must be numbers: {}".format(e))
+        return
+    failures = Counter()
+    for params in stream:
+        try:
+            reward = reward_function(params)
+            if not _number(reward, False) or not math.isfinite(reward):
+                raise TypeError("returned {!r}, not a finite number".format(reward))
+        except Exception as e:
+            failures["{}: {}".format(type(e).__name__, e)] += 1
+    for failure, count in failures.items():
+        errors.append("reward_function failed on {} of {} sampled steps: {}".format(count, steps, failure))
+
+
+def check_s3(bucket, run, errors):
+    import boto3
+    s3 = boto3.client("s3")
+
+    def exists(prefix):
+        return s3.list_objects_v2(Bucket=bucket, Prefix=prefix, MaxKeys=1).get("KeyCount", 0) > 0
+
+    model = run.get("DR_LOCAL_S3_MODEL_PREFIX")
+    if exists(model):
+        errors.append("Model {} already exists in {}. Change the model name DR_LOCAL_S3_MODEL_PREFIX in run.env".format(
+            model, bucket))
+    pretrained = run.get("DR_LOCAL_S3_PRETRAINED_PREFIX")
+    if run.get("DR_LOCAL_S3_PRETRAINED") == "True" and pretrained and not exists(pretrained):
+        errors.append("pretrained model DR_LOCAL_S3_PRETRAINED_PREFIX={} doesn't exist in {}.".format(pretrained, bucket))
+
+
+def validate(custom_files, bucket=None, refresh_tracks=False):
+    """Run every check on a custom files directory. Returns (errors, warnings)."""
+    errors, warnings = [], []
+    config = ConfigSession()
+    documents = {}
+    for name in ["hyperparameters.json", "model_metadata.json"]:
+        try:
+            documents[name] = config.data(os.path.join(custom_files, name))
+        except (OSError, ValueError) as e:
+            errors.append("error in {}: {}".format(name, e))
+            documents[name] = {}
+    hyperparameters, metadata = documents["hyperparameters.json"], documents["model_metadata.json"]
+    run = env_variables(config, os.path.join(custom_files, "run.env"))
+    system = env_variables(config, os.path.join(custom_files, "system.env"))
+
+    check_hyperparameters(hyperparameters, errors)
+    check_metadata(metadata, hyperparameters, errors)
+    check_environment(run, system, hyperparameters, metadata, load_manifest(refresh=refresh_tracks), errors, warnings)
+    check_reward(os.path.join(custom_files, "reward_function.py"), run, errors)
+    if bucket:
+        check_s3(bucket, run, errors)
+    return errors, warnings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate the custom files before creating an instance")
+    parser.add_argument("--custom-files", default=os.environ.get("DOTS_CUSTOM_FILES_DIR", "custom-files"))
+    parser.add_argument("--bucket", help="also check the model prefixes in this S3 bucket")
+    parser.add_argument("--refresh-tracks", action="store_true", help="download the track list again")
+    args = parser.parse_args()
+
+    started = time.time()
+    errors, warnings = validate(args.custom_files, args.bucket, args.refresh_tracks)
+    for warning in warnings:
+        print("WARNING " + warning)
+    for error in errors:
+        print("ERROR " + error)
+    print("{} errors, {} warnings in {} ({:.2f}s)".format(len(errors), len(warnings), args.custom_files,
+                                                         time.time() - started))
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()